@@ -48,6 +48,8 @@ setuptools.setup(
         'pandas': ["pandas>=0.25.0,<2.0"],
         'pysftp': ["pysftp>=0.2.8,<0.3"],
         'boto3': ["boto3>=1.7.0,<2.0"],
+        'async': ["aiohttp>=3.6,<4.0"],
+        'json': ["orjson>=3.0,<4.0"],
         'docs': ["sphinx>=3.0,<4.0", "sphinx-argparse>=0.2,<.3"],
         'tests': test_deps,
         ':sys_platform=="linux2" or sys_platform=="linux"': ['keyrings.alt==3.1'],
@@ -276,6 +276,7 @@ from .annotations import Annotations
 from .client import PUBLIC, AUTHENTICATED_USERS
 # public APIs
 from .client import Synapse, login
+from .async_client import AsyncSynapse
 from .core.version_check import check_for_updates, release_notes
 from .entity import Entity, Project, Folder, File, Link, DockerRepository
 from .evaluation import Evaluation, Submission, SubmissionStatus
@@ -293,9 +294,10 @@ __version__ = json.load(
 
 __all__ = [
     # objects
-    'Synapse', 'Activity', 'Entity', 'Project', 'Folder', 'File', 'Link', 'DockerRepository', 'Evaluation',
-    'Submission', 'SubmissionStatus', 'Schema', 'EntityViewSchema', 'Column', 'Row', 'RowSet', 'Table', 'PartialRowset',
-    'Team', 'UserProfile', 'UserGroupHeader', 'TeamMember', 'Wiki', 'Annotations', 'SubmissionViewSchema',
+    'Synapse', 'AsyncSynapse', 'Activity', 'Entity', 'Project', 'Folder', 'File', 'Link', 'DockerRepository',
+    'Evaluation', 'Submission', 'SubmissionStatus', 'Schema', 'EntityViewSchema', 'Column', 'Row', 'RowSet', 'Table',
+    'PartialRowset', 'Team', 'UserProfile', 'UserGroupHeader', 'TeamMember', 'Wiki', 'Annotations',
+    'SubmissionViewSchema',
     # functions
     'login', 'build_table', 'as_table_columns', 'check_for_updates', 'release_notes',
     # enum
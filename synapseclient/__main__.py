@@ -13,6 +13,7 @@ import json
 import getpass
 import csv
 import re
+import time
 
 import synapseclient
 import synapseutils
@@ -20,7 +21,7 @@ import synapseutils
 from synapseclient import Activity
 from synapseclient.wiki import Wiki
 from synapseclient.annotations import Annotations
-from synapseclient.core import utils
+from synapseclient.core import cache_maintenance, utils
 from synapseclient.core.exceptions import (
     SynapseAuthenticationError,
     SynapseHTTPError,
@@ -447,6 +448,62 @@ def get_sts_token(args, syn):
     print(sts_string)
 
 
+def cache_stats(args, syn):
+    """Report the size and state of the local file cache"""
+    stats = cache_maintenance.stats(syn.cache, max_threads=args.max_threads)
+    print("Cache root:         %s" % syn.cache.cache_root_dir)
+    print("Cache directories:  %d" % stats.cache_dirs)
+    print("Entries:            %d" % stats.entries)
+    print("Size:               %s" % utils.humanizeBytes(stats.size))
+    print("Stale entries:      %d" % stats.stale_entries)
+    print("Orphaned files:     %d (%s)" % (stats.orphans, utils.humanizeBytes(stats.orphan_size)))
+
+
+def cache_purge(args, syn):
+    """Delete files from the local file cache"""
+    if args.older_than is None and args.max_size is None and not args.orphans:
+        raise ValueError('Specify at least one of --older-than, --max-size or --orphans')
+
+    before_date = time.time() - args.older_than * 24 * 60 * 60 if args.older_than is not None else None
+    max_size = utils.parse_bytes(args.max_size) if args.max_size is not None else None
+    purged = cache_maintenance.purge(syn.cache, before_date=before_date, max_size=max_size, orphans=args.orphans,
+                                     dry_run=args.dry_run, max_threads=args.max_threads)
+    if args.dry_run:
+        for path in purged:
+            print(path)
+    print('%s %d cache directories and orphaned files' % ('Would delete' if args.dry_run else 'Deleted', len(purged)))
+
+
+def cache_verify(args, syn):
+    """Check the local file cache for stale entries and orphaned files and optionally for corrupt files"""
+    reports = cache_maintenance.verify(syn.cache, max_threads=args.max_threads)
+    for report in reports:
+        for path in report.stale_entries:
+            print('stale\t%s\t%s' % (report.cache_dir, path))
+        for path in report.orphans:
+            print('orphan\t%s\t%s' % (report.cache_dir, path))
+    stats = cache_maintenance.stats(syn.cache, reports=reports)
+    print('%d stale entries and %d orphaned files (%s), remove them with "synapse cache purge --orphans"'
+          % (stats.stale_entries, stats.orphans, utils.humanizeBytes(stats.orphan_size)))
+
+    if args.checksums:
+        checksums = cache_maintenance.verify_checksums(syn.cache, max_threads=args.max_threads,
+                                                       resume=not args.restart)
+        for path, expected_md5, actual_md5, quarantined_path in checksums.mismatches:
+            print('corrupt\t%s\texpected md5 %s but found %s\t%s'
+                  % (path, expected_md5, actual_md5, quarantined_path or 'entry removed'))
+        if checksums.resumed_fanout_dirs:
+            print('Resumed an interrupted run, %d cache directories were already verified'
+                  % checksums.resumed_fanout_dirs)
+        print('Verified %d files (%s) in %.1fs at %.1f MB/s, %d corrupt files quarantined, %d files have no recorded'
+              ' md5' % (checksums.files, utils.humanizeBytes(checksums.size), checksums.elapsed, checksums.throughput,
+                        len(checksums.mismatches), checksums.unverifiable))
+
+
+# commands that only work with local files and don't need to log in
+LOCAL_COMMANDS = (cache_stats, cache_purge, cache_verify)
+
+
 def build_parser():
     """Builds the argument parser and returns the result."""
 
@@ -843,6 +900,40 @@ def build_parser():
         choices=['json', 'boto', 'shell', 'bash', 'cmd', 'powershell'])
     parser_get_sts_token.set_defaults(func=get_sts_token)
 
+    parser_cache = subparsers.add_parser('cache', help='report on and clean up the local file cache')
+    cache_subparsers = parser_cache.add_subparsers(title='cache commands', dest='cache_command', metavar='COMMAND',
+                                                   help='For additional help: "synapse cache <COMMAND> -h"')
+    # set rather than passed for python 3.6, where a bare "synapse cache" would otherwise have no func
+    cache_subparsers.required = True
+
+    parser_cache_stats = cache_subparsers.add_parser('stats', help='report the size and state of the cache')
+    parser_cache_stats.set_defaults(func=cache_stats)
+
+    parser_cache_purge = cache_subparsers.add_parser('purge', help='delete files from the cache, files you '
+                                                                   'downloaded to other locations are never deleted')
+    parser_cache_purge.add_argument('--older-than', dest='older_than', type=float, metavar='DAYS',
+                                    help='delete files cached more than this many days ago')
+    parser_cache_purge.add_argument('--max-size', dest='max_size', metavar='SIZE',
+                                    help='then delete the least recently cached files until the cache is at most '
+                                         'this size, e.g. 500GB')
+    parser_cache_purge.add_argument('--orphans', action='store_true', default=False,
+                                    help='then remove stale entries and delete files no entry refers to')
+    parser_cache_purge.add_argument('--dry-run', dest='dry_run', action='store_true', default=False,
+                                    help='only list what would be deleted')
+    parser_cache_purge.set_defaults(func=cache_purge)
+
+    parser_cache_verify = cache_subparsers.add_parser('verify', help='list stale entries and orphaned files')
+    parser_cache_verify.add_argument('--checksums', action='store_true', default=False,
+                                     help='also re-hash cached files against the md5 of the file they were downloaded '
+                                          'from and quarantine corrupt files')
+    parser_cache_verify.add_argument('--restart', action='store_true', default=False,
+                                     help='re-hash every file instead of resuming an interrupted --checksums run')
+    parser_cache_verify.set_defaults(func=cache_verify)
+
+    for parser_cache_command in (parser_cache_stats, parser_cache_purge, parser_cache_verify):
+        parser_cache_command.add_argument('--max-threads', dest='max_threads', type=int, default=None,
+                                          help='number of cache directories to scan concurrently')
+
     return parser
 
 
@@ -896,7 +987,7 @@ def main():
     args = build_parser().parse_args()
     synapseclient.USER_AGENT['User-Agent'] = "synapsecommandlineclient " + synapseclient.USER_AGENT['User-Agent']
     syn = synapseclient.Synapse(debug=args.debug, skip_checks=args.skip_checks, configPath=args.configPath)
-    if not ('func' in args and args.func == login):
+    if not ('func' in args and (args.func == login or args.func in LOCAL_COMMANDS)):
         # if we're not executing the "login" operation, automatically authenticate before running operation
         login_with_prompt(syn, args.synapseUser, args.synapsePassword, silent=True)
     perform_main(args, syn)
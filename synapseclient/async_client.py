@@ -0,0 +1,451 @@
+"""
+**************
+Asyncio client
+**************
+
+An asyncio client for the metadata calls of the Synapse REST API, so that a single event loop can keep thousands of
+requests in flight rather than tying up a thread per request. It uses the endpoints, credentials and retry policy of a
+:py:class:`synapseclient.Synapse` and requires `aiohttp <https://docs.aiohttp.org>`_::
+
+    pip install synapseclient[async]
+
+Example::
+
+    import asyncio
+    import synapseclient
+
+    syn = synapseclient.login()
+
+    async def crawl(parent_id):
+        async with synapseclient.AsyncSynapse(syn, max_concurrent_requests=200) as asyn:
+            children = [child async for child in asyn.getChildren(parent_id)]
+            return await asyncio.gather(*(asyn.get(child['id']) for child in children))
+
+    entities = asyncio.get_event_loop().run_until_complete(crawl('syn123'))
+
+Files are never downloaded or uploaded, use :py:meth:`synapseclient.Synapse.get` and
+:py:meth:`synapseclient.Synapse.store` for File entities whose content is needed.
+"""
+
+import asyncio
+import time
+
+import requests
+
+from synapseclient.annotations import Annotations, from_synapse_annotations, to_synapse_annotations
+from synapseclient.core import instrumentation, json_codec, utils
+from synapseclient.core.exceptions import SynapseError, SynapseHTTPError, SynapseTimeoutError
+from synapseclient.core.rate_limit import limited_call_async
+from synapseclient.core.retry import with_retry_async
+from synapseclient.core.utils import extract_synapse_id_from_query, id_of
+from synapseclient.entity import Entity, File, is_versionable, split_entity_namespaces
+from synapseclient.table import RowSet
+
+DEFAULT_MAX_CONCURRENT_REQUESTS = 100
+
+# the aiohttp counterparts of the requests exceptions retried by the standard retry policy
+ASYNC_RETRY_EXCEPTIONS = ['ClientConnectionError', 'ClientOSError', 'ClientPayloadError', 'ServerDisconnectedError',
+                          'TimeoutError']
+
+
+def _to_requests_response(method, url, status, reason, headers, content):
+    """
+    Wrap a response in a requests.Response so that it is checked, retried and parsed exactly like the responses of
+    the blocking client.
+    """
+    response = requests.Response()
+    response.status_code = status
+    response.reason = reason
+    response.headers = requests.structures.CaseInsensitiveDict(headers)
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response.url = url
+    response._content = content
+    response.request = requests.Request(method.upper(), url).prepare()
+    return response
+
+
+class AsyncSynapse:
+    """
+    Sends requests to Synapse from an asyncio event loop. Use it as an async context manager or :py:meth:`close` it
+    once done.
+
+    :param syn:                     the :py:class:`synapseclient.Synapse` whose endpoints and credentials are used,
+                                    log it in first to access anything that isn't public
+    :param max_concurrent_requests: the maximum number of requests in flight at once, further requests wait for their
+                                    turn. Waits between retries don't count.
+    :param session:                 an aiohttp.ClientSession to send the requests with, by default one with a
+                                    connection pool of max_concurrent_requests connections is created
+    """
+
+    def __init__(self, syn, max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS, session=None):
+        self.syn = syn
+        self.max_concurrent_requests = max_concurrent_requests
+        self._session = session
+        self._owns_session = session is None
+        # created on first use so that it belongs to the running event loop
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """Close the aiohttp.ClientSession created by this client"""
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            aiohttp = utils.attempt_import(
+                "aiohttp",
+                "\n\nThe libraries required for the asyncio client are not installed!\n"
+                "The Synapse asyncio client uses aiohttp to send requests.\n"
+            )
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrent_requests))
+        return self._session
+
+    ############################################################
+    #                   Low level Rest calls                   #
+    ############################################################
+
+    async def _send(self, method, uri, data, headers, **kwargs):
+        # paced by the same rate limiter as the requests of the blocking client to the host, a request waiting for it
+        # doesn't take up one of the max_concurrent_requests
+        return await limited_call_async(self.syn, uri, lambda: self._send_now(method, uri, data, headers, **kwargs))
+
+    async def _send_now(self, method, uri, data, headers, **kwargs):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        async with self._semaphore:
+            async with self._get_session().request(method.upper(), uri, data=data, headers=headers,
+                                                   **kwargs) as response:
+                content = await response.read()
+                return _to_requests_response(method, str(response.url), response.status, response.reason,
+                                             response.headers, content)
+
+    async def _rest_call(self, method, uri, data, endpoint, headers, retryPolicy, **kwargs):
+        uri, headers = self.syn._build_uri_and_headers(uri, endpoint=endpoint, headers=headers)
+        retryPolicy = self.syn._build_retry_policy(retryPolicy)
+        retryPolicy['retry_exceptions'] = retryPolicy['retry_exceptions'] + ASYNC_RETRY_EXCEPTIONS
+
+        with instrumentation.measure(instrumentation.KIND_REST, method, uri, body=data) as measurement:
+            response = await with_retry_async(lambda: self._send(method, uri, data, headers, **kwargs),
+                                              verbose=self.syn.debug, **retryPolicy)
+            measurement.response(response)
+        self.syn._handle_synapse_http_error(response)
+        return response
+
+    async def restGET(self, uri, endpoint=None, headers=None, retryPolicy={}, **kwargs):
+        """
+        Sends an HTTP GET request to the Synapse server.
+
+        :param uri:         URI on which get is performed
+        :param endpoint:    Server endpoint, defaults to self.syn.repoEndpoint
+        :param headers:     Dictionary of headers to use rather than the API-key-signed default set of headers
+        :param kwargs:      Any other arguments taken by an aiohttp.ClientSession request
+
+        :returns: JSON encoding of response
+        """
+        response = await self._rest_call('get', uri, None, endpoint, headers, retryPolicy, **kwargs)
+        return self.syn._return_rest_body(response)
+
+    async def restPOST(self, uri, body, endpoint=None, headers=None, retryPolicy={}, **kwargs):
+        """
+        Sends an HTTP POST request to the Synapse server.
+
+        :param uri:         URI on which get is performed
+        :param body:        The payload to be delivered
+        :param endpoint:    Server endpoint, defaults to self.syn.repoEndpoint
+        :param headers:     Dictionary of headers to use rather than the API-key-signed default set of headers
+        :param kwargs:      Any other arguments taken by an aiohttp.ClientSession request
+
+        :returns: JSON encoding of response
+        """
+        response = await self._rest_call('post', uri, body, endpoint, headers, retryPolicy, **kwargs)
+        return self.syn._return_rest_body(response)
+
+    async def restPUT(self, uri, body=None, endpoint=None, headers=None, retryPolicy={}, **kwargs):
+        """
+        Sends an HTTP PUT request to the Synapse server.
+
+        :param uri:         URI on which get is performed
+        :param body:        The payload to be delivered
+        :param endpoint:    Server endpoint, defaults to self.syn.repoEndpoint
+        :param headers:     Dictionary of headers to use rather than the API-key-signed default set of headers
+        :param kwargs:      Any other arguments taken by an aiohttp.ClientSession request
+
+        :returns: JSON encoding of response
+        """
+        response = await self._rest_call('put', uri, body, endpoint, headers, retryPolicy, **kwargs)
+        return self.syn._return_rest_body(response)
+
+    async def restDELETE(self, uri, endpoint=None, headers=None, retryPolicy={}, **kwargs):
+        """
+        Sends an HTTP DELETE request to the Synapse server.
+
+        :param uri:         URI of resource to be deleted
+        :param endpoint:    Server endpoint, defaults to self.syn.repoEndpoint
+        :param headers:     Dictionary of headers to use rather than the API-key-signed default set of headers
+        :param kwargs:      Any other arguments taken by an aiohttp.ClientSession request
+        """
+        await self._rest_call('delete', uri, None, endpoint, headers, retryPolicy, **kwargs)
+
+    ############################################################
+    #                  Get / Store methods                     #
+    ############################################################
+
+    async def get(self, entity, version=None, followLink=False):
+        """
+        Gets the metadata of a Synapse entity, see :py:meth:`synapseclient.Synapse.get`. Files are not downloaded.
+
+        :param entity:      A Synapse ID, a Synapse Entity object or a plain dictionary in which 'id' maps to a Synapse
+                            ID
+        :param version:     The specific version to get. Defaults to the most recent version.
+        :param followLink:  Whether the link returns the target Entity. Defaults to False
+
+        :returns: A new Synapse Entity object of the appropriate type
+        """
+        if isinstance(entity, str) and not utils.is_synapse_id(entity):
+            raise ValueError('The parameter %s is not a valid entity id' % entity)
+        if isinstance(entity, Entity) and not entity.get('id'):
+            raise ValueError("Cannot retrieve entity that has not been saved.")
+
+        version = version if version is not None else getattr(entity, 'versionNumber', None)
+        bundle = await self._getEntityBundle(entity, version)
+        if bundle is None:
+            raise ValueError("Cannot retrieve entity that has not been saved.")
+
+        if bundle['entity']['concreteType'] == 'org.sagebionetworks.repo.model.Link' and followLink:
+            bundle = await self._getEntityBundle(bundle['entity']['linksTo']['targetId'],
+                                                 bundle['entity']['linksTo'].get('targetVersionNumber'))
+
+        local_state = entity.local_state() if isinstance(entity, Entity) else {}
+        result = Entity.create(bundle['entity'], from_synapse_annotations(bundle['annotations']), local_state)
+        if isinstance(result, File):
+            result._update_file_handle(next((handle for handle in bundle['fileHandles']
+                                             if handle['id'] == result.dataFileHandleId), None))
+        return result
+
+    async def store(self, obj, *, createOrUpdate=True, forceVersion=True, versionLabel=None):
+        """
+        Creates a new Entity or updates an existing one along with its annotations, see
+        :py:meth:`synapseclient.Synapse.store`. A File must already have a dataFileHandleId, its file is not uploaded.
+
+        :param obj:             A Synapse Entity
+        :param createOrUpdate:  Indicates whether the method should automatically perform an update if the 'obj'
+                                conflicts with an existing Synapse object. Defaults to True.
+        :param forceVersion:    Indicates whether the method should increment the version of the object even if
+                                nothing has changed. Defaults to True.
+        :param versionLabel:    Arbitrary string used to label the version.
+
+        :returns: A Synapse Entity
+        """
+        if not isinstance(obj, (Entity, dict)):
+            raise ValueError("Only entities can be stored by the asyncio client, use Synapse.store")
+
+        properties, annotations, local_state = split_entity_namespaces(obj)
+        if local_state.get('path') and properties.get('dataFileHandleId') is None:
+            raise ValueError("The asyncio client doesn't upload files, use Synapse.store to store %s" %
+                             local_state['path'])
+
+        if 'id' in properties:
+            properties = await self._updateEntity(properties, forceVersion, versionLabel)
+        else:
+            if properties['concreteType'] == 'org.sagebionetworks.repo.model.Link':
+                target_properties = await self._getEntity(properties['linksTo']['targetId'],
+                                                          version=properties['linksTo'].get('targetVersionNumber'))
+                if target_properties['parentId'] == properties['parentId']:
+                    raise ValueError("Cannot create a Link to an entity under the same parent.")
+                properties['linksToClassName'] = target_properties['concreteType']
+                if target_properties.get('versionNumber') is not None \
+                        and properties['linksTo'].get('targetVersionNumber') is not None:
+                    properties['linksTo']['targetVersionNumber'] = target_properties['versionNumber']
+                properties['name'] = target_properties['name']
+            try:
+                properties = await self._createEntity(properties)
+            except SynapseHTTPError as ex:
+                if not (createOrUpdate and ex.response.status_code == 409):
+                    raise
+                existing_entity_id = await self.findEntityId(properties['name'], properties.get('parentId', None))
+                if existing_entity_id is None:
+                    raise
+                bundle = await self._getEntityBundle(existing_entity_id,
+                                                     requestedObjects={'includeEntity': True,
+                                                                       'includeAnnotations': True})
+                properties = {**bundle['entity'], **properties}
+                annotations = {**from_synapse_annotations(bundle['annotations']), **annotations}
+                properties = await self._updateEntity(properties, forceVersion, versionLabel)
+
+        annotations = await self.set_annotations(Annotations(properties['id'], properties['etag'], annotations))
+        properties['etag'] = annotations.etag
+
+        return await self.get(Entity.create(properties, annotations, local_state))
+
+    async def set_annotations(self, annotations: Annotations):
+        """
+        Store annotations for an Entity, see :py:meth:`synapseclient.Synapse.set_annotations`.
+
+        :returns: the updated :py:class:`synapseclient.annotations.Annotations` for the entity
+        """
+        if not isinstance(annotations, Annotations):
+            raise TypeError("Expected a synapseclient.Annotations object")
+
+        return from_synapse_annotations(await self.restPUT(f'/entity/{id_of(annotations)}/annotations2',
+                                                           body=json_codec.dumps(to_synapse_annotations(annotations))))
+
+    async def findEntityId(self, name, parent=None):
+        """
+        Find an Entity given its name and parent, see :py:meth:`synapseclient.Synapse.findEntityId`.
+
+        :returns: the Entity ID or None if not found
+        """
+        entity_lookup_request = {"parentId": id_of(parent) if parent else None,
+                                 "entityName": name}
+        try:
+            return (await self.restPOST("/entity/child", body=json_codec.dumps(entity_lookup_request))).get("id")
+        except SynapseHTTPError as e:
+            if e.response.status_code == 404:
+                return None
+            raise
+
+    async def _getEntityBundle(self, entity, version=None, requestedObjects=None):
+        if requestedObjects is None:
+            requestedObjects = {'includeEntity': True,
+                                'includeAnnotations': True,
+                                'includeFileHandles': True,
+                                'includeRestrictionInformation': True}
+        if isinstance(entity, dict) and 'id' not in entity and 'name' in entity:
+            entity = await self.findEntityId(entity['name'], entity.get('parentId', None))
+
+        try:
+            id_of(entity)
+        except ValueError:
+            return None
+
+        if version is not None:
+            uri = f'/entity/{id_of(entity)}/version/{int(version):d}/bundle2'
+        else:
+            uri = f'/entity/{id_of(entity)}/bundle2'
+        return await self.restPOST(uri, body=json_codec.dumps(requestedObjects))
+
+    async def _getEntity(self, entity, version=None):
+        uri = '/entity/' + id_of(entity)
+        if version:
+            uri += '/version/%d' % version
+        return await self.restGET(uri)
+
+    async def _createEntity(self, entity):
+        return await self.restPOST(uri='/entity', body=json_codec.dumps(entity))
+
+    async def _updateEntity(self, entity, incrementVersion=True, versionLabel=None):
+        uri = '/entity/%s' % id_of(entity)
+
+        if is_versionable(entity):
+            if incrementVersion or versionLabel is not None:
+                uri += '/version'
+                if 'versionNumber' in entity:
+                    entity['versionNumber'] += 1
+                    if 'versionLabel' in entity:
+                        entity['versionLabel'] = str(entity['versionNumber'])
+
+        if versionLabel:
+            entity['versionLabel'] = str(versionLabel)
+
+        return await self.restPUT(uri, body=json_codec.dumps(entity))
+
+    ############################################################
+    #                         Querying                         #
+    ############################################################
+
+    async def getChildren(self, parent, includeTypes=["folder", "file", "table", "link", "entityview", "dockerrepo"],
+                          sortBy="NAME", sortDirection="ASC"):
+        """
+        Retrieves all of the entities stored within a parent such as folder or project, see
+        :py:meth:`synapseclient.Synapse.getChildren`.
+
+        :returns: An async iterator over the children of the container
+        """
+        entityChildrenRequest = {'parentId': id_of(parent) if parent is not None else None,
+                                 'includeTypes': includeTypes,
+                                 'sortBy': sortBy,
+                                 'sortDirection': sortDirection,
+                                 'nextPageToken': None}
+        while True:
+            entityChildrenResponse = await self.restPOST('/entity/children',
+                                                         body=json_codec.dumps(entityChildrenRequest))
+            for child in entityChildrenResponse['page']:
+                yield child
+            if entityChildrenResponse.get('nextPageToken') is None:
+                break
+            entityChildrenRequest['nextPageToken'] = entityChildrenResponse['nextPageToken']
+
+    async def tableQuery(self, query, limit=None, offset=None, isConsistent=True):
+        """
+        Query a Synapse Table for all of its matching rows, like :py:meth:`synapseclient.Synapse.tableQuery` with
+        resultsAs="rowset".
+
+        :param query:           query string in a SQL-like syntax, for example "SELECT * from syn12345"
+        :param limit:           specify the maximum number of rows to be returned, defaults to None
+        :param offset:          don't return the first n rows, defaults to None
+        :param isConsistent:    defaults to True. If set to False, return results based on current state of the index
+                                without waiting for pending writes to complete.
+
+        :returns: a :py:class:`synapseclient.table.RowSet` with the rows of every page of the results
+        """
+        query_bundle_request = {
+            "concreteType": "org.sagebionetworks.repo.model.table.QueryBundleRequest",
+            "query": {
+                "sql": query,
+                "isConsistent": isConsistent,
+                "includeEntityEtag": True
+            }
+        }
+        if limit is not None:
+            query_bundle_request["query"]["limit"] = limit
+        if offset is not None:
+            query_bundle_request["query"]["offset"] = offset
+
+        table_id = extract_synapse_id_from_query(query)
+        result = await self._waitForAsync(f'/entity/{table_id}/table/query/async', query_bundle_request)
+        rowset = RowSet.from_json(result['queryResult']['queryResults'])
+        next_page_token = result['queryResult'].get('nextPageToken')
+        while next_page_token:
+            result = await self._waitForAsync(f'/entity/{table_id}/table/query/nextPage/async', next_page_token)
+            rowset['rows'].extend(RowSet.from_json(result['queryResults'])['rows'])
+            next_page_token = result.get('nextPageToken')
+        return rowset
+
+    async def _waitForAsync(self, uri, request, endpoint=None):
+        if endpoint is None:
+            endpoint = self.syn.repoEndpoint
+        with instrumentation.measure(instrumentation.KIND_ASYNC_JOB, 'post', endpoint + uri) as measurement:
+            async_job_id = await self.restPOST(uri + '/start', body=json_codec.dumps(request), endpoint=endpoint)
+
+            sleep = self.syn.table_query_sleep
+            start_time = time.time()
+            last_progress = None
+            while time.time() - start_time < self.syn.table_query_timeout:
+                result = await self.restGET(uri + '/get/%s' % async_job_id['token'], endpoint=endpoint)
+                if result.get('jobState', None) != 'PROCESSING':
+                    break
+                # Reset the time if we made progress (fix SYNPY-214)
+                progress = (result.get('progressMessage'), result.get('progressCurrent'))
+                if progress != last_progress:
+                    start_time = time.time()
+                    last_progress = progress
+                sleep = min(self.syn.table_query_max_sleep, sleep * self.syn.table_query_backoff)
+                await asyncio.sleep(sleep)
+            else:
+                raise SynapseTimeoutError(
+                    'Timeout waiting for query results: %0.1f seconds ' % (time.time() - start_time)
+                )
+            measurement.completed(result.get('jobState', None))
+            if result.get('jobState', None) == 'FAILED':
+                raise SynapseError(
+                    result.get('errorMessage', None) + '\n' + result.get('errorDetails', None),
+                    asynchronousJobStatus=result
+                )
+            return result
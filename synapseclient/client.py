@@ -34,6 +34,7 @@ import deprecated
 import functools
 import getpass
 import hashlib
+import itertools
 import json
 import logging
 import mimetypes
@@ -61,7 +62,8 @@ from .evaluation import Evaluation, Submission, SubmissionStatus
 from .table import SchemaBase, Column, TableQueryResult, CsvFileTable
 from .team import UserProfile, Team, TeamMember, UserGroupHeader
 from .wiki import Wiki, WikiAttachment
-from synapseclient.core import cache, exceptions, utils
+from synapseclient.core import cache, connection_pool, exceptions, instrumentation, json_codec, metadata_cache, \
+    rate_limit, utils
 from synapseclient.core.constants import config_file_constants
 from synapseclient.core.constants import concrete_types
 from synapseclient.core import cumulative_transfer_progress
@@ -80,7 +82,8 @@ from synapseclient.core.exceptions import (
 )
 from synapseclient.core.logging_setup import DEFAULT_LOGGER_NAME, DEBUG_LOGGER_NAME
 from synapseclient.core.version_check import version_check
-from synapseclient.core.pool_provider import DEFAULT_NUM_THREADS
+from synapseclient.core import pool_provider
+from synapseclient.core.pool_provider import DEFAULT_NUM_THREADS, configure_shared_executor
 from synapseclient.core.utils import id_of, get_properties, MB, memoize, is_json, extract_synapse_id_from_query, \
     find_data_file_handle, extract_zip_file_to_directory, is_integer, require_param
 from synapseclient.core.retry import with_retry
@@ -113,6 +116,14 @@ AUTHENTICATED_USERS = 273948
 DEBUG_DEFAULT = False
 REDIRECT_LIMIT = 5
 MAX_THREADS_CAP = 128
+# the maximum number of references in a request for entity headers
+ENTITY_HEADER_BATCH_SIZE = 100
+
+# the parts of an entity bundle retrieved by get
+DEFAULT_REQUESTED_OBJECTS = {'includeEntity': True,
+                             'includeAnnotations': True,
+                             'includeFileHandles': True,
+                             'includeRestrictionInformation': True}
 
 # Defines the standard retry policy applied to the rest methods
 # The retry period needs to span a minute because sending messages is limited to 10 per 60 seconds.
@@ -190,8 +201,21 @@ class Synapse(object):
     def __init__(self, repoEndpoint=None, authEndpoint=None, fileHandleEndpoint=None, portalEndpoint=None,
                  debug=None, skip_checks=False, configPath=CONFIG_FILE, requests_session=None):
         self._requests_session = requests_session or requests.Session()
+        # the connections to the Synapse endpoints, sized by max_threads, a custom requests_session is left as it is
+        self._connection_pool = None if requests_session else connection_pool.CountingHTTPAdapter()
+        # every request to Synapse and to pre-signed URLs is paced by the throttling of its host
+        self._rate_limiters = rate_limit.HostRateLimiters()
 
         cache_root_dir = cache.CACHE_ROOT_DIR
+        cache_index = cache.CACHE_INDEX_CACHE_MAP
+        cache_max_size = None
+        cache_lock = cache.LOCK_TYPE_MKDIR
+        cache_memo_size = 0
+        cache_shared_locations = []
+        cache_publish = True
+        cache_hardlink = False
+        metadata_cache_max_size = None
+        bundle_ttl = None
 
         config_debug = None
         # Check for a config file
@@ -200,13 +224,67 @@ class Synapse(object):
             config = self.getConfigFile(configPath)
             if config.has_option('cache', 'location'):
                 cache_root_dir = config.get('cache', 'location')
+            if config.has_option('cache', 'max_size'):
+                try:
+                    cache_max_size = utils.parse_bytes(config.get('cache', 'max_size'))
+                except ValueError as cause:
+                    raise ValueError("Invalid cache.max_size config setting %s" % config.get('cache', 'max_size')) \
+                        from cause
+                # only the sqlite index keeps track of how large the cache is
+                cache_index = cache.CACHE_INDEX_SQLITE
+            if config.has_option('cache', 'index'):
+                cache_index = config.get('cache', 'index').lower()
+            if config.has_option('cache', 'lock'):
+                cache_lock = config.get('cache', 'lock').lower()
+            if config.has_option('cache', 'memo_size'):
+                try:
+                    cache_memo_size = config.getint('cache', 'memo_size')
+                except ValueError as cause:
+                    raise ValueError("Invalid cache.memo_size config setting %s" % config.get('cache', 'memo_size')) \
+                        from cause
+            if config.has_option('cache', 'shared_locations'):
+                cache_shared_locations = [
+                    location.strip() for location in config.get('cache', 'shared_locations').split(',')
+                    if location.strip()
+                ]
+            if config.has_option('cache', 'publish'):
+                try:
+                    cache_publish = config.getboolean('cache', 'publish')
+                except ValueError as cause:
+                    raise ValueError("Invalid cache.publish config setting %s" % config.get('cache', 'publish')) \
+                        from cause
+            if config.has_option('cache', 'hardlink'):
+                try:
+                    cache_hardlink = config.getboolean('cache', 'hardlink')
+                except ValueError as cause:
+                    raise ValueError("Invalid cache.hardlink config setting %s" % config.get('cache', 'hardlink')) \
+                        from cause
+            if config.has_option('cache', 'metadata_max_size'):
+                try:
+                    metadata_cache_max_size = utils.parse_bytes(config.get('cache', 'metadata_max_size'))
+                except ValueError as cause:
+                    raise ValueError("Invalid cache.metadata_max_size config setting %s" %
+                                     config.get('cache', 'metadata_max_size')) from cause
+            if config.has_option('cache', 'bundle_ttl'):
+                try:
+                    bundle_ttl = config.getfloat('cache', 'bundle_ttl')
+                except ValueError as cause:
+                    raise ValueError("Invalid cache.bundle_ttl config setting %s" % config.get('cache', 'bundle_ttl')) \
+                        from cause
             if config.has_section('debug'):
                 debug = True
 
         if debug is None:
             debug = config_debug if config_debug is not None else DEBUG_DEFAULT
 
-        self.cache = cache.Cache(cache_root_dir)
+        self.cache = cache.Cache(cache_root_dir, index=cache_index, max_size=cache_max_size, lock=cache_lock,
+                                 memo_size=cache_memo_size, shared_cache_root_dirs=cache_shared_locations,
+                                 publish=cache_publish, hardlink=cache_hardlink)
+        # the bundles of past entity versions, kept on disk when cache.metadata_max_size is set
+        self.metadata_cache = metadata_cache.MetadataCache(self.cache.cache_root_dir, metadata_cache_max_size) \
+            if metadata_cache_max_size else None
+        # the bundles of the latest versions of entities, memoized for cache.bundle_ttl seconds when it is set
+        self._bundle_memo = metadata_cache.EntityBundleMemo(bundle_ttl) if bundle_ttl else None
         self._sts_token_store = sts_transfer.StsTokenStore()
 
         self.setEndpoints(repoEndpoint, authEndpoint, fileHandleEndpoint, portalEndpoint, skip_checks)
@@ -214,6 +292,10 @@ class Synapse(object):
         self.default_headers = {'content-type': 'application/json; charset=UTF-8',
                                 'Accept': 'application/json; charset=UTF-8'}
         self.credentials = None
+        # the credentials the ownerId of the logged in user was last looked up for and that ownerId
+        self._credentials_owner_id = (None, None)
+        # the credentials the memoized bundles were fetched with
+        self._bundle_memo_credentials = None
         self.debug = debug  # setter for debug initializes self.logger also
         self.skip_checks = skip_checks
 
@@ -226,6 +308,8 @@ class Synapse(object):
         transfer_config = self._get_transfer_config()
         self.max_threads = transfer_config['max_threads']
         self.use_boto_sts_transfers = transfer_config['use_boto_sts']
+        if transfer_config['max_shared_threads']:
+            configure_shared_executor(transfer_config['max_shared_threads'])
 
         # TODO: remove once most clients are no longer on versions <= 1.7.5
         cached_sessions.migrate_old_session_file_credentials_if_necessary(self)
@@ -250,6 +334,18 @@ class Synapse(object):
     @max_threads.setter
     def max_threads(self, value: int):
         self._max_threads = min(max(value, 1), MAX_THREADS_CAP)
+        if self._connection_pool is not None:
+            # every thread may be making requests to Synapse at once
+            self._connection_pool.resize(connection_pool.pool_size_for_threads(self._max_threads))
+
+    def get_connection_pool_stats(self):
+        """
+        Count how many of the requests this client sent to the Synapse endpoints reused an open connection.
+
+        :returns: a :py:class:`synapseclient.core.connection_pool.ConnectionPoolStats` or None if this client was
+                  given its own requests_session
+        """
+        return self._connection_pool.stats() if self._connection_pool is not None else None
 
     @property
     def username(self):
@@ -318,6 +414,10 @@ class Synapse(object):
         self.fileHandleEndpoint = endpoints['fileHandleEndpoint']
         self.portalEndpoint = endpoints['portalEndpoint']
 
+        if self._connection_pool is not None:
+            for endpoint in (self.repoEndpoint, self.authEndpoint, self.fileHandleEndpoint):
+                self._requests_session.mount(endpoint, self._connection_pool)
+
     def login(self, email=None, password=None, apiKey=None, sessionToken=None, rememberMe=False, silent=False,
               forced=False):
         """
@@ -427,6 +527,7 @@ class Synapse(object):
         # defaults
         transfer_config = {
             'max_threads': DEFAULT_NUM_THREADS,
+            'max_shared_threads': None,
             'use_boto_sts': False
         }
 
@@ -438,6 +539,12 @@ class Synapse(object):
                     except ValueError as cause:
                         raise ValueError(f"Invalid transfer.max_threads config setting {v}") from cause
 
+                elif k == 'max_shared_threads':
+                    try:
+                        transfer_config['max_shared_threads'] = int(v)
+                    except ValueError as cause:
+                        raise ValueError(f"Invalid transfer.max_shared_threads config setting {v}") from cause
+
                 elif k == 'use_boto_sts':
                     lower_v = v.lower()
                     if lower_v not in ('true', 'false'):
@@ -451,7 +558,7 @@ class Synapse(object):
         """Returns a validated session token."""
         try:
             req = {'email': email, 'password': password}
-            session = self.restPOST('/session', body=json.dumps(req), endpoint=self.authEndpoint,
+            session = self.restPOST('/session', body=json_codec.dumps(req), endpoint=self.authEndpoint,
                                     headers=self.default_headers)
             return session['sessionToken']
         except SynapseHTTPError as err:
@@ -496,6 +603,9 @@ class Synapse(object):
 
         # Remove the authentication information from memory
         self.credentials = None
+        # along with what it was allowed to see
+        if self._bundle_memo is not None:
+            self._bundle_memo.clear()
 
     def invalidateAPIKey(self):
         """Invalidates authentication across all clients."""
@@ -663,6 +773,64 @@ class Synapse(object):
 
         return self._getWithEntityBundle(entityBundle=bundle, entity=entity, **kwargs)
 
+    def get_many(self, entities, headersOnly=False, downloadFile=False, **kwargs):
+        """
+        Gets many Synapse entities, fetching up to max_threads of them at once. The entities are yielded in the order
+        they were given as soon as they are retrieved, so the results of a long list can be processed as they come.
+
+        :param entities:        An iterable of Synapse IDs, Synapse Entity objects or plain dictionaries in which 'id'
+                                maps to a Synapse ID
+        :param headersOnly:     Whether to only get the `EntityHeader
+                                <https://rest-docs.synapse.org/rest/org/sagebionetworks/repo/model/EntityHeader.html>`_
+                                of each entity, looked up in batches, rather than the entity and its annotations.
+                                An entity that doesn't exist or can't be read yields None. Defaults to False
+        :param downloadFile:    Whether associated files should be downloaded, alongside the retrieval of the following
+                                entities. Defaults to False
+        :param kwargs:          Any other arguments taken by :py:meth:`get`, e.g. version, downloadLocation,
+                                followLink or ifcollision
+
+        :returns: a generator over the entities, or their headers
+
+        Example::
+
+            for entity in syn.get_many(['syn123', 'syn456', 'syn789']):
+                print(entity.name, entity.versionNumber)
+
+            names = [header['name'] for header in syn.get_many(ids, headersOnly=True)]
+        """
+        if headersOnly:
+            return self._get_entity_headers(entities)
+        return self._get_many(entities, downloadFile=downloadFile, **kwargs)
+
+    def _get_many(self, entities, **kwargs):
+        executor = pool_provider.get_executor(self.max_threads, priority=pool_provider.PRIORITY_METADATA)
+        # enough gets in flight to keep the threads busy while the caller consumes the results in order
+        window = 2 * self.max_threads
+        futures = collections.deque()
+        try:
+            for entity in entities:
+                futures.append(executor.submit(self.get, entity, **kwargs))
+                if len(futures) >= window:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            # an error or an abandoned generator cancels the gets that haven't started yet
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _get_entity_headers(self, entities, batch_size=ENTITY_HEADER_BATCH_SIZE):
+        entities = iter(entities)
+        while True:
+            ids = [id_of(entity) for entity in itertools.islice(entities, batch_size)]
+            if not ids:
+                return
+            references = [{'targetId': entity_id} for entity_id in ids]
+            results = self.restPOST('/entity/header', body=json_codec.dumps({'references': references}))['results']
+            # the headers of the entities that don't exist or can't be read are left out
+            headers = {header['id']: header for header in results}
+            for entity_id in ids:
+                yield headers.get(entity_id)
+
     def _check_entity_restrictions(self, restrictionInformation, entity, downloadFile):
         if restrictionInformation['hasUnmetAccessRequirement']:
             warning_message = ("\nThis entity has access restrictions. Please visit the web page for this entity "
@@ -680,7 +848,7 @@ class Synapse(object):
         :param filepath:        path to local file
         :param limitSearch:     Limits the places in Synapse where the file is searched for.
         """
-        results = self.restGET('/entity/md5/%s' % utils.md5_for_file(filepath).hexdigest())['results']
+        results = self.restGET('/entity/md5/%s' % self.cache.md5_for_file(filepath))['results']
         if limitSearch is not None:
             # Go through and find the path of every entity found
             paths = [self.restGET('/entity/%s/path' % ent['id']) for ent in results]
@@ -830,7 +998,7 @@ class Synapse(object):
                 # create the foider if it does not exist already
                 if not os.path.exists(downloadLocation):
                     os.makedirs(downloadLocation)
-                shutil.copy(cached_file_path, downloadPath)
+                self.cache.link_or_copy(cached_file_path, downloadPath)
 
         else:  # download the file from URL (could be a local file)
             objectType = 'FileEntity' if submission is None else 'SubmissionAttachment'
@@ -1162,10 +1330,7 @@ class Synapse(object):
         #     If the user forgets to catch the return value of a syn.store(e)
         #     this allows them to recover by doing: e = syn.get(e)
         if requestedObjects is None:
-            requestedObjects = {'includeEntity': True,
-                                'includeAnnotations': True,
-                                'includeFileHandles': True,
-                                'includeRestrictionInformation': True}
+            requestedObjects = DEFAULT_REQUESTED_OBJECTS
         if isinstance(entity, collections.abc.Mapping) and 'id' not in entity and 'name' in entity:
             entity = self.findEntityId(entity['name'], entity.get('parentId', None))
 
@@ -1175,12 +1340,62 @@ class Synapse(object):
         except ValueError:
             return None
 
+        # only the default bundles of past versions are cached, they no longer change
+        use_metadata_cache = self.metadata_cache is not None and version is not None and \
+            requestedObjects == DEFAULT_REQUESTED_OBJECTS
+        if use_metadata_cache:
+            # bundles are kept per user, what a user may see depends on their access
+            user_id = self._get_owner_id()
+            bundle = self.metadata_cache.get(id_of(entity), version, user_id)
+            if bundle is not None:
+                return bundle
+        use_bundle_memo = self._bundle_memo is not None and version is None and \
+            requestedObjects == DEFAULT_REQUESTED_OBJECTS
+        if use_bundle_memo:
+            # what a user may see depends on their access, bundles memoized while logged in as someone else are dropped
+            if self._bundle_memo_credentials is not self.credentials:
+                self._bundle_memo.clear()
+                self._bundle_memo_credentials = self.credentials
+            bundle = self._get_memoized_bundle(entity)
+            if bundle is not None:
+                return bundle
+
         if version is not None:
             uri = f'/entity/{id_of(entity)}/version/{int(version):d}/bundle2'
         else:
             uri = f'/entity/{id_of(entity)}/bundle2'
-        bundle = self.restPOST(uri, body=json.dumps(requestedObjects))
+        bundle = self.restPOST(uri, body=json_codec.dumps(requestedObjects))
+
+        if use_metadata_cache:
+            self.metadata_cache.put(bundle, user_id)
+        if use_bundle_memo:
+            self._bundle_memo.put(id_of(entity), bundle)
+        return bundle
+
+    def _get_owner_id(self):
+        """
+        :returns: the ownerId of the logged in user or None if not logged in
+        """
+        credentials, owner_id = self._credentials_owner_id
+        if self.credentials is None:
+            return None
+        if credentials is not self.credentials:
+            owner_id = self.restGET('/userProfile')['ownerId']
+            self._credentials_owner_id = (self.credentials, owner_id)
+        return owner_id
 
+    def _get_memoized_bundle(self, entity):
+        """
+        :returns: the memoized bundle of the latest version of the entity if it is current or None
+        """
+        if self._bundle_memo is None:
+            return None
+        bundle, fresh = self._bundle_memo.get(id_of(entity))
+        if bundle is not None and not fresh:
+            # the entity alone tells whether the bundle changed for a fraction of the cost of the bundle
+            etag = self.restGET(f'/entity/{id_of(entity)}')['etag']
+            if not self._bundle_memo.revalidated(id_of(entity), etag):
+                return None
         return bundle
 
     def delete(self, obj, version=None):
@@ -1199,6 +1414,7 @@ class Synapse(object):
                 self.restDELETE(uri=f'/entity/{id_of(obj)}/version/{version}')
             else:
                 self.restDELETE(uri=f'/entity/{id_of(obj)}')
+            self._forget_cached_bundles(obj, version)
         elif hasattr(obj, "_synapse_delete"):
             return obj._synapse_delete(self)
         else:
@@ -1209,6 +1425,17 @@ class Synapse(object):
                     self.restDELETE(obj.deleteURI())
             except AttributeError:
                 raise SynapseError(f"Can't delete a {type(obj)}. Please specify a Synapse object or id")
+            if isinstance(obj, Entity):
+                self._forget_cached_bundles(obj, version)
+
+    def _forget_cached_bundles(self, entity, version=None):
+        if self.metadata_cache is not None:
+            self.metadata_cache.remove(id_of(entity), version)
+        self._forget_memoized_bundle(entity)
+
+    def _forget_memoized_bundle(self, entity):
+        if self._bundle_memo is not None:
+            self._bundle_memo.forget(id_of(entity))
 
     _user_name_cache = {}
 
@@ -1318,6 +1545,10 @@ class Synapse(object):
         a dict that also has id and etag attributes
         :rtype: :py:class:`synapseclient.annotations.Annotations`
         """
+        if version is None:
+            bundle = self._get_memoized_bundle(entity)
+            if bundle is not None:
+                return from_synapse_annotations(bundle['annotations'])
         return from_synapse_annotations(self._getRawAnnotations(entity, version))
 
     @deprecated.sphinx.deprecated(version='2.1.0', reason='deprecated and replaced with :py:meth:`set_annotations` '
@@ -1392,8 +1623,11 @@ class Synapse(object):
 
         synapseAnnos = to_synapse_annotations(annotations)
 
-        return from_synapse_annotations(self.restPUT(f'/entity/{id_of(annotations)}/annotations2',
-                                                     body=json.dumps(synapseAnnos)))
+        try:
+            return from_synapse_annotations(self.restPUT(f'/entity/{id_of(annotations)}/annotations2',
+                                                         body=json_codec.dumps(synapseAnnos)))
+        finally:
+            self._forget_memoized_bundle(annotations)
 
     ############################################################
     #                         Querying                         #
@@ -1427,7 +1661,7 @@ class Synapse(object):
                                  'nextPageToken': None}
         entityChildrenResponse = {"nextPageToken": "first"}
         while entityChildrenResponse.get('nextPageToken') is not None:
-            entityChildrenResponse = self.restPOST('/entity/children', body=json.dumps(entityChildrenRequest))
+            entityChildrenResponse = self.restPOST('/entity/children', body=json_codec.dumps(entityChildrenRequest))
             for child in entityChildrenResponse['page']:
                 yield child
             if entityChildrenResponse.get('nextPageToken') is not None:
@@ -1483,7 +1717,7 @@ class Synapse(object):
             ]}
         """
         if hasattr(entity, 'putACLURI'):
-            return self.restPUT(entity.putACLURI(), json.dumps(acl))
+            return self.restPUT(entity.putACLURI(), json_codec.dumps(acl))
         else:
             # Get benefactor. (An entity gets its ACL from its benefactor.)
             entity_id = id_of(entity)
@@ -1493,9 +1727,9 @@ class Synapse(object):
             # Update or create new ACL
             uri = '/entity/%s/acl' % entity_id
             if benefactor['id'] == entity_id:
-                return self.restPUT(uri, json.dumps(acl))
+                return self.restPUT(uri, json_codec.dumps(acl))
             else:
-                return self.restPOST(uri, json.dumps(acl))
+                return self.restPOST(uri, json_codec.dumps(acl))
 
     def _getUserbyPrincipalIdOrName(self, principalId=None):
         """
@@ -1639,13 +1873,16 @@ class Synapse(object):
         if 'id' in activity:
             # We're updating provenance
             uri = '/activity/%s' % activity['id']
-            activity = Activity(data=self.restPUT(uri, json.dumps(activity)))
+            activity = Activity(data=self.restPUT(uri, json_codec.dumps(activity)))
         else:
-            activity = self.restPOST('/activity', body=json.dumps(activity))
+            activity = self.restPOST('/activity', body=json_codec.dumps(activity))
 
         # assert that an entity is generated by an activity
         uri = '/entity/%s/generatedBy?generatedBy=%s' % (id_of(entity), activity['id'])
-        activity = Activity(data=self.restPUT(uri))
+        try:
+            activity = Activity(data=self.restPUT(uri))
+        finally:
+            self._forget_memoized_bundle(entity)
 
         return activity
 
@@ -1661,7 +1898,10 @@ class Synapse(object):
             return
 
         uri = '/entity/%s/generatedBy' % id_of(entity)
-        self.restDELETE(uri)
+        try:
+            self.restDELETE(uri)
+        finally:
+            self._forget_memoized_bundle(entity)
 
         # TODO: what happens if the activity is shared by more than one entity?
         uri = '/activity/%s' % activity['id']
@@ -1677,7 +1917,7 @@ class Synapse(object):
         """
 
         uri = '/activity/%s' % activity['id']
-        return Activity(data=self.restPUT(uri, json.dumps(activity)))
+        return Activity(data=self.restPUT(uri, json_codec.dumps(activity)))
 
     def _convertProvenanceList(self, usedList, limitSearch=None):
         """Convert a list of synapse Ids, URLs and local files by replacing local files with Synapse Ids"""
@@ -1706,7 +1946,7 @@ class Synapse(object):
                 'requestedFiles': [{'fileHandleId': fileHandleId,
                                     'associateObjectId': objectId,
                                     'associateObjectType': objectType or 'FileEntity'}]}
-        response = self.restPOST('/fileHandle/batch', body=json.dumps(body),
+        response = self.restPOST('/fileHandle/batch', body=json_codec.dumps(body),
                                  endpoint=self.fileHandleEndpoint)
         result = response['requestedFiles'][0]
         failure = result.get('failureCode')
@@ -1733,14 +1973,31 @@ class Synapse(object):
         """
         os.makedirs(os.path.dirname(destination), exist_ok=True)
 
+        # threads and processes sharing the cache that want the same file at once wait for one of them to download it
+        return self.cache.download_once(
+            fileHandleId,
+            destination,
+            lambda: self._download_file_handle(fileHandleId, objectId, objectType, destination, retries=retries),
+        )
+
+    def _download_file_handle(self, fileHandleId, objectId, objectType, destination, retries=5):
+        """
+        Download a file handle and add it to the cache, see :py:meth:`_downloadFileHandle`.
+        """
         while retries > 0:
             try:
                 fileResult = self._getFileHandleDownload(fileHandleId, objectId, objectType)
                 fileHandle = fileResult['fileHandle']
                 concreteType = fileHandle['concreteType']
                 storageLocationId = fileHandle.get('storageLocationId')
+                content_md5 = fileHandle.get('contentMd5')
+                cached_content_path = self.cache.get_by_md5(content_md5) if content_md5 else None
 
-                if concreteType == concrete_types.EXTERNAL_OBJECT_STORE_FILE_HANDLE:
+                if cached_content_path is not None:
+                    # the same bytes are already cached under another file handle (e.g. a copied file handle)
+                    downloaded_path = self.cache.link_or_copy(cached_content_path, destination)
+
+                elif concreteType == concrete_types.EXTERNAL_OBJECT_STORE_FILE_HANDLE:
                     profile = self._get_client_authenticated_s3_profile(fileHandle['endpointUrl'], fileHandle['bucket'])
                     downloaded_path = S3ClientWrapper.download_file(fileHandle['bucket'], fileHandle['endpointUrl'],
                                                                     fileHandle['fileKey'], destination,
@@ -1786,7 +2043,7 @@ class Synapse(object):
                                                               destination,
                                                               fileHandle['id'],
                                                               expected_md5=fileHandle.get('contentMd5'))
-                self.cache.add(fileHandle['id'], downloaded_path)
+                self.cache.add(fileHandle['id'], downloaded_path, md5=content_md5)
                 return downloaded_path
             except Exception as ex:
                 exc_info = sys.exc_info()
@@ -1809,17 +2066,20 @@ class Synapse(object):
                                           *,
                                           expected_md5=None):
         destination = os.path.abspath(destination)
-        temp_destination = utils.temp_download_filename(destination, file_handle_id)
+        # a partial multithreaded download has holes and is resumed from its journal,
+        # it is kept apart from the partial single threaded downloads that are resumed from their end
+        temp_destination = utils.temp_download_filename(destination, file_handle_id) + \
+            multithread_download.TEMP_FILE_SUFFIX
 
         request = multithread_download.DownloadRequest(file_handle_id=int(file_handle_id),
                                                        object_id=object_id,
                                                        object_type=object_type,
                                                        path=temp_destination)
 
-        multithread_download.download_file(self, request)
+        # the md5 is computed as the parts are downloaded rather than by reading the whole file again afterwards
+        actual_md5 = multithread_download.download_file(self, request, compute_md5=bool(expected_md5))
 
         if expected_md5:  # if md5 not set (should be the case for all except http download)
-            actual_md5 = utils.md5_for_file(temp_destination).hexdigest()
             # check md5 if given
             if actual_md5 != expected_md5:
                 try:
@@ -1878,9 +2138,12 @@ class Synapse(object):
                 range_header = {"Range": "bytes={start}-".format(start=os.path.getsize(temp_destination))} \
                     if os.path.exists(temp_destination) else {}
                 response = with_retry(
-                    lambda: self._requests_session.get(url,
-                                                       headers=self._generate_headers(url, range_header),
-                                                       stream=True, allow_redirects=False),
+                    lambda: self._rate_limiters.call(
+                        url,
+                        lambda: self._requests_session.get(url,
+                                                           headers=self._generate_headers(url, range_header),
+                                                           stream=True, allow_redirects=False)
+                    ),
                     verbose=self.debug, **STANDARD_RETRY_PARAMS)
                 try:
                     exceptions._raise_for_status(response, verbose=self.debug)
@@ -1997,7 +2260,7 @@ class Synapse(object):
             (mimetype, enc) = mimetypes.guess_type(externalURL, strict=False)
         if mimetype is not None:
             fileHandle['contentType'] = mimetype
-        return self.restPOST('/externalFileHandle', json.dumps(fileHandle), self.fileHandleEndpoint)
+        return self.restPOST('/externalFileHandle', json_codec.dumps(fileHandle), self.fileHandleEndpoint)
 
     def _createExternalObjectStoreFileHandle(self, s3_file_key, file_path, storage_location_id, mimetype=None):
         if mimetype is None:
@@ -2012,7 +2275,7 @@ class Synapse(object):
             'contentType': mimetype
         }
 
-        return self.restPOST('/externalFileHandle', json.dumps(file_handle), self.fileHandleEndpoint)
+        return self.restPOST('/externalFileHandle', json_codec.dumps(file_handle), self.fileHandleEndpoint)
 
     def create_external_s3_file_handle(self, bucket_name, s3_file_key, file_path, *,
                                        parent=None, storage_location_id=None, mimetype=None):
@@ -2054,7 +2317,7 @@ class Synapse(object):
             'contentType': mimetype
         }
 
-        return self.restPOST('/externalFileHandle/s3', json.dumps(file_handle), endpoint=self.fileHandleEndpoint)
+        return self.restPOST('/externalFileHandle/s3', json_codec.dumps(file_handle), endpoint=self.fileHandleEndpoint)
 
     def _get_file_handle_as_creator(self, fileHandle):
         """Retrieve a fileHandle from the fileHandle service.
@@ -2159,7 +2422,7 @@ class Synapse(object):
                                  + ('s' if storage_type == 'ProxyStorage' else '')
         kwargs['uploadType'] = upload_type_dict[storage_type]
 
-        return self.restPOST('/storageLocation', body=json.dumps(kwargs))
+        return self.restPOST('/storageLocation', body=json_codec.dumps(kwargs))
 
     def getMyStorageLocationSetting(self, storage_location_id):
         """
@@ -2185,7 +2448,7 @@ class Synapse(object):
         existing_setting = self.getProjectSetting(entity, 'upload')
         if existing_setting is not None:
             existing_setting['locations'] = locations
-            self.restPUT('/projectSettings', body=json.dumps(existing_setting))
+            self.restPUT('/projectSettings', body=json_codec.dumps(existing_setting))
             return self.getProjectSetting(entity, 'upload')
         else:
             project_destination = {'concreteType':
@@ -2195,7 +2458,7 @@ class Synapse(object):
                                    'projectId': id_of(entity)
                                    }
 
-            return self.restPOST('/projectSettings', body=json.dumps(project_destination))
+            return self.restPOST('/projectSettings', body=json_codec.dumps(project_destination))
 
     def getProjectSetting(self, project, setting_type):
         """
@@ -2277,7 +2540,7 @@ class Synapse(object):
         else:
             storage_location_kwargs['concreteType'] = concrete_types.SYNAPSE_S3_STORAGE_LOCATION_SETTING
 
-        storage_location_setting = self.restPOST('/storageLocation', json.dumps(storage_location_kwargs))
+        storage_location_setting = self.restPOST('/storageLocation', json_codec.dumps(storage_location_kwargs))
 
         storage_location_id = storage_location_setting['storageLocationId']
         project_setting = self.setStorageLocation(
@@ -2464,7 +2727,7 @@ class Synapse(object):
             invite_request['inviteeId'] = str(inviteeId)
 
         response = self.restPOST("/membershipInvitation",
-                                 body=json.dumps(invite_request))
+                                 body=json_codec.dumps(invite_request))
         return response
 
     def invite_to_team(self, team, user=None, inviteeEmail=None,
@@ -2629,7 +2892,7 @@ class Synapse(object):
         uri = '/evaluation/submission?etag=%s' % entity_etag
         if eligibility_hash:
             uri += "&submissionEligibilityHash={0}".format(eligibility_hash)
-        submitted = self.restPOST(uri, json.dumps(submission))
+        submitted = self.restPOST(uri, json_codec.dumps(submission))
         return submitted
 
     def _get_contributors(self, evaluation_id, team):
@@ -2991,39 +3254,43 @@ class Synapse(object):
     def _waitForAsync(self, uri, request, endpoint=None):
         if endpoint is None:
             endpoint = self.repoEndpoint
-        async_job_id = self.restPOST(uri+'/start', body=json.dumps(request), endpoint=endpoint)
-
-        # http://docs.synapse.org/rest/org/sagebionetworks/repo/model/asynch/AsynchronousJobStatus.html
-        sleep = self.table_query_sleep
-        start_time = time.time()
-        lastMessage, lastProgress, lastTotal, progressed = '', 0, 1, False
-        while time.time()-start_time < self.table_query_timeout:
-            result = self.restGET(uri+'/get/%s' % async_job_id['token'], endpoint=endpoint)
-            if result.get('jobState', None) == 'PROCESSING':
-                progressed = True
-                message = result.get('progressMessage', lastMessage)
-                progress = result.get('progressCurrent', lastProgress)
-                total = result.get('progressTotal', lastTotal)
-                if message != '':
-                    utils.printTransferProgress(progress, total, message, isBytes=False)
-                # Reset the time if we made progress (fix SYNPY-214)
-                if message != lastMessage or lastProgress != progress:
-                    start_time = time.time()
-                    lastMessage, lastProgress, lastTotal = message, progress, total
-                sleep = min(self.table_query_max_sleep, sleep * self.table_query_backoff)
-                doze(sleep)
+        with instrumentation.measure(instrumentation.KIND_ASYNC_JOB, 'post', endpoint + uri) as measurement:
+            async_job_id = self.restPOST(uri+'/start', body=json_codec.dumps(request), endpoint=endpoint)
+
+            # http://docs.synapse.org/rest/org/sagebionetworks/repo/model/asynch/AsynchronousJobStatus.html
+            sleep = self.table_query_sleep
+            start_time = time.time()
+            lastMessage, lastProgress, lastTotal, progressed = '', 0, 1, False
+            while time.time()-start_time < self.table_query_timeout:
+                result = self.restGET(uri+'/get/%s' % async_job_id['token'], endpoint=endpoint)
+                if result.get('jobState', None) == 'PROCESSING':
+                    progressed = True
+                    message = result.get('progressMessage', lastMessage)
+                    progress = result.get('progressCurrent', lastProgress)
+                    total = result.get('progressTotal', lastTotal)
+                    if message != '':
+                        utils.printTransferProgress(progress, total, message, isBytes=False)
+                    # Reset the time if we made progress (fix SYNPY-214)
+                    if message != lastMessage or lastProgress != progress:
+                        start_time = time.time()
+                        lastMessage, lastProgress, lastTotal = message, progress, total
+                    sleep = min(self.table_query_max_sleep, sleep * self.table_query_backoff)
+                    doze(sleep)
+                else:
+                    break
             else:
-                break
-        else:
-            raise SynapseTimeoutError('Timeout waiting for query results: %0.1f seconds ' % (time.time()-start_time))
-        if result.get('jobState', None) == 'FAILED':
-            raise SynapseError(
-                result.get('errorMessage', None) + '\n' + result.get('errorDetails', None),
-                asynchronousJobStatus=result
-            )
-        if progressed:
-            utils.printTransferProgress(total, total, message, isBytes=False)
-        return result
+                raise SynapseTimeoutError(
+                    'Timeout waiting for query results: %0.1f seconds ' % (time.time()-start_time)
+                )
+            measurement.completed(result.get('jobState', None))
+            if result.get('jobState', None) == 'FAILED':
+                raise SynapseError(
+                    result.get('errorMessage', None) + '\n' + result.get('errorDetails', None),
+                    asynchronousJobStatus=result
+                )
+            if progressed:
+                utils.printTransferProgress(total, total, message, isBytes=False)
+            return result
 
     def getColumn(self, id):
         """
@@ -3316,7 +3583,7 @@ class Synapse(object):
     def createColumn(self, name, columnType, maximumSize=None, defaultValue=None, enumValues=None):
         columnModel = Column(name=name, columnType=columnType, maximumSize=maximumSize, defaultValue=defaultValue,
                              enumValue=enumValues)
-        return Column(**self.restPOST('/column', json.dumps(columnModel)))
+        return Column(**self.restPOST('/column', json_codec.dumps(columnModel)))
 
     def createColumns(self, columns):
         """
@@ -3328,7 +3595,7 @@ class Synapse(object):
         """
         request_body = {'concreteType': 'org.sagebionetworks.repo.model.ListWrapper',
                         'list': list(columns)}
-        response = self.restPOST('/column/batch', json.dumps(request_body))
+        response = self.restPOST('/column/batch', json_codec.dumps(request_body))
         return [Column(**col) for col in response['list']]
 
     def _getColumnByName(self, schema, column_name):
@@ -3461,24 +3728,31 @@ class Synapse(object):
             raise ValueError("Columns not found: " + ", ".join('"' + col + '"' for col in cols_not_found))
         col_indices = [i for i, h in enumerate(table.headers) if h.name in columns]
         # see: http://docs.synapse.org/rest/org/sagebionetworks/repo/model/file/BulkFileDownloadRequest.html
-        file_handle_associations = []
-        file_handle_to_path_map = collections.OrderedDict()
-        seen_file_handle_ids = set()  # ensure not sending duplicate requests for the same FileHandle IDs
+        file_handle_ids = []
         for row in table:
             for col_index in col_indices:
                 file_handle_id = row[col_index]
                 if is_integer(file_handle_id):
-                    path_to_cached_file = self.cache.get(file_handle_id, path=downloadLocation)
-                    if path_to_cached_file:
-                        file_handle_to_path_map[file_handle_id] = path_to_cached_file
-                    elif file_handle_id not in seen_file_handle_ids:
-                        file_handle_associations.append(dict(
-                            associateObjectType="TableEntity",
-                            fileHandleId=file_handle_id,
-                            associateObjectId=table.tableId))
-                    seen_file_handle_ids.add(file_handle_id)
+                    file_handle_ids.append(file_handle_id)
                 else:
                     warnings.warn("Weird file handle: %s" % file_handle_id)
+
+        # look up every file handle in the cache at once rather than one at a time
+        cached_paths = self.cache.get_many(file_handle_ids, path=downloadLocation, max_threads=self.max_threads)
+
+        file_handle_associations = []
+        file_handle_to_path_map = collections.OrderedDict()
+        seen_file_handle_ids = set()  # ensure not sending duplicate requests for the same FileHandle IDs
+        for file_handle_id in file_handle_ids:
+            path_to_cached_file = cached_paths[file_handle_id]
+            if path_to_cached_file:
+                file_handle_to_path_map[file_handle_id] = path_to_cached_file
+            elif file_handle_id not in seen_file_handle_ids:
+                file_handle_associations.append(dict(
+                    associateObjectType="TableEntity",
+                    fileHandleId=file_handle_id,
+                    associateObjectId=table.tableId))
+            seen_file_handle_ids.add(file_handle_id)
         return file_handle_associations, file_handle_to_path_map
 
     def _get_default_view_columns(self, view_type, view_type_mask=None):
@@ -3550,7 +3824,7 @@ class Synapse(object):
         :returns: A dictionary containing an Entity's properties
         """
 
-        return self.restPOST(uri='/entity', body=json.dumps(get_properties(entity)))
+        return self.restPOST(uri='/entity', body=json_codec.dumps(get_properties(entity)))
 
     def _updateEntity(self, entity, incrementVersion=True, versionLabel=None):
         """
@@ -3574,7 +3848,11 @@ class Synapse(object):
         if versionLabel:
             entity['versionLabel'] = str(versionLabel)
 
-        return self.restPUT(uri, body=json.dumps(get_properties(entity)))
+        try:
+            return self.restPUT(uri, body=json_codec.dumps(get_properties(entity)))
+        finally:
+            # forgotten once the update is made so that a concurrent get doesn't memoize the old bundle again
+            self._forget_memoized_bundle(entity)
 
     def findEntityId(self, name, parent=None):
         """
@@ -3589,7 +3867,7 @@ class Synapse(object):
         entity_lookup_request = {"parentId": id_of(parent) if parent else None,
                                  "entityName": name}
         try:
-            return self.restPOST("/entity/child", body=json.dumps(entity_lookup_request)).get("id")
+            return self.restPOST("/entity/child", body=json_codec.dumps(entity_lookup_request)).get("id")
         except SynapseHTTPError as e:
             if e.response.status_code == 404:  # a 404 error is raised if the entity does not exist
                 return None
@@ -3616,7 +3894,7 @@ class Synapse(object):
             recipients=userIds,
             subject=messageSubject,
             fileHandleId=fileHandleId)
-        return self.restPOST(uri='/message', body=json.dumps(message))
+        return self.restPOST(uri='/message', body=json_codec.dumps(message))
 
     ############################################################
     #                   Low level Rest calls                   #
@@ -3657,8 +3935,12 @@ class Synapse(object):
         requests_session = requests_session or self._requests_session
 
         requests_method_fn = getattr(requests_session, method)
-        response = with_retry(lambda: requests_method_fn(uri, data=data, headers=headers, **kwargs),
-                              verbose=self.debug, **retryPolicy)
+        with instrumentation.measure(instrumentation.KIND_REST, method, uri, body=data) as measurement:
+            response = with_retry(
+                lambda: self._rate_limiters.call(uri, lambda: requests_method_fn(uri, data=data, headers=headers,
+                                                                                 **kwargs)),
+                verbose=self.debug, **retryPolicy)
+            measurement.response(response)
         self._handle_synapse_http_error(response)
         return response
 
@@ -3751,5 +4033,5 @@ class Synapse(object):
     def _return_rest_body(self, response):
         """Returns either a dictionary or a string depending on the 'content-type' of the response."""
         if is_json(response.headers.get('content-type', None)):
-            return response.json()
+            return json_codec.loads(response.content)
         return response.text
@@ -11,20 +11,41 @@ This is part of the internal implementation of the client and should not be acce
 """
 
 import collections.abc
+import concurrent.futures
+import contextlib
 import datetime
-import json
+import logging
 import operator
 import os
-import re
 import shutil
 import math
-
-from synapseclient.core.lock import Lock
-from synapseclient.core import utils
+import threading
+import time
+
+from synapseclient.core import pool_provider, utils
+from synapseclient.core.cache_index import (
+    CACHE_INDEX_CACHE_MAP,
+    CACHE_INDEX_SQLITE,
+    CACHE_INDEX_TYPES,
+    CACHE_MAP_FILE_NAME,
+    RACY_WINDOW,
+    SQLITE_INDEX_FILE_NAME,
+    CacheMapIndex,
+    SqliteCacheIndex,
+)
+from synapseclient.core.exceptions import SynapseFileCacheError
+from synapseclient.core.lock import LOCK_DEFAULT_MAX_AGE, LOCK_TYPE_FCNTL, LOCK_TYPE_MKDIR, LOCK_TYPES, fcntl, get_lock
+from synapseclient.core.logging_setup import DEFAULT_LOGGER_NAME
 
 
 CACHE_ROOT_DIR = os.path.join('~', '.synapseCache')
 
+# files used within this many seconds are never evicted, even if that leaves the cache larger than its max_size
+EVICTION_GRACE_PERIOD = 60
+
+# how long to wait for another process to finish downloading a file before downloading it as well
+DOWNLOAD_WAIT_TIMEOUT = datetime.timedelta(hours=1)
+
 
 def epoch_time_to_iso(epoch_time):
     """
@@ -65,26 +86,188 @@ def _get_modified_time(path):
     return None
 
 
+# ioctl request number to share the extents of one file with another on Linux (btrfs, xfs, ...)
+_FICLONE = 0x40049409
+
+
+def _file_signature(stat):
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def _renew_until(lock, stop):
+    while not stop.wait(LOCK_DEFAULT_MAX_AGE.total_seconds() / 3):
+        lock.renew()
+
+
+def _reflink(source, destination):
+    import fcntl
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+    shutil.copymode(source, destination)
+
+
+def link_or_copy(source, destination, hardlink=False):
+    """
+    Make the file at destination have the same content as the file at source without copying the bytes if
+    the file system allows it. Tries a copy-on-write reflink first, then a hard link if allowed and finally
+    falls back to a plain copy. Any existing file at destination is replaced.
+
+    A hard linked destination shares its modification time and content with its source, so modifying either
+    of them modifies both.
+
+    :param source:      path to the file to copy
+    :param destination: path to the file to create
+    :param hardlink:    whether a hard link to the source is acceptable
+
+    :returns: destination
+    """
+    if os.path.exists(destination):
+        if os.path.samefile(source, destination):
+            return destination
+        os.remove(destination)
+
+    try:
+        _reflink(source, destination)
+        return destination
+    except (ImportError, OSError):
+        # not supported by the platform or the file system
+        if os.path.exists(destination):
+            os.remove(destination)
+
+    if hardlink:
+        try:
+            os.link(source, destination)
+            return destination
+        except OSError:
+            # e.g. the files are on different devices
+            pass
+
+    shutil.copy(source, destination)
+    return destination
+
+
+def _copy_atomically(source, destination):
+    """
+    Copy a file so that other clients only ever see a complete copy at destination, e.g. in a cache shared between
+    the nodes of a cluster.
+    """
+    temp_path = "%s.%d.%d.tmp" % (destination, os.getpid(), threading.get_ident())
+    try:
+        link_or_copy(source, temp_path)
+        os.replace(temp_path, destination)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return destination
+
+
 class Cache:
     """
     Represent a cache in which files are accessed by file handle ID.
+
+    :param cache_root_dir:  the directory in which cached files and their meta data are stored
+    :param fanout:          the number of subdirectories cache directories are spread across
+    :param index:           how the index of cached files is stored, either "cachemap" for a .cacheMap file per
+                            cache directory or "sqlite" for a single SQLite database in the cache_root_dir.
+                            Falls back to "cachemap" if the SQLite database can't be used.
+    :param max_size:        the maximum total size in bytes of the files stored in the cache_root_dir. When adding a
+                            file takes the cache over this size the least recently used files are evicted in the
+                            background. Requires the "sqlite" index, None for an unbounded cache.
+    :param lock:            how access to the .cacheMap files is coordinated, either "mkdir" for lock directories
+                            that work on any file system and are shared with other clients or "fcntl" for faster
+                            flock based locks on POSIX systems. Not used by the "sqlite" index.
+    :param memo_size:       the number of parsed .cacheMap files to keep in memory, a memoized cache map is used
+                            without taking its lock for as long as the modification time, inode and size of the file
+                            are unchanged. 0 to always read them from disk. Not used by the "sqlite" index.
+    :param shared_cache_root_dirs:  further cache root directories to look in, in order, for files missing from the
+                            cache_root_dir, e.g. a cache on a network file system shared by the nodes of a cluster.
+                            Files found there are copied into the cache_root_dir so later reads of them stay local.
+                            Shared caches always use a "cachemap" index and "mkdir" locks, which work across nodes.
+                            They are read without taking their locks so that they may be read-only, and a shared
+                            cache root directory that doesn't exist is never created.
+    :param publish:         whether to copy downloaded files into the first of the shared_cache_root_dirs so that
+                            other clients sharing it don't download them again. Clients publishing to a shared cache
+                            also wait there for each other's downloads of the same file instead of repeating them.
+                            Nothing is published to a shared cache that isn't writable.
+    :param hardlink:        whether files in the cache_root_dir may be hard linked to the locations they are
+                            downloaded to when the file system can't reflink them. Saves copying large files, but
+                            modifying a hard linked download in place modifies the cached copy that later downloads of
+                            the same content are served from, so it is only safe if downloads are never modified.
     """
 
     def __setattr__(self, key, value):
         # expand out home shortcut ('~') and environment variables when setting cache_root_dir
         if key == "cache_root_dir":
             value = os.path.expandvars(os.path.expanduser(value))
-            # create the cache_root_dir if it does not already exist
-            if not os.path.exists(value):
+            # create the cache_root_dir if it does not already exist, a shared cache is left to whoever shares it
+            if not os.path.exists(value) and not self.__dict__.get('_shared', False):
                 os.makedirs(value)
         self.__dict__[key] = value
 
-    def __init__(self, cache_root_dir=CACHE_ROOT_DIR, fanout=1000):
+        # the SQLite index lives in the cache_root_dir so it moves along with it
+        if key in ("cache_root_dir", "index_type") and "index_type" in self.__dict__:
+            self._init_index()
+
+    def __init__(self, cache_root_dir=CACHE_ROOT_DIR, fanout=1000, index=CACHE_INDEX_CACHE_MAP, max_size=None,
+                 lock=LOCK_TYPE_MKDIR, memo_size=0, shared_cache_root_dirs=(), publish=True, hardlink=False,
+                 _shared=False):
+        if index not in CACHE_INDEX_TYPES:
+            raise ValueError("Invalid cache index %s, must be one of %s" % (index, CACHE_INDEX_TYPES))
+        if lock not in LOCK_TYPES:
+            raise ValueError("Invalid cache lock %s, must be one of %s" % (lock, LOCK_TYPES))
+        if lock == LOCK_TYPE_FCNTL and fcntl is None:
+            logging.getLogger(DEFAULT_LOGGER_NAME).warning(
+                "fcntl locks are not supported on this platform, falling back to %s locks", LOCK_TYPE_MKDIR
+            )
+            lock = LOCK_TYPE_MKDIR
+
+        self._shared = _shared
         # set root dir of cache in which meta data will be stored and files
         # will be stored here by default, but other locations can be specified
         self.cache_root_dir = cache_root_dir
         self.fanout = fanout
-        self.cache_map_file_name = ".cacheMap"
+        self.cache_map_file_name = CACHE_MAP_FILE_NAME
+        self.max_size = max_size
+        self.lock_type = lock
+        self.memo_size = memo_size
+        self._pruner = None
+        self._pruner_lock = threading.Lock()
+        # file handle id -> (destination, future) of the downloads in progress in this process
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self.shared_tiers = [
+            Cache(shared_cache_root_dir, fanout=fanout, lock=LOCK_TYPE_MKDIR, memo_size=memo_size, _shared=True)
+            for shared_cache_root_dir in shared_cache_root_dirs
+        ]
+        self.publish = publish
+        self.hardlink = hardlink
+        self.index_type = index
+
+        if max_size is not None and self._index.cache_size() is None:
+            logging.getLogger(DEFAULT_LOGGER_NAME).warning(
+                "The size of the cache at %s can't be bounded without the sqlite cache index, max_size is ignored",
+                self.cache_root_dir
+            )
+
+    def _init_index(self):
+        index = self.__dict__.get('_index')
+        if index is not None:
+            index.close()
+
+        if self.index_type == CACHE_INDEX_SQLITE:
+            db_path = os.path.join(self.cache_root_dir, SQLITE_INDEX_FILE_NAME)
+            try:
+                self.__dict__['_index'] = SqliteCacheIndex(db_path, self.cache_map_file_name)
+                return
+            except Exception as ex:
+                # e.g. a network file system without the locking and shared memory WAL mode requires
+                logging.getLogger(DEFAULT_LOGGER_NAME).warning(
+                    "Unable to use the cache index at %s, falling back to %s files: %s",
+                    db_path, self.cache_map_file_name, ex
+                )
+        self.__dict__['_index'] = CacheMapIndex(self.cache_map_file_name, self.lock_type, self.memo_size,
+                                                self.cache_root_dir)
 
     def get_cache_dir(self, file_handle_id):
         if isinstance(file_handle_id, collections.abc.Mapping):
@@ -97,24 +280,10 @@ class Cache:
         return os.path.join(self.cache_root_dir, str(int(file_handle_id) % self.fanout), str(file_handle_id))
 
     def _read_cache_map(self, cache_dir):
-        cache_map_file = os.path.join(cache_dir, self.cache_map_file_name)
-
-        if not os.path.exists(cache_map_file):
-            return {}
-
-        with open(cache_map_file, 'r') as f:
-            cache_map = json.load(f)
-        return cache_map
+        return self._index.read(cache_dir)
 
     def _write_cache_map(self, cache_dir, cache_map):
-        if not os.path.exists(cache_dir):
-            os.makedirs(cache_dir)
-
-        cache_map_file = os.path.join(cache_dir, self.cache_map_file_name)
-
-        with open(cache_map_file, 'w') as f:
-            json.dump(cache_map, f)
-            f.write('\n')  # For compatibility with R's JSON parser
+        self._index.write(cache_dir, cache_map)
 
     def contains(self, file_handle_id, path):
         """
@@ -124,17 +293,19 @@ class Cache:
         :param path: file path at which to look for a cached copy
         """
         cache_dir = self.get_cache_dir(file_handle_id)
-        if not os.path.exists(cache_dir):
+        if not self._index.exists(cache_dir):
             return False
 
-        with Lock(self.cache_map_file_name, dir=cache_dir):
-            cache_map = self._read_cache_map(cache_dir)
+        cache_map = self._index.read_memoized(cache_dir)
+        if cache_map is None:
+            with self._index.lock(cache_dir, shared=True):
+                cache_map = self._read_cache_map(cache_dir)
 
-            path = utils.normalize_path(path)
+        path = utils.normalize_path(path)
 
-            cached_time = cache_map.get(path, None)
-            if cached_time:
-                return compare_timestamps(_get_modified_time(path), cached_time)
+        cached_time = cache_map.get(path, None)
+        if cached_time:
+            return compare_timestamps(_get_modified_time(path), cached_time)
         return False
 
     def get(self, file_handle_id, path=None):
@@ -151,78 +322,429 @@ class Cache:
         :returns: Either a file path, if an unmodified cached copy of the file
                   exists in the specified location or None if it does not
         """
+        cached_file_path = self._get_local(file_handle_id, path)
+        # a modified file at an exact path means its cached copy is out of date, wherever else the file is cached
+        if cached_file_path is None and self.shared_tiers and not (path is not None and os.path.isfile(path)):
+            cached_file_path = self._get_from_shared_tiers(file_handle_id)
+        return cached_file_path
+
+    def _get_local(self, file_handle_id, path):
         cache_dir = self.get_cache_dir(file_handle_id)
-        if not os.path.exists(cache_dir):
+        if not self._index.exists(cache_dir):
             return None
 
-        with Lock(self.cache_map_file_name, dir=cache_dir):
+        cache_map = self._index.read_memoized(cache_dir)
+        if cache_map is not None:
+            # without the lock stale entries are skipped rather than removed, the next locked read cleans them up
+            cached_file_path = self._get_from_cache_map(cache_dir, cache_map, path, remove_stale=False)
+            if cached_file_path is not None:
+                self._index.touch(cache_dir, cached_file_path)
+            return cached_file_path
+
+        # looked up under a shared lock, only removing stale entries takes the write lock
+        with self._index.lock(cache_dir, shared=True):
             cache_map = self._read_cache_map(cache_dir)
+        entry_count = len(cache_map)
+        cached_file_path = self._get_from_cache_map(cache_dir, cache_map, path, remove_stale=False)
+        if len(cache_map) < entry_count:
+            with self._index.lock(cache_dir):
+                cached_file_path = self._get_from_cache_map(cache_dir, self._read_cache_map(cache_dir), path)
+        if cached_file_path is not None:
+            # keeps recently used files from being evicted when the cache is bounded in size
+            self._index.touch(cache_dir, cached_file_path)
+        return cached_file_path
+
+    def get_many(self, file_handle_ids, path=None, max_threads=None):
+        """
+        Retrieve many files from the cache at once, equivalent to calling :py:meth:`get` for each of the file
+        handles. Cache directories are looked up a fanout directory at a time, concurrently across a thread pool, or
+        all within a single transaction with the "sqlite" index. Stale entries are skipped rather than removed.
 
-            path = utils.normalize_path(path)
+        :param file_handle_ids: the ids of the file handles to look up
+        :param path:            as for :py:meth:`get`, applies to every file handle
+        :param max_threads:     the number of fanout directories to look up concurrently
 
-            # If the caller specifies a path and that path exists in the cache
-            # but has been modified, we need to indicate no match by returning
-            # None. The logic for updating a synapse entity depends on this to
-            # determine the need to upload a new file.
-
-            if path is not None:
-                # If we're given a path to a directory, look for a cached file in that directory
-                if os.path.isdir(path):
-                    matching_unmodified_directory = None
-                    removed_entry_from_cache = False  # determines if cache_map needs to be rewritten to disk
-
-                    # iterate a copy of cache_map to allow modifying original cache_map
-                    for cached_file_path, cached_time in dict(cache_map).items():
-                        if path == os.path.dirname(cached_file_path):
-                            # compare_timestamps has an implicit check for whether the path exists
-                            if compare_timestamps(_get_modified_time(cached_file_path), cached_time):
-                                # "break" instead of "return" to write removed invalid entries to disk if necessary
-                                matching_unmodified_directory = cached_file_path
-                                break
-                            else:
-                                # remove invalid cache entries pointing to files that that no longer exist
-                                # or have been modified
-                                del cache_map[cached_file_path]
-                                removed_entry_from_cache = True
-
-                    if removed_entry_from_cache:
-                        # write cache_map with non-existent entries removed
-                        self._write_cache_map(cache_dir, cache_map)
+        :returns: a dict mapping each of the file handle ids to the path of an unmodified cached copy of its file or
+                  None if there is none
+        """
+        cache_dirs = collections.OrderedDict(
+            (file_handle_id, self.get_cache_dir(file_handle_id)) for file_handle_id in file_handle_ids
+        )
+
+        def get_from_fanout_dir(fanout_dir, cache_dirs):
+            if fanout_dir is not None and not self._index.exists(fanout_dir):
+                return {}
+            cache_maps = self._index.read_many(set(cache_dirs.values()))
+            return {
+                file_handle_id: self._get_from_cache_map(cache_dir, cache_maps[cache_dir], path, remove_stale=False)
+                for file_handle_id, cache_dir in cache_dirs.items()
+            }
+
+        found = dict.fromkeys(cache_dirs)
+        for cached_file_paths in self._map_fanout_dirs(get_from_fanout_dir, cache_dirs, max_threads):
+            found.update(cached_file_paths)
+
+        self._index.touch_many([
+            (cache_dirs[file_handle_id], cached_file_path)
+            for file_handle_id, cached_file_path in found.items() if cached_file_path is not None
+        ])
+
+        if self.shared_tiers and not (path is not None and os.path.isfile(path)):
+            for file_handle_id, cached_file_path in found.items():
+                if cached_file_path is None:
+                    found[file_handle_id] = self._get_from_shared_tiers(file_handle_id)
+        return found
+
+    def _get_from_shared_tiers(self, file_handle_id):
+        """
+        Look for a file in the shared caches and copy the first unmodified copy found into the cache_root_dir.
 
-                    if matching_unmodified_directory is not None:
-                        return matching_unmodified_directory
+        :returns: the path of the copy in the cache_root_dir or None
+        """
+        for tier in self.shared_tiers:
+            try:
+                shared_file_path = tier._get_unlocked(file_handle_id)
+                if shared_file_path is None:
+                    continue
+                cache_dir = self.get_cache_dir(file_handle_id)
+                os.makedirs(cache_dir, exist_ok=True)
+                cached_file_path = _copy_atomically(
+                    shared_file_path, os.path.join(cache_dir, os.path.basename(shared_file_path))
+                )
+            except (OSError, ValueError) as ex:
+                # e.g. an unreadable file or a cache map caught halfway through being written
+                logging.getLogger(DEFAULT_LOGGER_NAME).warning(
+                    "Unable to read file handle %s from the shared cache at %s: %s",
+                    file_handle_id, tier.cache_root_dir, ex
+                )
+                continue
+            self.add(file_handle_id, cached_file_path)
+            return cached_file_path
+        return None
+
+    def _get_unlocked(self, file_handle_id):
+        """
+        Look up an unmodified cached copy of a file without taking the lock of its cache directory, which can't be
+        taken in a read-only cache. Stale entries are skipped rather than removed and the lookup isn't recorded.
 
-                # if we're given a full file path, look up a matching file in the cache
-                else:
-                    cached_time = cache_map.get(path, None)
-                    if cached_time:
-                        return path if compare_timestamps(_get_modified_time(path), cached_time) else None
+        :returns: the path of the cached copy or None
+        """
+        cache_dir = self.get_cache_dir(file_handle_id)
+        if not self._index.exists(cache_dir):
+            return None
+        cache_map = self._index.read_memoized(cache_dir)
+        if cache_map is None:
+            cache_map = self._read_cache_map(cache_dir)
+        return self._get_from_cache_map(cache_dir, cache_map, None, remove_stale=False)
 
-            # return most recently cached and unmodified file OR
-            # None if there are no unmodified files
-            for cached_file_path, cached_time in sorted(cache_map.items(), key=operator.itemgetter(1), reverse=True):
-                if compare_timestamps(_get_modified_time(cached_file_path), cached_time):
-                    return cached_file_path
+    def _publishing_tier(self):
+        """
+        :returns: the shared cache downloaded files are published to or None if there is none or it isn't writable
+        """
+        if not (self.publish and self.shared_tiers):
             return None
+        tier = self.shared_tiers[0]
+        # also False for a shared cache root directory that doesn't exist
+        return tier if os.access(tier.cache_root_dir, os.W_OK) else None
+
+    def _publish(self, file_handle_id, path):
+        """
+        Copy a downloaded file into the first shared cache, a read-only shared cache is skipped with a warning.
+        """
+        if not (self.publish and self.shared_tiers):
+            return
+        tier = self._publishing_tier()
+        if tier is None:
+            logging.getLogger(DEFAULT_LOGGER_NAME).warning(
+                "Unable to publish %s to the shared cache at %s: it is missing or read-only",
+                path, self.shared_tiers[0].cache_root_dir
+            )
+            return
+        try:
+            if tier.get(file_handle_id) is not None:
+                return
+            cache_dir = tier.get_cache_dir(file_handle_id)
+            os.makedirs(cache_dir, exist_ok=True)
+            tier.add(file_handle_id, _copy_atomically(path, os.path.join(cache_dir, os.path.basename(path))))
+        except (OSError, SynapseFileCacheError) as ex:
+            logging.getLogger(DEFAULT_LOGGER_NAME).warning(
+                "Unable to publish %s to the shared cache at %s: %s", path, tier.cache_root_dir, ex
+            )
+
+    def _map_fanout_dirs(self, func, items, max_threads):
+        """
+        Call func(fanout_dir, items) with the items of each fanout directory, concurrently when the index benefits from
+        it, otherwise once with every item and a fanout_dir of None.
 
-    def add(self, file_handle_id, path):
+        :param items:   a dict whose values are cache directories
+        """
+        if not self._index.parallel:
+            return [func(None, items)]
+
+        by_fanout_dir = collections.OrderedDict()
+        for key, cache_dir in items.items():
+            by_fanout_dir.setdefault(os.path.dirname(cache_dir), collections.OrderedDict())[key] = cache_dir
+        if len(by_fanout_dir) < 2:
+            return [func(fanout_dir, fanout_items) for fanout_dir, fanout_items in by_fanout_dir.items()]
+
+        executor = pool_provider.get_executor(thread_count=max_threads or pool_provider.DEFAULT_NUM_THREADS)
+        try:
+            return list(executor.map(lambda fanout_item: func(*fanout_item), by_fanout_dir.items()))
+        finally:
+            executor.shutdown()
+
+    def _get_from_cache_map(self, cache_dir, cache_map, path, remove_stale=True):
+        path = utils.normalize_path(path)
+
+        # If the caller specifies a path and that path exists in the cache
+        # but has been modified, we need to indicate no match by returning
+        # None. The logic for updating a synapse entity depends on this to
+        # determine the need to upload a new file.
+
+        if path is not None:
+            # If we're given a path to a directory, look for a cached file in that directory
+            if os.path.isdir(path):
+                matching_unmodified_directory = None
+                removed_entry_from_cache = False  # determines if cache_map needs to be rewritten to disk
+
+                # iterate a copy of cache_map to allow modifying original cache_map
+                for cached_file_path, cached_time in dict(cache_map).items():
+                    if path == os.path.dirname(cached_file_path):
+                        # compare_timestamps has an implicit check for whether the path exists
+                        if compare_timestamps(_get_modified_time(cached_file_path), cached_time):
+                            # "break" instead of "return" to write removed invalid entries to disk if necessary
+                            matching_unmodified_directory = cached_file_path
+                            break
+                        else:
+                            # remove invalid cache entries pointing to files that that no longer exist
+                            # or have been modified
+                            del cache_map[cached_file_path]
+                            removed_entry_from_cache = True
+
+                if removed_entry_from_cache and remove_stale:
+                    # write cache_map with non-existent entries removed
+                    self._write_cache_map(cache_dir, cache_map)
+
+                if matching_unmodified_directory is not None:
+                    return matching_unmodified_directory
+
+            # if we're given a full file path, look up a matching file in the cache
+            else:
+                cached_time = cache_map.get(path, None)
+                if cached_time:
+                    return path if compare_timestamps(_get_modified_time(path), cached_time) else None
+
+        # return most recently cached and unmodified file OR
+        # None if there are no unmodified files
+        for cached_file_path, cached_time in sorted(cache_map.items(), key=operator.itemgetter(1), reverse=True):
+            if compare_timestamps(_get_modified_time(cached_file_path), cached_time):
+                return cached_file_path
+        return None
+
+    def get_by_md5(self, md5):
+        """
+        Find an unmodified cached copy of a file by the MD5 of its content, regardless of the file handle it was
+        cached under. Only the sqlite cache index records MD5s.
+
+        :param md5: hex digest of the MD5 of the content
+
+        :returns: the path to a cached copy of the content or None
+        """
+        if md5 is None:
+            return None
+
+        for cached_file_path, cached_time in self._index.find_by_md5(md5):
+            if compare_timestamps(_get_modified_time(cached_file_path), cached_time):
+                return cached_file_path
+        return None
+
+    def md5_for_file(self, path):
+        """
+        Calculate the MD5 of the content of a file, reusing the MD5 recorded when the file was last downloaded,
+        uploaded or hashed for as long as its modification time, size and inode are unchanged.
+
+        :param path: path to the file
+
+        :returns: the hex digest of the MD5
+        """
+        path = utils.normalize_path(path)
+        # stat before reading so that a file modified while it is hashed won't match its digest
+        stat = os.stat(path)
+        digest = self._index.get_file_digest(path)
+        if digest is not None \
+                and (digest['modified_time_ns'], digest['size'], digest['inode']) == _file_signature(stat) \
+                and digest['recorded_on'] - stat.st_mtime >= RACY_WINDOW:
+            return digest['md5']
+
+        md5 = utils.md5_for_file(path).hexdigest()
+        self._record_file_md5(path, md5, stat)
+        return md5
+
+    def _record_file_md5(self, path, md5, stat=None):
+        stat = stat or os.stat(path)
+        modified_time_ns, size, inode = _file_signature(stat)
+        self._index.set_file_digest(path, dict(md5=md5, modified_time_ns=modified_time_ns, size=size, inode=inode,
+                                               recorded_on=time.time()))
+
+    def link_or_copy(self, cached_file_path, destination):
+        """
+        Put a copy of a cached file at destination, sharing the bytes with the cached copy where possible.
+        Files are only hard linked if the cache was created with hardlink set and they are in the cache_root_dir,
+        files outside it belong to the user.
+
+        :returns: destination
+        """
+        in_cache = utils.normalize_path(cached_file_path).startswith(utils.normalize_path(self.cache_root_dir) + '/')
+        return link_or_copy(cached_file_path, destination, hardlink=self.hardlink and in_cache)
+
+    def download_once(self, file_handle_id, destination, download):
+        """
+        Download a file unless another thread of this process or another process sharing the cache is already
+        downloading the same file handle, in which case wait for it to finish and use its cached copy instead.
+        Downloaded files are published to the shared cache, if any.
+
+        :param file_handle_id:
+        :param destination: path to download the file to
+        :param download:    function that downloads the file to destination, adds it to the cache and returns the
+                            path of the downloaded file
+
+        :returns: the path of the downloaded file
+        """
+        key = str(file_handle_id)
+        with self._in_flight_lock:
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                future = concurrent.futures.Future()
+                self._in_flight[key] = (destination, future)
+
+        if in_flight is not None:
+            in_flight_destination, in_flight_future = in_flight
+            try:
+                downloaded_path = in_flight_future.result()
+            except Exception:
+                # their download failed, try it ourselves
+                return self.download_once(file_handle_id, destination, download)
+            if utils.equal_paths(in_flight_destination, destination):
+                return downloaded_path
+            return self._copy_from_cache(file_handle_id, destination) or download()
+
+        try:
+            with self._download_claim(file_handle_id) as waited:
+                # another process may have downloaded it while we waited
+                downloaded_path = waited and self._copy_from_cache(file_handle_id, destination)
+                if not downloaded_path:
+                    downloaded_path = download()
+                    self._publish(file_handle_id, downloaded_path)
+            future.set_result(downloaded_path)
+            return downloaded_path
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+
+    @contextlib.contextmanager
+    def _download_claim(self, file_handle_id):
+        """
+        Held by the one process sharing the cache that downloads a file handle, yields whether another process held it
+        first and so may have downloaded the file already. Taken in the shared cache when publishing to one.
+        """
+        claim_cache = self._publishing_tier() or self
+        lock = get_lock(claim_cache.lock_type, claim_cache.cache_map_file_name + '.download',
+                        dir=claim_cache.get_cache_dir(file_handle_id))
+        waited = not lock.acquire()
+        if waited:
+            try:
+                lock.blocking_acquire(timeout=DOWNLOAD_WAIT_TIMEOUT)
+            except SynapseFileCacheError:
+                # don't wait any longer, download it as well
+                yield True
+                return
+
+        stop = threading.Event()
+        heartbeat = None
+        if claim_cache.lock_type == LOCK_TYPE_MKDIR:
+            # a mkdir lock is broken once it gets old, keep it young so only the lock of a dead process is broken
+            heartbeat = threading.Thread(target=_renew_until, args=(lock, stop), daemon=True)
+            heartbeat.start()
+        try:
+            yield waited
+        finally:
+            stop.set()
+            if heartbeat is not None:
+                heartbeat.join()
+            lock.release()
+
+    def _copy_from_cache(self, file_handle_id, destination):
+        """
+        :returns: destination after linking or copying an unmodified cached copy of the file there or None if there is
+                  no such copy
+        """
+        cached_file_path = self.get(file_handle_id, destination)
+        if cached_file_path is None:
+            return None
+        if not utils.equal_paths(cached_file_path, destination):
+            self.link_or_copy(cached_file_path, destination)
+            self.add(file_handle_id, destination)
+        return destination
+
+    def add(self, file_handle_id, path, md5=None):
         """
         Add a file to the cache
+
+        :param file_handle_id:
+        :param path:    path to the file
+        :param md5:     the MD5 of the content of the file if known, makes the content findable by get_by_md5
         """
         if not path or not os.path.exists(path):
             raise ValueError("Can't find file \"%s\"" % path)
 
         cache_dir = self.get_cache_dir(file_handle_id)
-        with Lock(self.cache_map_file_name, dir=cache_dir):
+        with self._index.lock(cache_dir):
             cache_map = self._read_cache_map(cache_dir)
 
             path = utils.normalize_path(path)
             # write .000 milliseconds for backward compatibility
             cache_map[path] = epoch_time_to_iso(math.floor(_get_modified_time(path)))
             self._write_cache_map(cache_dir, cache_map)
+            if md5 is not None:
+                self._index.set_md5(cache_dir, path, md5)
+        if md5 is not None:
+            self._record_file_md5(path, md5)
 
+        self._prune_in_background_if_full()
         return cache_map
 
+    def add_many(self, files, max_threads=None):
+        """
+        Add many files to the cache at once, equivalent to calling :py:meth:`add` for each of them. Cache directories
+        are updated a fanout directory at a time, concurrently across a thread pool, or all within a single
+        transaction with the "sqlite" index.
+
+        :param files:       (file handle id, path to the file) pairs
+        :param max_threads: the number of fanout directories to update concurrently
+        """
+        paths = collections.OrderedDict()
+        for file_handle_id, path in files:
+            if not path or not os.path.exists(path):
+                raise ValueError("Can't find file \"%s\"" % path)
+            paths.setdefault(self.get_cache_dir(file_handle_id), []).append(utils.normalize_path(path))
+        cache_dirs = collections.OrderedDict((cache_dir, cache_dir) for cache_dir in paths)
+
+        def add_to_fanout_dir(fanout_dir, cache_dirs):
+            with self._index.batch():
+                for cache_dir in cache_dirs:
+                    with self._index.lock(cache_dir):
+                        cache_map = self._read_cache_map(cache_dir)
+                        for path in paths[cache_dir]:
+                            # write .000 milliseconds for backward compatibility
+                            cache_map[path] = epoch_time_to_iso(math.floor(_get_modified_time(path)))
+                        self._write_cache_map(cache_dir, cache_map)
+
+        self._map_fanout_dirs(add_to_fanout_dir, cache_dirs, max_threads)
+        self._prune_in_background_if_full()
+
     def remove(self, file_handle_id, path=None, delete=None):
         """
         Remove a file from the cache.
@@ -241,7 +763,7 @@ class Cache:
         if path is None and isinstance(file_handle_id, collections.abc.Mapping) and 'path' in file_handle_id:
             path = file_handle_id['path']
 
-        with Lock(self.cache_map_file_name, dir=cache_dir):
+        with self._index.lock(cache_dir):
             cache_map = self._read_cache_map(cache_dir)
 
             if path is None:
@@ -260,40 +782,77 @@ class Cache:
 
             self._write_cache_map(cache_dir, cache_map)
 
+        for path in removed:
+            self._index.remove_file_digest(path)
+
         return removed
 
-    def _cache_dirs(self):
+    def _prune_in_background_if_full(self):
+        if self.max_size is None:
+            return
+
+        cache_size = self._index.cache_size()
+        if cache_size is None or cache_size <= self.max_size:
+            return
+
+        with self._pruner_lock:
+            # one pruner at a time is enough, a running one will keep going until the cache fits
+            if self._pruner is None or not self._pruner.is_alive():
+                self._pruner = threading.Thread(target=self.prune, name='synapse-cache-pruner', daemon=True)
+                self._pruner.start()
+
+    def prune(self, max_size=None, dry_run=False):
         """
-        Generate a list of all cache dirs, directories of the form:
-        [cache.cache_root_dir]/949/59949
+        Evict the least recently used files from the cache until the files stored in the cache_root_dir take up no more
+        than max_size bytes. Files stored outside the cache_root_dir are never deleted, and neither are files used
+        within the last EVICTION_GRACE_PERIOD seconds.
+
+        :param max_size:    the size in bytes to shrink the cache to, defaults to the max_size of the cache
+        :param dry_run:     print the paths of the files that would be evicted instead of deleting them
+
+        :returns: the number of files evicted
         """
-        for item1 in os.listdir(self.cache_root_dir):
-            path1 = os.path.join(self.cache_root_dir, item1)
-            if os.path.isdir(path1) and re.match('\\d+', item1):
-                for item2 in os.listdir(path1):
-                    path2 = os.path.join(path1, item2)
-                    if os.path.isdir(path2) and re.match('\\d+', item2):
-                        yield path2
+        max_size = self.max_size if max_size is None else max_size
+        cache_size = self._index.cache_size()
+        if max_size is None or cache_size is None or cache_size <= max_size:
+            return 0
+
+        entries = self._index.lru_entries()
+        # the running total may count a file cached under several file handles more than once
+        cache_size = sum(size or 0 for _, size, _ in entries)
+
+        count = 0
+        evict_before = time.time() - EVICTION_GRACE_PERIOD
+        for path, size, last_accessed in entries:
+            if cache_size <= max_size or last_accessed > evict_before:
+                break
+
+            if dry_run:
+                print(path)
+            else:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                self._index.remove_path(path)
+
+            cache_size -= size or 0
+            count += 1
+        return count
 
-    def purge(self, before_date, dry_run=False):
+    def purge(self, before_date, dry_run=False, max_threads=None):
         """
         Purge the cache. Use with caution. Delete files whose cache maps were last updated prior to the given date.
 
         Deletes .cacheMap files and files stored in the cache.cache_root_dir, but does not delete files stored outside
-        the cache.
+        the cache. See :py:func:`synapseclient.core.cache_maintenance.purge` for other criteria.
+
+        :param max_threads: the number of fanout directories to scan and purge concurrently
         """
-        if isinstance(before_date, datetime.datetime):
-            before_date = utils.to_unix_epoch_time_secs(before_date)
-        count = 0
-        for cache_dir in self._cache_dirs():
-            # _get_modified_time returns None if the cache map file doesn't
-            # exist and n > None evaluates to True in python 2.7(wtf?). I'm guessing it's
-            # OK to purge directories in the cache that have no .cacheMap file
-            last_modified_time = _get_modified_time(os.path.join(cache_dir, self.cache_map_file_name))
-            if last_modified_time is None or before_date > last_modified_time:
-                if dry_run:
-                    print(cache_dir)
-                else:
-                    shutil.rmtree(cache_dir)
-                count += 1
-        return count
+        from synapseclient.core import cache_maintenance
+
+        purged = cache_maintenance.purge(self, before_date=before_date, dry_run=dry_run, max_threads=max_threads)
+        if dry_run:
+            for cache_dir in purged:
+                print(cache_dir)
+        return len(purged)
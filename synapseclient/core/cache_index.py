@@ -0,0 +1,767 @@
+# Note: Even though this has Sphinx format, this is not meant to be part of the public docs
+
+"""
+*****************
+File Cache Index
+*****************
+
+Storage backends for the index that maps file handle IDs to the locations of cached copies of their files.
+
+Two backends are available:
+
+* :py:class:`CacheMapIndex` stores a JSON ``.cacheMap`` file in every ``[fanout]/[file handle id]`` cache directory.
+  This is the original layout and is shared with the R client and older versions of this client.
+* :py:class:`SqliteCacheIndex` stores every entry in a single WAL mode SQLite database at the root of the cache.
+  Lookups cost a single indexed query instead of a lock directory, an open and a JSON parse per file handle,
+  and many file handles can be resolved within one transaction. Existing ``.cacheMap`` files are imported the
+  first time their file handle is looked up.
+
+This is part of the internal implementation of the client and should not be accessed directly by users of the client.
+"""
+
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+
+try:
+    import sqlite3
+except ImportError:
+    # some minimal python builds ship without sqlite, the .cacheMap index is always available
+    sqlite3 = None
+
+from synapseclient.core import utils
+from synapseclient.core.lock import LOCK_TYPE_MKDIR, get_lock
+
+
+CACHE_MAP_FILE_NAME = '.cacheMap'
+SQLITE_INDEX_FILE_NAME = '.cacheIndex.sqlite'
+
+FILE_DIGESTS_DIR_NAME = '.fileDigests'
+
+# a file modified within this many seconds of being read isn't trusted to be unchanged while its stat is, file systems
+# with a coarse modification time could otherwise hide a second write made within the same tick
+RACY_WINDOW = 2
+
+CACHE_INDEX_CACHE_MAP = 'cachemap'
+CACHE_INDEX_SQLITE = 'sqlite'
+CACHE_INDEX_TYPES = (CACHE_INDEX_CACHE_MAP, CACHE_INDEX_SQLITE)
+
+# seconds a connection will wait on a database locked by another process before giving up
+SQLITE_BUSY_TIMEOUT = 70
+
+# the access time of a cache entry is only rewritten once it is off by this many seconds, so that looking up recently
+# used files doesn't take the database write lock every time. Far finer than evicting the least recently used needs.
+ACCESS_TIME_RESOLUTION = 60
+
+# the number of host parameters bound into a single IN (...) clause, well under SQLite's default limit of 999
+_SQLITE_MAX_BATCH_SIZE = 500
+
+
+def _file_handle_id_of_cache_dir(cache_dir):
+    # cache dirs are always of the form [cache_root_dir]/[fanout]/[file handle id]
+    return int(os.path.basename(os.path.normpath(cache_dir)))
+
+
+def _get_file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+@contextlib.contextmanager
+def _no_lock():
+    yield
+
+
+def _batches(items, batch_size):
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+
+class CacheMapMemo:
+    """
+    A thread safe, in-memory memo of parsed cache map files bounded to the given number of entries, least recently
+    used entries are dropped first. An entry is only valid while the modification time, inode and size of its file
+    are unchanged so a hit costs a stat instead of a lock, an open and a JSON parse.
+
+    :param max_entries: the maximum number of cache maps to hold
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _signature(stat):
+        return stat.st_mtime_ns, stat.st_ino, stat.st_size
+
+    def get(self, cache_map_file):
+        """
+        :returns: a copy of the memoized cache map or None if it isn't memoized or the file changed since
+        """
+        try:
+            stat = os.stat(cache_map_file)
+        except FileNotFoundError:
+            self.forget(cache_map_file)
+            return {}
+
+        with self._lock:
+            entry = self._entries.get(cache_map_file)
+            if entry is None or entry[0] != self._signature(stat):
+                return None
+            self._entries.move_to_end(cache_map_file)
+            return dict(entry[1])
+
+    def put(self, cache_map_file, stat, cache_map):
+        """
+        Memoize the cache map parsed from or written to a file with the given stat result.
+        """
+        if time.time() - stat.st_mtime < RACY_WINDOW:
+            self.forget(cache_map_file)
+            return
+
+        with self._lock:
+            self._entries[cache_map_file] = (self._signature(stat), dict(cache_map))
+            self._entries.move_to_end(cache_map_file)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def forget(self, cache_map_file):
+        with self._lock:
+            self._entries.pop(cache_map_file, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class CacheMapIndex:
+    """
+    Stores the cache map of each file handle in a JSON file within its cache directory.
+    Concurrent access is coordinated through a lock per cache directory (see
+    :py:func:`synapseclient.core.lock.get_lock`), all clients sharing a cache must use the same type of lock.
+
+    :param cache_map_file_name: name of the cache map file within each cache directory
+    :param lock_type:           type of lock used to coordinate access to the cache map files
+    :param memo_size:           number of parsed cache maps to memoize in memory (see :py:class:`CacheMapMemo`),
+                                0 to always read them from disk
+    :param cache_root_dir:      the root of the cache, file digests are kept in a directory within it.
+                                None to not keep file digests.
+    """
+
+    def __init__(self, cache_map_file_name=CACHE_MAP_FILE_NAME, lock_type=LOCK_TYPE_MKDIR, memo_size=0,
+                 cache_root_dir=None):
+        self.cache_map_file_name = cache_map_file_name
+        self.lock_type = lock_type
+        self.cache_root_dir = cache_root_dir
+        self._memo = CacheMapMemo(memo_size) if memo_size > 0 else None
+
+    # every cache directory is read on its own, many of them are best read concurrently
+    parallel = True
+
+    def lock(self, cache_dir, shared=False):
+        return get_lock(self.lock_type, self.cache_map_file_name, dir=cache_dir, shared=shared)
+
+    def batch(self):
+        """
+        Group many writes to different cache directories, each cache directory is still locked on its own.
+        """
+        return _no_lock()
+
+    def exists(self, cache_dir):
+        """
+        Cheap check whether the cache directory may hold any entries at all.
+        """
+        return os.path.exists(cache_dir)
+
+    def read(self, cache_dir):
+        cache_map_file = os.path.join(cache_dir, self.cache_map_file_name)
+
+        if not os.path.exists(cache_map_file):
+            return {}
+
+        with open(cache_map_file, 'r') as f:
+            stat = os.fstat(f.fileno())
+            cache_map = json.load(f)
+        if self._memo is not None:
+            self._memo.put(cache_map_file, stat, cache_map)
+        return cache_map
+
+    def read_memoized(self, cache_dir):
+        """
+        Read a cache map without taking its lock, only possible when an up to date copy of it is memoized.
+
+        :returns: the cache map or None if it has to be read from disk under its lock
+        """
+        if self._memo is None:
+            return None
+        return self._memo.get(os.path.join(cache_dir, self.cache_map_file_name))
+
+    def read_many(self, cache_dirs):
+        """
+        :returns: a dict mapping each of the given cache directories to its cache map
+        """
+        cache_maps = {}
+        for cache_dir in cache_dirs:
+            if not self.exists(cache_dir):
+                cache_maps[cache_dir] = {}
+                continue
+
+            cache_map = self.read_memoized(cache_dir)
+            if cache_map is None:
+                with self.lock(cache_dir):
+                    cache_map = self.read(cache_dir)
+            cache_maps[cache_dir] = cache_map
+        return cache_maps
+
+    def write(self, cache_dir, cache_map):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        cache_map_file = os.path.join(cache_dir, self.cache_map_file_name)
+
+        with open(cache_map_file, 'w') as f:
+            json.dump(cache_map, f)
+            f.write('\n')  # For compatibility with R's JSON parser
+        if self._memo is not None:
+            self._memo.put(cache_map_file, os.stat(cache_map_file), cache_map)
+
+    def last_modified(self, cache_dir):
+        """
+        :returns: the time in seconds since the unix epoch at which the cache map was last written or None
+        """
+        cache_map_file = os.path.join(cache_dir, self.cache_map_file_name)
+        if os.path.exists(cache_map_file):
+            return os.path.getmtime(cache_map_file)
+        return None
+
+    def remove_dir(self, cache_dir):
+        """
+        Forget every entry of a cache directory which is about to be deleted. The .cacheMap is deleted along with it.
+        """
+        if self._memo is not None:
+            self._memo.forget(os.path.join(cache_dir, self.cache_map_file_name))
+
+    def touch(self, cache_dir, path):
+        """
+        Record that the cached copy of a file at path was just used.
+        """
+        pass
+
+    def touch_many(self, entries):
+        """
+        Record that the cached copies of many files were just used, see :py:meth:`touch`.
+
+        :param entries: (cache directory, path) pairs
+        """
+        pass
+
+    def cache_size(self):
+        """
+        :returns: the total size in bytes of the files stored within the cache root or None if it isn't tracked
+        """
+        return None
+
+    def lru_entries(self):
+        """
+        :returns: (path, size, last access time) of every file stored within the cache root, least recently used first
+        """
+        return []
+
+    def remove_path(self, path):
+        """
+        Forget all entries of the file at path.
+        """
+        self.remove_file_digest(path)
+
+    def set_md5(self, cache_dir, path, md5):
+        """
+        Record the MD5 of the content of a cached file.
+        """
+        pass
+
+    def get_md5(self, cache_dir, path):
+        """
+        :returns: the MD5 recorded for the content of a cached file or None
+        """
+        return None
+
+    def file_handle_ids(self):
+        """
+        :returns: the ids of the file handles with entries that are not stored in a cache directory of their own,
+                  those are found by scanning the cache
+        """
+        return []
+
+    def find_by_md5(self, md5):
+        """
+        .cacheMap files don't record the MD5s of the files, finding cached files by their content requires the sqlite
+        index.
+
+        :returns: an empty list
+        """
+        return []
+
+    def _file_digest_path(self, path):
+        key = hashlib.sha1(path.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_root_dir, FILE_DIGESTS_DIR_NAME, key[:2], key + '.json')
+
+    def get_file_digest(self, path):
+        """
+        :returns: the digest last recorded for the file at path as a dict of its md5, modified_time_ns, size, inode
+                  and recorded_on or None
+        """
+        if self.cache_root_dir is None:
+            return None
+        try:
+            with open(self._file_digest_path(path), 'r') as f:
+                digest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return digest if digest.get('path') == path else None
+
+    def set_file_digest(self, path, digest):
+        """
+        Record the digest of the file at path, see :py:meth:`get_file_digest`.
+        """
+        if self.cache_root_dir is None:
+            return
+        digest_path = self._file_digest_path(path)
+        os.makedirs(os.path.dirname(digest_path), exist_ok=True)
+
+        # digests are replaced atomically so they can be read without a lock
+        temp_path = '%s.%d.%d' % (digest_path, os.getpid(), threading.get_ident())
+        with open(temp_path, 'w') as f:
+            json.dump(dict(digest, path=path), f)
+        os.replace(temp_path, digest_path)
+
+    def remove_file_digest(self, path):
+        """
+        Forget the digest recorded for the file at path, e.g. once it is no longer cached.
+        """
+        if self.cache_root_dir is None:
+            return
+        digest_path = self._file_digest_path(path)
+        try:
+            with open(digest_path, 'r') as f:
+                digest = json.load(f)
+        except (OSError, ValueError):
+            return
+        # a hash collision doesn't remove the digest of another path
+        if digest.get('path') == path:
+            _remove_if_exists(digest_path)
+
+    def remove_missing_file_digests(self):
+        """
+        Forget the digests recorded for files that no longer exist.
+
+        :returns: the number of digests removed
+        """
+        if self.cache_root_dir is None:
+            return 0
+        removed = 0
+        digests_dir = os.path.join(self.cache_root_dir, FILE_DIGESTS_DIR_NAME)
+        for dir_path, _, file_names in os.walk(digests_dir):
+            for file_name in file_names:
+                if not file_name.endswith('.json'):
+                    # being written
+                    continue
+                digest_path = os.path.join(dir_path, file_name)
+                try:
+                    with open(digest_path, 'r') as f:
+                        path = json.load(f).get('path')
+                except OSError:
+                    continue
+                except ValueError:
+                    path = None
+                if path is None or not os.path.exists(path):
+                    _remove_if_exists(digest_path)
+                    removed += 1
+        return removed
+
+    def close(self):
+        if self._memo is not None:
+            self._memo.clear()
+
+
+class SqliteCacheIndex:
+    """
+    Stores the cache maps of all file handles in a single SQLite database in WAL mode so that readers never block
+    writers. Each thread (and each forked process) uses its own connection, writes are serialized by SQLite.
+
+    Alongside the modification time that makes up a cache map entry the size of the file, the last time the entry was
+    used and whether the file is stored within the cache root are recorded, which makes it possible to bound the size
+    of the cache. Entries are also indexed by the MD5 of their content, when known, so that a file can be found in
+    the cache by its content regardless of the file handle it was cached under. Looking up an entry only takes the
+    database write lock when its last use is recorded, at most every ACCESS_TIME_RESOLUTION seconds.
+
+    :param db_path:                 path to the SQLite database file, created if it does not exist. Files within the
+                                    directory containing the database are considered stored in the cache.
+    :param cache_map_file_name:     name of the legacy cache map files to import
+    """
+
+    # each item upgrades the schema by one version, the version of a database is kept in its user_version
+    SCHEMA_VERSIONS = [
+        [
+            """
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                file_handle_id INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                modified_time TEXT NOT NULL,
+                size INTEGER,
+                md5 TEXT,
+                PRIMARY KEY (file_handle_id, path)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS cache_entries_path ON cache_entries (path)",
+            """
+            CREATE TABLE IF NOT EXISTS cache_dirs (
+                file_handle_id INTEGER PRIMARY KEY,
+                updated_on REAL NOT NULL
+            )
+            """,
+        ],
+        [
+            "ALTER TABLE cache_entries ADD COLUMN accessed_on REAL",
+            "ALTER TABLE cache_entries ADD COLUMN in_cache INTEGER NOT NULL DEFAULT 0",
+            "UPDATE cache_entries SET in_cache = in_cache_root(path)",
+            "CREATE INDEX cache_entries_lru ON cache_entries (in_cache, accessed_on)",
+
+            # the total size of the files within the cache root is maintained as entries change
+            "CREATE TABLE cache_stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+            """
+            INSERT INTO cache_stats (name, value)
+            SELECT 'size', COALESCE(SUM(size), 0) FROM cache_entries WHERE in_cache
+            """,
+            """
+            CREATE TRIGGER cache_entries_size_insert AFTER INSERT ON cache_entries WHEN NEW.in_cache
+            BEGIN
+                UPDATE cache_stats SET value = value + COALESCE(NEW.size, 0) WHERE name = 'size';
+            END
+            """,
+            """
+            CREATE TRIGGER cache_entries_size_delete AFTER DELETE ON cache_entries WHEN OLD.in_cache
+            BEGIN
+                UPDATE cache_stats SET value = value - COALESCE(OLD.size, 0) WHERE name = 'size';
+            END
+            """,
+            """
+            CREATE TRIGGER cache_entries_size_update AFTER UPDATE OF size, in_cache ON cache_entries
+            BEGIN
+                UPDATE cache_stats
+                SET value = value - (CASE WHEN OLD.in_cache THEN COALESCE(OLD.size, 0) ELSE 0 END)
+                                  + (CASE WHEN NEW.in_cache THEN COALESCE(NEW.size, 0) ELSE 0 END)
+                WHERE name = 'size';
+            END
+            """,
+        ],
+        [
+            "CREATE INDEX cache_entries_md5 ON cache_entries (md5)",
+        ],
+        [
+            # the MD5 of any file by path, whether or not it is cached, valid while its stat is unchanged
+            """
+            CREATE TABLE file_digests (
+                path TEXT PRIMARY KEY,
+                md5 TEXT NOT NULL,
+                modified_time_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                recorded_on REAL NOT NULL
+            )
+            """,
+        ],
+    ]
+
+    def __init__(self, db_path, cache_map_file_name=CACHE_MAP_FILE_NAME):
+        if sqlite3 is None:
+            raise ImportError("The sqlite3 module is not available in this python installation")
+        self.db_path = db_path
+        self.cache_map_file_name = cache_map_file_name
+        self._cache_root_prefix = utils.normalize_path(os.path.dirname(db_path)) + '/'
+        self._local = threading.local()
+
+        # fail fast (so the caller can fall back to the .cacheMap layout) if the database can't be used
+        with self._transaction() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for statements in self.SCHEMA_VERSIONS[version:]:
+                for statement in statements:
+                    conn.execute(statement)
+            conn.execute('PRAGMA user_version = %d' % len(self.SCHEMA_VERSIONS))
+
+    def _in_cache_root(self, path):
+        return path.startswith(self._cache_root_prefix)
+
+    def _connection(self):
+        # connections must not be shared across threads nor survive a fork
+        pid = os.getpid()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != pid:
+            conn = sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.create_function('in_cache_root', 1, self._in_cache_root)
+            self._local.conn = conn
+            self._local.pid = pid
+            self._local.depth = 0
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self, shared=False):
+        """
+        A transaction that may be nested, only the outermost one begins and commits.
+
+        :param shared:  begin a read transaction that doesn't block other readers or writers instead of
+                        taking the database write lock up front
+        """
+        conn = self._connection()
+        if self._local.depth == 0:
+            conn.execute('BEGIN' if shared else 'BEGIN IMMEDIATE')
+        self._local.depth += 1
+        try:
+            yield conn
+        except BaseException:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                conn.execute('ROLLBACK')
+            raise
+        else:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                conn.execute('COMMIT')
+
+    # a single query resolves many cache directories at once
+    parallel = False
+
+    def lock(self, cache_dir, shared=False):
+        # every read is a consistent snapshot on its own, only read-modify-write sequences need the write lock
+        return _no_lock() if shared else self._transaction()
+
+    def batch(self):
+        """
+        Group many writes to different cache directories into a single transaction.
+        """
+        return self._transaction()
+
+    def exists(self, cache_dir):
+        # the database holds entries for files stored outside the cache as well, so there is no directory to check
+        return True
+
+    def _unknown_file_handle_ids(self, conn, file_handle_ids):
+        unknown = set(file_handle_ids)
+        for batch in _batches(list(file_handle_ids), _SQLITE_MAX_BATCH_SIZE):
+            unknown.difference_update(row[0] for row in conn.execute(
+                'SELECT file_handle_id FROM cache_dirs WHERE file_handle_id IN (%s)' % ','.join('?' * len(batch)),
+                batch))
+        return unknown
+
+    def _migrate(self, by_file_handle_id, always_record=False):
+        """
+        Imports the legacy .cacheMap of every given file handle not yet known to the database.
+
+        :param by_file_handle_id:   a dict mapping file handle ids to their cache directories
+        :param always_record:       record file handles that have no .cacheMap as known as well.
+                                    Reads don't so that a lookup of an uncached file handle never takes the
+                                    database write lock.
+        """
+        legacy = CacheMapIndex(self.cache_map_file_name)
+        conn = self._connection()
+        if self._local.depth == 0:
+            unknown = self._unknown_file_handle_ids(conn, by_file_handle_id)
+            candidates = {
+                file_handle_id: by_file_handle_id[file_handle_id] for file_handle_id in unknown
+                if always_record or legacy.last_modified(by_file_handle_id[file_handle_id]) is not None
+            }
+        else:
+            candidates = by_file_handle_id
+        if not candidates:
+            return
+
+        with self._transaction() as conn:
+            # check again now that we hold the write lock, another process may have beaten us to it
+            for file_handle_id in self._unknown_file_handle_ids(conn, candidates):
+                cache_dir = candidates[file_handle_id]
+                last_modified = legacy.last_modified(cache_dir)
+                if last_modified is None and not always_record:
+                    continue
+                cache_map = legacy.read(cache_dir) if last_modified is not None else {}
+                # files we know nothing about besides when they were cached are the first to go
+                conn.executemany(
+                    'INSERT OR IGNORE INTO cache_entries (file_handle_id, path, modified_time, size, in_cache)'
+                    ' VALUES (?, ?, ?, ?, ?)',
+                    [(file_handle_id, path, cached_time, _get_file_size(path), self._in_cache_root(path))
+                     for path, cached_time in cache_map.items()]
+                )
+                conn.execute('INSERT INTO cache_dirs (file_handle_id, updated_on) VALUES (?, ?)',
+                             (file_handle_id, last_modified or time.time()))
+
+    def read(self, cache_dir):
+        return self.read_many([cache_dir])[cache_dir]
+
+    def read_memoized(self, cache_dir):
+        """
+        SQLite keeps its own page cache, lookups always go through the database.
+        """
+        return None
+
+    def read_many(self, cache_dirs):
+        """
+        Looks up the cache maps of many cache directories within a single transaction.
+
+        :returns: a dict mapping each of the given cache directories to its cache map
+        """
+        by_file_handle_id = {_file_handle_id_of_cache_dir(cache_dir): cache_dir for cache_dir in cache_dirs}
+        cache_maps = {cache_dir: {} for cache_dir in cache_dirs}
+
+        self._migrate(by_file_handle_id)
+        with self._transaction(shared=True) as conn:
+            for batch in _batches(list(by_file_handle_id), _SQLITE_MAX_BATCH_SIZE):
+                rows = conn.execute(
+                    'SELECT file_handle_id, path, modified_time FROM cache_entries WHERE file_handle_id IN (%s)'
+                    % ','.join('?' * len(batch)),
+                    batch
+                )
+                for file_handle_id, path, modified_time in rows:
+                    cache_maps[by_file_handle_id[file_handle_id]][path] = modified_time
+        return cache_maps
+
+    def write(self, cache_dir, cache_map):
+        file_handle_id = _file_handle_id_of_cache_dir(cache_dir)
+        with self._transaction() as conn:
+            self._migrate({file_handle_id: cache_dir}, always_record=True)
+            existing = dict(conn.execute('SELECT path, modified_time FROM cache_entries WHERE file_handle_id = ?',
+                                         (file_handle_id,)))
+
+            conn.executemany('DELETE FROM cache_entries WHERE file_handle_id = ? AND path = ?',
+                             [(file_handle_id, path) for path in existing if path not in cache_map])
+            now = time.time()
+            for path, cached_time in cache_map.items():
+                if path not in existing:
+                    conn.execute('INSERT INTO cache_entries'
+                                 ' (file_handle_id, path, modified_time, size, accessed_on, in_cache)'
+                                 ' VALUES (?, ?, ?, ?, ?, ?)',
+                                 (file_handle_id, path, cached_time, _get_file_size(path), now,
+                                  self._in_cache_root(path)))
+                elif existing[path] != cached_time:
+                    # the file was modified so anything else we knew about its content is stale
+                    conn.execute('UPDATE cache_entries SET modified_time = ?, size = ?, md5 = NULL, accessed_on = ?'
+                                 ' WHERE file_handle_id = ? AND path = ?',
+                                 (cached_time, _get_file_size(path), now, file_handle_id, path))
+            conn.execute('UPDATE cache_dirs SET updated_on = ? WHERE file_handle_id = ?',
+                         (now, file_handle_id))
+
+    def touch(self, cache_dir, path):
+        self.touch_many([(cache_dir, path)])
+
+    def touch_many(self, entries):
+        # only entries whose access time is out of date take the write lock
+        now = time.time()
+        conn = self._connection()
+        outdated = []
+        for cache_dir, path in entries:
+            key = (_file_handle_id_of_cache_dir(cache_dir), path)
+            row = conn.execute('SELECT accessed_on FROM cache_entries WHERE file_handle_id = ? AND path = ?',
+                               key).fetchone()
+            if row is not None and (row[0] is None or abs(now - row[0]) >= ACCESS_TIME_RESOLUTION):
+                outdated.append((now,) + key)
+        if outdated:
+            with self._transaction() as conn:
+                conn.executemany('UPDATE cache_entries SET accessed_on = ? WHERE file_handle_id = ? AND path = ?',
+                                 outdated)
+
+    def cache_size(self):
+        return self._connection().execute("SELECT value FROM cache_stats WHERE name = 'size'").fetchone()[0]
+
+    def lru_entries(self):
+        # a file may be cached under more than one file handle (e.g. copied file handles), it's used when any is
+        return self._connection().execute(
+            'SELECT path, MAX(size), MAX(COALESCE(accessed_on, 0)) AS last_accessed FROM cache_entries'
+            ' WHERE in_cache GROUP BY path ORDER BY last_accessed'
+        ).fetchall()
+
+    def remove_path(self, path):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM cache_entries WHERE path = ?', (path,))
+            conn.execute('DELETE FROM file_digests WHERE path = ?', (path,))
+
+    def set_md5(self, cache_dir, path, md5):
+        with self._transaction() as conn:
+            conn.execute('UPDATE cache_entries SET md5 = ? WHERE file_handle_id = ? AND path = ?',
+                         (md5, _file_handle_id_of_cache_dir(cache_dir), path))
+
+    def file_handle_ids(self):
+        # entries of files stored outside the cache have no cache directory on disk
+        return [row[0] for row in self._connection().execute('SELECT DISTINCT file_handle_id FROM cache_entries')]
+
+    def get_md5(self, cache_dir, path):
+        row = self._connection().execute(
+            'SELECT md5 FROM cache_entries WHERE file_handle_id = ? AND path = ?',
+            (_file_handle_id_of_cache_dir(cache_dir), path)
+        ).fetchone()
+        return row[0] if row else None
+
+    def find_by_md5(self, md5):
+        return self._connection().execute(
+            'SELECT path, modified_time FROM cache_entries WHERE md5 = ? ORDER BY accessed_on DESC', (md5,)
+        ).fetchall()
+
+    def get_file_digest(self, path):
+        row = self._connection().execute(
+            'SELECT md5, modified_time_ns, size, inode, recorded_on FROM file_digests WHERE path = ?', (path,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('md5', 'modified_time_ns', 'size', 'inode', 'recorded_on'), row))
+
+    def set_file_digest(self, path, digest):
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO file_digests (path, md5, modified_time_ns, size, inode, recorded_on)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (path, digest['md5'], digest['modified_time_ns'], digest['size'], digest['inode'],
+                 digest['recorded_on'])
+            )
+
+    def remove_file_digest(self, path):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM file_digests WHERE path = ?', (path,))
+
+    def remove_missing_file_digests(self):
+        paths = [row[0] for row in self._connection().execute('SELECT path FROM file_digests')]
+        missing = [(path,) for path in paths if not os.path.exists(path)]
+        with self._transaction() as conn:
+            conn.executemany('DELETE FROM file_digests WHERE path = ?', missing)
+        return len(missing)
+
+    def last_modified(self, cache_dir):
+        file_handle_id = _file_handle_id_of_cache_dir(cache_dir)
+        row = self._connection().execute('SELECT updated_on FROM cache_dirs WHERE file_handle_id = ?',
+                                         (file_handle_id,)).fetchone()
+        if row:
+            return row[0]
+        return CacheMapIndex(self.cache_map_file_name).last_modified(cache_dir)
+
+    def remove_dir(self, cache_dir):
+        file_handle_id = _file_handle_id_of_cache_dir(cache_dir)
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM cache_entries WHERE file_handle_id = ?', (file_handle_id,))
+            conn.execute('DELETE FROM cache_dirs WHERE file_handle_id = ?', (file_handle_id,))
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
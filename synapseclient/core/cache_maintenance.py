@@ -0,0 +1,404 @@
+# Note: Even though this has Sphinx format, this is not meant to be part of the public docs
+
+"""
+*****************
+Cache Maintenance
+*****************
+
+Reporting on and cleaning up a :py:class:`synapseclient.core.cache.Cache`.
+
+The cache is scanned one fanout directory (``[cache_root_dir]/[file handle id modulo fanout]``) at a time across a
+thread pool, with :py:func:`os.scandir` so that the type and size of each file come along with the directory listing
+where the file system provides them. Each cache directory is reported as a :py:class:`CacheDirReport`:
+
+* entries are the (path, cached time) pairs of its cache map
+* stale entries are those whose file has since been deleted or modified
+* orphans are files stored in the cache directory that no unmodified entry refers to, e.g. left behind by an
+  interrupted download or by an entry that went stale. Files modified within the last
+  :py:data:`synapseclient.core.cache.EVICTION_GRACE_PERIOD` seconds may be downloads in progress and are never orphans.
+
+The integrity of cached files is checked by :py:func:`verify_checksums`, which re-hashes them against the MD5 recorded
+for them when they were downloaded or uploaded, i.e. the ``contentMd5`` of their file handle.
+
+This is part of the internal implementation of the client and should not be accessed directly by users of the client.
+"""
+
+import collections
+import datetime
+import os
+import shutil
+import threading
+import time
+
+from synapseclient.core import pool_provider, utils
+
+
+CacheDirReport = collections.namedtuple(
+    'CacheDirReport',
+    ['cache_dir', 'last_modified', 'size', 'entries', 'stale_entries', 'orphans']
+)
+CacheDirReport.__doc__ = """
+The state of a single cache directory.
+
+:param cache_dir:       path to the cache directory
+:param last_modified:   time in seconds since the unix epoch its cache map was last written or None
+:param size:            total size in bytes of the files stored within it
+:param entries:         dict of the path to the cached time of each of its entries
+:param stale_entries:   paths of its entries whose file was deleted or modified since it was cached
+:param orphans:         dict of the path to the size of each file stored within it but not referenced by an entry
+"""
+
+CacheStats = collections.namedtuple(
+    'CacheStats',
+    ['cache_dirs', 'entries', 'size', 'stale_entries', 'orphans', 'orphan_size']
+)
+CacheStats.__doc__ = """
+Totals over every cache directory, see :py:class:`CacheDirReport`.
+"""
+
+
+QUARANTINE_DIR_NAME = '.quarantine'
+VERIFY_JOURNAL_FILE_NAME = '.verifyJournal'
+
+
+class ChecksumReport(collections.namedtuple(
+    'ChecksumReport',
+    ['files', 'size', 'elapsed', 'mismatches', 'unverifiable', 'resumed_fanout_dirs']
+)):
+    """
+    The result of :py:func:`verify_checksums`.
+
+    :param files:               number of files re-hashed
+    :param size:                total size in bytes of the files re-hashed
+    :param elapsed:             seconds spent verifying
+    :param mismatches:          (path, expected md5, actual md5, quarantined path) of every cached file whose content no
+                                longer matches, the quarantined path is None for files stored outside the cache
+    :param unverifiable:        number of unmodified cached files without a recorded MD5
+    :param resumed_fanout_dirs: number of fanout directories skipped because an interrupted run already verified them
+    """
+
+    @property
+    def throughput(self):
+        """
+        :returns: the rate at which files were re-hashed in MB per second
+        """
+        return self.size / utils.MB / self.elapsed if self.elapsed else 0.0
+
+
+def _is_number(name):
+    return name.isdigit()
+
+
+def _scan_files(directory, skip_prefix):
+    """
+    Generate (path, stat) of every regular file below directory, except those whose name starts with skip_prefix.
+    """
+    try:
+        with os.scandir(directory) as it:
+            entries = list(it)
+    except FileNotFoundError:
+        return
+
+    for entry in entries:
+        if entry.name.startswith(skip_prefix):
+            continue
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scan_files(entry.path, skip_prefix)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.path, entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            # removed while we were looking at it
+            continue
+
+
+def _fanout_dirs(cache):
+    """
+    :returns: a dict of every fanout directory to the cache directories within it known to the index but not
+              necessarily present on disk
+    """
+    with os.scandir(cache.cache_root_dir) as it:
+        fanout_dirs = {entry.path: set() for entry in it if _is_number(entry.name) and entry.is_dir()}
+    for file_handle_id in cache._index.file_handle_ids():
+        cache_dir = cache.get_cache_dir(file_handle_id)
+        fanout_dirs.setdefault(os.path.dirname(cache_dir), set()).add(cache_dir)
+    return collections.OrderedDict(sorted(fanout_dirs.items()))
+
+
+def _scan_fanout_dir(cache, fanout_dir, known_cache_dirs=()):
+    from synapseclient.core.cache import EVICTION_GRACE_PERIOD, _get_modified_time, compare_timestamps
+
+    cache_dirs = set(known_cache_dirs)
+    try:
+        with os.scandir(fanout_dir) as it:
+            cache_dirs.update(entry.path for entry in it if _is_number(entry.name) and entry.is_dir())
+    except FileNotFoundError:
+        pass
+    cache_dirs = sorted(cache_dirs)
+
+    index = cache._index
+    cache_maps = index.read_many(cache_dirs)
+    recently = time.time() - EVICTION_GRACE_PERIOD
+    reports = []
+    for cache_dir in cache_dirs:
+        entries = cache_maps[cache_dir]
+        stale_entries = [path for path, cached_time in entries.items()
+                         if not compare_timestamps(_get_modified_time(path), cached_time)]
+
+        files = dict(_scan_files(cache_dir, cache.cache_map_file_name))
+        referenced = {utils.normalize_path(path) for path in set(entries).difference(stale_entries)}
+        orphans = {path: stat.st_size for path, stat in files.items()
+                   if utils.normalize_path(path) not in referenced and stat.st_mtime < recently}
+
+        reports.append(CacheDirReport(
+            cache_dir=cache_dir,
+            last_modified=index.last_modified(cache_dir),
+            size=sum(stat.st_size for stat in files.values()),
+            entries=entries,
+            stale_entries=stale_entries,
+            orphans=orphans,
+        ))
+    return reports
+
+
+def _map(func, items, max_threads=None):
+    executor = pool_provider.get_executor(thread_count=max_threads or pool_provider.DEFAULT_NUM_THREADS)
+    try:
+        return list(executor.map(func, items))
+    finally:
+        executor.shutdown()
+
+
+def scan(cache, max_threads=None):
+    """
+    Scan every cache directory of a cache, fanout directories are scanned concurrently.
+
+    :param cache:       the :py:class:`synapseclient.core.cache.Cache` to scan
+    :param max_threads: the number of fanout directories to scan concurrently
+
+    :returns: a list of :py:class:`CacheDirReport`
+    """
+    reports = _map(lambda fanout_item: _scan_fanout_dir(cache, *fanout_item), _fanout_dirs(cache).items(), max_threads)
+    return [report for fanout_reports in reports for report in fanout_reports]
+
+
+def stats(cache, max_threads=None, reports=None):
+    """
+    Summarize the contents of a cache.
+
+    :param reports: the result of a previous :py:func:`scan`, otherwise the cache is scanned
+
+    :returns: a :py:class:`CacheStats`
+    """
+    if reports is None:
+        reports = scan(cache, max_threads=max_threads)
+    return CacheStats(
+        cache_dirs=len(reports),
+        entries=sum(len(report.entries) for report in reports),
+        size=sum(report.size for report in reports),
+        stale_entries=sum(len(report.stale_entries) for report in reports),
+        orphans=sum(len(report.orphans) for report in reports),
+        orphan_size=sum(sum(report.orphans.values()) for report in reports),
+    )
+
+
+def verify(cache, max_threads=None):
+    """
+    Find the cache directories holding stale entries or orphaned files.
+
+    :returns: a list of the :py:class:`CacheDirReport` of every such cache directory
+    """
+    return [report for report in scan(cache, max_threads=max_threads) if report.stale_entries or report.orphans]
+
+
+def _remove_cache_dir(cache, report):
+    cache._index.remove_dir(report.cache_dir)
+    shutil.rmtree(report.cache_dir, ignore_errors=True)
+    for path in report.entries:
+        cache._index.remove_file_digest(path)
+
+
+def _remove_stale(cache, report):
+    from synapseclient.core.cache import _get_modified_time, compare_timestamps
+
+    with cache._index.lock(report.cache_dir):
+        # entries may have been refreshed since the scan
+        cache_map = cache._read_cache_map(report.cache_dir)
+        stale_entries = [path for path in report.stale_entries
+                         if path in cache_map and not compare_timestamps(_get_modified_time(path), cache_map[path])]
+        if stale_entries:
+            for path in stale_entries:
+                del cache_map[path]
+            cache._write_cache_map(report.cache_dir, cache_map)
+            for path in stale_entries:
+                cache._index.remove_file_digest(path)
+
+        referenced = {utils.normalize_path(path) for path in cache_map}
+        for path in report.orphans:
+            if utils.normalize_path(path) not in referenced:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+def purge(cache, before_date=None, max_size=None, orphans=False, dry_run=False, max_threads=None):
+    """
+    Purge a cache, use with caution. Any combination of the criteria may be given, they are applied in order.
+
+    Deletes cache maps and files stored in the cache.cache_root_dir, but never deletes files stored outside the cache.
+
+    :param cache:       the :py:class:`synapseclient.core.cache.Cache` to purge
+    :param before_date: delete every cache directory whose cache map was last written before this date, given as a
+                        datetime or in seconds since the unix epoch. Cache directories without a cache map are deleted
+                        as well.
+    :param max_size:    then delete the least recently written cache directories until the files stored within the
+                        cache take up at most this many bytes
+    :param orphans:     then remove stale entries from cache maps and delete orphaned files
+    :param dry_run:     only report what would be deleted, otherwise the MD5s recorded for files that no longer exist
+                        are forgotten as well
+    :param max_threads: the number of fanout directories to scan and purge concurrently
+
+    :returns: a list of the cache directories and orphaned files that were (or would be) deleted
+    """
+    if isinstance(before_date, datetime.datetime):
+        before_date = utils.to_unix_epoch_time_secs(before_date)
+
+    reports = scan(cache, max_threads=max_threads)
+
+    expired = []
+    if before_date is not None:
+        remaining = []
+        for report in reports:
+            if report.last_modified is None or before_date > report.last_modified:
+                expired.append(report)
+            else:
+                remaining.append(report)
+        reports = remaining
+
+    if max_size is not None:
+        size = sum(report.size for report in reports)
+        reports.sort(key=lambda report: report.last_modified or 0)
+        while reports and size > max_size:
+            report = reports.pop(0)
+            expired.append(report)
+            size -= report.size
+
+    stale = [report for report in reports if report.stale_entries or report.orphans] if orphans else []
+
+    if not dry_run:
+        _map(lambda report: _remove_cache_dir(cache, report), expired, max_threads)
+        _map(lambda report: _remove_stale(cache, report), stale, max_threads)
+        cache._index.remove_missing_file_digests()
+
+    return [report.cache_dir for report in expired] + [path for report in stale for path in report.orphans]
+
+
+def _expected_md5(cache, cache_dir, path):
+    md5 = cache._index.get_md5(cache_dir, path)
+    if md5 is not None:
+        return md5
+
+    # the digest recorded when the file was last downloaded, uploaded or hashed is only known to describe the cached
+    # content if the file wasn't written since, a changed size with an unchanged modification time means corruption
+    digest = cache._index.get_file_digest(path)
+    if digest is not None and digest['modified_time_ns'] == os.stat(path).st_mtime_ns:
+        return digest['md5']
+    return None
+
+
+def _quarantine(cache, cache_dir, path):
+    """
+    Remove the entry of a corrupt file and move the file out of the way if it is stored within the cache.
+
+    :returns: the path the file was moved to or None if it is stored outside the cache
+    """
+    with cache._index.lock(cache_dir):
+        cache_map = cache._read_cache_map(cache_dir)
+        if cache_map.pop(path, None) is not None:
+            cache._write_cache_map(cache_dir, cache_map)
+
+    cache_root_dir = utils.normalize_path(cache.cache_root_dir)
+    if not utils.normalize_path(path).startswith(cache_root_dir + '/'):
+        return None
+    quarantined_path = os.path.join(cache_root_dir, QUARANTINE_DIR_NAME,
+                                    os.path.relpath(utils.normalize_path(path), cache_root_dir))
+    os.makedirs(os.path.dirname(quarantined_path), exist_ok=True)
+    os.replace(path, quarantined_path)
+    return quarantined_path
+
+
+def _verify_fanout_dir_checksums(cache, fanout_dir, known_cache_dirs):
+    """
+    :returns: (files, size, mismatches, unverifiable) of the fanout directory
+    """
+    files = size = unverifiable = 0
+    mismatches = []
+    for report in _scan_fanout_dir(cache, fanout_dir, known_cache_dirs):
+        for path in set(report.entries).difference(report.stale_entries):
+            try:
+                expected_md5 = _expected_md5(cache, report.cache_dir, path)
+                if expected_md5 is None:
+                    unverifiable += 1
+                    continue
+                actual_md5 = utils.md5_for_file(path).hexdigest()
+                files += 1
+                size += os.path.getsize(path)
+            except FileNotFoundError:
+                # deleted since the scan, the entry is merely stale
+                continue
+
+            if actual_md5 != expected_md5:
+                mismatches.append((path, expected_md5, actual_md5, _quarantine(cache, report.cache_dir, path)))
+    return files, size, mismatches, unverifiable
+
+
+def verify_checksums(cache, max_threads=None, resume=True):
+    """
+    Re-hash every unmodified cached file and compare it against the MD5 recorded for it when it was downloaded or
+    uploaded. Files whose content no longer matches lose their cache entry and, if stored within the cache, are moved
+    to a quarantine directory in the cache root so that they are downloaded again when next needed.
+
+    Progress is journaled in the cache root a fanout directory at a time, a run that is interrupted picks up where it
+    left off.
+
+    :param cache:       the :py:class:`synapseclient.core.cache.Cache` to verify
+    :param max_threads: the number of fanout directories to verify concurrently
+    :param resume:      skip the fanout directories verified by an interrupted run, False to start over
+
+    :returns: a :py:class:`ChecksumReport`
+    """
+    journal_path = os.path.join(cache.cache_root_dir, VERIFY_JOURNAL_FILE_NAME)
+    verified = set()
+    if resume and os.path.exists(journal_path):
+        with open(journal_path, 'r') as journal:
+            verified.update(line.rstrip('\n') for line in journal)
+
+    fanout_items = [(fanout_dir, known_cache_dirs) for fanout_dir, known_cache_dirs in _fanout_dirs(cache).items()
+                    if os.path.basename(fanout_dir) not in verified]
+    journal_lock = threading.Lock()
+
+    with open(journal_path, 'a' if resume else 'w') as journal:
+        def verify_fanout_dir(fanout_item):
+            fanout_dir, known_cache_dirs = fanout_item
+            result = _verify_fanout_dir_checksums(cache, fanout_dir, known_cache_dirs)
+            with journal_lock:
+                journal.write(os.path.basename(fanout_dir) + '\n')
+                journal.flush()
+            return result
+
+        start_time = time.time()
+        results = _map(verify_fanout_dir, fanout_items, max_threads)
+        elapsed = time.time() - start_time
+
+    # a completed run leaves nothing to resume
+    os.remove(journal_path)
+
+    return ChecksumReport(
+        files=sum(result[0] for result in results),
+        size=sum(result[1] for result in results),
+        elapsed=elapsed,
+        mismatches=[mismatch for result in results for mismatch in result[2]],
+        unverifiable=sum(result[3] for result in results),
+        resumed_fanout_dirs=len(verified),
+    )
@@ -0,0 +1,86 @@
+"""
+The pools of HTTP connections a requests.Session keeps open to the Synapse endpoints.
+
+A requests.Session keeps at most 10 idle connections per host by default. Threads beyond that still get a connection
+but it is closed once their request is done ("Connection pool is full, discarding connection"), so the next request
+pays for a new TCP connection and TLS handshake. The adapter here is sized from the number of threads a client uses
+and counts how often a request found a pooled connection to reuse.
+"""
+
+import typing
+
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+
+
+class ConnectionPoolStats(typing.NamedTuple):
+    """
+    How the connections of a pool were used since it was created.
+
+    :param requests:    the number of requests sent
+    :param hits:        the number of requests sent over a pooled connection
+    :param misses:      the number of requests that had to open a new connection
+    """
+    requests: int
+    hits: int
+    misses: int
+
+
+def pool_size_for_threads(max_threads):
+    """
+    :returns: the number of connections per host to keep, one for each thread and one for the thread that started
+              them, but no fewer than the requests default
+    """
+    return max(max_threads + 1, DEFAULT_POOLSIZE)
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter that can be resized without losing count of the connections its pools opened.
+
+    :param pool_maxsize:    the maximum number of idle connections kept per host
+    """
+
+    __attrs__ = HTTPAdapter.__attrs__ + ['_retired']
+
+    def __init__(self, pool_maxsize=DEFAULT_POOLSIZE, **kwargs):
+        # (requests, connections) counted by the pools that have since been closed
+        self._retired = (0, 0)
+        super().__init__(pool_maxsize=pool_maxsize, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        # pools are closed when they are evicted or the adapter is closed or resized, keep their counts
+        self.poolmanager.pools.dispose_func = self._retire
+
+    def _retire(self, pool):
+        requests, connections = self._retired
+        self._retired = (requests + pool.num_requests, connections + pool.num_connections)
+        pool.close()
+
+    def resize(self, pool_maxsize):
+        """
+        Change the number of idle connections kept per host, the connections kept so far are closed.
+        """
+        if pool_maxsize == self._pool_maxsize:
+            return
+        old_poolmanager = self.poolmanager
+        self._pool_maxsize = pool_maxsize
+        self.init_poolmanager(self._pool_connections, pool_maxsize, block=self._pool_block)
+        old_poolmanager.clear()
+
+    def stats(self):
+        """
+        :returns: the ConnectionPoolStats of every pool of this adapter so far
+        """
+        requests, connections = self._retired
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:
+                # evicted in the meantime and so counted as retired
+                continue
+            requests += pool.num_requests
+            connections += pool.num_connections
+        misses = min(connections, requests)
+        return ConnectionPoolStats(requests=requests, hits=requests - misses, misses=misses)
@@ -3,11 +3,19 @@ Created on Sep 21, 2017
 
 @author: bhoff
 
-sleep while checking registered _listeners
+sleep while listening for interruptions
+
+Dozing threads block on a condition variable rather than polling, so they cost nothing while they sleep. Registered
+_listeners are cancellation hooks: they are called when a doze starts and again whenever :py:func:`interrupt` wakes the
+dozing threads, and a listener cuts a doze short by raising an exception, which propagates to the dozing thread.
 """
+import threading
 import time
 
 _listeners = []
+_condition = threading.Condition()
+# incremented by every interrupt so that dozing threads can tell they were woken on purpose
+_interruptions = 0
 
 
 def add_listener(listener):
@@ -20,9 +28,40 @@ def clear_listeners():
     del _listeners[:]
 
 
-def doze(secs, listener_check_interval_secs=0.1):
-    end_time = time.time() + secs
-    while time.time() < end_time:
-        for listener in _listeners:
+def interrupt():
+    """
+    Wake every dozing thread at once to call the listeners, e.g. after a cancellation that a listener reports by
+    raising an exception. Threads whose listeners don't raise go back to sleep until the end of their doze.
+    """
+    global _interruptions
+    with _condition:
+        _interruptions += 1
+        _condition.notify_all()
+
+
+def doze(secs, listener_check_interval_secs=None):
+    """
+    Sleep for secs seconds unless a listener raises an exception when the doze starts or is interrupted.
+
+    :param secs:                            how long to sleep for
+    :param listener_check_interval_secs:    no longer used, listeners are called on :py:func:`interrupt` instead of
+                                            periodically
+    """
+    end_time = time.monotonic() + secs
+    if secs <= 0:
+        return
+
+    with _condition:
+        interruptions = _interruptions
+    while True:
+        # called without holding the condition, a listener may take a while or interrupt in turn
+        for listener in list(_listeners):
             listener()
-        time.sleep(listener_check_interval_secs)
+
+        with _condition:
+            while interruptions == _interruptions:
+                remaining = end_time - time.monotonic()
+                if remaining <= 0:
+                    return
+                _condition.wait(remaining)
+            interruptions = _interruptions
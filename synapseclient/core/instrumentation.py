@@ -0,0 +1,594 @@
+"""
+***************
+Instrumentation
+***************
+
+Reports every request the client sends so that the time spent talking to Synapse and to the storage behind it can be
+measured. A sink is any callable taking a :py:class:`RequestEvent`, once one is registered an event is emitted for
+every REST call, every part of a multipart upload or multithreaded download sent to a pre-signed URL and every
+asynchronous job waited on::
+
+    from synapseclient.core import instrumentation
+
+    summary = instrumentation.HistogramSummary()
+    instrumentation.add_sink(summary)
+    syn.tableQuery("select * from syn123")
+    print(summary.summary())
+
+Events record the latency of the whole request, including the retries made by :py:func:`synapseclient.core.retry
+.with_retry` and the time spent waiting on the client side rate limits of :py:mod:`synapseclient.core.rate_limit`, so
+a slow endpoint can be told apart from a throttled one. The URIs of REST calls are reduced to endpoint templates, e.g.
+``/repo/v1/entity/{id}/bundle2``, to keep the number of distinct endpoints small.
+
+Three sinks are provided:
+
+* :py:class:`HistogramSummary` keeps latency histograms and totals per endpoint in memory
+* :py:class:`PrometheusTextFileExporter` periodically writes them to a file in the Prometheus text format, e.g. for
+  the textfile collector of the node exporter
+* :py:class:`OpenTelemetrySpanAdapter` turns every event into an OpenTelemetry span, which requires the
+  ``opentelemetry-api`` package
+
+While no sink is registered measuring a request costs a single check of the registered sinks.
+"""
+
+import bisect
+import logging
+import math
+import os
+import re
+import threading
+
+try:
+    import contextvars
+except ImportError:
+    # only in the standard library from Python 3.7
+    contextvars = None
+import time
+import typing
+import urllib.parse
+
+from synapseclient.core.logging_setup import DEFAULT_LOGGER_NAME
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+# the status codes of the responses to throttled requests
+THROTTLING_STATUS_CODES = (429, 503)
+
+KIND_REST = 'rest'
+KIND_PART_UPLOAD = 'part_upload'
+KIND_PART_DOWNLOAD = 'part_download'
+KIND_ASYNC_JOB = 'async_job'
+
+# the endpoint of requests to pre-signed URLs, whose paths are the keys of the objects in storage
+PRESIGNED_URL_ENDPOINT = '/{key}'
+
+# the upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+
+# path segments that identify an object rather than name an endpoint, e.g. Synapse ids, version numbers, job tokens
+_ID_SEGMENT = re.compile(r'^(syn)?\d+(\.\d+)?$|^[0-9a-f-]{20,}$', re.IGNORECASE)
+
+
+class RequestEvent(typing.NamedTuple):
+    """
+    A request sent by the client.
+
+    :param kind:            one of KIND_REST, KIND_PART_UPLOAD, KIND_PART_DOWNLOAD or KIND_ASYNC_JOB
+    :param method:          the HTTP method
+    :param host:            the host the request was sent to
+    :param endpoint:        the template of the path of the request, see :py:func:`endpoint_template`
+    :param status:          the HTTP status code of the response, the final state of an asynchronous job or None if
+                            the request failed without a response
+    :param start_time:      when the request started, in seconds since the epoch
+    :param latency:         the number of seconds the request took including retries and waits
+    :param bytes_sent:      the size of the request body
+    :param bytes_received:  the size of the response body
+    :param retries:         the number of times the request was retried
+    :param retry_wait:      the number of seconds spent backing off between retries
+    :param throttle_wait:   the number of seconds spent waiting because the host throttled requests
+    :param error:           the name of the exception the request failed with or None
+    """
+    kind: str
+    method: str
+    host: str
+    endpoint: str
+    status: typing.Union[int, str, None]
+    start_time: float
+    latency: float
+    bytes_sent: int
+    bytes_received: int
+    retries: int
+    retry_wait: float
+    throttle_wait: float
+    error: typing.Optional[str]
+
+
+_sinks = ()
+_sinks_lock = threading.Lock()
+
+
+class _ThreadLocalVar:
+    """
+    Stands in for a contextvars.ContextVar where the contextvars module is missing, a value set by an asyncio task is
+    seen by the other tasks of its thread until it is reset
+    """
+
+    def __init__(self, default=None):
+        self._local = threading.local()
+        self._default = default
+
+    def get(self):
+        return getattr(self._local, 'value', self._default)
+
+    def set(self, value):
+        token = self.get()
+        self._local.value = value
+        return token
+
+    def reset(self, token):
+        self._local.value = token
+
+
+# the request being measured by the current thread or asyncio task
+if contextvars is not None:
+    _current = contextvars.ContextVar('synapseclient_instrumentation_measurement', default=None)
+else:
+    _current = _ThreadLocalVar()
+
+
+def add_sink(sink):
+    """
+    Emit the events of every request sent from now on to the sink.
+
+    :param sink: a callable taking a :py:class:`RequestEvent`, called from the thread that sent the request
+    """
+    global _sinks
+    with _sinks_lock:
+        _sinks = _sinks + (sink,)
+
+
+def remove_sink(sink):
+    """
+    Stop emitting events to the sink.
+    """
+    global _sinks
+    with _sinks_lock:
+        _sinks = tuple(registered for registered in _sinks if registered != sink)
+
+
+def get_sinks():
+    """
+    :returns: a tuple of the registered sinks
+    """
+    return _sinks
+
+
+def endpoint_template(url):
+    """
+    :returns: the path of the url with the segments identifying objects replaced by ``{id}``, e.g.
+              ``/repo/v1/entity/{id}/version/{id}`` for ``https://repo-prod.prod.sagebase.org/repo/v1/entity/syn123/
+              version/2?limit=10``
+    """
+    path = urllib.parse.urlparse(url).path
+    return '/'.join('{id}' if _ID_SEGMENT.match(segment) else segment for segment in path.split('/'))
+
+
+def measure(kind, method, url, body=None, endpoint=None):
+    """
+    Measure a request, for use as a context manager around sending it and reading its response::
+
+        with instrumentation.measure(instrumentation.KIND_REST, 'get', url) as measurement:
+            response = session.get(url)
+            measurement.response(response)
+
+    The event is emitted when the context exits, recording the name of any exception raised.
+
+    :param kind:        the kind of the request, e.g. KIND_REST
+    :param method:      the HTTP method
+    :param url:         the url the request is sent to
+    :param body:        the body of the request, to count the bytes sent
+    :param endpoint:    the endpoint of the request, by default the :py:func:`endpoint_template` of the url
+
+    :returns: a context manager yielding an object recording the outcome of the request, which does nothing while no
+              sink is registered
+    """
+    if not _sinks:
+        return _NULL_MEASUREMENT
+    return _Measurement(kind, method, url, body, endpoint)
+
+
+def record_retry(wait, response=None):
+    """
+    Record a retry of the request measured by the current thread or task, if any.
+
+    :param wait:        the number of seconds waited before retrying
+    :param response:    the response of the attempt being retried, if the host throttled it the wait is counted as a
+                        throttling wait
+    """
+    measurement = _current.get()
+    if measurement is not None:
+        status = getattr(response, 'status_code', None)
+        measurement.retried(wait, throttled=isinstance(status, int) and status in THROTTLING_STATUS_CODES)
+
+
+def record_throttle_wait(wait):
+    """
+    Record time the request measured by the current thread or task, if any, spent waiting on a rate limit.
+
+    :param wait: the number of seconds waited
+    """
+    measurement = _current.get()
+    if measurement is not None:
+        measurement.throttle_wait += wait
+
+
+def _body_size(body):
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        return len(body)
+    return 0
+
+
+class _NullMeasurement:
+    """Stands in for a measurement while no sink is registered"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def response(self, response, bytes_received=None):
+        pass
+
+    def completed(self, status, bytes_received=0):
+        pass
+
+    def retried(self, wait, throttled=False):
+        pass
+
+
+_NULL_MEASUREMENT = _NullMeasurement()
+
+
+class _Measurement:
+    """Records the outcome of one request and emits its RequestEvent to the sinks"""
+
+    def __init__(self, kind, method, url, body, endpoint):
+        self.kind = kind
+        self.method = method.upper()
+        self.host = urllib.parse.urlparse(url).netloc.lower()
+        self.endpoint = endpoint or endpoint_template(url)
+        self.bytes_sent = _body_size(body)
+        self.status = None
+        self.bytes_received = 0
+        self.retries = 0
+        self.retry_wait = 0.0
+        self.throttle_wait = 0.0
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        self._start_time = time.time()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        latency = time.perf_counter() - self._started
+        _current.reset(self._token)
+        if exc_type is not None and self.status is None:
+            # e.g. a SynapseHTTPError raised for the response
+            status = getattr(getattr(exc_value, 'response', None), 'status_code', None)
+            self.status = status if isinstance(status, int) else None
+        event = RequestEvent(
+            kind=self.kind,
+            method=self.method,
+            host=self.host,
+            endpoint=self.endpoint,
+            status=self.status,
+            start_time=self._start_time,
+            latency=latency,
+            bytes_sent=self.bytes_sent,
+            bytes_received=self.bytes_received,
+            retries=self.retries,
+            retry_wait=self.retry_wait,
+            throttle_wait=self.throttle_wait,
+            error=exc_type.__name__ if exc_type is not None else None,
+        )
+        for sink in _sinks:
+            try:
+                sink(event)
+            except Exception:
+                # a broken sink must not fail the request
+                _logger.warning("The instrumentation sink %r failed", sink, exc_info=True)
+        return False
+
+    def response(self, response, bytes_received=None):
+        """
+        Record the response of the request.
+
+        :param response:        a requests.Response
+        :param bytes_received:  the size of the response body, by default its Content-Length
+        """
+        if bytes_received is None:
+            try:
+                bytes_received = int(response.headers.get('Content-Length') or 0)
+            except (AttributeError, TypeError, ValueError):
+                bytes_received = 0
+        status = getattr(response, 'status_code', None)
+        self.completed(status if isinstance(status, int) else None, bytes_received)
+
+    def completed(self, status, bytes_received=0):
+        """
+        Record the outcome of the request.
+
+        :param status:          the HTTP status code of the response or the final state of an asynchronous job
+        :param bytes_received:  the size of the response body
+        """
+        self.status = status
+        self.bytes_received = bytes_received
+
+    def retried(self, wait, throttled=False):
+        """
+        Record a retry of the request.
+
+        :param wait:        the number of seconds waited before retrying
+        :param throttled:   whether the request is retried because the host throttled it
+        """
+        self.retries += 1
+        if throttled:
+            self.throttle_wait += wait
+        else:
+            self.retry_wait += wait
+
+
+class EndpointStats:
+    """
+    The totals and latency histogram of the requests to one endpoint.
+
+    :param buckets: the upper bounds of the latency histogram buckets in seconds, in increasing order
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the number of requests in each bucket, the last one counting those slower than every bound
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.errors = 0
+        self.latency_sum = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+        self.retry_wait = 0.0
+        self.throttle_wait = 0.0
+        # status -> number of requests
+        self.statuses = {}
+
+    def add(self, event):
+        self.bucket_counts[bisect.bisect_left(self.buckets, event.latency)] += 1
+        self.count += 1
+        if event.error is not None or (isinstance(event.status, int) and event.status >= 400):
+            self.errors += 1
+        self.latency_sum += event.latency
+        self.bytes_sent += event.bytes_sent
+        self.bytes_received += event.bytes_received
+        self.retries += event.retries
+        self.retry_wait += event.retry_wait
+        self.throttle_wait += event.throttle_wait
+        self.statuses[event.status] = self.statuses.get(event.status, 0) + 1
+
+    def quantile(self, q):
+        """
+        :returns: an estimate of the q quantile of the latency in seconds interpolated within its bucket, or NaN if
+                  there were no requests
+        """
+        if not self.count:
+            return math.nan
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.bucket_counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if i == len(self.buckets):
+                    # beyond the last bound nothing is known but that the latency exceeded it
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+
+class HistogramSummary:
+    """
+    A sink keeping an :py:class:`EndpointStats` for each kind, method and endpoint of the requests sent.
+
+    :param buckets: the upper bounds of the latency histogram buckets in seconds
+    """
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def __call__(self, event):
+        key = (event.kind, event.method, event.endpoint)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = EndpointStats(self.buckets)
+            stats.add(event)
+
+    def stats(self):
+        """
+        :returns: a dict of (kind, method, endpoint) to the EndpointStats of the requests to it
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def reset(self):
+        """Forget every request recorded"""
+        with self._lock:
+            self._stats = {}
+
+    def summary(self):
+        """
+        :returns: a table of the requests to each endpoint, those the most time was spent on first
+        """
+        rows = sorted(self.stats().items(), key=lambda item: item[1].latency_sum, reverse=True)
+        lines = ['%-13s %-6s %-48s %7s %6s %9s %9s %9s %8s %9s %9s %12s' % (
+            'kind', 'method', 'endpoint', 'count', 'errors', 'total(s)', 'p50(s)', 'p99(s)', 'retries', 'retry(s)',
+            'thrtl(s)', 'MB')]
+        for (kind, method, endpoint), stats in rows:
+            lines.append('%-13s %-6s %-48s %7d %6d %9.2f %9.3f %9.3f %8d %9.2f %9.2f %12.2f' % (
+                kind, method, endpoint, stats.count, stats.errors, stats.latency_sum, stats.quantile(0.5),
+                stats.quantile(0.99), stats.retries, stats.retry_wait, stats.throttle_wait,
+                (stats.bytes_sent + stats.bytes_received) / 2 ** 20))
+        return '\n'.join(lines)
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class PrometheusTextFileExporter(HistogramSummary):
+    """
+    A sink writing the latency histograms and totals of the requests sent to a file in the Prometheus text
+    exposition format, at most once every write_interval seconds and whenever :py:meth:`write` is called.
+
+    The file is replaced atomically so that a collector never reads a partially written file.
+
+    :param path:            the file to write
+    :param write_interval:  the minimum number of seconds between writes triggered by requests
+    :param buckets:         the upper bounds of the latency histogram buckets in seconds
+    """
+
+    def __init__(self, path, write_interval=15, buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(buckets)
+        self.path = os.path.expanduser(path)
+        self.write_interval = write_interval
+        self._last_write = -math.inf
+        self._write_lock = threading.Lock()
+
+    def __call__(self, event):
+        super().__call__(event)
+        now = time.monotonic()
+        if now - self._last_write >= self.write_interval:
+            self._last_write = now
+            self.write()
+
+    def write(self):
+        """Write the metrics of every request recorded so far"""
+        with self._write_lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            temp_path = '%s.%d.%d' % (self.path, os.getpid(), threading.get_ident())
+            with open(temp_path, 'w') as f:
+                f.write(self.render())
+            os.replace(temp_path, self.path)
+
+    def render(self):
+        """
+        :returns: the metrics in the Prometheus text exposition format
+        """
+        stats = sorted(self.stats().items())
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for suffix, labels, value in samples:
+                label_text = ','.join('%s="%s"' % (label, _escape_label(label_value)) for label, label_value in labels)
+                lines.append('%s%s{%s} %s' % (name, suffix, label_text, _format_value(value)))
+
+        def endpoint_labels(key):
+            return list(zip(('kind', 'method', 'endpoint'), key))
+
+        histogram_samples = []
+        for key, endpoint_stats in stats:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), endpoint_stats.bucket_counts):
+                cumulative += bucket_count
+                histogram_samples.append(
+                    ('_bucket', endpoint_labels(key) + [('le', _format_value(float(bound)))], cumulative))
+            histogram_samples.append(('_sum', endpoint_labels(key), endpoint_stats.latency_sum))
+            histogram_samples.append(('_count', endpoint_labels(key), endpoint_stats.count))
+        metric('synapseclient_request_duration_seconds', 'histogram',
+               'The latency of the requests sent including retries and waits.', histogram_samples)
+
+        metric('synapseclient_responses_total', 'counter', 'The requests sent by their final status.',
+               [('', endpoint_labels(key) + [('status', '' if status is None else status)], count)
+                for key, endpoint_stats in stats for status, count in sorted(endpoint_stats.statuses.items(),
+                                                                             key=lambda item: str(item[0]))])
+
+        for name, attribute, help_text in (
+                ('synapseclient_request_errors_total', 'errors', 'The requests that failed.'),
+                ('synapseclient_request_sent_bytes_total', 'bytes_sent', 'The bytes of the request bodies sent.'),
+                ('synapseclient_request_received_bytes_total', 'bytes_received',
+                 'The bytes of the response bodies received.'),
+                ('synapseclient_request_retries_total', 'retries', 'The retries of requests.'),
+                ('synapseclient_request_retry_wait_seconds_total', 'retry_wait',
+                 'The time spent backing off between retries.'),
+                ('synapseclient_request_throttle_wait_seconds_total', 'throttle_wait',
+                 'The time spent waiting because a host throttled requests.')):
+            metric(name, 'counter', help_text,
+                   [('', endpoint_labels(key), getattr(endpoint_stats, attribute)) for key, endpoint_stats in stats])
+
+        return '\n'.join(lines) + '\n'
+
+
+class OpenTelemetrySpanAdapter:
+    """
+    A sink recording every request as an OpenTelemetry client span, a child of the span current in the thread that
+    sent it. Requires the ``opentelemetry-api`` package unless a tracer is given.
+
+    :param tracer:  the tracer to create spans with, by default that of the globally configured tracer provider
+    """
+
+    def __init__(self, tracer=None):
+        if tracer is None:
+            if otel_trace is None:
+                raise ImportError("Recording spans requires opentelemetry-api:\n    pip install opentelemetry-api\n")
+            tracer = otel_trace.get_tracer('synapseclient')
+        self.tracer = tracer
+
+    def __call__(self, event):
+        attributes = {
+            'synapse.request.kind': event.kind,
+            'http.method': event.method,
+            'net.peer.name': event.host,
+            'http.route': event.endpoint,
+            'http.request_content_length': event.bytes_sent,
+            'http.response_content_length': event.bytes_received,
+            'synapse.retries': event.retries,
+            'synapse.retry_wait': event.retry_wait,
+            'synapse.throttle_wait': event.throttle_wait,
+        }
+        if isinstance(event.status, int):
+            attributes['http.status_code'] = event.status
+        elif event.status is not None:
+            attributes['synapse.job_state'] = event.status
+        if event.error is not None:
+            attributes['error.type'] = event.error
+
+        span_kwargs = {}
+        if otel_trace is not None:
+            span_kwargs['kind'] = otel_trace.SpanKind.CLIENT
+        start_ns = int(event.start_time * 1e9)
+        span = self.tracer.start_span('%s %s' % (event.method, event.endpoint), start_time=start_ns,
+                                      attributes=attributes, **span_kwargs)
+        failed = event.error is not None or (isinstance(event.status, int) and event.status >= 400) \
+            or event.status == 'FAILED'
+        if failed and otel_trace is not None:
+            span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR))
+        span.end(end_time=start_ns + int(event.latency * 1e9))
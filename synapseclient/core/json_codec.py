@@ -0,0 +1,150 @@
+"""
+The JSON encoding of the bodies sent to and received from Synapse.
+
+Request bodies are encoded compactly, without the indentation and sorted keys that are only useful to people reading
+them, and both encoding and decoding use `orjson <https://github.com/ijl/orjson>`_ or
+`ujson <https://github.com/ultrajson/ultrajson>`_ when one is installed, which are several times faster than the
+standard library json module on large bodies such as table row sets and entity bundles::
+
+    pip install synapseclient[json]
+
+Every codec encodes datetimes in the format Synapse expects and objects with a ``to_json`` method by it, see
+:py:mod:`synapseclient.core.models.custom_json`, and values a faster codec can't encode, e.g. integers wider than 64
+bits, fall back to the json module. orjson encodes NaN and infinities as null and decodes integers wider than 64 bits
+as floats, Synapse uses neither. Human readable output, e.g. of ``str(entity)`` or
+:py:meth:`synapseclient.Synapse.printEntity`, is still produced by the json module.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# ensure the json module encodes datetimes and to_json objects like the other codecs
+from synapseclient.core.models import custom_json  # noqa: F401
+
+CODEC_ORJSON = 'orjson'
+CODEC_UJSON = 'ujson'
+CODEC_JSON = 'json'
+
+_COMPACT_SEPARATORS = (',', ':')
+
+
+def _default(obj):
+    # the fallback of the json module encoder, which custom_json patches to handle datetimes and to_json objects
+    return json.JSONEncoder().default(obj)
+
+
+def _json_dumps(obj, ensure_ascii):
+    return json.dumps(obj, separators=_COMPACT_SEPARATORS, ensure_ascii=ensure_ascii)
+
+
+def _orjson_dumps(obj, ensure_ascii):
+    try:
+        encoded = orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+    except TypeError:
+        return _json_dumps(obj, ensure_ascii)
+    if not ensure_ascii:
+        return encoded.decode('utf-8')
+    try:
+        # bytes.isascii is only there from Python 3.7
+        return encoded.decode('ascii')
+    except UnicodeDecodeError:
+        # orjson always writes UTF-8, the json module escapes the rare bodies that aren't ASCII
+        return _json_dumps(obj, ensure_ascii)
+
+
+def _orjson_loads(data):
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # e.g. NaN, which the json module accepts, it raises the same error if the data isn't valid JSON at all
+        return json.loads(data)
+
+
+def _ujson_dumps(obj, ensure_ascii):
+    try:
+        return ujson.dumps(obj, ensure_ascii=ensure_ascii, escape_forward_slashes=False, default=_default)
+    except (TypeError, OverflowError):
+        return _json_dumps(obj, ensure_ascii)
+
+
+def _ujson_loads(data):
+    try:
+        return ujson.loads(data)
+    except ValueError:
+        return json.loads(data)
+
+
+if orjson is not None:
+    # datetimes and dataclasses are encoded by _default like the json module does
+    _ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_NON_STR_KEYS
+
+_CODECS = {
+    CODEC_JSON: (_json_dumps, json.loads),
+}
+if ujson is not None:
+    _CODECS[CODEC_UJSON] = (_ujson_dumps, _ujson_loads)
+if orjson is not None:
+    _CODECS[CODEC_ORJSON] = (_orjson_dumps, _orjson_loads)
+
+
+def available_codecs():
+    """
+    :returns: the names of the codecs that can be used, fastest first
+    """
+    return [name for name in (CODEC_ORJSON, CODEC_UJSON, CODEC_JSON) if name in _CODECS]
+
+
+_codec_name = available_codecs()[0]
+_dumps, _loads = _CODECS[_codec_name]
+
+
+def get_codec():
+    """
+    :returns: the name of the codec in use
+    """
+    return _codec_name
+
+
+def set_codec(name):
+    """
+    Use the given codec, e.g. to compare their results. The fastest one installed is used by default.
+
+    :param name: one of :py:func:`available_codecs`
+    """
+    global _codec_name, _dumps, _loads
+    if name not in _CODECS:
+        raise ValueError("The JSON codec %s is not available, must be one of %s" % (name, available_codecs()))
+    _codec_name = name
+    _dumps, _loads = _CODECS[name]
+
+
+def dumps(obj, ensure_ascii=True):
+    """
+    Encode obj as compact JSON.
+
+    :param obj:             the object to encode
+    :param ensure_ascii:    whether to escape all non-ASCII characters
+
+    :returns: a JSON string
+    """
+    return _dumps(obj, ensure_ascii)
+
+
+def loads(data):
+    """
+    Decode JSON.
+
+    :param data: a JSON document as a str or as UTF-8 bytes
+
+    :returns: the decoded object
+    """
+    return _loads(data)
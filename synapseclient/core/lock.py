@@ -2,15 +2,28 @@ import errno
 import os
 import shutil
 import sys
+import threading
 import time
 import datetime
 
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
 from synapseclient.core.exceptions import SynapseFileCacheError
 from synapseclient.core.dozer import doze
 
 LOCK_DEFAULT_MAX_AGE = datetime.timedelta(seconds=10)
 DEFAULT_BLOCKING_TIMEOUT = datetime.timedelta(seconds=70)
 CACHE_UNLOCK_WAIT_TIME = 0.5
+# the first wait for a mkdir lock, doubled on every further attempt up to CACHE_UNLOCK_WAIT_TIME
+CACHE_UNLOCK_INITIAL_WAIT_TIME = 0.01
+
+LOCK_TYPE_MKDIR = 'mkdir'
+LOCK_TYPE_FCNTL = 'fcntl'
+LOCK_TYPES = (LOCK_TYPE_MKDIR, LOCK_TYPE_FCNTL)
 
 
 class LockedException(Exception):
@@ -70,18 +83,26 @@ class Lock(object):
             timeout = self.default_blocking_timeout
         lock_acquired = False
         tryLockStartTime = time.time()
+        wait_time = CACHE_UNLOCK_INITIAL_WAIT_TIME
         while time.time() - tryLockStartTime < timeout.total_seconds():
             lock_acquired = self.acquire(break_old_locks)
             if lock_acquired:
                 break
             else:
-                doze(CACHE_UNLOCK_WAIT_TIME)
+                # most locks are only held for the few milliseconds it takes to update a .cacheMap
+                doze(wait_time)
+                wait_time = min(wait_time * 2, CACHE_UNLOCK_WAIT_TIME)
         if not lock_acquired:
             raise SynapseFileCacheError(
                 "Could not obtain a lock on the file cache within timeout: %s  "
                 "Please try again later" % str(timeout)
             )
 
+    def renew(self):
+        """Reset the age of a held lock so that it isn't broken as stale while its holder is still at work"""
+        if self.held:
+            os.utime(self.lock_dir_path)
+
     def release(self):
         """Release lock or do nothing if lock is not held"""
         if self.held:
@@ -98,3 +119,141 @@ class Lock(object):
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.release()
+
+
+class _FlockWaiter(object):
+    """
+    Blocks in flock on a separate thread so that waiting for a lock can time out while still waking up
+    as soon as the lock is released.
+    """
+
+    def __init__(self, fd, operation):
+        self._fd = fd
+        self._operation = operation
+        self._error = None
+        self._done = threading.Event()
+        self._state_lock = threading.Lock()
+        self._abandoned = False
+        threading.Thread(target=self._wait_for_lock, daemon=True).start()
+
+    def _wait_for_lock(self):
+        try:
+            fcntl.flock(self._fd, self._operation)
+        except OSError as ex:
+            self._error = ex
+        with self._state_lock:
+            if self._abandoned:
+                # nobody wants the lock anymore, closing the descriptor releases it
+                os.close(self._fd)
+            else:
+                self._done.set()
+
+    def wait(self, timeout):
+        """
+        :returns: the locked file descriptor or None if the lock could not be obtained within timeout seconds
+        """
+        self._done.wait(timeout)
+        with self._state_lock:
+            if not self._done.is_set():
+                self._abandoned = True
+                return None
+        if self._error:
+            os.close(self._fd)
+            raise self._error
+        return self._fd
+
+
+class FcntlLock(object):
+    """
+    Implements a lock with fcntl.flock on a file named [lockname].flock, either shared by any number of readers
+    or held exclusively by a single writer. Waiting for the lock blocks in the kernel, which wakes the waiter up
+    as soon as the lock is released, and the lock is released by the operating system if its holder dies so
+    there are never any stale locks to break.
+
+    Only available on POSIX systems. Network file systems may not support flock, or (like NFS on Linux) emulate
+    it with POSIX record locks that don't exclude threads of the same process. Use a :py:class:`Lock` there.
+    """
+    SUFFIX = 'flock'
+
+    def __init__(self, name, dir=None, shared=False, default_blocking_timeout=DEFAULT_BLOCKING_TIMEOUT):
+        if fcntl is None:
+            raise NotImplementedError("fcntl locks are not supported on this platform")
+        self.name = name
+        self.held = False
+        self.shared = shared
+        self.dir = dir if dir else os.getcwd()
+        self.lock_file_path = os.path.join(self.dir, ".".join([name, FcntlLock.SUFFIX]))
+        self.default_blocking_timeout = default_blocking_timeout
+        self._fd = None
+
+    @property
+    def _operation(self):
+        return fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+
+    def _open(self):
+        os.makedirs(self.dir, exist_ok=True)
+        # the lock file is never deleted, removing it while another process waits on it would split the lock in two
+        return os.open(self.lock_file_path, os.O_RDWR | os.O_CREAT, 0o666)
+
+    def acquire(self, break_old_locks=True):
+        """Try to acquire lock. Return True on success or False otherwise"""
+        if self.held:
+            return True
+        fd = self._open()
+        try:
+            fcntl.flock(fd, self._operation | fcntl.LOCK_NB)
+        except OSError as err:
+            os.close(fd)
+            if err.errno not in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                raise
+            return False
+        self._fd = fd
+        self.held = True
+        return True
+
+    def blocking_acquire(self, timeout=None, break_old_locks=True):
+        if self.acquire(break_old_locks):
+            return True
+        if timeout is None:
+            timeout = self.default_blocking_timeout
+
+        fd = _FlockWaiter(self._open(), self._operation).wait(timeout.total_seconds())
+        if fd is None:
+            raise SynapseFileCacheError(
+                "Could not obtain a lock on the file cache within timeout: %s  "
+                "Please try again later" % str(timeout)
+            )
+        self._fd = fd
+        self.held = True
+        return True
+
+    def release(self):
+        """Release lock or do nothing if lock is not held"""
+        if self.held:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+            self.held = False
+
+    # Make the lock object a Context Manager
+    def __enter__(self):
+        self.blocking_acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def get_lock(lock_type, name, dir=None, shared=False):
+    """
+    Create a lock of the given type.
+
+    :param lock_type:   "fcntl" for a :py:class:`FcntlLock` or "mkdir" for a :py:class:`Lock`
+    :param name:        name of the lock
+    :param dir:         directory in which the lock lives
+    :param shared:      whether the lock may be shared with other readers, only fcntl locks can be
+    """
+    if lock_type == LOCK_TYPE_FCNTL:
+        return FcntlLock(name, dir=dir, shared=shared)
+    elif lock_type == LOCK_TYPE_MKDIR:
+        return Lock(name, dir=dir)
+    raise ValueError("Invalid lock type %s, must be one of %s" % (lock_type, LOCK_TYPES))
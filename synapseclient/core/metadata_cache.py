@@ -0,0 +1,274 @@
+# Note: Even though this has Sphinx format, this is not meant to be part of the public docs
+
+"""
+*********************
+Entity Metadata Cache
+*********************
+
+Keeps the entity bundles of past versions of entities on local disk so that getting a pinned version again costs no
+round trip to Synapse. The entity, annotations and file handles of a version stop changing once a newer version of the
+entity is created, so only the bundles of versions that are no longer the latest are kept and they never need to be
+revalidated. Bundles of entities with unmet access requirements aren't kept so the requirements are checked again
+until they are met.
+
+Every bundle is a JSON file ``[cache root]/.entityBundles/[user id]/[entity id]/[version].json`` that can be read
+directly when debugging, the least recently used ones are deleted once the bundles take up more than the configured
+size. Bundles are kept per user, the ownerId of the user they were fetched for, so that a user sharing the cache
+location never gets a bundle they weren't allowed to fetch themselves.
+
+The bundles of the latest versions of entities can change at any time. They can be memoized for a short while in
+memory by an :py:class:`EntityBundleMemo`, which asks Synapse whether the etag of an entity changed once its bundle is
+older than the time to live rather than fetching the whole bundle again.
+
+This is part of the internal implementation of the client and should not be accessed directly by users of the client.
+"""
+
+import collections
+import copy
+import json
+import os
+import shutil
+import threading
+import time
+import typing
+
+ENTITY_BUNDLES_DIR_NAME = '.entityBundles'
+
+# the user id the bundles fetched without logging in are kept under
+ANONYMOUS_USER_ID = 'anonymous'
+
+# the default number of bundles held by an EntityBundleMemo
+DEFAULT_BUNDLE_MEMO_SIZE = 10000
+
+
+class MetadataCacheEntry(typing.NamedTuple):
+    """
+    A bundle kept in the metadata cache.
+
+    :param user_id:     the ownerId of the user the bundle was fetched for or ANONYMOUS_USER_ID
+    :param entity_id:   the Synapse ID of the entity
+    :param version:     the version number of the entity
+    :param path:        the JSON file holding the bundle
+    :param size:        the size of the file in bytes
+    :param last_used:   when the bundle was last stored or read, in seconds since the epoch
+    """
+    user_id: str
+    entity_id: str
+    version: int
+    path: str
+    size: int
+    last_used: float
+
+
+def is_cacheable(bundle):
+    """
+    :returns: whether the bundle of an entity version can no longer change
+    """
+    entity = bundle.get('entity') or {}
+    restrictions = bundle.get('restrictionInformation') or {}
+    return entity.get('isLatestVersion') is False \
+        and entity.get('versionNumber') is not None \
+        and not restrictions.get('hasUnmetAccessRequirement', False)
+
+
+class MetadataCache:
+    """
+    An on-disk cache of the entity bundles of past versions of entities, see the module documentation.
+
+    :param cache_root_dir:  the root of the file cache, the bundles are kept in a directory within it
+    :param max_size:        the maximum number of bytes the bundles may take up
+    """
+
+    def __init__(self, cache_root_dir, max_size):
+        self.cache_dir = os.path.join(os.path.expanduser(cache_root_dir), ENTITY_BUNDLES_DIR_NAME)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # bytes taken up by the bundles, counted on the first store
+        self._size = None
+
+    def _user_dir(self, user_id):
+        return os.path.join(self.cache_dir, str(user_id) if user_id is not None else ANONYMOUS_USER_ID)
+
+    def _bundle_path(self, user_id, entity_id, version):
+        return os.path.join(self._user_dir(user_id), entity_id.lower(), '%d.json' % int(version))
+
+    def get(self, entity_id, version, user_id):
+        """
+        :param user_id: the ownerId of the user getting the bundle, None if not logged in
+
+        :returns: the cached bundle of the given version of the entity fetched for the user or None
+        """
+        path = self._bundle_path(user_id, entity_id, version)
+        try:
+            with open(path, 'r') as f:
+                bundle = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            # the modification time records when the bundle was last used
+            os.utime(path)
+        except OSError:
+            pass
+        return bundle
+
+    def put(self, bundle, user_id):
+        """
+        Keep the bundle of an entity version if it can no longer change.
+
+        :param user_id: the ownerId of the user the bundle was fetched for, None if not logged in
+
+        :returns: whether the bundle was kept
+        """
+        if not is_cacheable(bundle):
+            return False
+
+        path = self._bundle_path(user_id, bundle['entity']['id'], bundle['entity']['versionNumber'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # bundles are replaced atomically so they can be read without a lock
+        temp_path = '%s.%d.%d' % (path, os.getpid(), threading.get_ident())
+        with open(temp_path, 'w') as f:
+            json.dump(bundle, f)
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry.size for entry in self.entries())
+            else:
+                self._size += size
+            if self._size > self.max_size:
+                self._evict()
+        return True
+
+    def _evict(self):
+        # called with the lock held, other processes may have added or evicted bundles so the size is counted again
+        entries = sorted(self.entries(), key=lambda entry: entry.last_used)
+        self._size = sum(entry.size for entry in entries)
+        for entry in entries:
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            self._size -= entry.size
+
+    def remove(self, entity_id, version=None):
+        """
+        Forget the cached bundle of a version of an entity, or of all its versions if version is None, for every user.
+        """
+        with self._lock:
+            for user_dir in self._user_dirs():
+                if version is None:
+                    shutil.rmtree(os.path.join(user_dir.path, entity_id.lower()), ignore_errors=True)
+                else:
+                    try:
+                        os.remove(os.path.join(user_dir.path, entity_id.lower(), '%d.json' % int(version)))
+                    except FileNotFoundError:
+                        pass
+            self._size = None
+
+    def clear(self):
+        """
+        Forget every cached bundle.
+        """
+        with self._lock:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            self._size = None
+
+    def _user_dirs(self):
+        try:
+            return [entry for entry in os.scandir(self.cache_dir)
+                    if entry.name.isdigit() or entry.name == ANONYMOUS_USER_ID]
+        except FileNotFoundError:
+            return []
+
+    def entries(self):
+        """
+        :returns: a list of the MetadataCacheEntry of every cached bundle
+        """
+        entries = []
+        for user_dir in self._user_dirs():
+            try:
+                entity_dirs = list(os.scandir(user_dir.path))
+            except (NotADirectoryError, FileNotFoundError):
+                continue
+            for entity_dir in entity_dirs:
+                try:
+                    bundle_files = list(os.scandir(entity_dir.path))
+                except (NotADirectoryError, FileNotFoundError):
+                    continue
+                for bundle_file in bundle_files:
+                    version, extension = os.path.splitext(bundle_file.name)
+                    if extension != '.json' or not version.isdigit():
+                        continue
+                    try:
+                        stat = bundle_file.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append(MetadataCacheEntry(user_id=user_dir.name, entity_id=entity_dir.name,
+                                                      version=int(version), path=bundle_file.path,
+                                                      size=stat.st_size, last_used=stat.st_mtime))
+        return entries
+
+
+class EntityBundleMemo:
+    """
+    A thread safe, in-memory memo of the bundles of the latest versions of entities bounded to the given number of
+    entries, least recently used entries are dropped first. Copies of the bundles are stored and returned so that
+    changes made by callers don't leak into the memo.
+
+    :param ttl:         the number of seconds a bundle is used for before its etag needs to be checked again
+    :param max_entries: the maximum number of bundles to hold
+    """
+
+    def __init__(self, ttl, max_entries=DEFAULT_BUNDLE_MEMO_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # entity id -> (time the bundle was fetched or last revalidated, bundle)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, entity_id):
+        """
+        :returns: (a copy of the memoized bundle, whether it is younger than the ttl) or (None, False)
+        """
+        with self._lock:
+            entry = self._entries.get(entity_id.lower())
+            if entry is None:
+                return None, False
+            self._entries.move_to_end(entity_id.lower())
+        validated_on, bundle = entry
+        return copy.deepcopy(bundle), time.monotonic() - validated_on < self.ttl
+
+    def put(self, entity_id, bundle):
+        bundle = copy.deepcopy(bundle)
+        with self._lock:
+            self._entries[entity_id.lower()] = (time.monotonic(), bundle)
+            self._entries.move_to_end(entity_id.lower())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def revalidated(self, entity_id, etag):
+        """
+        Record the current etag of an entity.
+
+        :returns: whether the memoized bundle is still current, if not it is forgotten
+        """
+        with self._lock:
+            entry = self._entries.get(entity_id.lower())
+            if entry is None:
+                return False
+            if entry[1].get('entity', {}).get('etag') != etag:
+                del self._entries[entity_id.lower()]
+                return False
+            self._entries[entity_id.lower()] = (time.monotonic(), entry[1])
+            return True
+
+    def forget(self, entity_id):
+        with self._lock:
+            self._entries.pop(entity_id.lower(), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
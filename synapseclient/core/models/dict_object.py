@@ -6,6 +6,8 @@
 import collections.abc
 import json
 
+from synapseclient.core import json_codec
+
 
 class DictObject(dict):
 
@@ -25,4 +27,4 @@ class DictObject(dict):
         return json.dumps(self, sort_keys=True, indent=2)
 
     def json(self, ensure_ascii=True):
-        return json.dumps(self, sort_keys=True, indent=2, ensure_ascii=ensure_ascii)
+        return json_codec.dumps(self, ensure_ascii=ensure_ascii)
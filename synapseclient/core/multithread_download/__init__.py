@@ -3,6 +3,8 @@ from .download_threads import (
     download_file,
     shared_executor,
     SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE,
+    TEMP_FILE_SUFFIX,
 )
 
-__all__ = ['DownloadRequest', 'download_file', 'shared_executor', 'SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE']
+__all__ = ['DownloadRequest', 'download_file', 'shared_executor', 'SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE',
+           'TEMP_FILE_SUFFIX']
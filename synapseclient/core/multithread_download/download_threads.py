@@ -6,17 +6,24 @@ import datetime
 
 import concurrent.futures
 from contextlib import contextmanager
+import hashlib
 from http import HTTPStatus
+import logging
 import os
 from requests import Session, Response
 from requests.adapters import HTTPAdapter
-from typing import Generator, NamedTuple
+import socket
+from typing import Callable, Generator, NamedTuple
 from urllib.parse import urlparse, parse_qs
+import urllib3
 from urllib3.util.retry import Retry
 import time
 
+from synapseclient.core import instrumentation, json_codec
 from synapseclient.core.exceptions import SynapseError
-from synapseclient.core.pool_provider import get_executor
+from synapseclient.core.logging_setup import DEFAULT_LOGGER_NAME
+from synapseclient.core.pool_provider import PRIORITY_TRANSFER, get_executor
+from synapseclient.core.rate_limit import limited_call
 from synapseclient.core.cumulative_transfer_progress import printTransferProgress
 
 # constants
@@ -24,10 +31,41 @@ MAX_QUEUE_SIZE: int = 20
 MAX_RETRIES: int = 20
 MiB: int = 2 ** 20
 SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE: int = 8 * MiB
+# the size of the buffer each thread reads the body of a part into before writing it to the file
+STREAM_BUFFER_SIZE: int = MiB // 4
+# the most bytes received ahead of the hashed prefix of a file that are kept in memory to be hashed, the window
+# grows with the bytes of the parts downloaded at once up to MAX_HASH_WINDOW_SIZE, beyond which they are read back
+HASH_WINDOW_SIZE: int = 64 * MiB
+MAX_HASH_WINDOW_SIZE: int = 512 * MiB
+# the suffix of the temporary file of a multithreaded download, which is preallocated to the full size of the file
+# and filled in any order, so that the single threaded download doesn't mistake it for the start of the file
+TEMP_FILE_SUFFIX: str = '.multithreaded'
+# the suffix of the journal of the parts of a file downloaded so far, kept next to it
+JOURNAL_SUFFIX: str = '.parts'
+
+# the adaptive scheduling of part downloads, see _AdaptiveScheduler
+# the number of parts downloaded at once when a download starts
+INITIAL_CONCURRENCY: int = 4
+# the factor the number of parts downloaded at once is multiplied by while that increases the throughput
+CONCURRENCY_RAMP_FACTOR: int = 2
+# the gain in throughput below which more parts at once are considered to not help
+THROUGHPUT_PLATEAU_GAIN: float = 0.1
+# the shortest time and the fewest parts the throughput of a level of concurrency is measured over
+MIN_LEVEL_SECONDS: float = 2.0
+MIN_LEVEL_PARTS: int = 4
+# the number of seconds a part should take to download at the throughput measured for a single connection
+TARGET_PART_SECONDS: float = 5.0
+# the largest part and the most parts a file is split into
+MAX_PART_SIZE: int = 128 * MiB
+MAX_PARTS_PER_FILE: int = 10000
 ISO_AWS_STR_FORMAT: str = '%Y%m%dT%H%M%SZ'
 CONNECT_FACTOR: int = 3
 BACK_OFF_FACTOR: float = 0.5
 
+# the errors of a connection failing while the body of a part is read, the rest of the part is requested again
+STREAM_ERRORS = (urllib3.exceptions.HTTPError, ConnectionError, socket.timeout)
+
+_logger = logging.getLogger(DEFAULT_LOGGER_NAME)
 
 _thread_local = _threading.local()
 
@@ -151,18 +189,28 @@ class PresignedUrlProvider(object):
 
 
 def _generate_chunk_ranges(file_size: int,
+                           downloaded_ranges=(),
+                           get_part_size: Callable[[], int] = None,
                            ) -> Generator:
     """
     Creates a generator which yields byte ranges and meta data required to make a range request download of url and
     write the data to file_name located at path. Download chunk sizes are 8MB by default.
 
     :param file_size: The size of the file
+    :param downloaded_ranges: The sorted (start, end) byte ranges of the file already downloaded, which are skipped
+    :param get_part_size: A function returning the size of the next range, called as each range is generated
     :return: A generator of byte ranges and meta data needed to download the file in a multi-threaded manner
     """
-    for start in range(0, file_size, SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE):
-        # the start and end of a range in HTTP are both inclusive
-        end = min(start + SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE, file_size) - 1
-        yield start, end
+    position = 0
+    for downloaded_start, downloaded_end in list(downloaded_ranges) + [(file_size, file_size)]:
+        start = position
+        while start < downloaded_start:
+            part_size = get_part_size() if get_part_size else SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE
+            # the start and end of a range in HTTP are both inclusive
+            end = min(start + part_size, downloaded_start) - 1
+            yield start, end
+            start = end + 1
+        position = max(position, downloaded_end + 1)
 
 
 def _pre_signed_url_expiration_time(url: str) -> datetime:
@@ -192,14 +240,15 @@ def _get_new_session() -> Session:
     return session
 
 
-def _get_file_size(url: str) -> int:
+def _get_file_size(url: str, client=None) -> int:
     """
     Gets the size of the file located at url
     :param url: The pre-signed url of the file
+    :param client: The synapseclient whose rate limits the request is subject to
     :return: The size of the file in bytes
     """
     session = _get_new_session()
-    res_get = session.get(url, stream=True)
+    res_get = limited_call(client, url, lambda: session.get(url, stream=True))
     return int(res_get.headers['Content-Length'])
 
 
@@ -208,6 +257,7 @@ def download_file(
     download_request: DownloadRequest,
     *,
     max_concurrent_parts: int = None,
+    compute_md5: bool = False,
 ):
     """
     Main driver for the multi-threaded download. Users an ExecutorService, either set externally onto a thread
@@ -216,6 +266,8 @@ def download_file(
     :param client: A synapseclient
     :param download_request: A batch of DownloadRequest objects specifying what Synapse files to download
     :param max_concurrent_parts: The maximum concurrent number parts to download at once when downloading this file
+    :param compute_md5: Whether to compute the MD5 of the file as its parts are downloaded
+    :return: The hex MD5 digest of the downloaded file if compute_md5 is set, otherwise None
     """
 
     # we obtain an executor from a thread local if we are in the context of a Synapse sync
@@ -224,12 +276,12 @@ def download_file(
     shutdown_after = False
     if not executor:
         shutdown_after = True
-        executor = get_executor(client.max_threads)
+        executor = get_executor(client.max_threads, priority=PRIORITY_TRANSFER)
 
     max_concurrent_parts = max_concurrent_parts or client.max_threads
     try:
         downloader = _MultithreadedDownloader(client, executor, max_concurrent_parts)
-        downloader.download_file(download_request)
+        return downloader.download_file(download_request, compute_md5=compute_md5)
     finally:
         # if we created the Executor for the purposes of processing this download we also
         # shut it down. if it was passed in from the outside then it's managed by the caller
@@ -250,6 +302,388 @@ def _get_thread_session():
     return session
 
 
+def _get_thread_buffer():
+    # get the buffer the thread reads part bodies into, reused for every part so that the memory used by a download
+    # depends on the number of threads but not on the part size
+    buffer = getattr(_thread_local, 'buffer', None)
+    if buffer is None:
+        buffer = _thread_local.buffer = memoryview(bytearray(STREAM_BUFFER_SIZE))
+    return buffer
+
+
+if hasattr(os, 'pwrite'):
+    def _write_at(fd, data, offset):
+        """Write all of data to the file descriptor at the offset without moving its file position"""
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+
+    def _read_at(fd, size, offset):
+        """Read up to size bytes from the file descriptor at the offset without moving its file position"""
+        return os.pread(fd, size, offset)
+else:
+    # there are no positional writes on Windows, the threads take turns seeking and writing the shared descriptor
+    _seek_lock = _threading.Lock()
+
+    def _write_at(fd, data, offset):
+        """Write all of data to the file descriptor at the offset"""
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while data:
+                data = data[os.write(fd, data):]
+
+    def _read_at(fd, size, offset):
+        """Read up to size bytes from the file descriptor at the offset"""
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, size)
+
+
+class _OrderedHasher:
+    """
+    Computes the MD5 of a file from the data written by the part downloads as it lands, in whatever order the parts
+    complete. Data written at the end of the prefix of the file hashed so far is hashed right away by the thread that
+    wrote it, data written beyond it is kept until the prefix reaches it: in memory while no more than window_size
+    bytes are held, otherwise only its range is kept and it is read back from the file, where it is still in the page
+    cache.
+
+    The ranges kept are hashed by a task of the executor, so that a part download that reaches them carries on
+    reading its connection rather than hashing what the other parts wrote. One thread hashes at a time, without
+    holding the lock so that the other threads can carry on writing.
+
+    :param fd:          a readable descriptor of the file
+    :param executor:    the executor that runs the hashing of the ranges kept
+    :param window_size: the most bytes of data written ahead of the hashed prefix to hold in memory
+    """
+
+    def __init__(self, fd, executor, window_size=HASH_WINDOW_SIZE):
+        self._fd = fd
+        self._executor = executor
+        # can be changed as the download goes, e.g. as its parts grow
+        self.window_size = window_size
+        self._md5 = hashlib.md5()
+        # the end of the hashed prefix
+        self._position = 0
+        # start -> (end, the data or None if it has to be read back) of the ranges written beyond the prefix
+        self._pending = {}
+        self._held = 0
+        # whether a thread is hashing
+        self._hashing = False
+        self._failed = False
+        # the task hashing the ranges kept, if any
+        self._task = None
+        # set to stop hashing when the download fails
+        self._aborted = False
+        self._lock = _threading.Condition()
+
+    @property
+    def position(self):
+        """The number of bytes at the start of the file hashed so far"""
+        return self._position
+
+    def written(self, offset, data):
+        """
+        Hash data written to the file at the offset as soon as the bytes before it have been.
+
+        :param offset:  the offset of the data in the file
+        :param data:    a bytes-like object, it is copied if it needs to be kept
+        """
+        with self._lock:
+            if offset != self._position or self._hashing:
+                held = None
+                if self._held + len(data) <= self.window_size:
+                    held = bytes(data)
+                    self._held += len(held)
+                self._pending[offset] = (offset + len(data), held)
+                return
+            self._hashing = True
+        try:
+            self._md5.update(data)
+        except BaseException:
+            self._fail()
+            raise
+        with self._lock:
+            self._position = offset + len(data)
+            if self._position not in self._pending:
+                self._hashing = False
+                self._lock.notify_all()
+                return
+        self._submit_catch_up()
+
+    def written_before(self, start, end):
+        """
+        Hash a range of the file written before the hasher was created, e.g. by an interrupted download, once the
+        bytes before it have been, see :py:meth:`advance`.
+
+        :param start:   the offset of the range
+        :param end:     the offset of the first byte after the range
+        """
+        with self._lock:
+            self._pending[start] = (end, None)
+
+    def advance(self):
+        """
+        Start hashing the ranges that follow the hashed prefix in the background unless a thread already is. Ranges
+        are otherwise only hashed once the data at the end of the prefix is written.
+        """
+        with self._lock:
+            if self._hashing or self._position not in self._pending:
+                return
+            self._hashing = True
+        self._submit_catch_up()
+
+    def _submit_catch_up(self):
+        # called by the thread that set _hashing
+        try:
+            self._task = self._executor.submit(self._catch_up)
+        except BaseException:
+            self._fail()
+            raise
+
+    def _catch_up(self):
+        # hashes the ranges that follow the hashed prefix until there are no more
+        try:
+            while True:
+                with self._lock:
+                    if self._aborted or self._position not in self._pending:
+                        self._hashing = False
+                        self._lock.notify_all()
+                        return
+                    end, data = self._pending.pop(self._position)
+                    if data is not None:
+                        self._held -= len(data)
+                if data is None:
+                    self._hash_from_file(self._position, end)
+                else:
+                    self._md5.update(data)
+                with self._lock:
+                    self._position = end
+        except BaseException:
+            self._fail()
+            raise
+
+    def _fail(self):
+        with self._lock:
+            # the range being hashed is lost
+            self._failed = True
+            self._hashing = False
+            self._lock.notify_all()
+
+    def _hash_from_file(self, start, end):
+        position = start
+        while position < end:
+            if self._aborted:
+                raise SynapseError('The download was aborted')
+            data = _read_at(self._fd, min(end - position, STREAM_BUFFER_SIZE), position)
+            if not data:
+                raise SynapseError(f'Could not read back bytes {position}-{end - 1} of the file to hash them')
+            self._md5.update(data)
+            position += len(data)
+
+    def abort(self):
+        """
+        Stop hashing, returns once no thread is reading the file so that its descriptor can be closed.
+        """
+        with self._lock:
+            self._aborted = True
+            if self._task is not None and self._task.cancel():
+                # the hashing task never started
+                self._hashing = False
+            while self._hashing:
+                self._lock.wait()
+
+    def hexdigest(self, file_size):
+        """
+        :param file_size: the size of the file
+
+        :returns: the hex MD5 digest of the file once all of it has been written
+        """
+        self.advance()
+        with self._lock:
+            # e.g. the ranges of an interrupted download being hashed in the background
+            while self._hashing:
+                self._lock.wait()
+            if self._failed or self._position != file_size:
+                raise SynapseError(f'Only the first {self._position} of {file_size} bytes of the file were hashed')
+            return self._md5.hexdigest()
+
+
+class _DownloadJournal:
+    """
+    Records the byte ranges of a file downloaded so far in a sidecar file next to it, so that a download interrupted
+    by an error or by the end of the process can be resumed by downloading only the missing ranges. The first line
+    identifies the download, every other line holds a downloaded range, e.g. ``0-8388607``, both ends inclusive.
+    Ranges are only recorded once their bytes have been written to the file, a line cut short by a crash is ignored.
+
+    :param path:            the path of the file being downloaded
+    :param file_handle_id:  the id of the file handle being downloaded
+    :param file_size:       the size of the file
+    """
+
+    def __init__(self, path, file_handle_id, file_size):
+        self.path = path + JOURNAL_SUFFIX
+        self._data_path = path
+        self._header = json_codec.dumps({'fileHandleId': str(file_handle_id), 'fileSize': file_size})
+        self._file_size = file_size
+        self._file = None
+
+    def load(self):
+        """
+        :returns: a sorted list of the (start, end) byte ranges, both inclusive, recorded by a previous download of
+                  the same file, empty unless both the journal and a file of the expected size exist
+        """
+        try:
+            if os.path.getsize(self._data_path) != self._file_size:
+                return []
+            with open(self.path, 'r') as f:
+                lines = f.read().split('\n')
+        except OSError:
+            return []
+        if lines[0] != self._header:
+            return []
+
+        ranges = []
+        # the last line is either empty or was cut short
+        for line in lines[1:-1]:
+            try:
+                start, end = (int(offset) for offset in line.split('-'))
+            except ValueError:
+                continue
+            if 0 <= start <= end < self._file_size:
+                ranges.append((start, end))
+
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def open(self, resume):
+        """
+        Start recording ranges, after those already recorded if resuming or in a new journal otherwise.
+        """
+        if resume:
+            self._file = open(self.path, 'a')
+        else:
+            self._file = open(self.path, 'w')
+            self._file.write(self._header + '\n')
+            self._file.flush()
+
+    def record(self, start, end):
+        """Record that the bytes from start to end, inclusive, have been written to the file"""
+        self._file.write(f'{start}-{end}\n')
+        # flushed so that the range survives the process, the MD5 of the file catches what doesn't survive the system
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """Close and delete the journal once the download is complete"""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class _AdaptiveScheduler:
+    """
+    Chooses the size of the ranges of a file to download and the number of them to download at once.
+
+    Parts are sized so that one takes about TARGET_PART_SECONDS to download at the throughput measured for a single
+    connection, so that a retry doesn't cost much on a lossy link while a fast one doesn't make an excessive number
+    of requests, and never smaller than needed to split the file into at most MAX_PARTS_PER_FILE parts.
+
+    The number of parts downloaded at once starts at INITIAL_CONCURRENCY and is multiplied by CONCURRENCY_RAMP_FACTOR,
+    up to max_concurrency, for as long as that increases the aggregate throughput by at least THROUGHPUT_PLATEAU_GAIN.
+    Once it doesn't, the level with the best throughput is kept.
+
+    :param file_size:       the size of the file
+    :param max_concurrency: the most parts to download at once
+    :param logger:          the logger the decisions are logged to at the debug level
+    """
+
+    def __init__(self, file_size, max_concurrency, logger):
+        self._logger = logger
+        self._lock = _threading.Lock()
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = min(INITIAL_CONCURRENCY, self.max_concurrency)
+        self._ramping = self.concurrency < self.max_concurrency
+        self._min_part_size = max(SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE, -(-file_size // MAX_PARTS_PER_FILE))
+        self.part_size = self._min_part_size
+
+        # the throughput of a single connection in bytes per second, a moving average
+        self._stream_throughput = None
+        # the best aggregate throughput and the concurrency it was measured at
+        self._best_throughput = 0.0
+        self._best_concurrency = self.concurrency
+        # the parts completed since the current level of concurrency was set
+        self._level_started = time.monotonic()
+        self._level_bytes = 0
+        self._level_parts = 0
+
+        self._logger.debug(f'Downloading {file_size} bytes in parts of {self.part_size} bytes,'
+                           f' {self.concurrency} at once')
+
+    def part_completed(self, size, seconds):
+        """
+        Record a completed part and adapt the part size and concurrency to the throughput measured.
+
+        :param size:    the number of bytes of the part
+        :param seconds: the number of seconds the part took to download
+        """
+        with self._lock:
+            if seconds > 0:
+                throughput = size / seconds
+                self._stream_throughput = throughput if self._stream_throughput is None \
+                    else 0.7 * self._stream_throughput + 0.3 * throughput
+            self._level_bytes += size
+            self._level_parts += 1
+
+            elapsed = time.monotonic() - self._level_started
+            if elapsed < MIN_LEVEL_SECONDS or self._level_parts < max(MIN_LEVEL_PARTS, self.concurrency):
+                return
+            self._adapt_concurrency(self._level_bytes / elapsed)
+            self._adapt_part_size()
+            self._level_started = time.monotonic()
+            self._level_bytes = 0
+            self._level_parts = 0
+
+    def _adapt_concurrency(self, throughput):
+        if not self._ramping:
+            return
+        if throughput >= self._best_throughput * (1 + THROUGHPUT_PLATEAU_GAIN):
+            self._best_throughput = throughput
+            self._best_concurrency = self.concurrency
+            self.concurrency = min(self.concurrency * CONCURRENCY_RAMP_FACTOR, self.max_concurrency)
+            self._ramping = self.concurrency < self.max_concurrency
+            self._logger.debug(f'Aggregate download throughput {throughput / MiB:.1f} MiB/s with'
+                               f' {self._best_concurrency} parts at once, downloading {self.concurrency} at once')
+        else:
+            self._ramping = False
+            self._logger.debug(f'Aggregate download throughput {throughput / MiB:.1f} MiB/s with {self.concurrency}'
+                               f' parts at once is no better than {self._best_throughput / MiB:.1f} MiB/s with'
+                               f' {self._best_concurrency}, downloading {self._best_concurrency} at once')
+            self.concurrency = self._best_concurrency
+
+    def _adapt_part_size(self):
+        if not self._stream_throughput:
+            return
+        part_size = int(self._stream_throughput * TARGET_PART_SECONDS) // MiB * MiB
+        part_size = min(max(part_size, self._min_part_size), max(MAX_PART_SIZE, self._min_part_size))
+        # small changes aren't worth logging or changing for
+        if abs(part_size - self.part_size) > self.part_size // 4:
+            self._logger.debug(f'Download throughput per connection {self._stream_throughput / MiB:.1f} MiB/s,'
+                               f' downloading parts of {part_size} bytes')
+            self.part_size = part_size
+
+
 class _MultithreadedDownloader:
     """
     An object to manage the downloading of a Synapse file in concurrent chunks from a URL
@@ -268,36 +702,71 @@ class _MultithreadedDownloader:
         self._syn = syn
         self._executor = executor
         self._max_concurrent_parts = max_concurrent_parts
-
-    def download_file(self, request):
+        # set to stop the running part downloads when the download fails
+        self._aborted = _threading.Event()
+        # hashes the parts as they are written when the MD5 of the file is computed
+        self._hasher = None
+        # records the parts downloaded so far
+        self._journal = None
+        # chooses the part size and the number of parts downloaded at once
+        self._scheduler = None
+
+    def download_file(self, request, compute_md5=False):
+        """
+        :returns: the hex MD5 digest of the file if compute_md5 is set, otherwise None
+        """
         url_provider = PresignedUrlProvider(self._syn, request)
 
         url_info = url_provider.get_info()
-        file_size = _get_file_size(url_info.url)
-        chunk_range_generator = _generate_chunk_ranges(file_size)
-
-        self._prep_file(request)
+        file_size = _get_file_size(url_info.url, self._syn)
+
+        # resume a previous download of the file if there is one
+        self._journal = _DownloadJournal(request.path, request.file_handle_id, file_size)
+        downloaded_ranges = self._journal.load()
+        if downloaded_ranges:
+            downloaded_size = sum(end - start + 1 for start, end in downloaded_ranges)
+            self._syn.logger.info(f'Resuming the download of {request.path},'
+                                  f' {downloaded_size} of {file_size} bytes were downloaded previously')
+        else:
+            downloaded_size = 0
+            self._prep_file(request, file_size)
+        self._journal.open(resume=bool(downloaded_ranges))
+
+        self._scheduler = _AdaptiveScheduler(file_size, self._max_concurrent_parts, self._syn.logger)
+        chunk_range_generator = _generate_chunk_ranges(file_size, downloaded_ranges,
+                                                       get_part_size=lambda: self._scheduler.part_size)
 
         transfer_status = TransferStatus(file_size)
+        transfer_status.transferred = downloaded_size
 
+        # the part downloads write their ranges straight into the file through a descriptor shared by all of them,
         # the entrant thread runs in a loop doing the following:
         # 1. scheduling any additional part downloads as previous parts are completed
-        # 2. writing any completed parts out to the local disk
+        # 2. recording the completed parts in the journal and reporting the progress
         # 3. waiting for additional parts to complete
+        fd = os.open(request.path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        if compute_md5:
+            self._hasher = _OrderedHasher(fd, self._executor, window_size=self._hash_window_size())
+            if downloaded_ranges:
+                for start, end in downloaded_ranges:
+                    self._hasher.written_before(start, end + 1)
+                # the ranges downloaded before are read back and hashed alongside the download of the rest
+                self._hasher.advance()
         pending_futures = set()
         completed_futures = set()
         try:
             while True:
                 submitted_futures = self._submit_chunks(
                     url_provider,
+                    fd,
                     chunk_range_generator,
                     pending_futures,
                 )
+                pending_futures = pending_futures.union(submitted_futures)
 
-                self._write_chunks(request, completed_futures, transfer_status)
+                self._update_progress(request, completed_futures, transfer_status)
 
                 # once there is nothing else pending we are done with the file download
-                pending_futures = pending_futures.union(submitted_futures)
                 if not pending_futures:
                     break
 
@@ -310,22 +779,109 @@ class _MultithreadedDownloader:
 
         except BaseException:
             # on any exception (e.g. KeyboardInterrupt), attempt to cancel any pending futures.
-            # if they are already running this won't have any effect though
+            # parts already running stop at their next write, the file can't be closed under them
+            # since its descriptor could be reused by another file
+            self._aborted.set()
             for future in pending_futures:
                 future.cancel()
-
-            try:
-                os.remove(request.path)
-            except FileNotFoundError:
-                pass
+            concurrent.futures.wait(pending_futures)
+            if self._hasher is not None:
+                # e.g. reading back the ranges of an interrupted download
+                self._hasher.abort()
+            os.close(fd)
+
+            # the file is kept along with the journal of the parts that were downloaded
+            # so that downloading it again only downloads the rest
+            for future in completed_futures.union(pending_futures):
+                if not future.cancelled() and future.exception() is None:
+                    start, chunk_size = future.result()
+                    self._journal.record(start, start + chunk_size - 1)
+            self._journal.close()
 
             raise
 
-    @staticmethod
-    def _get_response_with_retry(presigned_url_provider, start: int, end: int) -> Response:
+        try:
+            # the last part was hashed as it was written
+            return self._hasher.hexdigest(file_size) if self._hasher is not None else None
+        finally:
+            os.close(fd)
+            self._journal.remove()
+
+    def _download_part(self, presigned_url_provider, fd, start: int, end: int):
+        """
+        Download a range of the file and write it into the file, requesting the rest of the range again if the
+        connection fails while its body is read.
+
+        :returns: the start of the range and the number of bytes written
+        """
+        started = time.monotonic()
+        with instrumentation.measure(instrumentation.KIND_PART_DOWNLOAD, 'get', presigned_url_provider.get_info().url,
+                                     endpoint=instrumentation.PRESIGNED_URL_ENDPOINT) as measurement:
+            position = start
+            try_counter = 0
+            while True:
+                _, response = self._get_response_with_retry(presigned_url_provider, position, end)
+                position += self._write_response(response, fd, position, end)
+                if position > end:
+                    break
+
+                try_counter += 1
+                if try_counter >= MAX_RETRIES:
+                    raise SynapseError(
+                        f'Could not download the file: {presigned_url_provider.get_info().file_name},'
+                        f' please try again.')
+                instrumentation.record_retry(0)
+            measurement.response(response, bytes_received=end - start + 1)
+        if self._scheduler is not None:
+            self._scheduler.part_completed(end - start + 1, time.monotonic() - started)
+            if self._hasher is not None:
+                self._hasher.window_size = self._hash_window_size()
+        return start, end - start + 1
+
+    def _hash_window_size(self):
+        # the parts downloading at once are written ahead of the hashed prefix, memory is traded for reading them
+        # back from the file up to MAX_HASH_WINDOW_SIZE
+        in_flight = self._scheduler.part_size * self._scheduler.concurrency
+        return min(max(HASH_WINDOW_SIZE, in_flight), MAX_HASH_WINDOW_SIZE)
+
+    def _write_response(self, response, fd, offset: int, end: int) -> int:
+        """
+        Write the body of a range response into the file at offset through the thread's buffer.
+
+        :returns: the number of bytes written before the body ended or the connection failed
+        """
+        buffer = _get_thread_buffer()
+        written = 0
+        remaining = end - offset + 1
+        try:
+            while remaining > 0:
+                if self._aborted.is_set():
+                    raise SynapseError('The download was aborted')
+                read = response.raw.readinto(buffer[:min(remaining, len(buffer))])
+                if not read:
+                    break
+                _write_at(fd, buffer[:read], offset + written)
+                if self._hasher is not None:
+                    self._hasher.written(offset + written, buffer[:read])
+                written += read
+                remaining -= read
+        except STREAM_ERRORS as ex:
+            _logger.debug("The connection failed after %d bytes of the range %d-%d: %s", written, offset, end, ex)
+        finally:
+            if remaining > 0:
+                # the connection is in an unknown state, don't return it to the pool
+                response.close()
+        return written
+
+    def _get_response_with_retry(self, presigned_url_provider, start: int, end: int) -> Response:
         session = _get_thread_session()
         range_header = {'Range': f'bytes={start}-{end}'}
-        response = session.get(presigned_url_provider.get_info().url, headers=range_header, stream=True)
+
+        def get_range():
+            url = presigned_url_provider.get_info().url
+            return limited_call(self._syn, url, lambda: session.get(url, headers=range_header, stream=True))
+
+        response = get_range()
         # try request until successful or out of retries
         try_counter = 1
         while response.status_code != HTTPStatus.PARTIAL_CONTENT:
@@ -333,26 +889,32 @@ class _MultithreadedDownloader:
                 raise SynapseError(
                     f'Could not download the file: {presigned_url_provider.get_info().file_name},'
                     f' please try again.')
-            response = session.get(presigned_url_provider.get_info().url, headers=range_header, stream=True)
+            instrumentation.record_retry(0, response)
+            response = get_range()
             try_counter += 1
         return start, response
 
     @staticmethod
-    def _prep_file(request):
-        # upon receiving the parts of the file we'll open the file
-        # and write the specific byte ranges, but to open it in
-        # r+ mode we need to to exist and be empty
-        open(request.path, 'wb').close()
-
-    def _submit_chunks(self, url_provider, chunk_range_generator, pending_futures):
-        submit_count = self._max_concurrent_parts - len(pending_futures)
+    def _prep_file(request, file_size):
+        # the parts write their byte ranges into the file as they are received
+        # so it is created empty and extended to its full size up front
+        with open(request.path, 'wb') as f:
+            f.truncate(file_size)
+
+    def _submit_chunks(self, url_provider, fd, chunk_range_generator, pending_futures):
+        concurrency = self._scheduler.concurrency if self._scheduler is not None else self._max_concurrent_parts
+        submit_count = concurrency - len(pending_futures)
         submitted_futures = set()
+        if submit_count <= 0:
+            # the concurrency was lowered
+            return submitted_futures
 
         for chunk_range in chunk_range_generator:
             start, end = chunk_range
             chunk_future = self._executor.submit(
-                self._get_response_with_retry,
+                self._download_part,
                 url_provider,
+                fd,
                 start,
                 end,
             )
@@ -363,21 +925,16 @@ class _MultithreadedDownloader:
 
         return submitted_futures
 
-    @staticmethod
-    def _write_chunks(request, completed_futures, transfer_status):
-        if completed_futures:
-            with open(request.path, 'rb+') as file_write:
-                for chunk_future in completed_futures:
-                    start, chunk_response = chunk_future.result()
-                    chunk_data = chunk_response.content
-                    file_write.seek(start)
-                    file_write.write(chunk_response.content)
-
-                    transfer_status.transferred += len(chunk_data)
-                    printTransferProgress(transfer_status.transferred,
-                                          transfer_status.total_bytes_to_be_transferred,
-                                          'Downloading ', os.path.basename(request.path),
-                                          dt=transfer_status.elapsed_time())
+    def _update_progress(self, request, completed_futures, transfer_status):
+        for chunk_future in completed_futures:
+            start, chunk_size = chunk_future.result()
+            self._journal.record(start, start + chunk_size - 1)
+
+            transfer_status.transferred += chunk_size
+            printTransferProgress(transfer_status.transferred,
+                                  transfer_status.total_bytes_to_be_transferred,
+                                  'Downloading ', os.path.basename(request.path),
+                                  dt=transfer_status.elapsed_time())
 
     @staticmethod
     def _check_for_errors(request, completed_futures):
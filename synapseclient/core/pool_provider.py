@@ -4,14 +4,24 @@ Both a multiprocessing style ThreadPool and an Executor based pool
 are available, Executors should be preferred for new work as it provides
 a more modern interface.
 
+Executors given a priority are lanes of a single process wide pool of threads shared by every Synapse client,
+so that concurrent uploads, downloads and syncs don't each start their own threads. The pool runs queued tasks of a
+higher priority first, e.g. PRIORITY_METADATA tasks ahead of PRIORITY_TRANSFER ones, and its size can be set with
+:py:func:`configure_shared_executor`.
+
 To use these wrappers for single thread environment, set the following:
 
     synapseclient.config.single_threaded = True
 """
 
+import collections
 from concurrent.futures import Executor, Future, ThreadPoolExecutor
+import concurrent.futures
+import functools
 import multiprocessing
 import multiprocessing.dummy
+import os
+import threading
 
 from . import config
 
@@ -19,6 +29,14 @@ from . import config
 # https://docs.python.org/3/library/concurrent.futures.html#concurrent.futures.ThreadPoolExecutor
 DEFAULT_NUM_THREADS = multiprocessing.cpu_count() + 4
 
+# the default number of threads in the process wide shared pool, room for a sync and its transfers at once
+DEFAULT_SHARED_NUM_THREADS = 2 * DEFAULT_NUM_THREADS
+
+# task priorities of the shared pool, lower values run first
+PRIORITY_METADATA = 0
+PRIORITY_TRANSFER = 1
+PRIORITIES = (PRIORITY_METADATA, PRIORITY_TRANSFER)
+
 
 class SingleThreadPool:
 
@@ -48,6 +66,10 @@ class SingleThreadExecutor(Executor):
 
         return f
 
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        # Executor.shutdown only takes cancel_futures from Python 3.9, every future is done by the time it is submitted
+        self._shutdown = True
+
 
 class FakeLock:
 
@@ -69,6 +91,181 @@ class SingleValue:
         return FakeLock()
 
 
+class PrioritizedExecutor:
+    """
+    A pool of threads shared by tasks of different priorities. Threads are started as tasks are submitted, up to
+    max_workers of them, and each picks the queued task of the highest priority whose priority isn't already running
+    its limit of tasks. Tasks of the same priority run in the order they were submitted.
+
+    PRIORITY_METADATA tasks may wait on PRIORITY_TRANSFER tasks, e.g. a sync's file downloads wait on the parts of the
+    file, so they are limited to fewer than max_workers threads at once to always leave threads for the transfers.
+    PRIORITY_TRANSFER tasks must not wait on other tasks of the pool.
+
+    Tasks are submitted through the Executors returned by :py:meth:`lane`.
+
+    :param max_workers:         the maximum number of threads, at least 2
+    :param metadata_workers:    the maximum number of PRIORITY_METADATA tasks running at once, fewer than max_workers.
+                                Defaults to half of max_workers.
+    """
+
+    def __init__(self, max_workers=DEFAULT_SHARED_NUM_THREADS, metadata_workers=None):
+        self._condition = threading.Condition()
+        self._queues = {priority: collections.deque() for priority in PRIORITIES}
+        self._running = dict.fromkeys(PRIORITIES, 0)
+        self._workers = 0
+        self._idle = 0
+        self.configure(max_workers, metadata_workers)
+
+    def configure(self, max_workers, metadata_workers=None):
+        """Change the number of threads, any threads beyond the new maximum stop once they are done with their task"""
+        max_workers = max(max_workers, 2)
+        metadata_workers = min(max(metadata_workers or max_workers // 2, 1), max_workers - 1)
+        with self._condition:
+            self.max_workers = max_workers
+            self._limits = {PRIORITY_METADATA: metadata_workers, PRIORITY_TRANSFER: max_workers}
+            # let idle threads beyond the new maximum stop and the others pick up anything newly allowed to run
+            self._idle = 0
+            self._condition.notify_all()
+
+    def lane(self, priority, max_workers=None):
+        """
+        :param priority:    the priority of the tasks submitted to the returned Executor
+        :param max_workers: the maximum number of those tasks running at once, None for as many as the pool allows
+
+        :returns: an Executor for submitting tasks to this pool, shutting it down waits for (or cancels) only the tasks
+                  submitted through it and leaves the pool running
+        """
+        if priority not in PRIORITIES:
+            raise ValueError("Invalid priority %s, must be one of %s" % (priority, PRIORITIES))
+        return _LaneExecutor(self, priority, max_workers)
+
+    def _submit(self, priority, task):
+        with self._condition:
+            self._queues[priority].append(task)
+            if self._idle:
+                self._idle -= 1
+                self._condition.notify()
+            elif self._workers < self.max_workers:
+                self._workers += 1
+                threading.Thread(target=self._work, name='synapse-shared-%d' % self._workers, daemon=True).start()
+
+    def _next_task(self):
+        for priority in PRIORITIES:
+            if self._queues[priority] and self._running[priority] < self._limits[priority]:
+                return priority, self._queues[priority].popleft()
+        return None, None
+
+    def _work(self):
+        priority = None
+        while True:
+            with self._condition:
+                if priority is not None:
+                    self._running[priority] -= 1
+                while True:
+                    if self._workers > self.max_workers:
+                        self._workers -= 1
+                        return
+                    priority, task = self._next_task()
+                    if task is not None:
+                        break
+                    self._idle += 1
+                    self._condition.wait()
+                self._running[priority] += 1
+            task()
+
+
+class _LaneExecutor(Executor):
+    """The tasks of one priority submitted to a PrioritizedExecutor, optionally with a limit of their own"""
+
+    def __init__(self, pool, priority, max_workers=None):
+        self._pool = pool
+        self._priority = priority
+        self._max_workers = max_workers
+        self._lock = threading.Lock()
+        self._futures = set()
+        self._pending = collections.deque()
+        self._running = 0
+        self._shutdown = False
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        task = functools.partial(self._run, future, fn, args, kwargs)
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            self._futures.add(future)
+            if self._max_workers is not None and self._running >= self._max_workers:
+                self._pending.append(task)
+                return future
+            self._running += 1
+        self._pool._submit(self._priority, task)
+        return future
+
+    def _run(self, future, fn, args, kwargs):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as ex:
+                    future.set_exception(ex)
+                else:
+                    future.set_result(result)
+        finally:
+            with self._lock:
+                self._futures.discard(future)
+                next_task = self._pending.popleft() if self._pending else None
+                if next_task is None:
+                    self._running -= 1
+            if next_task is not None:
+                self._pool._submit(self._priority, next_task)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._lock:
+            self._shutdown = True
+            futures = list(self._futures)
+        if cancel_futures:
+            for future in futures:
+                future.cancel()
+        if wait:
+            concurrent.futures.wait(futures)
+
+
+_shared_executor = None
+_shared_executor_lock = threading.Lock()
+
+
+def get_shared_executor():
+    """
+    :returns: the PrioritizedExecutor shared by the whole process
+    """
+    global _shared_executor
+    with _shared_executor_lock:
+        if _shared_executor is None:
+            _shared_executor = PrioritizedExecutor()
+        return _shared_executor
+
+
+def configure_shared_executor(max_workers, metadata_workers=None):
+    """
+    Set the size of the pool of threads shared by the whole process, see :py:class:`PrioritizedExecutor`.
+
+    :param max_workers:         the maximum number of threads
+    :param metadata_workers:    the maximum number of threads running PRIORITY_METADATA tasks
+    """
+    get_shared_executor().configure(max_workers, metadata_workers)
+
+
+def _reset_shared_executor():
+    # the threads of the shared pool don't survive a fork
+    global _shared_executor, _shared_executor_lock
+    _shared_executor = None
+    _shared_executor_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_shared_executor)
+
+
 def get_pool():
     if config.single_threaded:
         return SingleThreadPool()
@@ -76,17 +273,21 @@ def get_pool():
         return multiprocessing.dummy.Pool(DEFAULT_NUM_THREADS)
 
 
-def get_executor(thread_count=DEFAULT_NUM_THREADS):
+def get_executor(thread_count=DEFAULT_NUM_THREADS, priority=None):
     """
     Provides an Executor as defined by the client config suitable
     for running tasks work as defined by the client config.
 
     :param thread_count:        number of concurrent threads
+    :param priority:            PRIORITY_METADATA or PRIORITY_TRANSFER to run the tasks in the process wide shared
+                                pool of threads, at most thread_count of them at once, or None for a new pool
 
     :return: an Executor
     """
     if config.single_threaded:
         return SingleThreadExecutor()
+    elif priority is not None:
+        return get_shared_executor().lane(priority, max_workers=thread_count)
     else:
         return ThreadPoolExecutor(max_workers=thread_count)
 
@@ -0,0 +1,288 @@
+"""
+Client side rate limiting of the requests sent to a host, shared by all the threads of a Synapse client.
+
+Retrying throttled requests on their own makes every thread back off and retry independently, so many threads send
+their retries in bursts and are throttled again. An :py:class:`AdaptiveRateLimiter` instead learns what a host will
+take from its throttling responses (429 Too Many Requests and 503 Service Unavailable):
+
+* every request takes a token from a bucket refilled at the learned rate, and no more than the learned number of
+  requests are in flight at once
+* neither is limited until the host first throttles a request, after that both are halved on each throttling
+  response and grow back additively with every successful request (AIMD), probing for the highest sustainable rate
+* a Retry-After header pauses all requests to the host until the time given has passed
+
+The requests of the asyncio client go through the same limiters, waiting with :py:func:`asyncio.sleep` rather than
+blocking the event loop.
+"""
+
+import asyncio
+import collections
+import email.utils
+import math
+import threading
+import time
+import urllib.parse
+
+from synapseclient.core import instrumentation
+from synapseclient.core.instrumentation import THROTTLING_STATUS_CODES
+
+# the lowest rate, in requests per second, the limiter slows down to
+MIN_RATE = 0.5
+# the factor the rate and concurrency are cut by on throttling
+DECREASE_FACTOR = 0.5
+# the throttling responses within this many seconds of a decrease are answers to requests sent before it
+DECREASE_INTERVAL = 1.0
+# how many requests per second the rate grows by each second of successful requests
+RATE_INCREASE = 1.0
+# the number of seconds over which the rate of requests being sent is measured
+RATE_WINDOW = 5.0
+# the longest Retry-After honored, in seconds
+MAX_RETRY_AFTER = 300
+# how often, in seconds, a coroutine waiting for a request in flight to be released checks again
+ASYNC_POLL_INTERVAL = 0.05
+
+
+def _parse_retry_after(value):
+    """
+    :returns: the number of seconds to wait given by a Retry-After header value or None
+    """
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        seconds = retry_at.timestamp() - time.time()
+    return min(max(seconds, 0), MAX_RETRY_AFTER)
+
+
+class AdaptiveRateLimiter:
+    """
+    Limits the rate and concurrency of the requests sent to one host, see the module documentation.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        # requests per second and requests in flight, None until the host first throttles
+        self._rate = None
+        self._concurrency = None
+        self._tokens = 0.0
+        self._refilled_at = time.monotonic()
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._last_decrease = -math.inf
+        # the start times of the requests sent within the last RATE_WINDOW seconds
+        self._sent = collections.deque()
+
+    @property
+    def rate(self):
+        """The learned number of requests per second or None if not limited"""
+        return self._rate
+
+    @property
+    def concurrency(self):
+        """The learned number of requests in flight at once or None if not limited"""
+        return int(self._concurrency) if self._concurrency is not None else None
+
+    def call(self, function):
+        """
+        Send a request once the limits allow it and learn from its response.
+
+        :param function:    a function with no arguments sending the request and returning its requests.Response
+
+        :returns: function()
+        """
+        self._acquire()
+        try:
+            response = function()
+        finally:
+            self._release()
+        self._learn(response)
+        return response
+
+    async def call_async(self, function):
+        """
+        Send a request from an asyncio event loop once the limits allow it and learn from its response, see
+        :py:meth:`call`.
+
+        :param function:    a coroutine function with no arguments sending the request and returning a
+                            requests.Response
+
+        :returns: await function()
+        """
+        await self._acquire_async()
+        try:
+            response = await function()
+        finally:
+            self._release()
+        self._learn(response)
+        return response
+
+    def _acquire(self):
+        with self._condition:
+            started = None
+            while True:
+                now = time.monotonic()
+                wait = self._wait_time(now)
+                if wait <= 0:
+                    break
+                started = started or now
+                self._condition.wait(None if wait == math.inf else wait)
+            self._take(now)
+        if started is not None:
+            instrumentation.record_throttle_wait(now - started)
+
+    async def _acquire_async(self):
+        started = None
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                wait = self._wait_time(now)
+                if wait <= 0:
+                    self._take(now)
+                    break
+            started = started or now
+            # the condition can't be waited on without blocking the event loop
+            await asyncio.sleep(ASYNC_POLL_INTERVAL if wait == math.inf else wait)
+        if started is not None:
+            instrumentation.record_throttle_wait(now - started)
+
+    def _take(self, now):
+        # called with the condition held once the request can be sent
+        self._in_flight += 1
+        if self._rate is not None:
+            self._tokens -= 1
+        self._sent.append(now)
+        while self._sent and self._sent[0] < now - RATE_WINDOW:
+            self._sent.popleft()
+
+    def _release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def _learn(self, response):
+        status_code = getattr(response, 'status_code', None)
+        if status_code in THROTTLING_STATUS_CODES:
+            self.throttled(_parse_retry_after(response.headers.get('Retry-After')))
+        elif isinstance(status_code, int) and status_code < 400:
+            self.succeeded()
+
+    def _wait_time(self, now):
+        # called with the condition held, returns how long to wait before the next request can be sent
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._concurrency is not None and self._in_flight >= int(self._concurrency):
+            # woken by the release of a request
+            return math.inf
+        if self._rate is not None:
+            self._tokens = min(max(self._rate, 1.0), self._tokens + (now - self._refilled_at) * self._rate)
+            self._refilled_at = now
+            if self._tokens < 1:
+                return (1 - self._tokens) / self._rate
+        return 0
+
+    def succeeded(self):
+        """Grow the limits additively after a request that wasn't throttled"""
+        with self._condition:
+            if self._rate is not None:
+                # one request per second more for every second of requests at the current rate
+                self._rate += RATE_INCREASE / self._rate
+            if self._concurrency is not None:
+                # one request in flight more for every round of requests at the current concurrency
+                self._concurrency += 1 / self._concurrency
+            self._condition.notify_all()
+
+    def throttled(self, retry_after=None):
+        """
+        Cut the limits after a throttled request.
+
+        :param retry_after: the number of seconds the host asked to wait before sending further requests
+        """
+        with self._condition:
+            now = time.monotonic()
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+            if now - self._last_decrease < DECREASE_INTERVAL:
+                return
+            self._last_decrease = now
+
+            while self._sent and self._sent[0] < now - RATE_WINDOW:
+                self._sent.popleft()
+            sent_rate = len(self._sent) / RATE_WINDOW
+            rate = sent_rate if self._rate is None else min(self._rate, max(sent_rate, MIN_RATE))
+            self._rate = max(rate * DECREASE_FACTOR, MIN_RATE)
+            self._tokens = min(self._tokens, 0.0)
+            # the throttled request itself was released before it was found to be throttled
+            concurrency = self._in_flight + 1 if self._concurrency is None else self._concurrency
+            self._concurrency = max(concurrency * DECREASE_FACTOR, 1.0)
+
+
+class HostRateLimiters:
+    """
+    An :py:class:`AdaptiveRateLimiter` for each host requests are sent to, e.g. the Synapse endpoints and the storage
+    behind pre-signed URLs are throttled separately.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._limiters = {}
+
+    def for_url(self, url):
+        """
+        :returns: the AdaptiveRateLimiter of the host of the url
+        """
+        host = urllib.parse.urlparse(url).netloc.lower()
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = self._limiters[host] = AdaptiveRateLimiter()
+            return limiter
+
+    def call(self, url, function):
+        """
+        Send a request to the url through the limiter of its host, see :py:meth:`AdaptiveRateLimiter.call`.
+        """
+        return self.for_url(url).call(function)
+
+    async def call_async(self, url, function):
+        """
+        Send a request to the url from an asyncio event loop through the limiter of its host, see
+        :py:meth:`AdaptiveRateLimiter.call_async`.
+        """
+        return await self.for_url(url).call_async(function)
+
+
+def limited_call(syn, url, function):
+    """
+    Send a request to the url through the rate limiters of the Synapse client.
+
+    :param syn:         the Synapse client the request is sent for
+    :param url:         the url the request is sent to
+    :param function:    a function with no arguments sending the request and returning its requests.Response
+
+    :returns: function()
+    """
+    rate_limiters = getattr(syn, '_rate_limiters', None)
+    if not isinstance(rate_limiters, HostRateLimiters):
+        return function()
+    return rate_limiters.call(url, function)
+
+
+async def limited_call_async(syn, url, function):
+    """
+    Send a request to the url from an asyncio event loop through the rate limiters of the Synapse client.
+
+    :param syn:         the Synapse client the request is sent for
+    :param url:         the url the request is sent to
+    :param function:    a coroutine function with no arguments sending the request and returning a requests.Response
+
+    :returns: await function()
+    """
+    rate_limiters = getattr(syn, '_rate_limiters', None)
+    if not isinstance(rate_limiters, HostRateLimiters):
+        return await function()
+    return await rate_limiters.call_async(url, function)
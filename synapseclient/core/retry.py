@@ -1,7 +1,9 @@
+import asyncio
 import random
 import sys
 import logging
 
+from synapseclient.core import instrumentation
 from synapseclient.core.logging_setup import DEBUG_LOGGER_NAME, DEFAULT_LOGGER_NAME
 from synapseclient.core.utils import is_json
 from synapseclient.core.dozer import doze
@@ -29,10 +31,7 @@ def with_retry(function, verbose=False,
         result = self._with_retry(lambda: foo("1", "2", "3"), **STANDARD_RETRY_PARAMS)
     """
 
-    if verbose:
-        logger = logging.getLogger(DEBUG_LOGGER_NAME)
-    else:
-        logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+    logger = _get_logger(verbose)
 
     # Retry until we succeed or run out of tries
     total_wait = 0
@@ -40,7 +39,6 @@ def with_retry(function, verbose=False,
         # Start with a clean slate
         exc = None
         exc_info = None
-        retry = False
         response = None
 
         # Try making the call
@@ -53,37 +51,8 @@ def with_retry(function, verbose=False,
             if hasattr(ex, 'response'):
                 response = ex.response
 
-        # Check if we got a retry-able error
-        if response is not None and hasattr(response, 'status_code'):
-            if response.status_code in retry_status_codes:
-                response_message = _get_message(response)
-                retry = True
-                logger.debug("retrying on status code: %s" % str(response.status_code))
-                # TODO: this was originally printed regardless of 'verbose' was that behavior correct?
-                logger.debug(str(response_message))
-                if (response.status_code == 429) and (wait > 10):
-                    logger.warning('%s...\n' % response_message)
-                    logger.warning('Retrying in %i seconds' % wait)
-
-            elif response.status_code not in range(200, 299):
-                # For all other non 200 messages look for retryable errors in the body or reason field
-                response_message = _get_message(response)
-                if any([msg.lower() in response_message.lower() for msg in retry_errors]):
-                    retry = True
-                    logger.debug('retrying %s' % response_message)
-                # special case for message throttling
-                elif 'Please slow down.  You may send a maximum of 10 message' in response:
-                    retry = True
-                    wait = 16
-                    logger.debug("retrying " + response_message)
-
-        # Check if we got a retry-able exception
-        if exc is not None:
-            if (exc.__class__.__name__ in retry_exceptions or
-                    exc.__class__ in retry_exceptions or
-                    any([msg.lower() in str(exc_info[1]).lower() for msg in retry_errors])):
-                retry = True
-                logger.debug("retrying exception: " + str(exc))
+        retry, wait = _should_retry(response, exc, exc_info, wait, retry_status_codes, retry_errors, retry_exceptions,
+                                    logger)
 
         # Wait then retry
         retries -= 1
@@ -92,6 +61,7 @@ def with_retry(function, verbose=False,
             logger.debug(('total wait time {total_wait:5.0f} seconds\n '
                           '... Retrying in {wait:5.1f} seconds...'.format(total_wait=total_wait, wait=randomized_wait)))
             total_wait += randomized_wait
+            instrumentation.record_retry(randomized_wait, response)
             doze(randomized_wait)
             wait = min(max_wait, wait*back_off)
             continue
@@ -103,6 +73,101 @@ def with_retry(function, verbose=False,
         return response
 
 
+async def with_retry_async(function, verbose=False,
+                           retry_status_codes=[429, 500, 502, 503, 504], retry_errors=[], retry_exceptions=[],
+                           retries=3, wait=1, back_off=2, max_wait=30):
+    """
+    Retries the given coroutine function under the same conditions as :py:func:`with_retry`, waiting between
+    attempts without blocking the event loop.
+
+    :param function:    A coroutine function with no arguments.
+
+    :returns: await function()
+    """
+    logger = _get_logger(verbose)
+
+    total_wait = 0
+    while True:
+        exc = None
+        exc_info = None
+        response = None
+
+        try:
+            response = await function()
+        except Exception as ex:
+            exc = ex
+            exc_info = sys.exc_info()
+            logger.debug("calling %s resulted in an Exception" % function)
+            if hasattr(ex, 'response'):
+                response = ex.response
+
+        retry, wait = _should_retry(response, exc, exc_info, wait, retry_status_codes, retry_errors, retry_exceptions,
+                                    logger)
+
+        retries -= 1
+        if retries >= 0 and retry:
+            randomized_wait = wait*random.uniform(0.5, 1.5)
+            logger.debug(('total wait time {total_wait:5.0f} seconds\n '
+                          '... Retrying in {wait:5.1f} seconds...'.format(total_wait=total_wait, wait=randomized_wait)))
+            total_wait += randomized_wait
+            instrumentation.record_retry(randomized_wait, response)
+            await asyncio.sleep(randomized_wait)
+            wait = min(max_wait, wait*back_off)
+            continue
+
+        if exc_info is not None and exc_info[0] is not None:
+            logger.debug("retries have run out. re-raising the exception", exc_info=True)
+            raise exc
+        return response
+
+
+def _get_logger(verbose):
+    return logging.getLogger(DEBUG_LOGGER_NAME if verbose else DEFAULT_LOGGER_NAME)
+
+
+def _should_retry(response, exc, exc_info, wait, retry_status_codes, retry_errors, retry_exceptions, logger):
+    """
+    Decide whether a call that returned the response or raised exc should be retried.
+
+    :returns: whether to retry and how long to wait before doing so
+    """
+    retry = False
+
+    # Check if we got a retry-able error
+    if response is not None and hasattr(response, 'status_code'):
+        if response.status_code in retry_status_codes:
+            response_message = _get_message(response)
+            retry = True
+            logger.debug("retrying on status code: %s" % str(response.status_code))
+            # TODO: this was originally printed regardless of 'verbose' was that behavior correct?
+            logger.debug(str(response_message))
+            if (response.status_code == 429) and (wait > 10):
+                logger.warning('%s...\n' % response_message)
+                logger.warning('Retrying in %i seconds' % wait)
+
+        elif response.status_code not in range(200, 299):
+            # For all other non 200 messages look for retryable errors in the body or reason field
+            response_message = _get_message(response)
+            if any([msg.lower() in response_message.lower() for msg in retry_errors]):
+                retry = True
+                logger.debug('retrying %s' % response_message)
+            # special case for message throttling
+            elif 'Please slow down.  You may send a maximum of 10 message' in response:
+                retry = True
+                wait = 16
+                logger.debug("retrying " + response_message)
+
+    # Check if we got a retry-able exception
+    if exc is not None:
+        if (exc.__class__.__name__ in retry_exceptions or
+                exc.__class__ in retry_exceptions or
+                any([msg.lower() in str(exc_info[1]).lower() for msg in retry_errors])):
+            retry = True
+            logger.debug("retrying exception: " + str(exc))
+
+    return retry, wait
+
+
 def _get_message(response):
     """
     Extracts the message body or a response object by checking for a json response and returning the reason otherwise
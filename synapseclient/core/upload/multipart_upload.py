@@ -15,7 +15,6 @@ not need to call any of these functions directly.
 import concurrent.futures
 from contextlib import contextmanager
 import hashlib
-import json
 import math
 import mimetypes
 import os
@@ -24,7 +23,7 @@ import threading
 import time
 from typing import List, Mapping
 
-from synapseclient.core import pool_provider
+from synapseclient.core import instrumentation, json_codec, pool_provider
 from synapseclient.core.cumulative_transfer_progress import printTransferProgress
 from synapseclient.core.exceptions import (
     _raise_for_status,  # why is is this a single underscore
@@ -32,7 +31,8 @@ from synapseclient.core.exceptions import (
     SynapseUploadAbortedException,
     SynapseUploadFailedException,
 )
-from synapseclient.core.utils import md5_for_file, MB
+from synapseclient.core.rate_limit import limited_call
+from synapseclient.core.utils import MB
 
 # AWS limits
 MAX_NUMBER_OF_PARTS = 10000
@@ -60,7 +60,7 @@ def shared_executor(executor):
 @contextmanager
 def _executor(max_threads, shutdown_wait):
     """Yields an executor for running some asynchronous code, either obtaining the executor
-    from the shared_executor or otherwise creating one.
+    from the shared_executor or otherwise a lane of the process wide shared pool of threads.
 
     :param max_threads: the maxmimum number of threads a created executor should use
     :param shutdown_wait: whether a created executor should shutdown after running the yielded to code
@@ -69,7 +69,7 @@ def _executor(max_threads, shutdown_wait):
     shutdown_after = False
     if not executor:
         shutdown_after = True
-        executor = pool_provider.get_executor(thread_count=max_threads)
+        executor = pool_provider.get_executor(thread_count=max_threads, priority=pool_provider.PRIORITY_TRANSFER)
 
     try:
         yield executor
@@ -153,7 +153,7 @@ class UploadAttempt:
             "/file/multipart?forceRestart={}".format(
                 str(self._force_restart).lower()
             ),
-            json.dumps(upload_request),
+            json_codec.dumps(upload_request),
             endpoint=self._syn.fileHandleEndpoint,
         )
 
@@ -174,7 +174,7 @@ class UploadAttempt:
 
         response = self._syn.restPOST(
             uri,
-            json.dumps(body),
+            json_codec.dumps(body),
             requests_session=requests_session,
             endpoint=self._syn.fileHandleEndpoint,
         )
@@ -239,34 +239,40 @@ class UploadAttempt:
         md5.update(chunk)
         md5_hex = md5.hexdigest()
 
-        for retry in range(2):
-            try:
-                response = session.put(
-                    pre_signed_part_url,
-                    chunk,
-                )
-                _raise_for_status(response)
+        with instrumentation.measure(instrumentation.KIND_PART_UPLOAD, 'put', pre_signed_part_url, body=chunk,
+                                     endpoint=instrumentation.PRESIGNED_URL_ENDPOINT) as measurement:
+            for retry in range(2):
+                try:
+                    response = limited_call(
+                        self._syn,
+                        pre_signed_part_url,
+                        lambda: session.put(pre_signed_part_url, chunk),
+                    )
+                    measurement.response(response)
+                    _raise_for_status(response)
 
-                # completed upload part to s3 successfully
-                break
+                    # completed upload part to s3 successfully
+                    break
 
-            except SynapseHTTPError as ex:
-                if ex.response.status_code == 403 and retry < 1:
-                    # we interpret this to mean our pre_signed url expired.
-                    self._syn.logger.debug(
-                        "The pre-signed upload URL for part {} has expired."
-                        "Refreshing urls and retrying.\n".format(part_number)
-                    )
+                except SynapseHTTPError as ex:
+                    if ex.response.status_code == 403 and retry < 1:
+                        # we interpret this to mean our pre_signed url expired.
+                        self._syn.logger.debug(
+                            "The pre-signed upload URL for part {} has expired."
+                            "Refreshing urls and retrying.\n".format(part_number)
+                        )
 
-                    # we refresh all the urls and obtain this part's
-                    # specific url for the retry
-                    pre_signed_part_url = self._refresh_pre_signed_part_urls(
-                        part_number,
-                        pre_signed_part_url,
-                    )
+                        measurement.retried(0)
+
+                        # we refresh all the urls and obtain this part's
+                        # specific url for the retry
+                        pre_signed_part_url = self._refresh_pre_signed_part_urls(
+                            part_number,
+                            pre_signed_part_url,
+                        )
 
-                else:
-                    raise
+                    else:
+                        raise
 
         # now tell synapse that we uploaded that part successfully
         self._syn.restPUT(
@@ -455,7 +461,8 @@ def multipart_upload_file(
     file_size = os.path.getsize(file_path)
     if not dest_file_name:
         dest_file_name = os.path.basename(file_path)
-    md5_hex = md5_for_file(file_path).hexdigest()
+    # an unchanged file that was hashed before, e.g. when it was last uploaded, isn't read again
+    md5_hex = syn.cache.md5_for_file(file_path)
 
     if content_type is None:
         mime_type, _ = mimetypes.guess_type(file_path, strict=False)
@@ -662,6 +662,22 @@ def humanizeBytes(num_bytes):
     return 'Oops larger than Exabytes'
 
 
+def parse_bytes(size):
+    """
+    Parse a human readable size such as "500MB", "1.5 TB" or "1048576" into a number of bytes.
+    Units are binary multiples, as in :py:func:`humanizeBytes`.
+    """
+    if isinstance(size, int):
+        return size
+
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmgtpe]?)(?:i?b)?\s*$', str(size), re.IGNORECASE)
+    if not match:
+        raise ValueError('Invalid size: %s' % size)
+
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' kmgtpe'.index(unit.lower() or ' '))
+
+
 def touch(path, times=None):
     """
     Make sure a file exists. Update its access and modified times.
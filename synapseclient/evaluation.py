@@ -75,9 +75,9 @@ Submission Status
    :members: __init__
 
 """
-import json
 import typing
 
+from synapseclient.core import json_codec
 from synapseclient.core.models.dict_object import DictObject
 from synapseclient.annotations import (Annotations,
                                        from_synapse_annotations,
@@ -267,5 +267,4 @@ class SubmissionStatus(DictObject):
             json_dict['submissionAnnotations'] = to_synapse_annotations(
                 annotations
             )
-        return json.dumps(json_dict, sort_keys=True, indent=2,
-                          ensure_ascii=ensure_ascii)
+        return json_codec.dumps(json_dict, ensure_ascii=ensure_ascii)
@@ -83,8 +83,8 @@ Wiki methods
 """
 
 import os
-import json
 
+from synapseclient.core import json_codec
 from synapseclient.core.models.dict_object import DictObject
 from synapseclient.core.utils import id_of
 
@@ -129,7 +129,7 @@ class Wiki(DictObject):
 
     def json(self):
         """Returns the JSON representation of the Wiki object."""
-        return json.dumps({k: v for k, v in self.items() if k in self.__PROPERTIES})
+        return json_codec.dumps({k: v for k, v in self.items() if k in self.__PROPERTIES})
 
     def getURI(self):
         """For internal use."""
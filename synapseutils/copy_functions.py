@@ -1,10 +1,10 @@
 import synapseclient
 from synapseclient import File, Project, Folder, Table, Schema, Link, Wiki, Entity, Activity
+from synapseclient.core import json_codec
 from synapseclient.core.cache import Cache
 from synapseclient.core.exceptions import SynapseHTTPError
 from synapseclient.core.constants.limits import MAX_FILE_HANDLE_PER_COPY_REQUEST
 import re
-import json
 import itertools
 import math
 
@@ -99,7 +99,7 @@ def _copy_file_handles_batch(self, file_handle_ids, obj_types, obj_ids, new_con_
     copy_file_handle_request = _create_batch_file_handle_copy_request(file_handle_ids, obj_types, obj_ids,
                                                                       new_con_types, new_file_names)
     # make backend call which performs the copy specified by copy_file_handle_request
-    copied_file_handles = self.restPOST('/filehandles/copy', body=json.dumps(copy_file_handle_request),
+    copied_file_handles = self.restPOST('/filehandles/copy', body=json_codec.dumps(copy_file_handle_request),
                                         endpoint=self.fileHandleEndpoint)
     return copied_file_handles.get("copyResults")
 
@@ -166,11 +166,12 @@ def _batch_iterator_generator(iterables, batch_size):
 
 def _copy_cached_file_handles(cache, copiedFileHandles):
     # type: (Cache , dict) -> None
-    for copy_result in copiedFileHandles:
-        if copy_result.get('failureCode') is None:  # sucessfully copied
-            original_cache_path = cache.get(copy_result['originalFileHandleId'])
-            if original_cache_path:
-                cache.add(copy_result['newFileHandle']['id'], original_cache_path)
+    copied = [copy_result for copy_result in copiedFileHandles
+              if copy_result.get('failureCode') is None]  # sucessfully copied
+    original_cache_paths = cache.get_many([copy_result['originalFileHandleId'] for copy_result in copied])
+    cache.add_many([(copy_result['newFileHandle']['id'], original_cache_paths[copy_result['originalFileHandleId']])
+                    for copy_result in copied
+                    if original_cache_paths[copy_result['originalFileHandleId']]])
 
 
 def changeFileMetaData(syn, entity, downloadAs=None, contentType=None):
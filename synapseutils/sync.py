@@ -12,7 +12,7 @@ from synapseclient.entity import is_container
 from synapseclient.core import config
 from synapseclient.core.utils import id_of, is_url, is_synapse_id
 from synapseclient import File, table
-from synapseclient.core.pool_provider import SingleThreadExecutor
+from synapseclient.core.pool_provider import PRIORITY_METADATA, PRIORITY_TRANSFER, SingleThreadExecutor, get_executor
 from synapseclient.core import utils
 from synapseclient.core.cumulative_transfer_progress import CumulativeTransferProgress
 from synapseclient.core.exceptions import SynapseFileNotFoundError, SynapseHTTPError, SynapseProvenanceError
@@ -30,13 +30,14 @@ DEFAULT_GENERATED_MANIFEST_KEYS = ['path', 'parent', 'name', 'synapseStore', 'co
 
 
 @contextmanager
-def _sync_executor(syn):
+def _sync_executor(syn, priority=PRIORITY_METADATA):
     """Use this context manager to run some sync code with an executor that will
-    be created and then shutdown once the context completes."""
+    be created and then shutdown once the context completes. The executor is a lane
+    of the process wide shared pool of threads running tasks of the given priority."""
     if syn.max_threads < 2 or config.single_threaded:
         executor = SingleThreadExecutor()
     else:
-        executor = concurrent.futures.ThreadPoolExecutor(syn.max_threads)
+        executor = get_executor(syn.max_threads, priority=priority)
 
     try:
         yield executor
@@ -89,10 +90,11 @@ def syncFromSynapse(syn, entity, path=None, ifcollision='overwrite.local', allFi
     # 2. each file download will run in a separate thread in an Executor
     # 3. downloads that support S3 multipart concurrent downloads will be scheduled by the thread in #2 and have
     #    their parts downloaded in additional threads in the same Executor
-    # To support multipart downloads in #3 using the same Executor as the download thread #2, we need at least
-    # 2 threads always, if those aren't available then we'll run single threaded to avoid a deadlock
-    with _sync_executor(syn) as executor:
-        sync_from_synapse = _SyncDownloader(syn, executor)
+    # The threads of #2 and #3 come from the process wide shared pool, #3 at a lower priority so that the
+    # metadata requests of #2 aren't stuck behind the transfers. The pool always leaves threads for the transfers
+    # that #2 waits on, but we still need at least 2 threads, otherwise we'll run single threaded.
+    with _sync_executor(syn) as executor, _sync_executor(syn, PRIORITY_TRANSFER) as transfer_executor:
+        sync_from_synapse = _SyncDownloader(syn, executor, transfer_executor=transfer_executor)
         files = sync_from_synapse.sync(entity, path, ifcollision, followLink)
 
     # the allFiles parameter used to be passed in as part of the recursive implementation of this function
@@ -198,13 +200,17 @@ class _SyncDownloader:
     Manages the downloads associated associated with a syncFromSynapse call concurrently.
     """
 
-    def __init__(self, syn, executor: concurrent.futures.Executor, max_concurrent_file_downloads=None):
+    def __init__(self, syn, executor: concurrent.futures.Executor, max_concurrent_file_downloads=None,
+                 transfer_executor: concurrent.futures.Executor = None):
         """
-        :param syn:         A synapse client
-        :param executor:    An ExecutorService in which concurrent file downlaods can be scheduled
+        :param syn:                 A synapse client
+        :param executor:            An ExecutorService in which concurrent file downlaods can be scheduled
+        :param transfer_executor:   An ExecutorService in which the parts of multipart downloads can be scheduled,
+                                    defaults to executor
         """
         self._syn = syn
         self._executor = executor
+        self._transfer_executor = transfer_executor or executor
 
         # by default limit the number of concurrent file downloads that can happen at once to some proportion
         # of the available threads. otherwise we could end up downloading a single part from many files at once
@@ -250,7 +256,7 @@ class _SyncDownloader:
             # when conducting that download (shared progress bar, ExecutorService shared
             # by all multi threaded downloads in this sync)
             with progress.accumulate_progress(), \
-                    download_shared_executor(self._executor):
+                    download_shared_executor(self._transfer_executor):
 
                 entity = self._syn.get(
                     entity_id,
@@ -402,15 +408,19 @@ class _SyncUploader:
     Files will be uploaded concurrently and in an order that honors any interdependent provenance.
     """
 
-    def __init__(self, syn, executor: concurrent.futures.Executor, max_concurrent_file_transfers=None):
+    def __init__(self, syn, executor: concurrent.futures.Executor, max_concurrent_file_transfers=None,
+                 transfer_executor: concurrent.futures.Executor = None):
         """
-        :param syn:         A synapse client
-        :param executor:    An ExecutorService in which concurrent file downlaods can be scheduled
+        :param syn:                 A synapse client
+        :param executor:            An ExecutorService in which concurrent file downlaods can be scheduled
+        :param transfer_executor:   An ExecutorService in which the parts of multipart uploads can be scheduled,
+                                    defaults to executor
         """
         self._syn = syn
 
         max_concurrent_file_transfers = max(int(max_concurrent_file_transfers or self._syn.max_threads / 2), 1)
         self._executor = executor
+        self._transfer_executor = transfer_executor or executor
         self._file_semaphore = threading.BoundedSemaphore(max_concurrent_file_transfers)
 
     @staticmethod
@@ -561,7 +571,7 @@ class _SyncUploader:
         progress,
     ):
         try:
-            with upload_shared_executor(self._executor):
+            with upload_shared_executor(self._transfer_executor):
                 # we configure an upload thread local shared executor so that any multipart
                 # uploads that result from this upload will share the executor of this sync
                 # rather than creating their own threadpool.
@@ -909,8 +919,8 @@ def _manifest_upload(syn, df):
         )
         items.append(item)
 
-    with _sync_executor(syn) as executor:
-        uploader = _SyncUploader(syn, executor)
+    with _sync_executor(syn) as executor, _sync_executor(syn, PRIORITY_TRANSFER) as transfer_executor:
+        uploader = _SyncUploader(syn, executor, transfer_executor=transfer_executor)
         uploader.upload(items)
 
     return True
@@ -1,7 +1,13 @@
 import concurrent.futures
 import datetime
+import hashlib
+import io
 import os
 import requests
+import tempfile
+import threading
+import time
+import urllib3
 
 import pytest
 from unittest import TestCase
@@ -145,10 +151,11 @@ def test_download_file(mock_multithreaded_downloader_init):
     max_concurrent_parts = 5
 
     with download_threads.shared_executor(mock_executor):
-        download_file(syn, request, max_concurrent_parts=max_concurrent_parts)
+        md5 = download_file(syn, request, max_concurrent_parts=max_concurrent_parts, compute_md5=True)
 
     mock_multithreaded_downloader_init.assert_called_once_with(syn, mock_executor, max_concurrent_parts)
-    mock_downloader.download_file.assert_called_once_with(request)
+    mock_downloader.download_file.assert_called_once_with(request, compute_md5=True)
+    assert mock_downloader.download_file.return_value == md5
 
     # executor was passed in from the outside, so it should be managed from the outside
     assert not mock_executor.shutdown.called
@@ -184,7 +191,7 @@ def test_download_file__executor_shutdown(mock_multithreaded_downloader_init, mo
 
     # no max_concurrent_parts passed, should default to the number of client configured threads
     mock_multithreaded_downloader_init.assert_called_once_with(syn, mock_executor, max_threads)
-    mock_downloader.download_file.assert_called_once_with(request)
+    mock_downloader.download_file.assert_called_once_with(request, compute_md5=False)
 
     # internally created executor should be shutdown
     assert mock_executor.shutdown.called
@@ -206,10 +213,13 @@ class MultithreadedDownloaderTests(TestCase):
                 mock.patch.object(download_threads, 'TransferStatus') as mock_transfer_status_init, \
                 mock.patch.object(download_threads, '_get_file_size') as mock_get_file_size, \
                 mock.patch.object(download_threads, '_generate_chunk_ranges') as mock_generate_chunk_ranges, \
+                mock.patch.object(download_threads, '_DownloadJournal') as mock_journal_init, \
                 mock.patch.object(_MultithreadedDownloader, '_prep_file') as mock_prep_file, \
                 mock.patch.object(_MultithreadedDownloader, '_submit_chunks') as mock_submit_chunks, \
-                mock.patch.object(_MultithreadedDownloader, '_write_chunks') as mock_write_chunks, \
+                mock.patch.object(_MultithreadedDownloader, '_update_progress') as mock_update_progress, \
                 mock.patch('concurrent.futures.wait') as mock_futures_wait, \
+                mock.patch.object(download_threads.os, 'open') as mock_os_open, \
+                mock.patch.object(download_threads.os, 'close') as mock_os_close, \
                 mock.patch.object(_MultithreadedDownloader, '_check_for_errors') as mock_check_for_errors:
 
             mock_url_info = mock.create_autospec(PresignedUrlInfo, url=url)
@@ -220,6 +230,8 @@ class MultithreadedDownloaderTests(TestCase):
             mock_get_file_size.return_value = file_size
             chunk_generator = mock.Mock()
             mock_generate_chunk_ranges.return_value = chunk_generator
+            mock_journal = mock_journal_init.return_value
+            mock_journal.load.return_value = []
 
             transfer_status = TransferStatus(file_size)
             mock_transfer_status_init.return_value = transfer_status
@@ -250,21 +262,28 @@ class MultithreadedDownloaderTests(TestCase):
 
             downloader.download_file(request)
 
-            mock_prep_file.assert_called_once_with(request)
+            mock_prep_file.assert_called_once_with(request, file_size)
+            mock_journal_init.assert_called_once_with(path, file_handle_id, file_size)
+            mock_journal.open.assert_called_once_with(resume=False)
+            mock_generate_chunk_ranges.assert_called_once_with(file_size, [], get_part_size=mock.ANY)
+            fd = mock_os_open.return_value
+            mock_os_close.assert_called_once_with(fd)
+            # the download is complete, there is nothing left to resume
+            mock_journal.remove.assert_called_once_with()
 
             expected_submit_chunks_calls = [
-                mock.call(mock_url_provider, chunk_generator, set()),
-                mock.call(mock_url_provider, chunk_generator, set([second_future])),
-                mock.call(mock_url_provider, chunk_generator, set()),
+                mock.call(mock_url_provider, fd, chunk_generator, set()),
+                mock.call(mock_url_provider, fd, chunk_generator, set([second_future])),
+                mock.call(mock_url_provider, fd, chunk_generator, set()),
             ]
             assert expected_submit_chunks_calls == mock_submit_chunks.call_args_list
 
-            expected_write_chunk_calls = [
+            expected_update_progress_calls = [
                 mock.call(request, set(), transfer_status),
                 mock.call(request, set([first_future]), transfer_status),
                 mock.call(request, set([second_future, third_future]), transfer_status),
             ]
-            assert expected_write_chunk_calls == mock_write_chunks.call_args_list
+            assert expected_update_progress_calls == mock_update_progress.call_args_list
 
             expected_futures_wait_calls = [
                 mock.call(set([first_future, second_future]), return_when=concurrent.futures.FIRST_COMPLETED),
@@ -294,10 +313,11 @@ class MultithreadedDownloaderTests(TestCase):
                 mock.patch.object(download_threads, 'TransferStatus') as mock_transfer_status_init, \
                 mock.patch.object(download_threads, '_get_file_size') as mock_get_file_size, \
                 mock.patch.object(download_threads, '_generate_chunk_ranges') as mock_generate_chunk_ranges, \
+                mock.patch.object(download_threads, '_DownloadJournal') as mock_journal_init, \
                 mock.patch.object(download_threads, 'os') as mock_os, \
                 mock.patch.object(_MultithreadedDownloader, '_prep_file'), \
                 mock.patch.object(_MultithreadedDownloader, '_submit_chunks') as mock_submit_chunks, \
-                mock.patch.object(_MultithreadedDownloader, '_write_chunks'), \
+                mock.patch.object(_MultithreadedDownloader, '_update_progress'), \
                 mock.patch('concurrent.futures.wait') as mock_futures_wait:
 
             mock_url_info = mock.create_autospec(PresignedUrlInfo, url=url)
@@ -308,6 +328,8 @@ class MultithreadedDownloaderTests(TestCase):
             mock_get_file_size.return_value = file_size
             chunk_generator = mock.Mock()
             mock_generate_chunk_ranges.return_value = chunk_generator
+            mock_journal = mock_journal_init.return_value
+            mock_journal.load.return_value = []
 
             transfer_status = TransferStatus(file_size)
             mock_transfer_status_init.return_value = transfer_status
@@ -330,21 +352,29 @@ class MultithreadedDownloaderTests(TestCase):
             with pytest.raises(exception.__class__):
                 downloader.download_file(request)
 
-            # file should have been removed
-            mock_os.remove.assert_called_once_with(path)
+            # file should have been closed once the running parts stopped
+            assert downloader._aborted.is_set()
+            mock_futures_wait.assert_called_with(set([part_future_2]))
+            mock_os.close.assert_called_once_with(mock_os.open.return_value)
+
+            # the file and its journal are kept so that the download can be resumed
+            mock_os.remove.assert_not_called()
+            mock_journal.close.assert_called_once_with()
+            mock_journal.remove.assert_not_called()
 
             # should have been an attempt to cancel the Future
             part_future_2.cancel.assert_called_once_with()
 
-    @mock.patch.object(download_threads, 'open')
-    def test_prep_file(self, mock_open):
-        """Should open and close the file to create/truncate it"""
-        path = '/tmp/foo'
-        request = DownloadRequest(None, None, None, path)
-        download_threads._MultithreadedDownloader._prep_file(request)
-        mock_open.assert_called_once_with(path, 'wb')
-
-        mock_open.return_value.close.assert_called_once_with()
+    def test_prep_file(self):
+        """Should create the file at its full size, replacing any existing file"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'foo')
+            with open(path, 'wb') as f:
+                f.write(b'existing content that is longer')
+            request = DownloadRequest(None, None, None, path)
+            download_threads._MultithreadedDownloader._prep_file(request, 10)
+            with open(path, 'rb') as f:
+                assert f.read() == bytes(10)
 
     def test_submit_chunks(self):
         """Verify chunks are submitted to the executor as expected, not exceeding the available
@@ -363,14 +393,16 @@ class MultithreadedDownloaderTests(TestCase):
         file_size = int(2.5 * download_threads.SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE)
         chunk_range_generator = download_threads._generate_chunk_ranges(file_size)
 
+        fd = 3
         downloader = _MultithreadedDownloader(syn, executor, max_concurrent_parts)
-        submitted_futures = downloader._submit_chunks(url_provider, chunk_range_generator, pending_futures)
+        submitted_futures = downloader._submit_chunks(url_provider, fd, chunk_range_generator, pending_futures)
 
         ranges = [r for r in download_threads._generate_chunk_ranges(file_size)][:expected_submit_count]
         expected_submits = [
             mock.call(
-                downloader._get_response_with_retry,
+                downloader._download_part,
                 url_provider,
+                fd,
                 start,
                 end,
             ) for start, end in ranges
@@ -378,61 +410,164 @@ class MultithreadedDownloaderTests(TestCase):
         assert expected_submits == executor_submit.call_args_list
         assert set(executor_submit_side_effect) == submitted_futures
 
-    @mock.patch.object(download_threads, 'open')
-    def test_write_chunks__none_ready(self, mock_open):
-        """Verify that if there are no parts ready that nothing is written out"""
-        request = mock.Mock()
-        transfer_status = mock.Mock()
-        completed_futures = set()
-        downloader = _MultithreadedDownloader(mock.Mock(), mock.Mock(), 5)
-        downloader._write_chunks(request, completed_futures, transfer_status)
-        assert not mock_open.called
-
     @mock.patch.object(download_threads, 'printTransferProgress')
-    @mock.patch.object(download_threads, 'open')
-    def test_write_chunks(self, mock_open, mock_print_transfer_progress):
-        """Verify expected behavior writing out chunks to disk"""
+    def test_update_progress(self, mock_print_transfer_progress):
+        """Verify the progress is reported as parts complete"""
         request = mock.Mock(path='/tmp/foo')
 
-        chunks = [b'foo', b'bar', b'baz']
-        file_size = sum(len(d) for d in chunks)
+        chunk_sizes = [3, 5, 2]
+        file_size = sum(chunk_sizes)
         transfer_status = TransferStatus(file_size)
 
         completed_futures = []
-        expected_seeks = []
-        expected_writes = []
         expected_print_transfer_progresses = []
 
         byte_start = 0
-        for chunk in chunks:
-            future = mock.Mock(
-                result=mock.Mock(
-                    return_value=(
-                        byte_start,
-                        mock.Mock(content=chunk)
-                    )
-                )
-            )
-            completed_futures.append(future)
-            expected_seeks.append(mock.call(byte_start))
-            expected_writes.append(mock.call(chunk))
-
-            byte_start += len(chunk)
+        for chunk_size in chunk_sizes:
+            completed_futures.append(mock.Mock(result=mock.Mock(return_value=(byte_start, chunk_size))))
+            byte_start += chunk_size
             expected_print_transfer_progresses.append(
                 mock.call(byte_start, file_size, 'Downloading ', os.path.basename(request.path), dt=mock.ANY)
             )
 
         downloader = _MultithreadedDownloader(mock.Mock(), mock.Mock(), 5)
-        downloader._write_chunks(request, completed_futures, transfer_status)
-
-        # with open (as a context manager)
-        mock_write = mock_open.return_value.__enter__.return_value
-        assert expected_seeks == mock_write.seek.call_args_list
-        assert expected_writes == mock_write.write.call_args_list
+        downloader._journal = mock.create_autospec(download_threads._DownloadJournal)
+        downloader._update_progress(request, completed_futures, transfer_status)
 
-        assert sum(len(c) for c in chunks) == transfer_status.transferred
+        assert [mock.call(0, 2), mock.call(3, 7), mock.call(8, 9)] == downloader._journal.record.call_args_list
+        assert file_size == transfer_status.transferred
         assert expected_print_transfer_progresses == mock_print_transfer_progress.call_args_list
 
+    def test_write_response(self):
+        """Verify the body of a part is written into the file at its offset through the reusable buffer"""
+        data = os.urandom(int(2.5 * download_threads.STREAM_BUFFER_SIZE))
+        response = mock.Mock(raw=io.BytesIO(data))
+
+        with tempfile.TemporaryFile() as f:
+            f.truncate(len(data) + 10)
+            downloader = _MultithreadedDownloader(mock.Mock(), mock.Mock(), 5)
+            assert len(data) == downloader._write_response(response, f.fileno(), 10, len(data) + 9)
+            f.seek(0)
+            assert bytes(10) + data == f.read()
+        assert not response.close.called
+
+    def test_write_response__connection_failed(self):
+        """Verify the bytes received before the connection failed are written and counted"""
+        reads = [b'abc']
+
+        def readinto(buffer):
+            if not reads:
+                raise urllib3.exceptions.ProtocolError('reset')
+            data = reads.pop()
+            buffer[:len(data)] = data
+            return len(data)
+
+        response = mock.Mock(raw=mock.Mock(readinto=readinto))
+
+        with tempfile.TemporaryFile() as f:
+            f.truncate(6)
+            downloader = _MultithreadedDownloader(mock.Mock(), mock.Mock(), 5)
+            assert 3 == downloader._write_response(response, f.fileno(), 0, 5)
+            assert b'abc' == f.read(3)
+        response.close.assert_called_once_with()
+
+    def test_write_response__aborted(self):
+        downloader = _MultithreadedDownloader(mock.Mock(), mock.Mock(), 5)
+        downloader._aborted.set()
+        with pytest.raises(SynapseError):
+            downloader._write_response(mock.Mock(raw=io.BytesIO(b'abc')), 0, 0, 2)
+
+    def test_download_part(self):
+        """Verify the rest of a part is requested again when its body is cut short"""
+        url_provider = mock.create_autospec(download_threads.PresignedUrlProvider)
+        downloader = _MultithreadedDownloader(mock.Mock(), mock.Mock(), 5)
+        first_response = mock.Mock()
+        second_response = mock.Mock()
+        with mock.patch.object(downloader, '_get_response_with_retry') as mock_get_response, \
+                mock.patch.object(downloader, '_write_response') as mock_write_response:
+            mock_get_response.side_effect = [(10, first_response), (14, second_response)]
+            mock_write_response.side_effect = [4, 6]
+
+            assert (10, 10) == downloader._download_part(url_provider, 3, 10, 19)
+
+        assert [mock.call(url_provider, 10, 19), mock.call(url_provider, 14, 19)] == mock_get_response.call_args_list
+        assert [mock.call(first_response, 3, 10, 19), mock.call(second_response, 3, 14, 19)] == \
+            mock_write_response.call_args_list
+
+    def test_download_part__exceed_max_retries(self):
+        url_provider = mock.create_autospec(download_threads.PresignedUrlProvider)
+        downloader = _MultithreadedDownloader(mock.Mock(), mock.Mock(), 5)
+        with mock.patch.object(downloader, '_get_response_with_retry') as mock_get_response, \
+                mock.patch.object(downloader, '_write_response') as mock_write_response:
+            mock_get_response.return_value = (0, mock.Mock())
+            mock_write_response.return_value = 0
+
+            with pytest.raises(SynapseError):
+                downloader._download_part(url_provider, 3, 0, 9)
+        assert download_threads.MAX_RETRIES == mock_get_response.call_count
+
+    @staticmethod
+    def _download(path, data, requested_ranges, fail_from=None):
+        """Download data to path through a thread pool in parts that arrive out of order, the parts starting at or
+        after fail_from fail"""
+        part_size = download_threads.STREAM_BUFFER_SIZE // 2
+        url_provider = mock.create_autospec(PresignedUrlProvider)
+        url_provider.get_info.return_value = PresignedUrlInfo('foo', 'https://foo.com/bar', None)
+
+        def get(url, headers, stream):
+            start, end = [int(i) for i in headers['Range'][len('bytes='):].split('-')]
+            requested_ranges.append((start, end))
+            if fail_from is not None and start >= fail_from:
+                # after the earlier parts completed, parts still running when the download fails are abandoned
+                time.sleep(0.05)
+                raise requests.exceptions.ConnectionError()
+            # later parts arrive first
+            time.sleep(0.01 * (len(data) - start) / len(data))
+            return mock.Mock(status_code=206, raw=io.BytesIO(data[start:end + 1]))
+
+        with concurrent.futures.ThreadPoolExecutor(4) as executor, \
+                mock.patch.object(download_threads, 'PresignedUrlProvider', return_value=url_provider), \
+                mock.patch.object(download_threads, '_get_file_size', return_value=len(data)), \
+                mock.patch.object(download_threads, 'SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE', part_size), \
+                mock.patch.object(download_threads, '_get_thread_session', return_value=mock.Mock(get=get)), \
+                mock.patch.object(download_threads, 'printTransferProgress'):
+            request = DownloadRequest(123, 'syn456', 'FileEntity', path)
+            downloader = _MultithreadedDownloader(mock.Mock(), executor, 4)
+            return downloader.download_file(request, compute_md5=True)
+
+    def test_download_file__md5(self):
+        """Download a file end to end, hashing it as its parts arrive out of order"""
+        data = os.urandom(int(2.5 * download_threads.STREAM_BUFFER_SIZE))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'foo')
+            assert hashlib.md5(data).hexdigest() == self._download(path, data, [])
+            with open(path, 'rb') as f:
+                assert data == f.read()
+            assert ['foo'] == os.listdir(temp_dir)
+
+    def test_download_file__resume(self):
+        """Verify a failed download is resumed by downloading only the parts that are missing"""
+        data = os.urandom(int(2.5 * download_threads.STREAM_BUFFER_SIZE))
+        part_size = download_threads.STREAM_BUFFER_SIZE // 2
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'foo')
+            first_ranges = []
+            with pytest.raises(ValueError):
+                self._download(path, data, first_ranges, fail_from=3 * part_size)
+            assert os.path.exists(path + download_threads.JOURNAL_SUFFIX)
+
+            second_ranges = []
+            assert hashlib.md5(data).hexdigest() == self._download(path, data, second_ranges)
+            with open(path, 'rb') as f:
+                assert data == f.read()
+            assert ['foo'] == os.listdir(temp_dir)
+
+        # the parts that completed the first time are not downloaded again
+        downloaded = [(start, end) for start, end in first_ranges if start < 3 * part_size]
+        assert downloaded
+        assert not set(downloaded) & set(second_ranges)
+        assert len(data) == sum(end - start + 1 for start, end in downloaded + second_ranges)
+
     def test_check_for_errors__no_errors(self):
         """Verify check_for_errors when there were no errors"""
         downloader = _MultithreadedDownloader(mock.Mock(), mock.Mock(), 5)
@@ -515,6 +650,249 @@ class MultithreadedDownloaderTests(TestCase):
         )
 
 
+def test_generate_chunk_ranges__downloaded_ranges():
+    with mock.patch.object(download_threads, 'SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE', 8):
+        result = list(download_threads._generate_chunk_ranges(40, [(0, 7), (12, 19), (30, 39)]))
+    assert [(8, 11), (20, 27), (28, 29)] == result
+
+
+def test_generate_chunk_ranges__part_size():
+    part_sizes = iter([4, 8, 16, 16])
+    result = list(download_threads._generate_chunk_ranges(40, [(4, 7)], get_part_size=lambda: next(part_sizes)))
+    assert [(0, 3), (8, 15), (16, 31), (32, 39)] == result
+
+
+class TestAdaptiveScheduler:
+
+    @pytest.fixture(autouse=True)
+    def part_size(self):
+        with mock.patch.object(download_threads, 'SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE', 8 * download_threads.MiB):
+            yield
+
+    @staticmethod
+    def _scheduler(file_size=download_threads.MiB, max_concurrency=16):
+        return download_threads._AdaptiveScheduler(file_size, max_concurrency, mock.Mock())
+
+    @staticmethod
+    def _complete_level(scheduler, throughput):
+        # the parts of a level complete MIN_LEVEL_SECONDS after it started at the given aggregate throughput
+        parts = max(download_threads.MIN_LEVEL_PARTS, scheduler.concurrency)
+        seconds = download_threads.MIN_LEVEL_SECONDS
+        part_size = throughput * seconds / parts
+        with mock.patch('time.monotonic', return_value=scheduler._level_started + seconds):
+            for _ in range(parts):
+                scheduler.part_completed(part_size, seconds * scheduler.concurrency / parts)
+
+    def test_initial_part_size(self):
+        assert download_threads.SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE == self._scheduler().part_size
+        # a file is split into at most MAX_PARTS_PER_FILE parts
+        file_size = 1024 ** 4
+        assert -(-file_size // download_threads.MAX_PARTS_PER_FILE) == self._scheduler(file_size).part_size
+
+    def test_initial_concurrency(self):
+        assert download_threads.INITIAL_CONCURRENCY == self._scheduler().concurrency
+        assert 2 == self._scheduler(max_concurrency=2).concurrency
+
+    def test_ramp_until_plateau(self):
+        scheduler = self._scheduler(max_concurrency=64)
+        self._complete_level(scheduler, 10 * download_threads.MiB)
+        assert 8 == scheduler.concurrency
+        self._complete_level(scheduler, 20 * download_threads.MiB)
+        assert 16 == scheduler.concurrency
+
+        # no better with twice the parts at once, so go back to the best level and stay there
+        self._complete_level(scheduler, 21 * download_threads.MiB)
+        assert 8 == scheduler.concurrency
+        self._complete_level(scheduler, 40 * download_threads.MiB)
+        assert 8 == scheduler.concurrency
+        assert scheduler._logger.debug.called
+
+    def test_ramp__max_concurrency(self):
+        scheduler = self._scheduler(max_concurrency=6)
+        self._complete_level(scheduler, 10 * download_threads.MiB)
+        assert 6 == scheduler.concurrency
+        self._complete_level(scheduler, 1 * download_threads.MiB)
+        assert 6 == scheduler.concurrency
+
+    def test_no_decision_before_level_measured(self):
+        scheduler = self._scheduler()
+        with mock.patch('time.monotonic', return_value=scheduler._level_started + 1):
+            for _ in range(10):
+                scheduler.part_completed(download_threads.MiB, 0.01)
+        assert download_threads.INITIAL_CONCURRENCY == scheduler.concurrency
+        assert download_threads.SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE == scheduler.part_size
+
+    def test_part_size_from_stream_throughput(self):
+        scheduler = self._scheduler()
+        # 4 MiB/s per connection
+        self._complete_level(scheduler, 16 * download_threads.MiB)
+        assert 4 * download_threads.MiB * download_threads.TARGET_PART_SECONDS == scheduler.part_size
+
+        # never smaller than the default or larger than MAX_PART_SIZE
+        scheduler = self._scheduler()
+        self._complete_level(scheduler, 1024 * download_threads.MiB)
+        assert download_threads.MAX_PART_SIZE == scheduler.part_size
+        scheduler = self._scheduler()
+        self._complete_level(scheduler, download_threads.MiB)
+        assert download_threads.SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE == scheduler.part_size
+
+
+def test_submit_chunks__concurrency_lowered():
+    downloader = _MultithreadedDownloader(mock.Mock(), mock.Mock(), 8)
+    downloader._scheduler = mock.Mock(concurrency=2)
+    pending = {mock.Mock() for _ in range(3)}
+    assert set() == downloader._submit_chunks(mock.Mock(), 1, iter([(0, 9)]), pending)
+    downloader._executor.submit.assert_not_called()
+
+
+def test_hash_window_size():
+    downloader = _MultithreadedDownloader(mock.Mock(), mock.Mock(), 8)
+    downloader._scheduler = mock.Mock(part_size=8 * download_threads.MiB, concurrency=4)
+    assert download_threads.HASH_WINDOW_SIZE == downloader._hash_window_size()
+
+    # the window holds the parts downloading at once
+    downloader._scheduler = mock.Mock(part_size=32 * download_threads.MiB, concurrency=8)
+    assert 256 * download_threads.MiB == downloader._hash_window_size()
+
+    downloader._scheduler = mock.Mock(part_size=download_threads.MAX_PART_SIZE, concurrency=64)
+    assert download_threads.MAX_HASH_WINDOW_SIZE == downloader._hash_window_size()
+
+
+class TestDownloadJournal:
+
+    def test_record_and_load(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'foo')
+            with open(path, 'wb') as f:
+                f.truncate(100)
+
+            journal = download_threads._DownloadJournal(path, 123, 100)
+            assert [] == journal.load()
+            journal.open(resume=False)
+            for start, end in ((50, 59), (0, 9), (10, 19), (30, 39)):
+                journal.record(start, end)
+            journal.close()
+
+            # a range cut short by a crash is ignored
+            with open(journal.path, 'a') as f:
+                f.write('60-6')
+
+            assert [(0, 19), (30, 39), (50, 59)] == download_threads._DownloadJournal(path, 123, 100).load()
+
+            # the journal of another file handle or size doesn't apply
+            assert [] == download_threads._DownloadJournal(path, 456, 100).load()
+            assert [] == download_threads._DownloadJournal(path, 123, 200).load()
+
+            journal.remove()
+            assert ['foo'] == os.listdir(temp_dir)
+
+    def test_load__file_missing(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'foo')
+            journal = download_threads._DownloadJournal(path, 123, 100)
+            with open(path, 'wb'):
+                pass
+            journal.open(resume=False)
+            journal.record(0, 9)
+            journal.close()
+
+            # the file was replaced by a smaller one or deleted, its parts have to be downloaded again
+            assert [] == journal.load()
+            os.remove(path)
+            assert [] == journal.load()
+
+
+class TestOrderedHasher:
+
+    @pytest.fixture
+    def executor(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            yield executor
+
+    def test_written_out_of_order(self, executor):
+        data = os.urandom(100)
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            hasher = download_threads._OrderedHasher(f.fileno(), executor, window_size=30)
+            for start in (60, 30, 90, 0):
+                # the data of the first range written beyond the prefix is held, the rest is read back from the file
+                hasher.written(start, data[start:start + 30])
+            assert hashlib.md5(data).hexdigest() == hasher.hexdigest(len(data))
+            assert 100 == hasher.position
+
+    def test_written__catch_up_in_background(self):
+        data = os.urandom(100)
+        executor = mock.Mock()
+        hasher = download_threads._OrderedHasher(None, executor)
+        hasher.written(50, data[50:])
+
+        # the thread that writes the start of the file only hashes its own data
+        hasher.written(0, data[:50])
+        assert 50 == hasher.position
+        executor.submit.assert_called_once_with(hasher._catch_up)
+
+        hasher._catch_up()
+        assert 100 == hasher.position
+        assert hashlib.md5(data).hexdigest() == hasher.hexdigest(len(data))
+
+    def test_written_before(self, executor):
+        data = os.urandom(100)
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            hasher = download_threads._OrderedHasher(f.fileno(), executor)
+            hasher.written_before(0, 40)
+            hasher.written_before(60, 100)
+            hasher.written(40, data[40:60])
+            assert 0 == hasher.position
+            hasher.advance()
+            assert hashlib.md5(data).hexdigest() == hasher.hexdigest(len(data))
+            assert 100 == hasher.position
+
+    def test_abort(self, executor):
+        reading = threading.Event()
+        reads = []
+
+        def read_at(fd, size, offset):
+            reads.append(offset)
+            reading.set()
+            time.sleep(0.01)
+            return b'x' * size
+
+        file_size = 100 * download_threads.STREAM_BUFFER_SIZE
+        hasher = download_threads._OrderedHasher(None, executor)
+        hasher.written_before(0, file_size)
+        with mock.patch.object(download_threads, '_read_at', side_effect=read_at):
+            hasher.advance()
+            assert reading.wait(5)
+            hasher.abort()
+
+            # nothing reads the file once abort returns
+            read_count = len(reads)
+            time.sleep(0.05)
+            assert read_count == len(reads) < 100
+        with pytest.raises(SynapseError):
+            hasher.hexdigest(file_size)
+
+    def test_abort__not_started(self):
+        executor = mock.Mock()
+        executor.submit.return_value = concurrent.futures.Future()
+        hasher = download_threads._OrderedHasher(None, executor)
+        hasher.written_before(0, 10)
+        hasher.advance()
+
+        hasher.abort()
+        assert executor.submit.return_value.cancelled()
+
+    def test_hexdigest__incomplete(self, executor):
+        hasher = download_threads._OrderedHasher(None, executor)
+        hasher.written(10, b'abc')
+        assert 0 == hasher.position
+        with pytest.raises(SynapseError):
+            hasher.hexdigest(13)
+
+
 def test_shared_executor():
     """Test the shared_executor contextmanager which should set up thread_local Executor"""
     assert not hasattr(download_threads._thread_local, 'executor')
@@ -1,21 +1,28 @@
+import concurrent.futures
+import errno
 import re
 import os
+import threading
 import tempfile
 import time
 import random
+import sqlite3
+import pytest
 from unittest.mock import patch
 from collections import OrderedDict
 from multiprocessing import Process
 
 import synapseclient.core.cache as cache
+import synapseclient.core.cache_index as cache_index
+import synapseclient.core.lock as lock_module
 import synapseclient.core.utils as utils
 
 
-def add_file_to_cache(i, cache_root_dir):
+def add_file_to_cache(i, cache_root_dir, lock=cache.LOCK_TYPE_MKDIR):
     """
     Helper function for use in test_cache_concurrent_access
     """
-    my_cache = cache.Cache(cache_root_dir=cache_root_dir)
+    my_cache = cache.Cache(cache_root_dir=cache_root_dir, lock=lock)
     file_handle_ids = [1001, 1002, 1003, 1004, 1005]
     random.shuffle(file_handle_ids)
     for file_handle_id in file_handle_ids:
@@ -25,9 +32,10 @@ def add_file_to_cache(i, cache_root_dir):
         my_cache.add(file_handle_id, file_path)
 
 
-def test_cache_concurrent_access():
+@pytest.mark.parametrize("lock", [cache.LOCK_TYPE_MKDIR, cache.LOCK_TYPE_FCNTL])
+def test_cache_concurrent_access(lock):
     cache_root_dir = tempfile.mkdtemp()
-    processes = [Process(target=add_file_to_cache, args=(i, cache_root_dir)) for i in range(20)]
+    processes = [Process(target=add_file_to_cache, args=(i, cache_root_dir, lock)) for i in range(20)]
 
     for process in processes:
         process.start()
@@ -293,3 +301,630 @@ def test_set_cache_root_dir():
     # test that manually assigning cache_root_dir expands the path
     my_cache.cache_root_dir = non_expanded_path + "2"
     assert expanded_path + "2" == my_cache.cache_root_dir
+
+
+def add_file_to_sqlite_cache(i, cache_root_dir):
+    """
+    Helper function for use in test_sqlite_cache_concurrent_access
+    """
+    my_cache = cache.Cache(cache_root_dir=cache_root_dir, index=cache.CACHE_INDEX_SQLITE)
+    for file_handle_id in [1001, 1002, 1003]:
+        file_path = utils.touch(os.path.join(my_cache.get_cache_dir(file_handle_id), "file_%02d.junk" % i))
+        my_cache.add(file_handle_id, file_path)
+
+
+def test_sqlite_cache_concurrent_access():
+    cache_root_dir = tempfile.mkdtemp()
+    processes = [Process(target=add_file_to_sqlite_cache, args=(i, cache_root_dir)) for i in range(10)]
+
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        process.join()
+
+    my_cache = cache.Cache(cache_root_dir=cache_root_dir, index=cache.CACHE_INDEX_SQLITE)
+    for file_handle_id in [1001, 1002, 1003]:
+        cache_map = my_cache._read_cache_map(my_cache.get_cache_dir(file_handle_id))
+        assert len(cache_map) == 10
+
+
+def test_sqlite_cache_store_get_remove():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=cache.CACHE_INDEX_SQLITE)
+    assert isinstance(my_cache._index, cache.SqliteCacheIndex)
+
+    path1 = utils.touch(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"))
+    my_cache.add(file_handle_id=101201, path=path1)
+
+    # files outside the cache don't need a cache dir
+    path2 = utils.touch(os.path.join(tempfile.mkdtemp(), "file2.ext"))
+    my_cache.add(file_handle_id=101202, path=path2)
+
+    assert not os.path.exists(os.path.join(my_cache.get_cache_dir(101201), my_cache.cache_map_file_name))
+    assert utils.equal_paths(my_cache.get(101201), path1)
+    assert utils.equal_paths(my_cache.get(101202, path=os.path.dirname(path2)), path2)
+    assert my_cache.contains(101202, path2)
+    assert my_cache.get(101203) is None
+
+    new_time_stamp = cache._get_modified_time(path1) + 1
+    utils.touch(path1, (new_time_stamp, new_time_stamp))
+    assert my_cache.get(101201, path=path1) is None
+
+    assert [utils.normalize_path(path2)] == my_cache.remove(101202)
+    assert my_cache.get(101202) is None
+
+
+def test_sqlite_cache_migrates_cache_maps():
+    tmp_dir = tempfile.mkdtemp()
+    legacy_cache = cache.Cache(cache_root_dir=tmp_dir)
+
+    path1 = utils.touch(os.path.join(legacy_cache.get_cache_dir(101201), "file1.ext"))
+    legacy_cache.add(file_handle_id=101201, path=path1)
+
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=cache.CACHE_INDEX_SQLITE)
+    assert utils.equal_paths(my_cache.get(101201), path1)
+
+    # entries are read from the database from now on
+    path2 = utils.touch(os.path.join(my_cache.get_cache_dir(101201), "file2.ext"))
+    my_cache.add(file_handle_id=101201, path=path2)
+    assert set(my_cache._read_cache_map(my_cache.get_cache_dir(101201))) == \
+        {utils.normalize_path(path1), utils.normalize_path(path2)}
+    assert set(legacy_cache._read_cache_map(legacy_cache.get_cache_dir(101201))) == {utils.normalize_path(path1)}
+
+
+def test_sqlite_cache_read_many():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=cache.CACHE_INDEX_SQLITE)
+
+    paths = {}
+    for file_handle_id in range(1000, 1600):
+        paths[file_handle_id] = utils.touch(os.path.join(my_cache.get_cache_dir(file_handle_id), "file.ext"))
+        my_cache.add(file_handle_id, paths[file_handle_id])
+
+    cache_dirs = [my_cache.get_cache_dir(file_handle_id) for file_handle_id in range(1000, 1700)]
+    cache_maps = my_cache._index.read_many(cache_dirs)
+    assert len(cache_maps) == 700
+    for file_handle_id in range(1000, 1600):
+        assert list(cache_maps[my_cache.get_cache_dir(file_handle_id)]) == [utils.normalize_path(paths[file_handle_id])]
+    for file_handle_id in range(1600, 1700):
+        assert cache_maps[my_cache.get_cache_dir(file_handle_id)] == {}
+
+
+def test_sqlite_cache_fallback():
+    tmp_dir = tempfile.mkdtemp()
+    with patch.object(cache, "SqliteCacheIndex", side_effect=Exception("disk I/O error")):
+        my_cache = cache.Cache(cache_root_dir=tmp_dir, index=cache.CACHE_INDEX_SQLITE)
+    assert isinstance(my_cache._index, cache.CacheMapIndex)
+
+
+def test_sqlite_cache_purge():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=cache.CACHE_INDEX_SQLITE)
+
+    path1 = utils.touch(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"))
+    my_cache.add(file_handle_id=101201, path=path1)
+
+    assert my_cache.purge(before_date=time.time() - 60) == 0
+    assert my_cache.purge(before_date=time.time() + 60) == 1
+    assert not os.path.exists(path1)
+    assert my_cache._read_cache_map(my_cache.get_cache_dir(101201)) == {}
+
+
+def test_invalid_cache_index():
+    with pytest.raises(ValueError):
+        cache.Cache(cache_root_dir=tempfile.mkdtemp(), index="not an index")
+
+
+def test_invalid_cache_lock():
+    with pytest.raises(ValueError):
+        cache.Cache(cache_root_dir=tempfile.mkdtemp(), lock="not a lock")
+
+
+def test_fcntl_cache_lock_unsupported():
+    with patch.object(cache, "fcntl", None):
+        my_cache = cache.Cache(cache_root_dir=tempfile.mkdtemp(), lock=cache.LOCK_TYPE_FCNTL)
+    assert my_cache.lock_type == cache.LOCK_TYPE_MKDIR
+
+
+def _make_file(path, size):
+    utils.touch(path)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    return path
+
+
+def test_sqlite_cache_schema_upgrade():
+    tmp_dir = tempfile.mkdtemp()
+    db_path = os.path.join(tmp_dir, cache.SQLITE_INDEX_FILE_NAME)
+
+    # a database written before file sizes and access times were tracked
+    conn = sqlite3.connect(db_path)
+    for statement in cache.SqliteCacheIndex.SCHEMA_VERSIONS[0]:
+        conn.execute(statement)
+    path = utils.normalize_path(utils.touch(os.path.join(tmp_dir, "1", "1001", "file.ext")))
+    with open(path, 'w') as f:
+        f.write("some content")
+    conn.execute("INSERT INTO cache_entries (file_handle_id, path, modified_time, size) VALUES (1001, ?, ?, 12)",
+                 (path, "2015-05-05T21:34:55.000Z"))
+    conn.commit()
+    conn.close()
+
+    index = cache.SqliteCacheIndex(db_path)
+    assert index.cache_size() == 12
+    assert index.lru_entries() == [(path, 12, 0)]
+
+
+def test_sqlite_cache_size():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=cache.CACHE_INDEX_SQLITE)
+
+    path1 = os.path.join(my_cache.get_cache_dir(101201), "file1.ext")
+    _make_file(path1, 1000)
+    my_cache.add(101201, path1)
+
+    # files outside the cache don't count
+    path2 = _make_file(os.path.join(tempfile.mkdtemp(), "file2.ext"), 1000)
+    my_cache.add(101202, path2)
+    assert my_cache._index.cache_size() == 1000
+
+    my_cache.remove(101201)
+    assert my_cache._index.cache_size() == 0
+
+
+def test_cache_prune():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=cache.CACHE_INDEX_SQLITE)
+
+    paths = {}
+    for file_handle_id in (101201, 101202, 101203):
+        paths[file_handle_id] = os.path.join(my_cache.get_cache_dir(file_handle_id), "file.ext")
+        _make_file(paths[file_handle_id], 1000)
+        my_cache.add(file_handle_id, paths[file_handle_id])
+
+    outside_path = _make_file(os.path.join(tempfile.mkdtemp(), "file.ext"), 5000)
+    my_cache.add(101204, outside_path)
+
+    with patch.object(cache.time, "time", return_value=time.time() - 3600):
+        # 101202 was used long ago, 101201 a little later, 101203 just now
+        my_cache._index.touch(my_cache.get_cache_dir(101202), utils.normalize_path(paths[101202]))
+    with patch.object(cache.time, "time", return_value=time.time() - 1800):
+        my_cache._index.touch(my_cache.get_cache_dir(101201), utils.normalize_path(paths[101201]))
+
+    # the cache fits
+    assert my_cache.prune(max_size=3000) == 0
+
+    # recently used files are never evicted
+    assert my_cache.prune(max_size=0, dry_run=True) == 2
+
+    assert my_cache.prune(max_size=2000) == 1
+    assert not os.path.exists(paths[101202])
+    assert my_cache.get(101202) is None
+    assert os.path.exists(paths[101201])
+    assert os.path.exists(outside_path)
+    assert my_cache._index.cache_size() == 2000
+
+
+def test_cache_get_records_access():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=cache.CACHE_INDEX_SQLITE)
+
+    path = utils.touch(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"))
+    with patch.object(cache.time, "time", return_value=1000):
+        my_cache.add(101201, path)
+    assert my_cache._index.lru_entries()[0][2] < 2000
+
+    my_cache.get(101201)
+    assert my_cache._index.lru_entries()[0][2] > time.time() - 60
+
+
+def test_cache_get_without_write_lock():
+    tmp_dir = tempfile.mkdtemp()
+    with patch.object(cache_index, "SQLITE_BUSY_TIMEOUT", 0.1):
+        my_cache = cache.Cache(cache_root_dir=tmp_dir, index=cache.CACHE_INDEX_SQLITE)
+    path = utils.touch(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"))
+    my_cache.add(101201, path)
+
+    # another process holds the write lock
+    writer = sqlite3.connect(my_cache._index.db_path, isolation_level=None)
+    writer.execute('BEGIN IMMEDIATE')
+    try:
+        assert utils.equal_paths(my_cache.get(101201), path)
+        assert my_cache.get_many([101201, 101202]) == {101201: utils.normalize_path(path), 101202: None}
+        assert my_cache.contains(101201, path)
+    finally:
+        writer.execute('ROLLBACK')
+        writer.close()
+
+    # the use of an entry is recorded once its access time is out of date
+    with patch.object(cache_index.time, "time", return_value=time.time() + cache_index.ACCESS_TIME_RESOLUTION):
+        my_cache.get(101201)
+    assert my_cache._index.lru_entries()[0][2] > time.time() + cache_index.ACCESS_TIME_RESOLUTION - 10
+
+
+def test_cache_add_prunes_in_background():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=cache.CACHE_INDEX_SQLITE, max_size=1500)
+
+    path1 = os.path.join(my_cache.get_cache_dir(101201), "file1.ext")
+    _make_file(path1, 1000)
+    with patch.object(cache.threading, "Thread") as mock_thread:
+        my_cache.add(101201, path1)
+        mock_thread.assert_not_called()
+
+        path2 = os.path.join(my_cache.get_cache_dir(101202), "file2.ext")
+        _make_file(path2, 1000)
+        my_cache.add(101202, path2)
+        mock_thread.assert_called_once_with(target=my_cache.prune, name='synapse-cache-pruner', daemon=True)
+        mock_thread.return_value.start.assert_called_once_with()
+
+
+def test_cache_max_size_requires_sqlite_index():
+    with patch.object(cache.logging, "getLogger") as mock_get_logger:
+        cache.Cache(cache_root_dir=tempfile.mkdtemp(), max_size=1000)
+    assert mock_get_logger.return_value.warning.called
+
+
+def test_cache_get_by_md5():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=cache.CACHE_INDEX_SQLITE)
+
+    path1 = _make_file(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"), 10)
+    my_cache.add(101201, path1, md5="abc")
+
+    assert utils.equal_paths(my_cache.get_by_md5("abc"), path1)
+    assert my_cache.get_by_md5("def") is None
+    assert my_cache.get_by_md5(None) is None
+
+    # modified files no longer have the recorded content
+    new_time_stamp = cache._get_modified_time(path1) + 2
+    utils.touch(path1, (new_time_stamp, new_time_stamp))
+    assert my_cache.get_by_md5("abc") is None
+
+    # and re-adding it without an md5 forgets the old one
+    my_cache.add(101201, path1)
+    assert my_cache.get_by_md5("abc") is None
+
+
+def test_link_or_copy():
+    tmp_dir = tempfile.mkdtemp()
+    source = _make_file(os.path.join(tmp_dir, "source.ext"), 10)
+    destination = os.path.join(tmp_dir, "destination.ext")
+
+    with patch.object(cache, "_reflink", side_effect=OSError("not supported")):
+        assert destination == cache.link_or_copy(source, destination)
+        assert not os.path.samefile(source, destination)
+
+        assert destination == cache.link_or_copy(source, destination, hardlink=True)
+        assert os.path.samefile(source, destination)
+
+        # linking a file to itself leaves it alone
+        assert destination == cache.link_or_copy(source, destination, hardlink=True)
+        assert os.path.exists(source)
+
+    with open(destination, 'rb') as f:
+        assert f.read() == b'x' * 10
+
+
+def test_cache_link_or_copy__no_hardlink_by_default():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir)
+    cached_path = _make_file(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"), 10)
+    destination = os.path.join(tempfile.mkdtemp(), "file1.ext")
+
+    with patch.object(cache, "_reflink", side_effect=OSError("not supported")):
+        my_cache.link_or_copy(cached_path, destination)
+    assert not os.path.samefile(cached_path, destination)
+
+    # modifying the download leaves the cached copy alone
+    with open(destination, 'wb') as f:
+        f.write(b'modified')
+    with open(cached_path, 'rb') as f:
+        assert f.read() == b'x' * 10
+
+
+def test_cache_link_or_copy_only_hardlinks_cached_files():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, hardlink=True)
+    cached_path = _make_file(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"), 10)
+    user_path = _make_file(os.path.join(tempfile.mkdtemp(), "file1.ext"), 10)
+    destination = os.path.join(tempfile.mkdtemp(), "file1.ext")
+
+    with patch.object(cache, "link_or_copy") as mock_link_or_copy:
+        my_cache.link_or_copy(cached_path, destination)
+        mock_link_or_copy.assert_called_once_with(cached_path, destination, hardlink=True)
+
+        mock_link_or_copy.reset_mock()
+        my_cache.link_or_copy(user_path, destination)
+        mock_link_or_copy.assert_called_once_with(user_path, destination, hardlink=False)
+
+
+def test_cache_memoizes_cache_maps():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, memo_size=10)
+    other_cache = cache.Cache(cache_root_dir=tmp_dir)
+    path1 = _make_file(os.path.join(tempfile.mkdtemp(), "file1.ext"), 10)
+    path2 = _make_file(os.path.join(tempfile.mkdtemp(), "file2.ext"), 10)
+    cache_dir = my_cache.get_cache_dir(101201)
+
+    # cache maps written moments ago aren't trusted to a coarse modification time
+    with patch.object(cache_index, "RACY_WINDOW", 0):
+        other_cache.add(101201, path1)
+        assert my_cache.get(101201) == utils.normalize_path(path1)
+
+        with patch.object(my_cache._index, "lock", side_effect=AssertionError("memoized reads aren't locked")):
+            assert my_cache.get(101201, path1) == utils.normalize_path(path1)
+            assert my_cache.contains(101201, path1)
+            assert my_cache._index.read_many([cache_dir]) == {cache_dir: other_cache._read_cache_map(cache_dir)}
+
+        # another client changing the .cacheMap invalidates the memoized copy
+        os.utime(path2, (time.time() + 10, time.time() + 10))
+        other_cache.add(101201, path2)
+        assert my_cache.get(101201) == utils.normalize_path(path2)
+
+        other_cache.remove(101201)
+        assert my_cache.get(101201) is None
+
+
+def test_cache_map_memo():
+    tmp_dir = tempfile.mkdtemp()
+    memo = cache_index.CacheMapMemo(2)
+    files = [_make_file(os.path.join(tmp_dir, str(i)), 10) for i in range(3)]
+    for i, f in enumerate(files):
+        os.utime(f, (time.time() - 60, time.time() - 60))
+        memo.put(f, os.stat(f), {"path": i})
+
+    # the least recently used entry is dropped
+    assert memo.get(files[0]) is None
+    assert memo.get(files[1]) == {"path": 1}
+    assert memo.get(files[2]) == {"path": 2}
+
+    # an entry is only valid while the file is unchanged
+    with open(files[1], 'a') as f:
+        f.write('x')
+    assert memo.get(files[1]) is None
+
+    # a file modified within the racy window isn't memoized
+    memo.put(files[0], os.stat(files[0]), {"path": 0})
+    os.utime(files[0])
+    memo.put(files[0], os.stat(files[0]), {"path": 0})
+    assert memo.get(files[0]) is None
+
+    # a missing file is an empty cache map
+    os.remove(files[2])
+    assert memo.get(files[2]) == {}
+
+
+@pytest.mark.parametrize("index", cache_index.CACHE_INDEX_TYPES)
+def test_cache_get_many_add_many(index):
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=index)
+    download_dir = tempfile.mkdtemp()
+    # file handles spread over more than one fanout directory
+    file_handle_ids = [101201, 102201, 101202, 101203]
+    paths = [_make_file(os.path.join(download_dir, "file%d.ext" % i), 10) for i in range(3)]
+
+    my_cache.add_many(zip(file_handle_ids, paths))
+    with pytest.raises(ValueError):
+        my_cache.add_many([(101204, os.path.join(download_dir, "missing.ext"))])
+
+    expected = {file_handle_id: utils.normalize_path(path) for file_handle_id, path in zip(file_handle_ids, paths)}
+    expected[101203] = None
+    for max_threads in (1, 4):
+        assert my_cache.get_many(file_handle_ids, max_threads=max_threads) == expected
+    for file_handle_id in file_handle_ids:
+        assert my_cache.get(file_handle_id) == expected[file_handle_id]
+
+    # a path not in the cache map falls back to any unmodified cached copy, as with get
+    assert my_cache.get_many([101201, 101202], path=paths[0]) == {101201: expected[101201], 101202: expected[101202]}
+    in_download_dir = my_cache.get_many([101201, 102201], path=download_dir)
+    assert in_download_dir == {101201: expected[101201], 102201: expected[102201]}
+    assert my_cache.get_many([]) == {}
+
+
+@pytest.mark.parametrize("index", cache_index.CACHE_INDEX_TYPES)
+def test_cache_md5_for_file(index):
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, index=index)
+    path = _make_file(os.path.join(tempfile.mkdtemp(), "file1.ext"), 10)
+    expected_md5 = utils.md5_for_file(path).hexdigest()
+    an_hour_ago = time.time() - 3600
+    os.utime(path, (an_hour_ago, an_hour_ago))
+
+    with patch.object(utils, "md5_for_file", wraps=utils.md5_for_file) as mock_md5_for_file:
+        assert my_cache.md5_for_file(path) == expected_md5
+        assert my_cache.md5_for_file(path) == expected_md5
+        # the digest is kept with the cache so another client reuses it as well
+        assert cache.Cache(cache_root_dir=tmp_dir, index=index).md5_for_file(path) == expected_md5
+        assert mock_md5_for_file.call_count == 1
+
+        # a modified file is hashed again
+        with open(path, 'a') as f:
+            f.write('y')
+        os.utime(path, (an_hour_ago + 1, an_hour_ago + 1))
+        assert my_cache.md5_for_file(path) == utils.md5_for_file(path).hexdigest()
+        assert mock_md5_for_file.call_count == 3
+
+        # as is a file modified so recently another write could hide behind an unchanged modification time
+        os.utime(path)
+        my_cache.md5_for_file(path)
+        my_cache.md5_for_file(path)
+        assert mock_md5_for_file.call_count == 5
+
+    # the md5 of a downloaded file is recorded when it is added to the cache
+    downloaded_path = _make_file(os.path.join(my_cache.get_cache_dir(101201), "file2.ext"), 10)
+    os.utime(downloaded_path, (an_hour_ago, an_hour_ago))
+    my_cache.add(101201, downloaded_path, md5="abc")
+    assert my_cache.md5_for_file(downloaded_path) == "abc"
+
+
+@pytest.mark.parametrize("index", cache_index.CACHE_INDEX_TYPES)
+def test_cache_remove_forgets_file_digests(index):
+    my_cache = cache.Cache(cache_root_dir=tempfile.mkdtemp(), index=index)
+    paths = [_make_file(os.path.join(my_cache.get_cache_dir(101201), name), 10) for name in ("file1.ext", "file2.ext")]
+    for path in paths:
+        my_cache.add(101201, path, md5="abc")
+        assert my_cache._index.get_file_digest(path) is not None
+
+    my_cache.remove(101201, paths[0])
+    assert my_cache._index.get_file_digest(paths[0]) is None
+    assert my_cache._index.get_file_digest(paths[1]) is not None
+
+    my_cache.remove(101201)
+    assert my_cache._index.get_file_digest(paths[1]) is None
+
+
+@pytest.mark.parametrize("lock", [cache.LOCK_TYPE_MKDIR, cache.LOCK_TYPE_FCNTL])
+def test_cache_download_once(lock):
+    my_cache = cache.Cache(cache_root_dir=tempfile.mkdtemp(), lock=lock)
+    destinations = [os.path.join(tempfile.mkdtemp(), "file1.ext") for _ in range(2)]
+    started = threading.Event()
+    proceed = threading.Event()
+    downloads = []
+
+    def download():
+        downloads.append(destinations[0])
+        started.set()
+        proceed.wait(10)
+        _make_file(destinations[0], 10)
+        my_cache.add(101201, destinations[0])
+        return destinations[0]
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        first = executor.submit(my_cache.download_once, 101201, destinations[0], download)
+        started.wait(10)
+        # the second download of the same file handle waits on the first one instead of downloading it again
+        second = executor.submit(my_cache.download_once, 101201, destinations[1], download)
+        proceed.set()
+        assert first.result() == destinations[0]
+        assert second.result() == destinations[1]
+
+    assert downloads == [destinations[0]]
+    assert os.path.exists(destinations[1])
+    assert utils.equal_paths(my_cache.get(101201, destinations[1]), destinations[1])
+
+
+def test_cache_download_once_waits_for_other_process():
+    my_cache = cache.Cache(cache_root_dir=tempfile.mkdtemp())
+    destination = os.path.join(tempfile.mkdtemp(), "file1.ext")
+
+    # another process is downloading the file handle
+    claim = lock_module.get_lock(cache.LOCK_TYPE_MKDIR, my_cache.cache_map_file_name + '.download',
+                                 dir=my_cache.get_cache_dir(101201))
+    assert claim.acquire()
+    cached_path = _make_file(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"), 10)
+    my_cache.add(101201, cached_path)
+    threading.Timer(0.2, claim.release).start()
+
+    def download():
+        raise AssertionError("the file was downloaded by the other process")
+
+    assert my_cache.download_once(101201, destination, download) == destination
+    assert os.path.exists(destination)
+
+
+def test_cache_download_once_failure():
+    my_cache = cache.Cache(cache_root_dir=tempfile.mkdtemp())
+
+    def download():
+        raise ValueError("download failed")
+
+    with pytest.raises(ValueError):
+        my_cache.download_once(101201, os.path.join(tempfile.mkdtemp(), "file1.ext"), download)
+    assert my_cache._in_flight == {}
+
+    # a later download of the same file handle isn't blocked by the failed one
+    destination = _make_file(os.path.join(tempfile.mkdtemp(), "file1.ext"), 10)
+    assert my_cache.download_once(101201, destination, lambda: destination) == destination
+
+
+def test_lock_renew():
+    lock = lock_module.Lock("renewed", dir=tempfile.mkdtemp())
+    assert lock.acquire()
+    an_hour_ago = time.time() - 3600
+    os.utime(lock.lock_dir_path, (an_hour_ago, an_hour_ago))
+    lock.renew()
+    assert lock.get_age() < lock.max_age.total_seconds()
+    # only the times are reset, not set to the epoch
+    assert os.stat(lock.lock_dir_path).st_atime >= an_hour_ago
+    lock.release()
+
+
+def test_cache_shared_tiers():
+    shared_root_dir = tempfile.mkdtemp()
+    shared_cache = cache.Cache(cache_root_dir=shared_root_dir)
+    shared_path = _make_file(os.path.join(shared_cache.get_cache_dir(101201), "file1.ext"), 10)
+    shared_cache.add(101201, shared_path)
+
+    my_cache = cache.Cache(cache_root_dir=tempfile.mkdtemp(), shared_cache_root_dirs=[shared_root_dir])
+
+    # a file found in the shared cache is promoted to the local cache
+    cached_path = my_cache.get(101201)
+    assert utils.equal_paths(cached_path, os.path.join(my_cache.get_cache_dir(101201), "file1.ext"))
+    assert not utils.equal_paths(cached_path, shared_path)
+    assert utils.equal_paths(my_cache._get_local(101201, None), cached_path)
+    assert my_cache.get_many([101201, 101202]) == {101201: cached_path, 101202: None}
+
+    # a modified file at an exact path is never replaced by the shared copy
+    modified_path = _make_file(os.path.join(tempfile.mkdtemp(), "file2.ext"), 10)
+    my_cache.add(101203, modified_path)
+    shared_cache.add(101203, _make_file(os.path.join(shared_cache.get_cache_dir(101203), "file2.ext"), 10))
+    os.utime(modified_path, (time.time() + 10, time.time() + 10))
+    assert my_cache.get(101203, modified_path) is None
+
+    # downloads are published to the shared cache
+    destination = os.path.join(tempfile.mkdtemp(), "file3.ext")
+
+    def download():
+        _make_file(destination, 10)
+        my_cache.add(101204, destination)
+        return destination
+
+    assert my_cache.download_once(101204, destination, download) == destination
+    assert utils.equal_paths(shared_cache.get(101204),
+                             os.path.join(shared_cache.get_cache_dir(101204), "file3.ext"))
+
+    # unless publishing is disabled
+    read_only_cache = cache.Cache(cache_root_dir=tempfile.mkdtemp(), shared_cache_root_dirs=[shared_root_dir],
+                                  publish=False)
+    destination = os.path.join(tempfile.mkdtemp(), "file4.ext")
+    read_only_cache.download_once(101205, destination, lambda: _make_file(destination, 10))
+    assert shared_cache.get(101205) is None
+
+
+def test_cache_shared_tiers__read_only():
+    shared_root_dir = tempfile.mkdtemp()
+    shared_cache = cache.Cache(cache_root_dir=shared_root_dir)
+    shared_cache.add(101301, _make_file(os.path.join(shared_cache.get_cache_dir(101301), "file1.ext"), 10))
+    my_cache = cache.Cache(cache_root_dir=tempfile.mkdtemp(), shared_cache_root_dirs=[shared_root_dir])
+
+    makedirs = os.makedirs
+
+    def read_only_makedirs(name, *args, **kwargs):
+        if utils.normalize_path(name).startswith(utils.normalize_path(shared_root_dir)):
+            raise OSError(errno.EROFS, os.strerror(errno.EROFS), name)
+        return makedirs(name, *args, **kwargs)
+
+    destination = os.path.join(tempfile.mkdtemp(), "file2.ext")
+    with patch.object(os, 'makedirs', side_effect=read_only_makedirs), \
+            patch.object(os, 'access', return_value=False), \
+            patch.object(cache.logging.getLogger(cache.DEFAULT_LOGGER_NAME), 'warning') as warning:
+        # looked up without taking the locks of the shared cache
+        assert utils.equal_paths(my_cache.get(101301), os.path.join(my_cache.get_cache_dir(101301), "file1.ext"))
+        assert my_cache.get(101302) is None
+
+        # downloads are claimed locally and not published
+        assert my_cache.download_once(101303, destination, lambda: _make_file(destination, 10)) == destination
+    assert shared_cache.get(101303) is None
+    assert "missing or read-only" in warning.call_args[0][0]
+
+
+def test_cache_shared_tiers__missing():
+    shared_root_dir = os.path.join(tempfile.mkdtemp(), "shared")
+    my_cache = cache.Cache(cache_root_dir=tempfile.mkdtemp(), shared_cache_root_dirs=[shared_root_dir])
+    assert my_cache.get(101401) is None
+
+    destination = os.path.join(tempfile.mkdtemp(), "file1.ext")
+    my_cache.download_once(101401, destination, lambda: _make_file(destination, 10))
+    # the shared cache isn't created
+    assert not os.path.exists(shared_root_dir)
@@ -0,0 +1,186 @@
+import os
+import tempfile
+import time
+
+import pytest
+
+import synapseclient.core.cache as cache
+import synapseclient.core.cache_index as cache_index
+import synapseclient.core.cache_maintenance as cache_maintenance
+import synapseclient.core.utils as utils
+
+
+def _make_file(path, size, modified_time=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    if modified_time is not None:
+        os.utime(path, (modified_time, modified_time))
+    return utils.normalize_path(path)
+
+
+@pytest.fixture(params=cache_index.CACHE_INDEX_TYPES)
+def populated_cache(request):
+    """
+    A cache holding three cached files, a stale entry, an orphaned file and a download in progress.
+    """
+    my_cache = cache.Cache(cache_root_dir=tempfile.mkdtemp(), index=request.param)
+    an_hour_ago = time.time() - 3600
+
+    cached = [_make_file(os.path.join(my_cache.get_cache_dir(file_handle_id), "file.ext"), 10, an_hour_ago)
+              for file_handle_id in (101201, 102201, 101202)]
+    for file_handle_id, path in zip((101201, 102201, 101202), cached):
+        my_cache.add(file_handle_id, path)
+
+    # a file outside the cache that was modified since it was cached
+    outside = _make_file(os.path.join(tempfile.mkdtemp(), "outside.ext"), 10, an_hour_ago)
+    my_cache.add(101202, outside)
+    _make_file(outside, 20, an_hour_ago + 10)
+
+    orphan = _make_file(os.path.join(my_cache.get_cache_dir(101201), "orphan.ext"), 5, an_hour_ago)
+    in_progress = _make_file(os.path.join(my_cache.get_cache_dir(101201), "synapse_download_101201"), 7)
+
+    return my_cache, cached, outside, orphan, in_progress
+
+
+def test_scan_and_stats(populated_cache):
+    my_cache, cached, outside, orphan, in_progress = populated_cache
+
+    reports = {report.cache_dir: report for report in cache_maintenance.scan(my_cache, max_threads=2)}
+    assert set(reports) == {my_cache.get_cache_dir(file_handle_id) for file_handle_id in (101201, 102201, 101202)}
+
+    report = reports[my_cache.get_cache_dir(101201)]
+    assert report.size == 10 + 5 + 7
+    assert report.orphans == {orphan: 5}
+    assert report.stale_entries == []
+    assert reports[my_cache.get_cache_dir(101202)].stale_entries == [outside]
+
+    assert cache_maintenance.stats(my_cache) == cache_maintenance.CacheStats(
+        cache_dirs=3, entries=4, size=3 * 10 + 5 + 7, stale_entries=1, orphans=1, orphan_size=5
+    )
+    assert {report.cache_dir for report in cache_maintenance.verify(my_cache)} == {
+        my_cache.get_cache_dir(101201), my_cache.get_cache_dir(101202)
+    }
+
+
+def test_purge_orphans(populated_cache):
+    my_cache, cached, outside, orphan, in_progress = populated_cache
+
+    assert cache_maintenance.purge(my_cache, orphans=True, dry_run=True) == [orphan]
+    assert os.path.exists(orphan)
+
+    assert cache_maintenance.purge(my_cache, orphans=True) == [orphan]
+    assert not os.path.exists(orphan)
+    assert os.path.exists(in_progress)
+    # files outside the cache are never deleted, only their stale entries
+    assert os.path.exists(outside)
+    assert my_cache.get(101202) == cached[2]
+    assert cache_maintenance.verify(my_cache) == []
+
+
+def test_purge_by_age_and_size(populated_cache):
+    my_cache, cached, outside, orphan, in_progress = populated_cache
+    now = time.time()
+    cache_map_files = [os.path.join(my_cache.get_cache_dir(file_handle_id), my_cache.cache_map_file_name)
+                       for file_handle_id in (101201, 102201, 101202)]
+
+    if my_cache.index_type == cache_index.CACHE_INDEX_CACHE_MAP:
+        for age, cache_map_file in zip((3, 2, 1), cache_map_files):
+            os.utime(cache_map_file, (now - age * 3600, now - age * 3600))
+        assert cache_maintenance.purge(my_cache, before_date=now - 2.5 * 3600) == [my_cache.get_cache_dir(101201)]
+        assert cache_maintenance.purge(my_cache, max_size=15) == [my_cache.get_cache_dir(102201)]
+        assert my_cache.get(101201) is None
+        assert my_cache.get(102201) is None
+        assert my_cache.get(101202) == cached[2]
+    else:
+        # every cache directory was recorded moments ago
+        assert cache_maintenance.purge(my_cache, before_date=now - 60) == []
+        assert len(cache_maintenance.purge(my_cache, max_size=15)) == 2
+        assert my_cache.get(101202) == cached[2]
+
+    assert cache_maintenance.purge(my_cache, max_size=0, dry_run=True) == [my_cache.get_cache_dir(101202)]
+    assert my_cache.get(101202) == cached[2]
+    assert my_cache.purge(before_date=now + 60) == 1
+    assert cache_maintenance.scan(my_cache) == []
+
+
+@pytest.mark.parametrize("index", cache_index.CACHE_INDEX_TYPES)
+def test_verify_checksums(index):
+    my_cache = cache.Cache(cache_root_dir=tempfile.mkdtemp(), index=index)
+    an_hour_ago = time.time() - 3600
+
+    intact = _make_file(os.path.join(my_cache.get_cache_dir(101201), "intact.ext"), 10, an_hour_ago)
+    my_cache.add(101201, intact, md5=utils.md5_for_file(intact).hexdigest())
+    corrupt = _make_file(os.path.join(my_cache.get_cache_dir(102201), "corrupt.ext"), 10, an_hour_ago)
+    my_cache.add(102201, corrupt, md5=utils.md5_for_file(corrupt).hexdigest())
+    outside = _make_file(os.path.join(tempfile.mkdtemp(), "outside.ext"), 10, an_hour_ago)
+    my_cache.add(103201, outside, md5="not the md5")
+    unknown = _make_file(os.path.join(my_cache.get_cache_dir(101202), "unknown.ext"), 10, an_hour_ago)
+    my_cache.add(101202, unknown)
+
+    # bit rot leaves the modification time alone
+    corrupt_md5 = utils.md5_for_file(corrupt).hexdigest()
+    with open(corrupt, 'r+b') as f:
+        f.write(b'y')
+    os.utime(corrupt, (an_hour_ago, an_hour_ago))
+
+    report = cache_maintenance.verify_checksums(my_cache, max_threads=2)
+
+    assert report.files == 3
+    assert report.size == 30
+    assert report.unverifiable == 1
+    assert report.resumed_fanout_dirs == 0
+    assert report.throughput >= 0
+    quarantined = os.path.join(my_cache.cache_root_dir, cache_maintenance.QUARANTINE_DIR_NAME, "201", "102201",
+                               "corrupt.ext")
+    assert sorted(report.mismatches) == sorted([
+        (corrupt, corrupt_md5, utils.md5_for_file(quarantined).hexdigest(), quarantined),
+        (outside, "not the md5", utils.md5_for_file(outside).hexdigest(), None),
+    ])
+
+    # corrupt files are downloaded again when next needed, files outside the cache are left alone
+    assert not os.path.exists(corrupt)
+    assert my_cache.get(102201) is None
+    assert os.path.exists(outside)
+    assert my_cache.get(103201) is None
+    assert my_cache.get(101201) == intact
+    assert not os.path.exists(os.path.join(my_cache.cache_root_dir, cache_maintenance.VERIFY_JOURNAL_FILE_NAME))
+
+
+def test_verify_checksums_resumes():
+    my_cache = cache.Cache(cache_root_dir=tempfile.mkdtemp())
+    for file_handle_id in (101201, 101202):
+        path = _make_file(os.path.join(my_cache.get_cache_dir(file_handle_id), "file.ext"), 10)
+        my_cache.add(file_handle_id, path, md5=utils.md5_for_file(path).hexdigest())
+
+    # an interrupted run got through the first fanout directory
+    with open(os.path.join(my_cache.cache_root_dir, cache_maintenance.VERIFY_JOURNAL_FILE_NAME), 'w') as journal:
+        journal.write("201\n")
+
+    report = cache_maintenance.verify_checksums(my_cache)
+    assert (report.files, report.resumed_fanout_dirs) == (1, 1)
+
+    with open(os.path.join(my_cache.cache_root_dir, cache_maintenance.VERIFY_JOURNAL_FILE_NAME), 'w') as journal:
+        journal.write("201\n")
+    report = cache_maintenance.verify_checksums(my_cache, resume=False)
+    assert (report.files, report.resumed_fanout_dirs) == (2, 0)
+
+
+def test_purge_forgets_missing_file_digests(populated_cache):
+    my_cache, cached, outside, orphan, in_progress = populated_cache
+    for path in (cached[0], outside, orphan):
+        my_cache.md5_for_file(path)
+    os.remove(outside)
+
+    cache_maintenance.purge(my_cache, dry_run=True)
+    assert my_cache._index.get_file_digest(outside) is not None
+
+    cache_maintenance.purge(my_cache)
+    assert my_cache._index.get_file_digest(outside) is None
+    assert my_cache._index.get_file_digest(cached[0]) is not None
+
+    # as are the digests of the files of the cache directories and stale entries purged
+    cache_maintenance.purge(my_cache, orphans=True)
+    assert my_cache._index.get_file_digest(orphan) is None
+    cache_maintenance.purge(my_cache, max_size=0)
+    assert my_cache._index.get_file_digest(cached[0]) is None
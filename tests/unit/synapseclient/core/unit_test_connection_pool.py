@@ -0,0 +1,36 @@
+import requests
+
+from synapseclient.core.connection_pool import CountingHTTPAdapter, pool_size_for_threads
+
+
+def test_pool_size_for_threads():
+    assert pool_size_for_threads(1) == requests.adapters.DEFAULT_POOLSIZE
+    assert pool_size_for_threads(32) == 33
+
+
+def _use_pool(adapter, url, requests, connections):
+    pool = adapter.poolmanager.connection_from_url(url)
+    pool.num_requests += requests
+    pool.num_connections += connections
+    return pool
+
+
+def test_counting_http_adapter():
+    adapter = CountingHTTPAdapter(pool_maxsize=2)
+    assert adapter.stats() == (0, 0, 0)
+
+    pool = _use_pool(adapter, 'https://repo-prod.prod.sagebase.org/repo/v1', 5, 2)
+    assert pool.pool.maxsize == 2
+    _use_pool(adapter, 'https://file-prod.prod.sagebase.org/file/v1', 3, 1)
+    stats = adapter.stats()
+    assert (stats.requests, stats.hits, stats.misses) == (8, 5, 3)
+
+    # the counts of the pools closed by resizing are kept
+    adapter.resize(8)
+    assert adapter.stats() == (8, 5, 3)
+    pool = _use_pool(adapter, 'https://repo-prod.prod.sagebase.org/repo/v1', 2, 1)
+    assert pool.pool.maxsize == 8
+    assert adapter.stats() == (10, 6, 4)
+
+    adapter.close()
+    assert adapter.stats() == (10, 6, 4)
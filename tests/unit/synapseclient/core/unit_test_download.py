@@ -264,7 +264,9 @@ class Test__downloadFileHandle(unittest.TestCase):
         with patch.object(os, "makedirs"), \
                 patch.object(self.syn, "_getFileHandleDownload") as mock_getFileHandleDownload, \
                 patch.object(self.syn, "_download_from_url_multi_threaded") as mock_multi_thread_download, \
-                patch.object(self.syn, "cache"):
+                patch.object(self.syn, "cache") as mock_cache:
+            mock_cache.get_by_md5.return_value = None
+            mock_cache.download_once.side_effect = lambda file_handle_id, destination, download: download()
 
             mock_getFileHandleDownload.return_value = {
                 'fileHandle': {
@@ -290,8 +292,10 @@ class Test__downloadFileHandle(unittest.TestCase):
         with patch.object(os, "makedirs"), \
                 patch.object(self.syn, "_getFileHandleDownload") as mock_getFileHandleDownload, \
                 patch.object(self.syn, "_download_from_URL") as mock_download_from_URL, \
-                patch.object(self.syn, "cache"), \
+                patch.object(self.syn, "cache") as mock_cache, \
                 patch.object(sts_transfer, "is_storage_location_sts_enabled", return_value=False):
+            mock_cache.get_by_md5.return_value = None
+            mock_cache.download_once.side_effect = lambda file_handle_id, destination, download: download()
             mock_getFileHandleDownload.return_value = {
                 'fileHandle': file_handle,
                 'preSignedURL': 'asdf.com'
@@ -332,8 +336,10 @@ class Test__downloadFileHandle(unittest.TestCase):
         with patch.object(os, "makedirs"), \
                 patch.object(self.syn, "_getFileHandleDownload") as mock_getFileHandleDownload, \
                 patch.object(self.syn, "_download_from_URL") as mock_download_from_URL, \
-                patch.object(self.syn, "cache"), \
+                patch.object(self.syn, "cache") as mock_cache, \
                 patch.object(sts_transfer, "is_storage_location_sts_enabled", return_value=False):
+            mock_cache.get_by_md5.return_value = None
+            mock_cache.download_once.side_effect = lambda file_handle_id, destination, download: download()
             mock_getFileHandleDownload.return_value = {
                 'fileHandle': {
                     'id': '123',
@@ -353,6 +359,35 @@ class Test__downloadFileHandle(unittest.TestCase):
 
             mock_download_from_URL.assert_called_once_with("asdf.com", "/myfakepath", "123", expected_md5="someMD5")
 
+    def test_content_already_cached(self):
+        with patch.object(os, "makedirs"), \
+                patch.object(self.syn, "_getFileHandleDownload") as mock_getFileHandleDownload, \
+                patch.object(self.syn, "_download_from_URL") as mock_download_from_URL, \
+                patch.object(self.syn, "cache") as mock_cache:
+            mock_cache.get_by_md5.return_value = "/cache/1/1001/file.txt"
+            mock_cache.download_once.side_effect = lambda file_handle_id, destination, download: download()
+            mock_cache.link_or_copy.return_value = "/myfakepath"
+            mock_getFileHandleDownload.return_value = {
+                'fileHandle': {
+                    'id': '123',
+                    'concreteType': concrete_types.S3_FILE_HANDLE,
+                    'contentMd5': 'someMD5'
+                },
+                'preSignedURL': 'asdf.com'
+            }
+
+            assert "/myfakepath" == self.syn._downloadFileHandle(
+                fileHandleId=123,
+                objectId=456,
+                objectType="FileEntity",
+                destination="/myfakepath"
+            )
+
+            mock_cache.get_by_md5.assert_called_once_with("someMD5")
+            mock_cache.link_or_copy.assert_called_once_with("/cache/1/1001/file.txt", "/myfakepath")
+            mock_cache.add.assert_called_once_with('123', "/myfakepath", md5="someMD5")
+            mock_download_from_URL.assert_not_called()
+
 
 class Test_download_from_url_multi_threaded:
 
@@ -361,31 +396,31 @@ class Test_download_from_url_multi_threaded:
         self.syn = syn
 
     def test_md5_mismatch(self):
-        with patch.object(multithread_download, "download_file"), \
-             patch.object(utils, "md5_for_file") as mock_md5_for_file, \
+        with patch.object(multithread_download, "download_file") as mock_download_file, \
                 patch.object(os, "remove") as mock_os_remove, \
                 patch.object(shutil, "move") as mock_move:
             path = os.path.abspath("/myfakepath")
 
-            mock_md5_for_file.return_value.hexdigest.return_value = "unexpetedMd5"
+            mock_download_file.return_value = "unexpetedMd5"
 
             pytest.raises(SynapseMd5MismatchError, self.syn._download_from_url_multi_threaded, file_handle_id=123,
                           object_id=456, object_type="FileEntity",
                           destination=path, expected_md5="myExpectedMd5")
 
-            mock_os_remove.assert_called_once_with(utils.temp_download_filename(path, 123))
+            mock_os_remove.assert_called_once_with(
+                utils.temp_download_filename(path, 123) + multithread_download.TEMP_FILE_SUFFIX)
             mock_move.assert_not_called()
 
     def test_md5_match(self):
-        with patch.object(multithread_download, "download_file"), \
-             patch.object(utils, "md5_for_file") as mock_md5_for_file, \
+        with patch.object(multithread_download, "download_file") as mock_download_file, \
+                patch.object(utils, "md5_for_file") as mock_md5_for_file, \
                 patch.object(os, "remove") as mock_os_remove, \
                 patch.object(shutil, "move") as mock_move:
             path = os.path.abspath("/myfakepath")
 
             expected_md5 = "myExpectedMd5"
 
-            mock_md5_for_file.return_value.hexdigest.return_value = expected_md5
+            mock_download_file.return_value = expected_md5
 
             self.syn._download_from_url_multi_threaded(
                 file_handle_id=123,
@@ -395,8 +430,52 @@ class Test_download_from_url_multi_threaded:
                 expected_md5=expected_md5,
             )
 
+            # the md5 was computed during the download, the file isn't read again
+            mock_md5_for_file.assert_not_called()
+            assert mock_download_file.call_args[1]['compute_md5']
             mock_os_remove.assert_not_called()
-            mock_move.assert_called_once_with(utils.temp_download_filename(path, 123), path)
+            mock_move.assert_called_once_with(
+                utils.temp_download_filename(path, 123) + multithread_download.TEMP_FILE_SUFFIX, path)
+
+    def test_failed_then_single_threaded(self):
+        """
+        A failed multithreaded download leaves a file of the full size with holes in it, which the single threaded
+        download mustn't resume from its end.
+        """
+        url = "https://www.ayy.lmao/filerino.txt"
+        contents = "\n".join(str(i) for i in range(1000))
+        contents_md5 = hashlib.md5(contents.encode('utf-8')).hexdigest()
+
+        def failed_download(syn, request, compute_md5=False):
+            with open(request.path, 'wb') as f:
+                f.write(contents[:100].encode('utf-8'))
+                f.truncate(len(contents))
+            with open(request.path + '.parts', 'w') as f:
+                f.write('{}\n0-99\n')
+            raise ValueError("Failed downloading")
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            destination = os.path.join(temp_dir, 'filerino.txt')
+            with patch.object(multithread_download, "download_file", side_effect=failed_download):
+                pytest.raises(ValueError, self.syn._download_from_url_multi_threaded, file_handle_id=123,
+                              object_id=456, object_type="FileEntity", destination=destination,
+                              expected_md5=contents_md5)
+
+            mock_requests_get = MockRequestGetFunction([
+                create_mock_response(url, "stream", contents=contents, buffer_size=1024)
+            ])
+            with patch.object(self.syn._requests_session, 'get', side_effect=mock_requests_get), \
+                    patch.object(Synapse, '_generate_headers', side_effect=mock_generate_headers) as mock_headers:
+                assert destination == self.syn._download_from_URL(url, destination, 123, expected_md5=contents_md5)
+
+            # the whole file was requested
+            mock_headers.assert_called_once_with(url, {})
+            with open(destination) as f:
+                assert contents == f.read()
+            # the partial multithreaded download is kept for a multithreaded download to resume
+            temp_destination = utils.temp_download_filename(destination, 123) + multithread_download.TEMP_FILE_SUFFIX
+            assert os.path.exists(temp_destination)
+            assert os.path.exists(temp_destination + '.parts')
 
 
 def test_download_end_early_retry(syn):
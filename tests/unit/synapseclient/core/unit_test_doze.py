@@ -3,6 +3,11 @@ Created on Sep 21, 2017
 
 @author: bhoff
 """
+import threading
+import time
+
+import pytest
+
 import synapseclient.core.dozer as doze
 
 
@@ -25,3 +30,48 @@ def test_doze():
     doze.add_listener(counter)
     doze.doze(1)  # should call counter_inc() about 10 times
     assert counter.val > 0
+
+
+@pytest.fixture(autouse=True)
+def listeners():
+    yield
+    doze.clear_listeners()
+
+
+def test_doze_interrupt():
+    cancelled = threading.Event()
+
+    def cancellation_hook():
+        if cancelled.is_set():
+            raise InterruptedError()
+
+    doze.add_listener(cancellation_hook)
+    errors = []
+
+    def dozing():
+        try:
+            doze.doze(60)
+        except InterruptedError as ex:
+            errors.append(ex)
+
+    start = time.monotonic()
+    thread = threading.Thread(target=dozing)
+    thread.start()
+
+    # an interruption nobody cancelled doesn't end the doze
+    doze.interrupt()
+    time.sleep(0.1)
+    assert thread.is_alive()
+
+    cancelled.set()
+    doze.interrupt()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert len(errors) == 1
+    assert time.monotonic() - start < 10
+
+
+def test_doze_without_interrupt():
+    start = time.monotonic()
+    doze.doze(0.2)
+    assert time.monotonic() - start == pytest.approx(0.2, abs=0.1)
@@ -0,0 +1,228 @@
+import math
+import os
+import threading
+from unittest import mock
+
+import pytest
+
+from synapseclient.core import instrumentation
+from synapseclient.core.instrumentation import (
+    EndpointStats,
+    HistogramSummary,
+    OpenTelemetrySpanAdapter,
+    PrometheusTextFileExporter,
+    RequestEvent,
+)
+from synapseclient.core.rate_limit import AdaptiveRateLimiter
+from synapseclient.core.retry import with_retry
+
+
+@pytest.fixture
+def events():
+    events = []
+    instrumentation.add_sink(events.append)
+    yield events
+    instrumentation.remove_sink(events.append)
+    assert not instrumentation.get_sinks()
+
+
+def _event(latency=0.2, status=200, endpoint='/repo/v1/entity/{id}', **kwargs):
+    fields = dict(kind=instrumentation.KIND_REST, method='GET', host='repo-prod.prod.sagebase.org', endpoint=endpoint,
+                  status=status, start_time=1600000000.0, latency=latency, bytes_sent=10, bytes_received=100,
+                  retries=0, retry_wait=0.0, throttle_wait=0.0, error=None)
+    fields.update(kwargs)
+    return RequestEvent(**fields)
+
+
+def test_endpoint_template():
+    assert instrumentation.endpoint_template(
+        'https://repo-prod.prod.sagebase.org/repo/v1/entity/syn123/version/2?limit=10'
+    ) == '/repo/v1/entity/{id}/version/{id}'
+    assert instrumentation.endpoint_template(
+        'https://repo-prod.prod.sagebase.org/repo/v1/entity/query/async/get/1234'
+    ) == '/repo/v1/entity/query/async/get/{id}'
+    assert instrumentation.endpoint_template(
+        'https://repo-prod.prod.sagebase.org/repo/v1/entity/SYN123.4/table/column'
+    ) == '/repo/v1/entity/{id}/table/column'
+
+
+def test_measure__no_sinks():
+    assert not instrumentation.get_sinks()
+    with instrumentation.measure(instrumentation.KIND_REST, 'get', 'https://host/entity/syn1') as measurement:
+        measurement.response(mock.Mock(status_code=200))
+        instrumentation.record_retry(1, None)
+        instrumentation.record_throttle_wait(1)
+
+
+def test_measure(events):
+    response = mock.Mock(status_code=201, headers={'Content-Length': '42'})
+    with instrumentation.measure(instrumentation.KIND_REST, 'post', 'https://Host/repo/v1/entity/syn1/acl',
+                                 body='{"id":"é"}') as measurement:
+        instrumentation.record_retry(0.5, mock.Mock(status_code=500))
+        instrumentation.record_retry(2, mock.Mock(status_code=429))
+        instrumentation.record_throttle_wait(0.25)
+        measurement.response(response)
+
+    event, = events
+    assert event.kind == instrumentation.KIND_REST
+    assert event.method == 'POST'
+    assert event.host == 'host'
+    assert event.endpoint == '/repo/v1/entity/{id}/acl'
+    assert event.status == 201
+    assert event.bytes_sent == 11
+    assert event.bytes_received == 42
+    assert event.retries == 2
+    assert event.retry_wait == 0.5
+    assert event.throttle_wait == 2.25
+    assert event.latency >= 0
+    assert event.error is None
+
+
+def test_measure__nested(events):
+    with instrumentation.measure(instrumentation.KIND_ASYNC_JOB, 'post', 'https://host/a') as job:
+        with instrumentation.measure(instrumentation.KIND_REST, 'get', 'https://host/b'):
+            instrumentation.record_retry(1)
+        job.completed('COMPLETE')
+
+    # retries are recorded on the innermost request
+    rest, async_job = events
+    assert rest.retries == 1 and async_job.retries == 0
+    assert async_job.status == 'COMPLETE'
+
+
+def test_measure__without_contextvars(events):
+    # e.g. on Python 3.6
+    with mock.patch.object(instrumentation, '_current', instrumentation._ThreadLocalVar()):
+        test_measure__nested(events)
+        assert instrumentation._current.get() is None
+
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(instrumentation._current.get()))
+        with instrumentation.measure(instrumentation.KIND_REST, 'get', 'https://host/a'):
+            thread.start()
+            thread.join()
+        assert seen == [None]
+
+
+def test_measure__error(events):
+    error = ValueError()
+    error.response = mock.Mock(status_code=404)
+    with pytest.raises(ValueError):
+        with instrumentation.measure(instrumentation.KIND_REST, 'get', 'https://host/a'):
+            raise error
+
+    event, = events
+    assert event.error == 'ValueError'
+    assert event.status == 404
+
+
+def test_measure__broken_sink(events):
+    def broken(event):
+        raise RuntimeError()
+
+    instrumentation.add_sink(broken)
+    try:
+        with instrumentation.measure(instrumentation.KIND_REST, 'get', 'https://host/a'):
+            pass
+    finally:
+        instrumentation.remove_sink(broken)
+    assert len(events) == 1
+
+
+def test_with_retry(events):
+    responses = [mock.Mock(status_code=503), mock.Mock(status_code=200)]
+    with instrumentation.measure(instrumentation.KIND_REST, 'get', 'https://host/a'):
+        with_retry(lambda: responses.pop(0), retries=3, wait=0)
+
+    event, = events
+    assert event.retries == 1
+
+
+def test_rate_limiter(events):
+    limiter = AdaptiveRateLimiter()
+    limiter._paused_until = limiter._refilled_at + 10
+    with mock.patch('time.monotonic', side_effect=[limiter._refilled_at, limiter._refilled_at + 10]), \
+            mock.patch.object(limiter._condition, 'wait'):
+        with instrumentation.measure(instrumentation.KIND_REST, 'get', 'https://host/a'):
+            limiter.call(lambda: mock.Mock(status_code=200))
+
+    event, = events
+    assert event.throttle_wait == 10
+
+
+def test_endpoint_stats():
+    stats = EndpointStats((0.1, 1.0))
+    assert math.isnan(stats.quantile(0.5))
+    for latency in (0.05, 0.05, 0.5, 2):
+        stats.add(_event(latency=latency))
+    stats.add(_event(latency=0.5, status=500))
+
+    assert stats.bucket_counts == [2, 2, 1]
+    assert stats.count == 5
+    assert stats.errors == 1
+    assert stats.statuses == {200: 4, 500: 1}
+    assert stats.quantile(0.2) == pytest.approx(0.05)
+    assert stats.quantile(0.6) == pytest.approx(0.55)
+    assert stats.quantile(1) == 1.0
+
+
+def test_histogram_summary():
+    summary = HistogramSummary()
+    summary(_event())
+    summary(_event(latency=3, method='PUT'))
+    summary(_event(endpoint='/repo/v1/version'))
+
+    stats = summary.stats()
+    assert stats[(instrumentation.KIND_REST, 'GET', '/repo/v1/entity/{id}')].count == 1
+    # the endpoint most time was spent on comes first
+    assert summary.summary().splitlines()[1].split()[:3] == ['rest', 'PUT', '/repo/v1/entity/{id}']
+
+    summary.reset()
+    assert not summary.stats()
+
+
+def test_prometheus_text_file_exporter(tmpdir):
+    path = os.path.join(str(tmpdir), 'metrics', 'synapse.prom')
+    exporter = PrometheusTextFileExporter(path, buckets=(0.1, 1.0))
+    exporter(_event(latency=0.5, endpoint='/a"b'))
+    exporter(_event(latency=0.05, status=None, error='ConnectionError', endpoint='/a"b'))
+
+    with open(path) as f:
+        text = f.read()
+    labels = 'kind="rest",method="GET",endpoint="/a\\"b"'
+    # only the first request was written, the second came within the write interval
+    assert 'synapseclient_request_duration_seconds_count{%s} 1\n' % labels in text
+
+    exporter.write()
+    with open(path) as f:
+        text = f.read()
+    assert '# TYPE synapseclient_request_duration_seconds histogram\n' in text
+    assert 'synapseclient_request_duration_seconds_bucket{%s,le="0.1"} 1\n' % labels in text
+    assert 'synapseclient_request_duration_seconds_bucket{%s,le="1.0"} 2\n' % labels in text
+    assert 'synapseclient_request_duration_seconds_bucket{%s,le="+Inf"} 2\n' % labels in text
+    assert 'synapseclient_request_duration_seconds_count{%s} 2\n' % labels in text
+    assert 'synapseclient_responses_total{%s,status="200"} 1\n' % labels in text
+    assert 'synapseclient_responses_total{%s,status=""} 1\n' % labels in text
+    assert 'synapseclient_request_errors_total{%s} 1\n' % labels in text
+    assert 'synapseclient_request_received_bytes_total{%s} 200\n' % labels in text
+    assert not [name for name in os.listdir(os.path.dirname(path)) if name != 'synapse.prom']
+
+
+def test_open_telemetry_span_adapter():
+    tracer = mock.Mock()
+    adapter = OpenTelemetrySpanAdapter(tracer)
+    adapter(_event(latency=1.5, retries=2))
+
+    name, = tracer.start_span.call_args[0]
+    kwargs = tracer.start_span.call_args[1]
+    assert name == 'GET /repo/v1/entity/{id}'
+    assert kwargs['start_time'] == 1600000000 * 10 ** 9
+    assert kwargs['attributes']['http.status_code'] == 200
+    assert kwargs['attributes']['synapse.retries'] == 2
+    tracer.start_span.return_value.end.assert_called_once_with(end_time=1600000001500000000)
+
+
+def test_open_telemetry_span_adapter__not_installed():
+    with mock.patch.object(instrumentation, 'otel_trace', None):
+        with pytest.raises(ImportError):
+            OpenTelemetrySpanAdapter()
@@ -0,0 +1,66 @@
+import datetime
+import json
+
+import pytest
+
+from synapseclient.core import json_codec
+
+
+@pytest.fixture(params=json_codec.available_codecs())
+def codec(request):
+    previous = json_codec.get_codec()
+    json_codec.set_codec(request.param)
+    yield request.param
+    json_codec.set_codec(previous)
+
+
+def test_available_codecs():
+    codecs = json_codec.available_codecs()
+    assert codecs[-1] == json_codec.CODEC_JSON
+    assert json_codec.get_codec() == codecs[0]
+
+
+def test_set_codec__unavailable():
+    with pytest.raises(ValueError):
+        json_codec.set_codec('simplejson')
+
+
+def test_dumps(codec):
+    body = {'parentId': 'syn123', 'includeTypes': ['file', 'folder'], 'nextPageToken': None, 'limit': 50,
+            'fraction': 0.25, 'isLatestVersion': False}
+    encoded = json_codec.dumps(body)
+    assert isinstance(encoded, str)
+    assert encoded == json.dumps(body, separators=(',', ':'))
+    assert json_codec.loads(encoded) == body
+
+
+def test_dumps__datetime(codec):
+    body = {'createdOn': datetime.datetime(2020, 1, 2, 3, 4, 5, 6000)}
+    assert json_codec.dumps(body) == '{"createdOn":"2020-01-02 03:04:05.006"}'
+
+
+def test_dumps__to_json(codec):
+    class Wrapper:
+        def to_json(self):
+            return ['wrapped']
+    assert json_codec.dumps({'value': Wrapper()}) == '{"value":["wrapped"]}'
+
+
+def test_dumps__ensure_ascii(codec):
+    body = {'name': 'café'}
+    assert json_codec.dumps(body) == '{"name":"caf\\u00e9"}'
+    assert json_codec.loads(json_codec.dumps(body, ensure_ascii=False)) == body
+
+
+def test_dumps__big_int(codec):
+    body = {'value': 2 ** 70}
+    assert json_codec.loads(json_codec.dumps(body)) == body
+
+
+def test_loads__bytes(codec):
+    assert json_codec.loads(b'{"id":"syn123","versionNumber":2}') == {'id': 'syn123', 'versionNumber': 2}
+
+
+def test_loads__invalid(codec):
+    with pytest.raises(ValueError):
+        json_codec.loads('{"id":')
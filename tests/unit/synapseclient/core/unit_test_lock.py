@@ -1,9 +1,13 @@
 import random
+import tempfile
 import time
-from threading import Thread
+from threading import Thread, Timer
 from datetime import timedelta
 
-from synapseclient.core.lock import Lock
+import pytest
+
+from synapseclient.core.exceptions import SynapseFileCacheError
+from synapseclient.core.lock import FcntlLock, Lock, LOCK_TYPE_FCNTL, LOCK_TYPE_MKDIR, get_lock
 
 
 def test_lock():
@@ -78,3 +82,102 @@ def test_multithreaded():
 
     for key in counts:
         assert counts[key] == set(range(NUMBER_OF_TIMES_PER_THREAD))
+
+
+def test_fcntl_lock():
+    tmp_dir = tempfile.mkdtemp()
+    user1_lock = FcntlLock("foo", dir=tmp_dir)
+    user2_lock = FcntlLock("foo", dir=tmp_dir)
+
+    assert user1_lock.acquire()
+    assert not user2_lock.acquire()
+
+    user1_lock.release()
+
+    assert user2_lock.acquire()
+    assert not user1_lock.acquire()
+
+    user2_lock.release()
+
+
+def test_fcntl_lock_shared():
+    tmp_dir = tempfile.mkdtemp()
+    reader1_lock = FcntlLock("foo", dir=tmp_dir, shared=True)
+    reader2_lock = FcntlLock("foo", dir=tmp_dir, shared=True)
+    writer_lock = FcntlLock("foo", dir=tmp_dir)
+
+    assert reader1_lock.acquire()
+    assert reader2_lock.acquire()
+    assert not writer_lock.acquire()
+
+    reader1_lock.release()
+    reader2_lock.release()
+
+    assert writer_lock.acquire()
+    assert not reader1_lock.acquire()
+    writer_lock.release()
+
+
+def test_fcntl_lock_blocking_acquire_wakes_on_release():
+    tmp_dir = tempfile.mkdtemp()
+    user1_lock = FcntlLock("foo", dir=tmp_dir)
+    user2_lock = FcntlLock("foo", dir=tmp_dir)
+
+    assert user1_lock.acquire()
+    Timer(0.2, user1_lock.release).start()
+
+    start = time.time()
+    assert user2_lock.blocking_acquire(timeout=timedelta(seconds=5))
+    assert time.time() - start < 1
+    assert user2_lock.held
+    user2_lock.release()
+
+
+def test_fcntl_lock_blocking_acquire_timeout():
+    tmp_dir = tempfile.mkdtemp()
+    user1_lock = FcntlLock("foo", dir=tmp_dir)
+    user2_lock = FcntlLock("foo", dir=tmp_dir)
+
+    with user1_lock:
+        with pytest.raises(SynapseFileCacheError):
+            user2_lock.blocking_acquire(timeout=timedelta(seconds=0.1))
+        assert not user2_lock.held
+
+    # the abandoned waiter lets go of the lock as soon as it gets it
+    time.sleep(0.1)
+    assert user1_lock.acquire()
+    user1_lock.release()
+
+
+def do_stuff_with_a_fcntl_locked_resource(name, tmp_dir, event_log):
+    lock = FcntlLock("foo", dir=tmp_dir)
+    for i in range(NUMBER_OF_TIMES_PER_THREAD):
+        with lock:
+            event_log.append((name, 'start', i))
+            time.sleep(0.01)
+            event_log.append((name, 'end', i))
+
+
+def test_fcntl_lock_multithreaded():
+    tmp_dir = tempfile.mkdtemp()
+    event_log = []
+
+    threads = [Thread(target=do_stuff_with_a_fcntl_locked_resource, args=("thread %d" % i, tmp_dir, event_log))
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # every start is immediately followed by the end from the same thread
+    assert len(event_log) == 4 * NUMBER_OF_TIMES_PER_THREAD * 2
+    for start, end in zip(event_log[::2], event_log[1::2]):
+        assert (start[0], 'start', start[2]) == (end[0], 'start', end[2])
+        assert end[1] == 'end'
+
+
+def test_get_lock():
+    assert isinstance(get_lock(LOCK_TYPE_MKDIR, "foo"), Lock)
+    assert isinstance(get_lock(LOCK_TYPE_FCNTL, "foo", shared=True), FcntlLock)
+    with pytest.raises(ValueError):
+        get_lock("bogus", "foo")
@@ -0,0 +1,114 @@
+import json
+import os
+import tempfile
+import time
+from unittest.mock import patch
+
+from synapseclient.core.metadata_cache import EntityBundleMemo, MetadataCache, is_cacheable
+
+
+def _bundle(entity_id, version, is_latest=False, unmet_access_requirement=False, padding=''):
+    return {
+        'entity': {'id': entity_id, 'versionNumber': version, 'isLatestVersion': is_latest, 'description': padding,
+                   'concreteType': 'org.sagebionetworks.repo.model.FileEntity'},
+        'annotations': {'id': entity_id, 'etag': 'abc', 'annotations': {}},
+        'fileHandles': [],
+        'restrictionInformation': {'hasUnmetAccessRequirement': unmet_access_requirement},
+    }
+
+
+def test_is_cacheable():
+    assert is_cacheable(_bundle('syn1', 1))
+    assert not is_cacheable(_bundle('syn1', 2, is_latest=True))
+    assert not is_cacheable(_bundle('syn1', 1, unmet_access_requirement=True))
+    assert not is_cacheable({'entity': {'id': 'syn1', 'concreteType': 'org.sagebionetworks.repo.model.Folder'}})
+
+
+def test_metadata_cache():
+    cache_root_dir = tempfile.mkdtemp()
+    metadata_cache = MetadataCache(cache_root_dir, max_size=10000)
+
+    assert metadata_cache.get('syn1', 1, '123') is None
+    assert metadata_cache.put(_bundle('syn1', 1), '123')
+    assert not metadata_cache.put(_bundle('syn1', 2, is_latest=True), '123')
+    assert metadata_cache.get('syn1', 1, '123') == _bundle('syn1', 1)
+    assert metadata_cache.get('SYN1', 1, '123') == _bundle('syn1', 1)
+    assert metadata_cache.get('syn1', 2, '123') is None
+
+    # the bundles can be read directly
+    entry, = metadata_cache.entries()
+    assert (entry.user_id, entry.entity_id, entry.version) == ('123', 'syn1', 1)
+    assert entry.path == os.path.join(cache_root_dir, '.entityBundles', '123', 'syn1', '1.json')
+    with open(entry.path) as f:
+        assert json.load(f) == _bundle('syn1', 1)
+
+    metadata_cache.put(_bundle('syn2', 1), '123')
+    metadata_cache.put(_bundle('syn2', 2), None)
+    metadata_cache.remove('syn2', 1)
+    assert sorted((entry.entity_id, entry.version) for entry in metadata_cache.entries()) == [('syn1', 1), ('syn2', 2)]
+    metadata_cache.remove('syn2')
+    assert [entry.entity_id for entry in metadata_cache.entries()] == ['syn1']
+
+    metadata_cache.clear()
+    assert metadata_cache.entries() == []
+
+
+def test_metadata_cache_evicts_least_recently_used():
+    cache_root_dir = tempfile.mkdtemp()
+    bundle_size = len(json.dumps(_bundle('syn1', 1, padding='x' * 1000)))
+    metadata_cache = MetadataCache(cache_root_dir, max_size=int(bundle_size * 2.5))
+
+    for entity_id in ['syn1', 'syn2']:
+        metadata_cache.put(_bundle(entity_id, 1, padding='x' * 1000), '123')
+        os.utime(os.path.join(cache_root_dir, '.entityBundles', '123', entity_id, '1.json'), (1000, 1000))
+    # reading syn1 makes syn2 the least recently used
+    assert metadata_cache.get('syn1', 1, '123') is not None
+
+    metadata_cache.put(_bundle('syn3', 1, padding='x' * 1000), '456')
+    assert sorted(entry.entity_id for entry in metadata_cache.entries()) == ['syn1', 'syn3']
+
+
+def test_metadata_cache_per_user():
+    metadata_cache = MetadataCache(tempfile.mkdtemp(), max_size=10000)
+    metadata_cache.put(_bundle('syn1', 1), '123')
+
+    # another user sharing the cache fetches the bundle themselves
+    assert metadata_cache.get('syn1', 1, '456') is None
+    assert metadata_cache.get('syn1', 1, None) is None
+
+    metadata_cache.put(_bundle('syn1', 1), None)
+    assert metadata_cache.get('syn1', 1, None) == _bundle('syn1', 1)
+    assert sorted(entry.user_id for entry in metadata_cache.entries()) == ['123', 'anonymous']
+
+    # a deleted version is forgotten for every user
+    metadata_cache.remove('syn1', 1)
+    assert metadata_cache.entries() == []
+
+
+def test_entity_bundle_memo():
+    memo = EntityBundleMemo(ttl=60, max_entries=2)
+    bundle = _bundle('syn1', 2, is_latest=True)
+    bundle['entity']['etag'] = 'abc'
+
+    assert memo.get('syn1') == (None, False)
+    memo.put('syn1', bundle)
+    cached, fresh = memo.get('syn1')
+    assert cached == bundle and fresh
+    # callers get their own copy
+    cached['entity']['name'] = 'changed'
+    assert memo.get('syn1')[0] == bundle
+
+    with patch('synapseclient.core.metadata_cache.time.monotonic', return_value=time.monotonic() + 61):
+        assert memo.get('syn1') == (bundle, False)
+        assert memo.revalidated('syn1', 'abc')
+        assert memo.get('syn1') == (bundle, True)
+        assert not memo.revalidated('syn1', 'def')
+    assert memo.get('syn1') == (None, False)
+
+    # the least recently used bundles are dropped
+    for entity_id in ['syn1', 'syn2', 'syn3']:
+        memo.put(entity_id, bundle)
+    assert memo.get('syn1') == (None, False)
+    memo.forget('syn2')
+    assert memo.get('syn2') == (None, False)
+    assert memo.get('syn3')[0] == bundle
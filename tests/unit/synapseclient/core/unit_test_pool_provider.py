@@ -1,15 +1,22 @@
 from concurrent.futures import ThreadPoolExecutor
+import threading
 from unittest.mock import call, MagicMock, patch, PropertyMock
 from multiprocessing.sharedctypes import Synchronized
 from multiprocessing.pool import ThreadPool
 
+import pytest
+
 import synapseclient
 from synapseclient.core.pool_provider import (
+    PRIORITY_METADATA,
+    PRIORITY_TRANSFER,
+    PrioritizedExecutor,
     SingleThreadExecutor,
     SingleThreadPool,
     SingleValue,
     get_executor,
     get_pool,
+    get_shared_executor,
     get_value,
 )
 
@@ -37,6 +44,12 @@ class TestSingleThreadExecutor:
             assert result.done
             assert i == result.result()
 
+    def test_shutdown(self):
+        executor = SingleThreadExecutor()
+        executor.shutdown(wait=False, cancel_futures=True)
+        with pytest.raises(RuntimeError):
+            executor.submit(lambda: None)
+
 
 def _patch_config(single_threaded: bool):
     return patch.object(
@@ -56,6 +69,86 @@ class TestExecutorProvider:
         with _patch_config(False):
             assert isinstance(get_executor(), ThreadPoolExecutor)
 
+    def test_get_executor_with_priority(self):
+        with _patch_config(True):
+            assert isinstance(get_executor(priority=PRIORITY_TRANSFER), SingleThreadExecutor)
+
+        with _patch_config(False):
+            executor = get_executor(2, priority=PRIORITY_TRANSFER)
+            assert executor.submit(lambda: 5).result() == 5
+            executor.shutdown()
+
+            # the lanes share the threads of a single pool
+            assert executor._pool is get_shared_executor()
+            with pytest.raises(RuntimeError):
+                executor.submit(lambda: 5)
+
+
+class TestPrioritizedExecutor:
+
+    def test_priorities(self):
+        pool = PrioritizedExecutor(max_workers=2, metadata_workers=1)
+        metadata = pool.lane(PRIORITY_METADATA)
+        transfer = pool.lane(PRIORITY_TRANSFER)
+
+        # occupy both threads so that the tasks below are queued
+        blocked = threading.Event()
+        blockers = [transfer.submit(blocked.wait, 10) for _ in range(2)]
+
+        order = []
+        futures = [transfer.submit(order.append, 'transfer') for _ in range(2)]
+        futures += [metadata.submit(order.append, 'metadata') for _ in range(2)]
+        blocked.set()
+        for future in blockers + futures:
+            future.result(10)
+
+        # a metadata task runs first but no more than one at a time, leaving the other thread to the transfers
+        assert 'metadata' in order[:2]
+        assert sorted(order) == ['metadata', 'metadata', 'transfer', 'transfer']
+
+    def test_metadata_waiting_on_transfers(self):
+        pool = PrioritizedExecutor(max_workers=2)
+        metadata = pool.lane(PRIORITY_METADATA)
+        transfer = pool.lane(PRIORITY_TRANSFER)
+
+        # more metadata tasks than threads, each waiting on a transfer, mustn't deadlock
+        futures = [metadata.submit(lambda i: transfer.submit(lambda: i).result(10), i) for i in range(4)]
+        assert [future.result(10) for future in futures] == list(range(4))
+
+    def test_lane_limit_and_shutdown(self):
+        pool = PrioritizedExecutor(max_workers=4)
+        lane = pool.lane(PRIORITY_TRANSFER, max_workers=1)
+        lock = threading.Lock()
+        running = []
+        concurrency = []
+
+        def task():
+            with lock:
+                running.append(1)
+                concurrency.append(len(running))
+            threading.Event().wait(0.01)
+            with lock:
+                running.pop()
+
+        futures = [lane.submit(task) for _ in range(5)]
+        lane.shutdown()
+        assert all(future.done() for future in futures)
+        assert max(concurrency) == 1
+
+        # other lanes of the pool keep running
+        assert pool.lane(PRIORITY_TRANSFER).submit(lambda: 1).result(10) == 1
+
+    def test_exception(self):
+        pool = PrioritizedExecutor(max_workers=2)
+        future = pool.lane(PRIORITY_METADATA).submit(lambda: 1 / 0)
+        with pytest.raises(ZeroDivisionError):
+            future.result(10)
+        assert pool.lane(PRIORITY_METADATA).submit(lambda: 1).result(10) == 1
+
+    def test_invalid_priority(self):
+        with pytest.raises(ValueError):
+            PrioritizedExecutor().lane(5)
+
 
 class TestPoolProvider:
 
@@ -0,0 +1,151 @@
+import asyncio
+import email.utils
+import socket
+import threading
+import time
+from unittest import mock
+
+from synapseclient.core import rate_limit
+from synapseclient.core.rate_limit import (
+    AdaptiveRateLimiter, HostRateLimiters, _parse_retry_after, limited_call, limited_call_async
+)
+
+# the socket class before the unit test fixtures block remote connections
+_socket = socket.socket
+
+
+def _response(status_code, retry_after=None):
+    return mock.Mock(status_code=status_code, headers={'Retry-After': retry_after} if retry_after else {})
+
+
+def _run(coroutine):
+    # the event loop wakes itself up through a local socket pair
+    with mock.patch('socket.socket', _socket):
+        loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def _respond(status_code, retry_after=None):
+    await asyncio.sleep(0)
+    return _response(status_code, retry_after)
+
+
+def test_parse_retry_after():
+    assert _parse_retry_after(None) is None
+    assert _parse_retry_after('3') == 3
+    assert _parse_retry_after('100000') == rate_limit.MAX_RETRY_AFTER
+    assert 8 < _parse_retry_after(email.utils.formatdate(time.time() + 10, usegmt=True)) <= 10
+    assert _parse_retry_after('soon') is None
+
+
+def test_adaptive_rate_limiter():
+    limiter = AdaptiveRateLimiter()
+
+    # not limited until throttled
+    for _ in range(20):
+        assert limiter.call(lambda: _response(200)).status_code == 200
+    assert limiter.rate is None and limiter.concurrency is None
+
+    # cut to half of the rate requests were sent at
+    limiter.call(lambda: _response(429))
+    assert limiter.rate == 21 / rate_limit.RATE_WINDOW * rate_limit.DECREASE_FACTOR
+    assert limiter.concurrency == 1
+
+    # further throttling answers to requests sent before the cut are ignored
+    limiter.throttled()
+    assert limiter.rate == 21 / rate_limit.RATE_WINDOW * rate_limit.DECREASE_FACTOR
+
+    rate = limiter.rate
+    limiter.succeeded()
+    assert limiter.rate == rate + rate_limit.RATE_INCREASE / rate
+
+
+def test_adaptive_rate_limiter__rate():
+    limiter = AdaptiveRateLimiter()
+    limiter.throttled()
+    assert limiter.rate == rate_limit.MIN_RATE
+    limiter._rate = 20
+
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.call(lambda: _response(204))
+    # no burst is allowed right after throttling
+    assert time.monotonic() - start >= 4 / 21
+
+
+def test_adaptive_rate_limiter__retry_after():
+    limiter = AdaptiveRateLimiter()
+    limiter.call(lambda: _response(503, retry_after='0.2'))
+    limiter._rate = limiter._tokens = 100
+
+    start = time.monotonic()
+    limiter.call(lambda: _response(200))
+    assert time.monotonic() - start >= 0.15
+
+
+def test_adaptive_rate_limiter__concurrency():
+    limiter = AdaptiveRateLimiter()
+    limiter._concurrency = 2
+    lock = threading.Lock()
+    in_flight = [0, 0]
+
+    def request():
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight[1], in_flight[0])
+        time.sleep(0.01)
+        with lock:
+            in_flight[0] -= 1
+        return _response(500)
+
+    threads = [threading.Thread(target=limiter.call, args=(request,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert in_flight[1] == 2
+
+
+def test_host_rate_limiters():
+    limiters = HostRateLimiters()
+    limiter = limiters.for_url('https://repo-prod.prod.sagebase.org/repo/v1/entity/syn123')
+    assert limiters.for_url('https://REPO-prod.prod.sagebase.org/repo/v1/version') is limiter
+    assert limiters.for_url('https://bucket.s3.amazonaws.com/key') is not limiter
+
+    syn = mock.Mock(_rate_limiters=limiters)
+    limited_call(syn, 'https://bucket.s3.amazonaws.com/key', lambda: _response(429))
+    assert limiters.for_url('https://bucket.s3.amazonaws.com/key').rate is not None
+    assert limiter.rate is None
+
+    # a client without limiters sends the request as it is
+    assert limited_call(mock.Mock(), 'https://bucket.s3.amazonaws.com/key', lambda: _response(200)).status_code == 200
+
+
+def test_adaptive_rate_limiter__async():
+    limiter = AdaptiveRateLimiter()
+    _run(limiter.call_async(lambda: _respond(503, retry_after='0.2')))
+    assert limiter.concurrency == 1
+    limiter._rate = limiter._tokens = 100
+
+    async def send_all():
+        return await asyncio.gather(*(limiter.call_async(lambda: _respond(200)) for _ in range(3)))
+
+    # waits for the Retry-After without blocking the event loop, one request in flight at a time
+    start = time.monotonic()
+    assert [response.status_code for response in _run(send_all())] == [200] * 3
+    assert time.monotonic() - start >= 0.15
+    assert limiter._in_flight == 0
+
+
+def test_limited_call_async():
+    limiters = HostRateLimiters()
+    syn = mock.Mock(_rate_limiters=limiters)
+    _run(limited_call_async(syn, 'https://repo-prod.prod.sagebase.org/repo/v1/entity', lambda: _respond(429)))
+    assert limiters.for_url('https://repo-prod.prod.sagebase.org/repo/v1/entity').rate is not None
+
+    # a client without limiters sends the request as it is
+    response = _run(limited_call_async(mock.Mock(), 'https://repo-prod.prod.sagebase.org', lambda: _respond(200)))
+    assert response.status_code == 200
@@ -64,6 +64,24 @@ def test_humanizeBytes__None():
         utils.humanizeBytes(None)
 
 
+@pytest.mark.parametrize("size,expected", [
+    (1024, 1024),
+    ('1024', 1024),
+    ('10kB', 10 * 2 ** 10),
+    ('500 MB', 500 * 2 ** 20),
+    ('1.5TB', int(1.5 * 2 ** 40)),
+    ('2GiB', 2 * 2 ** 30),
+    ('3g', 3 * 2 ** 30),
+])
+def test_parse_bytes(size, expected):
+    assert utils.parse_bytes(size) == expected
+
+
+def test_parse_bytes__invalid():
+    with pytest.raises(ValueError):
+        utils.parse_bytes('lots')
+
+
 def test_id_of():
     assert utils.id_of(1) == '1'
     assert utils.id_of('syn12345') == 'syn12345'
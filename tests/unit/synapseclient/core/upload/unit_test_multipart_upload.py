@@ -1,11 +1,11 @@
 from concurrent.futures import Future
 import hashlib
-import json
 import math
 
 import pytest
 from unittest import mock
 
+from synapseclient.core import json_codec
 from synapseclient.core.exceptions import (
     SynapseHTTPError,
     SynapseUploadAbortedException,
@@ -76,7 +76,7 @@ class TestUploadAttempt:
 
         upload._syn.restPOST.assert_called_once_with(
             expected_uri,
-            json.dumps(expected_upload_request),
+            json_codec.dumps(expected_upload_request),
             endpoint=upload._syn.fileHandleEndpoint,
         )
 
@@ -126,7 +126,7 @@ class TestUploadAttempt:
 
         upload._syn.restPOST.assert_called_once_with(
             expected_uri,
-            json.dumps(expected_body),
+            json_codec.dumps(expected_body),
             requests_session=session,
             endpoint=upload._syn.fileHandleEndpoint,
         )
@@ -572,17 +572,13 @@ class TestMultipartUpload:
         with mock.patch('os.path.exists') as os_path_exists,\
                 mock.patch('os.path.isdir') as os_path_is_dir,\
                 mock.patch('os.path.getsize') as os_path_getsize,\
-                mock.patch.object(
-                    synapseclient.core.upload.multipart_upload,
-                    'md5_for_file',
-                ) as md5_for_file,\
                 mock.patch.object(
                     synapseclient.core.upload.multipart_upload,
                     '_multipart_upload',
                 ) as mock_multipart_upload:
 
             os_path_getsize.return_value = file_size
-            md5_for_file.return_value.hexdigest.return_value = md5_hex
+            syn.cache.md5_for_file.return_value = md5_hex
 
             os_path_exists.return_value = False
 
@@ -600,6 +596,7 @@ class TestMultipartUpload:
 
             # call w/ defaults
             multipart_upload_file(syn, file_path)
+            syn.cache.md5_for_file.assert_called_once_with(file_path)
             mock_multipart_upload.assert_called_once_with(
                 syn,
                 mock.ANY,  # lambda chunk function
@@ -1,9 +1,8 @@
-import json
-
 import pytest
 
 from synapseclient import (Evaluation, Submission, SubmissionStatus,
                            Annotations, evaluation)
+from synapseclient.core import json_codec
 
 
 def test_Evaluation():
@@ -58,10 +57,9 @@ def test_SubmissionStatus_json():
             "id": "foo"
         }
     }
-    expected_str = json.dumps(expected_status, sort_keys=True, indent=2,
-                              ensure_ascii=True)
-
-    assert returned_json_str == expected_str
+    # encoded compactly, in no particular key order
+    assert ' ' not in returned_json_str
+    assert json_codec.loads(returned_json_str) == expected_status
 
 
 def test__convert_to_annotation_cls_dict():
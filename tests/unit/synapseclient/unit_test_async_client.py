@@ -0,0 +1,216 @@
+import asyncio
+import json
+import socket
+from unittest.mock import patch
+
+import pytest
+
+from synapseclient import AsyncSynapse, File, Folder
+from synapseclient.core import instrumentation
+from synapseclient.core.exceptions import SynapseHTTPError
+from synapseclient.core.rate_limit import HostRateLimiters
+
+# the socket class before the unit test fixtures block remote connections
+_socket = socket.socket
+
+
+@pytest.fixture
+def run():
+    # the event loop wakes itself up through a local socket pair
+    with patch('socket.socket', _socket):
+        loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture(autouse=True)
+def rate_limiters(syn):
+    # the shared client would otherwise carry what its limiters learned from one test to the next
+    with patch.object(syn, '_rate_limiters', HostRateLimiters()) as rate_limiters:
+        yield rate_limiters
+
+
+class FakeResponse:
+    def __init__(self, url, status, body):
+        self.url = url
+        self.status = status
+        self.reason = 'OK' if status < 400 else 'Error'
+        self.headers = {'content-type': 'application/json;charset=UTF-8'}
+        self._content = json.dumps(body).encode('utf-8')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def read(self):
+        await asyncio.sleep(0)
+        return self._content
+
+
+class FakeSession:
+    """Answers requests from a list of (method, uri suffix, status, body) in order"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def request(self, method, url, data=None, headers=None):
+        self.requests.append((method, url, data))
+        expected_method, suffix, status, body = self.responses.pop(0)
+        assert method == expected_method
+        assert url.endswith(suffix)
+        return self._respond(FakeResponse(url, status, body))
+
+    def _respond(self, response):
+        session = self
+
+        class Context:
+            async def __aenter__(self):
+                session.in_flight += 1
+                session.max_in_flight = max(session.max_in_flight, session.in_flight)
+                await asyncio.sleep(0)
+                return response
+
+            async def __aexit__(self, *args):
+                session.in_flight -= 1
+
+        return Context()
+
+
+def test_rest_calls(syn, run):
+    session = FakeSession([('GET', '/entity/syn1', 200, {'id': 'syn1'}),
+                           ('POST', '/entity/child', 404, {'reason': 'not found'})])
+    asyn = AsyncSynapse(syn, session=session)
+
+    assert run(asyn.restGET('/entity/syn1')) == {'id': 'syn1'}
+    assert session.requests[0][1] == syn.repoEndpoint + '/entity/syn1'
+    assert run(asyn.findEntityId('foo', 'syn2')) is None
+    assert json.loads(session.requests[1][2]) == {'parentId': 'syn2', 'entityName': 'foo'}
+
+
+def test_rest_call_retried(syn, run):
+    session = FakeSession([('GET', '/entity/syn1', 503, {'reason': 'unavailable'}),
+                           ('GET', '/entity/syn1', 200, {'id': 'syn1'}),
+                           ('GET', '/entity/syn2', 400, {'reason': 'bad request'})])
+    asyn = AsyncSynapse(syn, session=session)
+
+    with patch('synapseclient.core.retry.random.uniform', return_value=0):
+        assert run(asyn.restGET('/entity/syn1')) == {'id': 'syn1'}
+    with pytest.raises(SynapseHTTPError):
+        run(asyn.restGET('/entity/syn2'))
+    assert len(session.requests) == 3
+
+
+def test_get(syn, run):
+    bundle = {
+        'entity': {'id': 'syn1', 'name': 'foo.txt', 'parentId': 'syn2', 'etag': 'abc', 'dataFileHandleId': '42',
+                   'versionNumber': 1, 'concreteType': 'org.sagebionetworks.repo.model.FileEntity'},
+        'annotations': {'id': 'syn1', 'etag': 'abc', 'annotations': {'foo': {'type': 'STRING', 'value': ['bar']}}},
+        'fileHandles': [{'id': '42', 'contentMd5': '1234', 'contentSize': 3, 'fileName': 'foo.txt',
+                         'concreteType': 'org.sagebionetworks.repo.model.file.S3FileHandle'}],
+    }
+    session = FakeSession([('POST', '/entity/syn1/bundle2', 200, bundle)])
+    asyn = AsyncSynapse(syn, session=session)
+
+    entity = run(asyn.get('syn1'))
+    assert isinstance(entity, File)
+    assert entity.foo == ['bar']
+    assert entity['_file_handle']['contentMd5'] == '1234'
+    assert entity.path is None
+
+
+def test_store_does_not_upload(syn, run):
+    asyn = AsyncSynapse(syn, session=FakeSession([]))
+    with pytest.raises(ValueError):
+        run(asyn.store(File('/tmp/foo.txt', parent='syn2')))
+
+
+def test_store_folder(syn, run):
+    folder = {'id': 'syn3', 'name': 'foo', 'parentId': 'syn2', 'etag': 'abc',
+              'concreteType': 'org.sagebionetworks.repo.model.Folder'}
+    session = FakeSession([
+        ('POST', '/entity', 200, folder),
+        ('PUT', '/entity/syn3/annotations2', 200, {'id': 'syn3', 'etag': 'def',
+                                                   'annotations': {'foo': {'type': 'STRING', 'value': ['bar']}}}),
+        ('POST', '/entity/syn3/bundle2', 200, {'entity': {**folder, 'etag': 'def'},
+                                               'annotations': {'id': 'syn3', 'etag': 'def', 'annotations': {
+                                                   'foo': {'type': 'STRING', 'value': ['bar']}}},
+                                               'fileHandles': []}),
+    ])
+    asyn = AsyncSynapse(syn, session=session)
+
+    stored = run(asyn.store(Folder('foo', parent='syn2', foo='bar')))
+    assert stored.id == 'syn3'
+    assert stored.etag == 'def'
+    assert stored.foo == ['bar']
+    assert json.loads(session.requests[1][2])['etag'] == 'abc'
+
+
+def test_get_children(syn, run):
+    session = FakeSession([('POST', '/entity/children', 200, {'page': [{'id': 'syn3'}], 'nextPageToken': 'a'}),
+                           ('POST', '/entity/children', 200, {'page': [{'id': 'syn4'}]})])
+    asyn = AsyncSynapse(syn, session=session)
+
+    async def children():
+        return [child['id'] async for child in asyn.getChildren('syn2')]
+
+    assert run(children()) == ['syn3', 'syn4']
+    assert json.loads(session.requests[1][2])['nextPageToken'] == 'a'
+
+
+def test_max_concurrent_requests(syn, run):
+    session = FakeSession([('GET', '/entity/syn%d' % i, 200, {'id': 'syn%d' % i}) for i in range(20)])
+    asyn = AsyncSynapse(syn, max_concurrent_requests=3, session=session)
+
+    async def get_all():
+        return await asyncio.gather(*(asyn.restGET('/entity/syn%d' % i) for i in range(20)))
+
+    assert [entity['id'] for entity in run(get_all())] == ['syn%d' % i for i in range(20)]
+    assert session.max_in_flight == 3
+
+
+def test_requests_rate_limited(syn, run, rate_limiters):
+    session = FakeSession([('GET', '/entity/syn1', 429, {'reason': 'slow down'}),
+                           ('GET', '/entity/syn1', 200, {'id': 'syn1'})])
+    asyn = AsyncSynapse(syn, session=session)
+
+    with patch('synapseclient.core.retry.random.uniform', return_value=0):
+        assert run(asyn.restGET('/entity/syn1')) == {'id': 'syn1'}
+    # the throttling answer was learned by the limiter the blocking client shares
+    limiter = rate_limiters.for_url(session.requests[0][1])
+    assert limiter.rate is not None and limiter.concurrency is not None
+    assert limiter._in_flight == 0
+
+
+def test_requests_measured(syn, run):
+    session = FakeSession([('GET', '/entity/syn1', 503, {'reason': 'unavailable'}),
+                           ('GET', '/entity/syn1', 200, {'id': 'syn1'}),
+                           ('POST', '/table/query/async/start', 201, {'token': '7'}),
+                           ('GET', '/table/query/async/get/7', 200, {'jobState': 'COMPLETE'})])
+    asyn = AsyncSynapse(syn, session=session)
+    events = []
+    instrumentation.add_sink(events.append)
+    try:
+        with patch('synapseclient.core.retry.random.uniform', return_value=0):
+            run(asyn.restGET('/entity/syn1'))
+        run(asyn._waitForAsync('/entity/syn2/table/query/async', {'query': {}}))
+    finally:
+        instrumentation.remove_sink(events.append)
+
+    assert [(event.kind, event.method, event.endpoint, event.status, event.retries) for event in events] == [
+        (instrumentation.KIND_REST, 'GET', '/repo/v1/entity/{id}', 200, 1),
+        (instrumentation.KIND_REST, 'POST', '/repo/v1/entity/{id}/table/query/async/start', 201, 0),
+        (instrumentation.KIND_REST, 'GET', '/repo/v1/entity/{id}/table/query/async/get/{id}', 200, 0),
+        (instrumentation.KIND_ASYNC_JOB, 'POST', '/repo/v1/entity/{id}/table/query/async', 'COMPLETE', 0),
+    ]
+
+
+def test_close_leaves_given_session_open(syn, run):
+    session = FakeSession([])
+    asyn = AsyncSynapse(syn, session=session)
+    run(asyn.close())
+    assert asyn._session is session
@@ -5,6 +5,7 @@ import json
 import os
 import requests
 import tempfile
+import time
 import urllib.request as urllib_request
 import uuid
 
@@ -35,9 +36,11 @@ from synapseclient.core.exceptions import (
 from synapseclient.core.upload import upload_functions
 import synapseclient.core.utils as utils
 from synapseclient.client import DEFAULT_STORAGE_LOCATION_ID
+from synapseclient.core import json_codec
 from synapseclient.core.constants import concrete_types
 from synapseclient.core.credentials import UserLoginArgs
 from synapseclient.core.credentials.cred_data import SynapseCredentials
+from synapseclient.core.metadata_cache import EntityBundleMemo, MetadataCache
 from synapseclient.core.credentials.credential_provider import SynapseCredentialsProviderChain
 from synapseclient.core.models.dict_object import DictObject
 
@@ -303,6 +306,7 @@ class TestDownloadFileHandle:
 
         with patch.object(self.syn, '_getFileHandleDownload') as mock_get_file_handle_download,\
                 patch.object(self.syn, 'cache') as cache:
+            cache.download_once.side_effect = lambda file_handle_id, destination, download: download()
             mock_get_file_handle_download.return_value = {
                 'fileHandle': {
                     'id': file_handle_id,
@@ -329,7 +333,7 @@ class TestDownloadFileHandle:
                 self.syn.multi_threaded = multi_threaded
 
             mock_os.makedirs.assert_called_once_with(mock_os.path.dirname(destination), exist_ok=True)
-            cache.add.assert_called_once_with(file_handle_id, download_path)
+            cache.add.assert_called_once_with(file_handle_id, download_path, md5=None)
 
         assert expected_download_path == download_path
         mock_s3_client_wrapper.download_file.assert_called_once_with(
@@ -351,11 +355,12 @@ class TestDownloadFileHandle:
         expected_destination = os.path.abspath(destination)
 
         with patch.object(self.syn, '_getFileHandleDownload') as mock_get_file_handle_download,\
-                patch.object(self.syn, 'cache'),\
+                patch.object(self.syn, 'cache') as cache,\
                 patch.object(urllib_request, 'urlretrieve') as mock_url_retrieve,\
                 patch.object(utils, 'md5_for_file') as mock_md5_for_file,\
                 patch.object(os, 'makedirs'):
 
+            cache.download_once.side_effect = lambda file_handle_id, destination, download: download()
             mock_get_file_handle_download.return_value = {
                 'fileHandle': {
                     'id': file_handle_id,
@@ -418,12 +423,12 @@ class TestPrivateSubmit:
     def test_without_eligibility_hash(self):
         assert self.submission == self.syn._submit(self.submission, self.etag, None)
         uri = '/evaluation/submission?etag={0}'.format(self.etag)
-        self.mock_restPOST.assert_called_once_with(uri, json.dumps(self.submission))
+        self.mock_restPOST.assert_called_once_with(uri, json_codec.dumps(self.submission))
 
     def test_with_eligibitiy_hash(self):
         assert self.submission == self.syn._submit(self.submission, self.etag, self.eligibility_hash)
         uri = '/evaluation/submission?etag={0}&submissionEligibilityHash={1}'.format(self.etag, self.eligibility_hash)
-        self.mock_restPOST.assert_called_once_with(uri, json.dumps(self.submission))
+        self.mock_restPOST.assert_called_once_with(uri, json_codec.dumps(self.submission))
 
 
 class TestSubmit:
@@ -773,7 +778,7 @@ class TestPrivateUploadExternallyStoringProjects:
 def test_findEntityIdByNameAndParent__None_parent(syn):
     entity_name = "Kappa 123"
     expected_uri = "/entity/child"
-    expected_body = json.dumps({"parentId": None, "entityName": entity_name})
+    expected_body = json_codec.dumps({"parentId": None, "entityName": entity_name})
     expected_id = "syn1234"
     return_val = {'id': expected_id}
     with patch.object(syn, "restPOST", return_value=return_val) as mocked_POST:
@@ -787,7 +792,7 @@ def test_findEntityIdByNameAndParent__with_parent(syn):
     parentId = "syn42"
     parent_entity = Folder(name="wwwwwwwwwwwwwwwwwwwwww@@@@@@@@@@@@@@@@", id=parentId, parent="fakeParent")
     expected_uri = "/entity/child"
-    expected_body = json.dumps({"parentId": parentId, "entityName": entity_name})
+    expected_body = json_codec.dumps({"parentId": parentId, "entityName": entity_name})
     expected_id = "syn1234"
     return_val = {'id': expected_id}
     with patch.object(syn, "restPOST", return_value=return_val) as mocked_POST:
@@ -836,9 +841,9 @@ def test_getChildren__nextPageToken(syn):
         # check that the correct POST requests were sent
         # genrates JSOn for the expected request body
         def expected_request_JSON(token):
-            return json.dumps({'parentId': 'syn' + str(parent_project_id_int),
-                               'includeTypes': ["folder", "file", "table", "link", "entityview", "dockerrepo"],
-                               'sortBy': 'NAME', 'sortDirection': 'ASC', 'nextPageToken': token})
+            return json_codec.dumps({'parentId': 'syn' + str(parent_project_id_int),
+                                     'includeTypes': ["folder", "file", "table", "link", "entityview", "dockerrepo"],
+                                     'sortBy': 'NAME', 'sortDirection': 'ASC', 'nextPageToken': token})
         expected_POST_url = '/entity/children'
         mocked_POST.assert_has_calls([call(expected_POST_url, body=expected_request_JSON(None)),
                                       call(expected_POST_url, body=expected_request_JSON(nextPageToken))])
@@ -1026,6 +1031,110 @@ def test_get_unsaved_entity(syn):
     pytest.raises(ValueError, syn.get, Folder(name="folder", parent="syn456"))
 
 
+def test_get_many(syn):
+    ids = ['syn%d' % i for i in range(50)]
+
+    def get(entity, **kwargs):
+        # finish out of order
+        time.sleep(0.001 * (int(entity[3:]) % 3))
+        return Folder(id=entity, name=entity, parentId='syn1')
+
+    with patch.object(syn, 'get', side_effect=get) as mock_get:
+        assert [entity.id for entity in syn.get_many(ids)] == ids
+    mock_get.assert_any_call('syn7', downloadFile=False)
+
+    # an error is raised in its turn
+    with patch.object(syn, 'get', side_effect=[Folder(id='syn1', name='foo', parentId='syn2'), SynapseHTTPError()]):
+        entities = syn.get_many(['syn1', 'syn2'])
+        assert next(entities).id == 'syn1'
+        pytest.raises(SynapseHTTPError, next, entities)
+
+
+def test_get_many__headers_only(syn):
+    ids = ['syn%d' % i for i in range(150)]
+    responses = [{'results': [{'id': entity_id, 'name': entity_id} for entity_id in ids[:100] if entity_id != 'syn5']},
+                 {'results': [{'id': entity_id, 'name': entity_id} for entity_id in ids[100:]]}]
+
+    with patch.object(syn, 'restPOST', side_effect=responses) as mock_post:
+        headers = list(syn.get_many(ids, headersOnly=True))
+
+    assert headers[5] is None
+    assert [header['id'] for header in headers if header] == [entity_id for entity_id in ids if entity_id != 'syn5']
+    assert mock_post.call_count == 2
+    assert json.loads(mock_post.call_args_list[1][1]['body']) == {'references': [{'targetId': entity_id}
+                                                                                 for entity_id in ids[100:]]}
+
+
+def test_get_entity_bundle__metadata_cache():
+    syn = Synapse(debug=False, skip_checks=True)
+    syn.metadata_cache = MetadataCache(tempfile.mkdtemp(), max_size=utils.MB)
+    past_version = {'entity': {'id': 'syn1', 'versionNumber': 1, 'isLatestVersion': False},
+                    'restrictionInformation': {'hasUnmetAccessRequirement': False}}
+    latest_version = {'entity': {'id': 'syn1', 'versionNumber': 2, 'isLatestVersion': True},
+                      'restrictionInformation': {'hasUnmetAccessRequirement': False}}
+
+    with patch.object(syn, 'restPOST', side_effect=[past_version, latest_version, latest_version]) as mock_post:
+        # a past version is fetched once
+        assert syn._getEntityBundle('syn1', version=1) == past_version
+        assert syn._getEntityBundle('syn1', version=1) == past_version
+        # the latest version may still change
+        assert syn._getEntityBundle('syn1', version=2) == latest_version
+        assert syn._getEntityBundle('syn1', version=2) == latest_version
+    assert mock_post.call_count == 3
+
+    # bundles are kept per user
+    syn.credentials = Mock()
+    with patch.object(syn, 'restGET', return_value={'ownerId': '123'}) as mock_get, \
+            patch.object(syn, 'restPOST', return_value=past_version) as mock_post:
+        assert syn._getEntityBundle('syn1', version=1) == past_version
+        assert syn._getEntityBundle('syn1', version=1) == past_version
+    mock_post.assert_called_once()
+    # the ownerId is looked up once per login
+    mock_get.assert_called_once_with('/userProfile')
+    assert syn.metadata_cache.get('syn1', 1, '123') == past_version
+
+    with patch.object(syn, 'restDELETE'):
+        syn.delete('syn1', version=1)
+    assert syn.metadata_cache.get('syn1', 1, None) is None
+    assert syn.metadata_cache.get('syn1', 1, '123') is None
+
+
+def test_get_entity_bundle__bundle_memo():
+    syn = Synapse(debug=False, skip_checks=True)
+    syn._bundle_memo = EntityBundleMemo(ttl=60)
+    bundle = {'entity': {'id': 'syn1', 'etag': 'abc', 'versionNumber': 2, 'isLatestVersion': True},
+              'annotations': {'id': 'syn1', 'etag': 'abc',
+                              'annotations': {'foo': {'type': 'STRING', 'value': ['bar']}}},
+              'restrictionInformation': {'hasUnmetAccessRequirement': False}}
+
+    with patch.object(syn, 'restPOST', return_value=bundle) as mock_post, \
+            patch.object(syn, 'restGET', return_value={'id': 'syn1', 'etag': 'abc'}) as mock_get:
+        assert syn._getEntityBundle('syn1') == bundle
+        assert syn._getEntityBundle('syn1') == bundle
+        assert syn.get_annotations('syn1') == {'foo': ['bar']}
+        assert mock_post.call_count == 1
+        assert not mock_get.called
+
+        # once expired the etag is checked before the bundle is used again
+        with patch('synapseclient.core.metadata_cache.time.monotonic', return_value=time.monotonic() + 61):
+            assert syn._getEntityBundle('syn1') == bundle
+        mock_get.assert_called_once_with('/entity/syn1')
+        assert mock_post.call_count == 1
+
+        # changes made through the client are seen at once
+        with patch.object(syn, 'restPUT', return_value={'id': 'syn1', 'etag': 'def', 'annotations': {}}):
+            syn.set_annotations(Annotations('syn1', 'abc', {}))
+        assert syn._getEntityBundle('syn1') == bundle
+        assert mock_post.call_count == 2
+
+        # logging in as someone else, without logging out first, drops the bundles memoized for the last user
+        syn.credentials = Mock()
+        assert syn._getEntityBundle('syn1') == bundle
+        assert mock_post.call_count == 3
+        assert syn._getEntityBundle('syn1') == bundle
+        assert mock_post.call_count == 3
+
+
 def test_get_default_view_columns_nomask(syn):
     """Test no mask passed in"""
     with patch.object(syn, "restGET") as mock_restGET:
@@ -1067,7 +1176,7 @@ class TestCreateStorageLocationSetting:
             'concreteType': 'org.sagebionetworks.repo.model.project.ExternalObjectStorageLocationSetting',
             'uploadType': 'S3'
         }
-        self.mock_restPOST.assert_called_once_with('/storageLocation', body=json.dumps(expected))
+        self.mock_restPOST.assert_called_once_with('/storageLocation', body=json_codec.dumps(expected))
 
     def test_ProxyStorage(self):
         self.syn.createStorageLocationSetting("ProxyStorage")
@@ -1075,7 +1184,7 @@ class TestCreateStorageLocationSetting:
             'concreteType': 'org.sagebionetworks.repo.model.project.ProxyStorageLocationSettings',
             'uploadType': 'PROXYLOCAL'
         }
-        self.mock_restPOST.assert_called_once_with('/storageLocation', body=json.dumps(expected))
+        self.mock_restPOST.assert_called_once_with('/storageLocation', body=json_codec.dumps(expected))
 
     def test_ExternalS3Storage(self):
         self.syn.createStorageLocationSetting("ExternalS3Storage")
@@ -1083,7 +1192,7 @@ class TestCreateStorageLocationSetting:
             'concreteType': 'org.sagebionetworks.repo.model.project.ExternalS3StorageLocationSetting',
             'uploadType': 'S3'
         }
-        self.mock_restPOST.assert_called_once_with('/storageLocation', body=json.dumps(expected))
+        self.mock_restPOST.assert_called_once_with('/storageLocation', body=json_codec.dumps(expected))
 
     def test_ExternalStorage(self):
         self.syn.createStorageLocationSetting("ExternalStorage")
@@ -1091,7 +1200,7 @@ class TestCreateStorageLocationSetting:
             'concreteType': 'org.sagebionetworks.repo.model.project.ExternalStorageLocationSetting',
             'uploadType': 'SFTP'
         }
-        self.mock_restPOST.assert_called_once_with('/storageLocation', body=json.dumps(expected))
+        self.mock_restPOST.assert_called_once_with('/storageLocation', body=json_codec.dumps(expected))
 
 
 class TestSetStorageLocation:
@@ -1123,14 +1232,14 @@ class TestSetStorageLocation:
     def test_default(self):
         self.syn.setStorageLocation(self.entity, None)
         self.mock_getProjectSetting.assert_called_once_with(self.entity, 'upload')
-        self.mock_restPOST.assert_called_once_with('/projectSettings', body=json.dumps(self.expected_location))
+        self.mock_restPOST.assert_called_once_with('/projectSettings', body=json_codec.dumps(self.expected_location))
 
     def test_create(self):
         storage_location_id = 333
         self.expected_location['locations'] = [storage_location_id]
         self.syn.setStorageLocation(self.entity, storage_location_id)
         self.mock_getProjectSetting.assert_called_once_with(self.entity, 'upload')
-        self.mock_restPOST.assert_called_once_with('/projectSettings', body=json.dumps(self.expected_location))
+        self.mock_restPOST.assert_called_once_with('/projectSettings', body=json_codec.dumps(self.expected_location))
 
     def test_update(self):
         self.mock_getProjectSetting.return_value = self.expected_location
@@ -1140,7 +1249,7 @@ class TestSetStorageLocation:
         self.syn.setStorageLocation(self.entity, storage_location_id)
         self.mock_getProjectSetting.assert_called_with(self.entity, 'upload')
         assert 2 == self.mock_getProjectSetting.call_count
-        self.mock_restPUT.assert_called_once_with('/projectSettings', body=json.dumps(new_location))
+        self.mock_restPUT.assert_called_once_with('/projectSettings', body=json_codec.dumps(new_location))
         self.mock_restPOST.assert_not_called()
 
 
@@ -1381,7 +1490,7 @@ class TestMembershipInvitation:
                 message=self.message
             )
             patch_rest_post.assert_called_once_with("/membershipInvitation",
-                                                    body=json.dumps(invite_body))
+                                                    body=json_codec.dumps(invite_body))
 
     def test_invite_to_team__bothuseremail_specified(self):
         """Raise error when user and email is passed in"""
@@ -1572,7 +1681,8 @@ class TestRestCalls:
         syn_kwargs.update(kwargs)
 
         syn_method = getattr(self.syn, f"rest{method.upper()}")
-        with patch.object(self.syn, '_rest_call') as mock_rest_call:
+        with patch.object(self.syn, '_rest_call') as mock_rest_call, \
+                patch.object(self.syn, '_return_rest_body'):
             response = syn_method(*syn_args, **syn_kwargs)
             mock_rest_call.assert_called_once_with(
                 method, uri, body, endpoint, headers, retryPolicy, requests_session, **kwargs
@@ -1590,7 +1700,8 @@ class TestRestCalls:
             syn_args.append(None)
 
         syn_method = getattr(self.syn, f"rest{method.upper()}")
-        with patch.object(self.syn, '_rest_call') as mock_rest_call:
+        with patch.object(self.syn, '_rest_call') as mock_rest_call, \
+                patch.object(self.syn, '_return_rest_body'):
             response = syn_method(*syn_args)
             mock_rest_call.assert_called_once_with(method, uri, None, None, None, {}, None)
 
@@ -1669,10 +1780,10 @@ class TestSetAnnotations:
             # pass in non-annotation object
             self.syn.set_annotations(Annotations('syn123', '1d6c46e4-4d52-44e1-969f-e77b458d815a', {'foo': 'bar'}))
             mock_rest_put.assert_called_once_with('/entity/syn123/annotations2',
-                                                  body='{"id": "syn123",'
-                                                       ' "etag": "1d6c46e4-4d52-44e1-969f-e77b458d815a",'
-                                                       ' "annotations": {"foo": {"type": "STRING", '
-                                                       '"value": ["bar"]}}}')
+                                                  body='{"id":"syn123",'
+                                                       '"etag":"1d6c46e4-4d52-44e1-969f-e77b458d815a",'
+                                                       '"annotations":{"foo":{"type":"STRING",'
+                                                       '"value":["bar"]}}}')
 
 
 def test_get_unparseable_config():
@@ -1723,6 +1834,23 @@ def test_max_threads_bounded(syn):
     assert syn.max_threads == 1
 
 
+def test_connection_pool_sized_by_max_threads():
+    syn = Synapse(debug=False, skip_checks=True)
+    adapter = syn._requests_session.get_adapter(syn.repoEndpoint + '/entity/syn123')
+    assert adapter is syn._connection_pool
+    assert syn._requests_session.get_adapter(syn.fileHandleEndpoint + '/fileHandle') is adapter
+
+    syn.max_threads = 32
+    assert adapter._pool_maxsize == 33
+    assert syn.get_connection_pool_stats() == (0, 0, 0)
+
+    # a custom session is used as it is
+    requests_session = requests.Session()
+    syn = Synapse(debug=False, skip_checks=True, requests_session=requests_session)
+    assert type(requests_session.get_adapter(syn.repoEndpoint)) is requests.adapters.HTTPAdapter
+    assert syn.get_connection_pool_stats() is None
+
+
 @patch('synapseclient.Synapse._get_config_section_dict')
 def test_get_transfer_config(mock_config_dict):
     """Verify reading transfer.maxThreads from synapseConfig"""
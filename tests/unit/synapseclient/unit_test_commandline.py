@@ -161,3 +161,65 @@ def test_login_with_prompt__getpass(mock_authenticate_login, mock_input, mock_ge
     ]
 
     assert expected_authenticate_calls == mock_authenticate_login.call_args_list
+
+
+def test_command_cache_purge():
+    parser = cmdline.build_parser()
+    args = parser.parse_args(['cache', 'purge', '--older-than', '30', '--max-size', '1GB', '--orphans',
+                              '--max-threads', '4'])
+    syn = Mock()
+
+    with patch.object(cmdline.cache_maintenance, 'purge', return_value=['/cache/1/1']) as mock_purge, \
+            patch.object(cmdline.time, 'time', return_value=100 * 24 * 60 * 60):
+        cmdline.perform_main(args, syn)
+
+    mock_purge.assert_called_once_with(syn.cache, before_date=70 * 24 * 60 * 60, max_size=1024 ** 3, orphans=True,
+                                       dry_run=False, max_threads=4)
+
+    # there must be something to purge by
+    args = parser.parse_args(['cache', 'purge'])
+    with pytest.raises(ValueError):
+        cmdline.cache_purge(args, syn)
+
+
+def test_command_cache__no_command(capsys):
+    # a usage message rather than a missing func
+    with pytest.raises(SystemExit) as ex:
+        cmdline.build_parser().parse_args(['cache'])
+    assert ex.value.code == 2
+    assert 'cache: error: the following arguments are required: COMMAND' in capsys.readouterr().err
+
+
+@patch.object(cmdline, 'login_with_prompt')
+@patch.object(cmdline, 'perform_main')
+@patch.object(cmdline.synapseclient, 'Synapse')
+def test_cache_commands_do_not_login(mock_synapse, mock_perform_main, mock_login_with_prompt):
+    for command in (['cache', 'stats'], ['cache', 'verify'], ['cache', 'purge', '--orphans']):
+        with patch('sys.argv', ['synapse'] + command):
+            cmdline.main()
+    assert mock_perform_main.call_count == 3
+    mock_login_with_prompt.assert_not_called()
+
+    with patch('sys.argv', ['synapse', 'get', 'syn123']):
+        cmdline.main()
+    mock_login_with_prompt.assert_called_once()
+
+
+@patch('builtins.print')
+def test_command_cache_verify_checksums(mock_print):
+    parser = cmdline.build_parser()
+    args = parser.parse_args(['cache', 'verify', '--checksums', '--restart'])
+    syn = Mock()
+    checksums = cmdline.cache_maintenance.ChecksumReport(
+        files=2, size=2 * 1024 * 1024, elapsed=2.0, mismatches=[('/cache/1/1/a', 'abc', 'def', '/cache/.q/1/1/a')],
+        unverifiable=0, resumed_fanout_dirs=0,
+    )
+
+    with patch.object(cmdline.cache_maintenance, 'verify', return_value=[]), \
+            patch.object(cmdline.cache_maintenance, 'verify_checksums', return_value=checksums) as mock_verify:
+        cmdline.cache_verify(args, syn)
+
+    mock_verify.assert_called_once_with(syn.cache, max_threads=None, resume=False)
+    printed = [c[0][0] for c in mock_print.call_args_list]
+    assert 'corrupt\t/cache/1/1/a\texpected md5 abc but found def\t/cache/.q/1/1/a' in printed
+    assert 'at 1.0 MB/s' in printed[-1]
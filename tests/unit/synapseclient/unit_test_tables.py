@@ -564,15 +564,15 @@ def test_downloadTableColumns(syn, downloadLocation):
         '/tmp/foo/entry1',
         '/tmp/foo/entry2',
     ]
-    cached_paths = [
-        None,
-        '/tmp/foo',
-        None
-    ]
+    cached_paths = {
+        1: None,
+        2: '/tmp/foo',
+        3: None,
+    }
 
     expected_result = {
         1: zip_entry_file_paths[0],
-        2: cached_paths[1],
+        2: cached_paths[2],
         3: zip_entry_file_paths[1],
     }
 
@@ -583,7 +583,7 @@ def test_downloadTableColumns(syn, downloadLocation):
             patch.object(client, 'zipfile'), \
             patch.object(client, 'extract_zip_file_to_directory') as mock_extract_zip_file_to_directory:
 
-        mock_cache.get.side_effect = cached_paths
+        mock_cache.get_many.return_value = cached_paths
         mock_async.return_value = mock_async_response
         mock_ensure_dir.return_value = mock_cache.get_cache_dir.return_value = '/tmp/download'
         mock_download_file_handle.return_value = zip_file_path
@@ -591,6 +591,7 @@ def test_downloadTableColumns(syn, downloadLocation):
 
         result = syn.downloadTableColumns(table, ['id'], downloadLocation=downloadLocation)
 
+        mock_cache.get_many.assert_called_once_with([1, 2, 3], path=downloadLocation, max_threads=syn.max_threads)
         if downloadLocation:
             mock_ensure_dir.assert_called_once_with(downloadLocation)
         else:
@@ -2,12 +2,12 @@ import json
 import uuid
 
 import pytest
-from unittest.mock import patch, call
+from unittest.mock import MagicMock, patch, call
 
 import synapseclient
 import synapseutils
 from synapseutils.copy_functions import _copy_file_handles_batch, _create_batch_file_handle_copy_request, \
-    _batch_iterator_generator
+    _batch_iterator_generator, _copy_cached_file_handles
 
 
 def test_copyWiki_empty_Wiki(syn):
@@ -217,6 +217,22 @@ class TestProtectedCopyFileHandlesBatch:
                                                    endpoint=self.syn.fileHandleEndpoint)
 
 
+def test__copy_cached_file_handles():
+    cache = MagicMock()
+    cache.get_many.return_value = {"122": "/tmp/cached.txt", "124": None}
+    copy_results = [
+        {"newFileHandle": {"id": "123"}, "originalFileHandleId": "122"},
+        {"newFileHandle": {"id": "456"}, "originalFileHandleId": "124"},
+        {"failureCode": "NOT_FOUND", "originalFileHandleId": "125"},
+    ]
+
+    _copy_cached_file_handles(cache, copy_results)
+
+    # only successful copies are looked up, and only the cached ones are added
+    cache.get_many.assert_called_once_with(["122", "124"])
+    cache.add_many.assert_called_once_with([("123", "/tmp/cached.txt")])
+
+
 class TestProtectedCreateBatchFileHandleCopyRequest:
 
     def test__create_batch_file_handle_copy_request__no_optional_params(self):